@@ -0,0 +1,48 @@
+'use strict';
+
+// Embedding del volto calcolato al caricamento della foto (comando enroll di face_detection.py):
+// le analisi inviano questi pochi KB al posto della foto e saltano l'inferenza sulla galleria
+module.exports = {
+  up: async (queryInterface, Sequelize) => {
+    await queryInterface.addColumn('Users', 'face_embedding', {
+      type: Sequelize.BLOB,
+      allowNull: true,
+      comment: 'Embedding del volto in formato compatto (float16/float32 little-endian)'
+    });
+
+    await queryInterface.addColumn('Users', 'face_embedding_model', {
+      type: Sequelize.STRING(64),
+      allowNull: true,
+      comment: 'Modello che ha prodotto l\'embedding (es. Facenet512, Facenet512-onnx-int8)'
+    });
+
+    await queryInterface.addColumn('Users', 'face_embedding_dtype', {
+      type: Sequelize.STRING(10),
+      allowNull: true,
+      comment: 'Tipo dei valori in face_embedding'
+    });
+
+    await queryInterface.addColumn('Users', 'face_embedding_photo_hash', {
+      type: Sequelize.STRING(32),
+      allowNull: true,
+      comment: 'MD5 della foto da cui è stato calcolato l\'embedding'
+    });
+
+    await queryInterface.addColumn('Users', 'face_embedding_updated_at', {
+      type: Sequelize.DATE,
+      allowNull: true,
+      comment: 'Data calcolo embedding'
+    });
+
+    console.log('✅ Colonne face_embedding* aggiunte alla tabella Users');
+  },
+
+  down: async (queryInterface, Sequelize) => {
+    await queryInterface.removeColumn('Users', 'face_embedding');
+    await queryInterface.removeColumn('Users', 'face_embedding_model');
+    await queryInterface.removeColumn('Users', 'face_embedding_dtype');
+    await queryInterface.removeColumn('Users', 'face_embedding_photo_hash');
+    await queryInterface.removeColumn('Users', 'face_embedding_updated_at');
+    console.log('✅ Colonne face_embedding* rimosse dalla tabella Users');
+  }
+};
@@ -0,0 +1,155 @@
+'use strict';
+
+// Coda persistente delle analisi di riconoscimento (analysisQueueService): priorità
+// (lezione in corso > rianalisi del docente > backfill), accorpamento dei duplicati in coda
+// tramite coalesce_key e tentativi con backoff; i worker prelevano con FOR UPDATE SKIP LOCKED
+module.exports = {
+  up: async (queryInterface, Sequelize) => {
+    console.log('🧾 Creazione tabella AnalysisJobs...');
+
+    await queryInterface.createTable('AnalysisJobs', {
+      id: {
+        type: Sequelize.INTEGER,
+        primaryKey: true,
+        autoIncrement: true,
+        allowNull: false
+      },
+      type: {
+        type: Sequelize.ENUM('image', 'lesson'),
+        allowNull: false,
+        comment: 'image = una LessonImage, lesson = tutte le immagini della lezione'
+      },
+      lesson_id: {
+        type: Sequelize.INTEGER,
+        allowNull: false,
+        references: {
+          model: 'Lessons',
+          key: 'id'
+        },
+        onUpdate: 'CASCADE',
+        onDelete: 'CASCADE'
+      },
+      image_id: {
+        type: Sequelize.INTEGER,
+        allowNull: true,
+        references: {
+          model: 'LessonImages',
+          key: 'id'
+        },
+        onUpdate: 'CASCADE',
+        onDelete: 'CASCADE'
+      },
+      priority: {
+        type: Sequelize.INTEGER,
+        allowNull: false,
+        defaultValue: 10,
+        comment: '0 lezione in corso, 10 rianalisi docente, 20 backfill (più basso = prima)'
+      },
+      status: {
+        type: Sequelize.ENUM('queued', 'running', 'completed', 'failed', 'cancelled'),
+        allowNull: false,
+        defaultValue: 'queued'
+      },
+      coalesce_key: {
+        type: Sequelize.STRING(64),
+        allowNull: false,
+        comment: 'Richieste con la stessa chiave ancora in coda vengono accorpate'
+      },
+      coalesced: {
+        type: Sequelize.INTEGER,
+        allowNull: false,
+        defaultValue: 0,
+        comment: 'Richieste duplicate accorpate in questo job'
+      },
+      payload: {
+        type: Sequelize.JSONB,
+        allowNull: true
+      },
+      result: {
+        type: Sequelize.JSONB,
+        allowNull: true,
+        comment: 'Riepilogo del risultato (senza immagini)'
+      },
+      error: {
+        type: Sequelize.TEXT,
+        allowNull: true
+      },
+      attempts: {
+        type: Sequelize.INTEGER,
+        allowNull: false,
+        defaultValue: 0
+      },
+      max_attempts: {
+        type: Sequelize.INTEGER,
+        allowNull: false,
+        defaultValue: 3
+      },
+      run_at: {
+        type: Sequelize.DATE,
+        allowNull: false,
+        defaultValue: Sequelize.NOW,
+        comment: 'Prima esecuzione possibile (backoff dopo un errore)'
+      },
+      locked_by: {
+        type: Sequelize.STRING(128),
+        allowNull: true,
+        comment: 'Processo che sta eseguendo il job (host:pid)'
+      },
+      locked_at: {
+        type: Sequelize.DATE,
+        allowNull: true
+      },
+      started_at: {
+        type: Sequelize.DATE,
+        allowNull: true
+      },
+      finished_at: {
+        type: Sequelize.DATE,
+        allowNull: true
+      },
+      requested_by: {
+        type: Sequelize.INTEGER,
+        allowNull: true,
+        references: {
+          model: 'Users',
+          key: 'id'
+        },
+        onUpdate: 'CASCADE',
+        onDelete: 'SET NULL'
+      },
+      created_at: {
+        type: Sequelize.DATE,
+        allowNull: false,
+        defaultValue: Sequelize.NOW
+      },
+      updated_at: {
+        type: Sequelize.DATE,
+        allowNull: false,
+        defaultValue: Sequelize.NOW
+      }
+    });
+
+    // Prelievo: job in coda per priorità e scadenza
+    await queryInterface.addIndex('AnalysisJobs', ['status', 'priority', 'run_at'], {
+      name: 'analysis_jobs_claim_idx'
+    });
+    // Un solo job in coda per chiave: i duplicati diventano ON CONFLICT DO UPDATE
+    await queryInterface.addIndex('AnalysisJobs', ['coalesce_key'], {
+      name: 'analysis_jobs_queued_key_idx',
+      unique: true,
+      where: { status: 'queued' }
+    });
+    await queryInterface.addIndex('AnalysisJobs', ['lesson_id', 'created_at'], {
+      name: 'analysis_jobs_lesson_idx'
+    });
+
+    console.log('✅ Tabella AnalysisJobs creata');
+  },
+
+  down: async (queryInterface, Sequelize) => {
+    await queryInterface.dropTable('AnalysisJobs');
+    await queryInterface.sequelize.query('DROP TYPE IF EXISTS "enum_AnalysisJobs_type";');
+    await queryInterface.sequelize.query('DROP TYPE IF EXISTS "enum_AnalysisJobs_status";');
+    console.log('✅ Tabella AnalysisJobs eliminata');
+  }
+};
@@ -0,0 +1,576 @@
+"""
+Indice ANN sugli embeddings di tutti gli studenti (identificazione oltre il corso della lezione)
+I volti non riconosciuti nella galleria del corso vengono cercati nell'indice dell'istituto:
+HNSW di hnswlib o di faiss se installati, altrimenti ricerca esatta vettoriale (stessa API).
+L'indice parte dalla galleria compatta (gallery.path) e si aggiorna in modo incrementale con un
+journal JSONL condiviso tra i worker: iscrizioni, foto cambiate e rimozioni scritte da un
+processo vengono applicate dagli altri alla ricerca successiva. L'indice costruito sulla
+galleria viene salvato accanto al file (<galleria>.ann, senza galleria <journal>.ann): il primo
+worker lo costruisce, gli altri lo caricano.
+Lo snapshot registra l'offset del journal fino a cui è aggiornato; dopo ogni salvataggio il
+journal viene compattato a quell'offset (le voci più recenti della retention restano, per una
+galleria compatta in costruzione), così avvio e disco non crescono con la storia delle iscrizioni.
+"""
+
+import os
+import json
+import time
+import base64
+import logging
+from contextlib import contextmanager
+from typing import List, Dict, Any, Optional, Tuple, Iterable
+
+import numpy as np
+
+try:
+    import fcntl
+except ImportError:  # Windows: nessun lock inter-processo
+    fcntl = None
+
+logger = logging.getLogger('FaceDetectionV4')
+
+# Ordine di preferenza con backend "auto"
+ANN_BACKENDS = ("hnswlib", "faiss", "exact")
+ANN_CACHE_VERSION = 2
+
+class JournalTruncated(Exception):
+    """Il journal è stato compattato oltre l'offset del lettore: va ricaricato lo snapshot"""
+
+def _normalize(vectors: np.ndarray) -> np.ndarray:
+    vectors = np.atleast_2d(np.asarray(vectors, dtype=np.float32))
+    norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+    return np.ascontiguousarray(vectors / np.maximum(norms, 1e-12), dtype=np.float32)
+
+class ExactBackend:
+    """Prodotto scalare con tutte le righe: lineare, ma senza dipendenze e senza errori di recall"""
+
+    name = "exact"
+
+    def __init__(self, dim: int, params: Dict[str, Any]):
+        self.dim = dim
+        self.matrix = np.empty((max(16, int(params.get("initial_capacity", 1024))), dim), dtype=np.float32)
+        self.labels = np.empty(self.matrix.shape[0], dtype=np.int64)
+        self.count = 0
+        self._rows: Dict[int, int] = {}
+
+    def __len__(self) -> int:
+        return self.count
+
+    def add(self, labels: np.ndarray, vectors: np.ndarray):
+        for label, vector in zip(labels.tolist(), vectors):
+            row = self._rows.get(label)
+            if row is None:
+                if self.count == self.matrix.shape[0]:
+                    self.matrix = np.concatenate([self.matrix, np.empty_like(self.matrix)])
+                    self.labels = np.concatenate([self.labels, np.empty_like(self.labels)])
+                row = self.count
+                self.count += 1
+                self._rows[label] = row
+                self.labels[row] = label
+            self.matrix[row] = vector
+
+    def remove(self, labels: Iterable[int]):
+        # L'ultima riga prende il posto di quella rimossa: matrice sempre compatta
+        for label in labels:
+            row = self._rows.pop(label, None)
+            if row is None:
+                continue
+            last = self.count - 1
+            if row != last:
+                self.matrix[row] = self.matrix[last]
+                self.labels[row] = self.labels[last]
+                self._rows[int(self.labels[row])] = row
+            self.count = last
+
+    def save(self, path: str) -> Dict[str, Any]:
+        with open(path, 'wb') as f:
+            np.save(f, self.matrix[:self.count])
+            np.save(f, self.labels[:self.count])
+        return {}
+
+    @classmethod
+    def load(cls, path: str, dim: int, params: Dict[str, Any], state: Dict[str, Any]) -> 'ExactBackend':
+        backend = cls(dim, params)
+        with open(path, 'rb') as f:
+            matrix, labels = np.load(f), np.load(f)
+        backend.add(labels.astype(np.int64), matrix)
+        return backend
+
+    def search(self, queries: np.ndarray, k: int) -> Tuple[np.ndarray, np.ndarray]:
+        k = min(k, self.count)
+        similarity = queries @ self.matrix[:self.count].T
+        top = np.argpartition(-similarity, k - 1, axis=1)[:, :k]
+        top_sims = np.take_along_axis(similarity, top, axis=1)
+        order = np.argsort(-top_sims, axis=1, kind='stable')
+        top = np.take_along_axis(top, order, axis=1)
+        return self.labels[:self.count][top], np.take_along_axis(top_sims, order, axis=1)
+
+class HnswlibBackend:
+    """HNSW di hnswlib su prodotto scalare; le rimozioni marcano il nodo, i nuovi inserimenti
+    ne riusano lo slot"""
+
+    name = "hnswlib"
+
+    def __init__(self, dim: int, params: Dict[str, Any], create: bool = True):
+        import hnswlib
+        self.ef_search = int(params.get("ef_search", 64))
+        self.index = hnswlib.Index(space='ip', dim=dim)
+        self.live: set = set()
+        if not create:
+            return
+        self.index.init_index(
+            max_elements=max(16, int(params.get("initial_capacity", 1024))),
+            ef_construction=int(params.get("ef_construction", 200)),
+            M=int(params.get("M", 32)),
+            allow_replace_deleted=True
+        )
+        self.index.set_ef(self.ef_search)
+
+    def save(self, path: str) -> Dict[str, Any]:
+        self.index.save_index(path)
+        return {"live": sorted(self.live)}
+
+    @classmethod
+    def load(cls, path: str, dim: int, params: Dict[str, Any], state: Dict[str, Any]) -> 'HnswlibBackend':
+        backend = cls(dim, params, create=False)
+        backend.index.load_index(path, allow_replace_deleted=True)
+        backend.index.set_ef(backend.ef_search)
+        backend.live = set(state["live"])
+        return backend
+
+    def __len__(self) -> int:
+        return len(self.live)
+
+    def add(self, labels: np.ndarray, vectors: np.ndarray):
+        needed = len(self.live) + len(labels)
+        if needed > self.index.get_max_elements():
+            self.index.resize_index(max(needed, self.index.get_max_elements() * 2))
+        self.index.add_items(vectors, labels, replace_deleted=True)
+        self.live.update(labels.tolist())
+
+    def remove(self, labels: Iterable[int]):
+        for label in labels:
+            if label in self.live:
+                self.index.mark_deleted(label)
+                self.live.discard(label)
+
+    def search(self, queries: np.ndarray, k: int) -> Tuple[np.ndarray, np.ndarray]:
+        k = min(k, len(self.live))
+        self.index.set_ef(max(self.ef_search, k))
+        labels, distances = self.index.knn_query(queries, k=k)
+        # Spazio 'ip': distanza = 1 - prodotto scalare
+        return labels.astype(np.int64), 1 - distances
+
+class FaissBackend:
+    """IndexHNSWFlat di faiss (prodotto scalare). HNSW non supporta la rimozione: ogni vettore
+    ha un id interno, quelli sostituiti o rimossi vengono filtrati alla ricerca e l'indice è
+    ricostruito quando superano un quarto dei vivi"""
+
+    name = "faiss"
+
+    def __init__(self, dim: int, params: Dict[str, Any], create: bool = True):
+        import faiss
+        self.faiss = faiss
+        self.dim = dim
+        self.M = int(params.get("M", 32))
+        self.ef_construction = int(params.get("ef_construction", 200))
+        self.ef_search = int(params.get("ef_search", 64))
+        if create:
+            self._reset()
+
+    def _reset(self):
+        hnsw = self.faiss.IndexHNSWFlat(self.dim, self.M, self.faiss.METRIC_INNER_PRODUCT)
+        hnsw.hnsw.efConstruction = self.ef_construction
+        hnsw.hnsw.efSearch = self.ef_search
+        self.hnsw = hnsw
+        self.index = self.faiss.IndexIDMap2(hnsw)
+        self.next_id = 0
+        self.current: Dict[int, int] = {}    # label -> id interno attivo
+        self.owner: Dict[int, int] = {}      # id interno attivo -> label
+        self.stale = 0
+
+    def __len__(self) -> int:
+        return len(self.current)
+
+    def save(self, path: str) -> Dict[str, Any]:
+        self.faiss.write_index(self.index, path)
+        return {"current": [[label, internal_id] for label, internal_id in self.current.items()],
+                "next_id": self.next_id, "stale": self.stale}
+
+    @classmethod
+    def load(cls, path: str, dim: int, params: Dict[str, Any], state: Dict[str, Any]) -> 'FaissBackend':
+        backend = cls(dim, params, create=False)
+        backend.index = backend.faiss.read_index(path)
+        backend.hnsw = backend.faiss.downcast_index(backend.index.index)
+        backend.hnsw.hnsw.efSearch = backend.ef_search
+        backend.current = {label: internal_id for label, internal_id in state["current"]}
+        backend.owner = {internal_id: label for label, internal_id in state["current"]}
+        backend.next_id = state["next_id"]
+        backend.stale = state["stale"]
+        return backend
+
+    def add(self, labels: np.ndarray, vectors: np.ndarray):
+        internal = np.arange(self.next_id, self.next_id + len(labels), dtype=np.int64)
+        self.next_id += len(labels)
+        for label, internal_id in zip(labels.tolist(), internal.tolist()):
+            previous = self.current.get(label)
+            if previous is not None:
+                self.owner.pop(previous, None)
+                self.stale += 1
+            self.current[label] = internal_id
+            self.owner[internal_id] = label
+        self.index.add_with_ids(vectors, internal)
+        self._maybe_rebuild()
+
+    def remove(self, labels: Iterable[int]):
+        for label in labels:
+            internal_id = self.current.pop(label, None)
+            if internal_id is not None:
+                self.owner.pop(internal_id, None)
+                self.stale += 1
+        self._maybe_rebuild()
+
+    def _maybe_rebuild(self):
+        if self.stale <= max(64, len(self.current) // 4):
+            return
+        live = [(label, internal_id) for label, internal_id in self.current.items()]
+        vectors = np.stack([self.index.reconstruct(internal_id) for _, internal_id in live]) if live else None
+        self._reset()
+        if live:
+            self.add(np.array([label for label, _ in live], dtype=np.int64), vectors)
+
+    def search(self, queries: np.ndarray, k: int) -> Tuple[np.ndarray, np.ndarray]:
+        k = min(k, len(self.current))
+        # Risultati in più per compensare i vettori sostituiti/rimossi ancora nel grafo
+        fetch = min(self.index.ntotal, k + min(self.stale, 4 * k + 16))
+        self.hnsw.hnsw.efSearch = max(self.ef_search, fetch)
+        sims, internal = self.index.search(queries, fetch)
+
+        labels = np.full((len(queries), k), -1, dtype=np.int64)
+        out_sims = np.full((len(queries), k), -np.inf, dtype=np.float32)
+        for q in range(len(queries)):
+            col = 0
+            for internal_id, sim in zip(internal[q].tolist(), sims[q].tolist()):
+                label = self.owner.get(internal_id)
+                if label is None:
+                    continue
+                labels[q, col], out_sims[q, col] = label, sim
+                col += 1
+                if col == k:
+                    break
+        return labels, out_sims
+
+BACKEND_CLASSES = {"hnswlib": HnswlibBackend, "faiss": FaissBackend, "exact": ExactBackend}
+
+def create_backend(name: str, dim: int, params: Dict[str, Any]):
+    """Backend richiesto, oppure il primo disponibile in ANN_BACKENDS con "auto" """
+    candidates = ANN_BACKENDS if name == "auto" else (name, "exact")
+    for candidate in candidates:
+        try:
+            return BACKEND_CLASSES[candidate](dim, params)
+        except ImportError:
+            logger.debug("Backend ANN %s non installato", candidate)
+        except KeyError:
+            raise ValueError(f"Backend ANN sconosciuto: {candidate}")
+    return ExactBackend(dim, params)
+
+class StudentAnnIndex:
+    """Indice user_id → embedding normalizzato con inserimento, sostituzione e rimozione"""
+
+    def __init__(self, model: str, params: Dict[str, Any]):
+        self.model = model
+        self.params = params
+        self.backend_name = params.get("backend", "auto")
+        self.dim: Optional[int] = None
+        self.backend = None
+        self._labels: Dict[Any, int] = {}
+        self._user_ids: Dict[int, Any] = {}
+        self.photo_hashes: Dict[Any, Optional[str]] = {}
+        # Offset logico del journal incluso nello snapshot da cui è stato caricato
+        self.journal_offset = 0
+
+    def __len__(self) -> int:
+        return len(self.backend) if self.backend is not None else 0
+
+    @property
+    def backend_in_use(self) -> str:
+        return self.backend.name if self.backend is not None else "none"
+
+    def _label(self, user_id: Any) -> int:
+        label = self._labels.get(user_id)
+        if label is None:
+            label = len(self._labels)
+            self._labels[user_id] = label
+            self._user_ids[label] = user_id
+        return label
+
+    def upsert(self, user_ids: List[Any], embeddings: np.ndarray,
+               photo_hashes: Optional[List[Optional[str]]] = None):
+        """Aggiunge o sostituisce gli embeddings degli studenti indicati"""
+        if len(user_ids) == 0:
+            return
+        vectors = _normalize(embeddings)
+        if self.backend is None:
+            self.dim = vectors.shape[1]
+            self.backend = create_backend(self.backend_name, self.dim, self.params)
+        elif vectors.shape[1] != self.dim:
+            raise ValueError(f"Dimensione embedding {vectors.shape[1]} != indice {self.dim}")
+
+        labels = np.array([self._label(user_id) for user_id in user_ids], dtype=np.int64)
+        self.backend.add(labels, vectors)
+        for i, user_id in enumerate(user_ids):
+            self.photo_hashes[user_id] = photo_hashes[i] if photo_hashes is not None else None
+
+    def remove(self, user_ids: Iterable[Any]):
+        labels = [self._labels[user_id] for user_id in user_ids if user_id in self._labels]
+        if self.backend is not None and labels:
+            self.backend.remove(labels)
+        for user_id in user_ids:
+            self.photo_hashes.pop(user_id, None)
+
+    def __contains__(self, user_id: Any) -> bool:
+        return user_id in self.photo_hashes
+
+    def save(self, path: str, source: Any, journal_offset: int = 0) -> bool:
+        """Salva indice e mapping id; source identifica la galleria da cui è stato costruito,
+        journal_offset le voci del journal già applicate (False per un indice ancora vuoto)"""
+        if self.backend is None:
+            return False
+        tmp_path = f"{path}.tmp.{os.getpid()}"
+        state = self.backend.save(tmp_path)
+        meta = {
+            "version": ANN_CACHE_VERSION,
+            "source": source,
+            "model": self.model,
+            "backend": self.backend.name,
+            "dim": self.dim,
+            "user_ids": [self._user_ids[label] for label in range(len(self._user_ids))],
+            "photo_hashes": [[user_id, photo_hash] for user_id, photo_hash in self.photo_hashes.items()],
+            "journal_offset": int(journal_offset),
+            "state": state
+        }
+        with open(f"{tmp_path}.json", 'w') as f:
+            json.dump(meta, f)
+        # Prima i dati, poi i metadati: metadati nuovi implicano dati nuovi
+        os.replace(tmp_path, path)
+        os.replace(f"{tmp_path}.json", f"{path}.json")
+        self.journal_offset = int(journal_offset)
+        return True
+
+    @staticmethod
+    def saved_offset(path: str, source: Any) -> Optional[int]:
+        """Offset del journal dello snapshot salvato per la stessa galleria, None se assente"""
+        try:
+            with open(f"{path}.json", 'r') as f:
+                meta = json.load(f)
+        except (OSError, ValueError):
+            return None
+        if meta.get("version") != ANN_CACHE_VERSION or meta.get("source") != source:
+            return None
+        return int(meta.get("journal_offset", 0))
+
+    @classmethod
+    def load(cls, path: str, model: str, params: Dict[str, Any], source: Any) -> Optional['StudentAnnIndex']:
+        """Indice salvato da save() per la stessa galleria e modello; None se assente o diverso"""
+        try:
+            with open(f"{path}.json", 'r') as f:
+                meta = json.load(f)
+        except (OSError, ValueError):
+            return None
+        wanted = params.get("backend", "auto")
+        if (meta.get("version") != ANN_CACHE_VERSION or meta.get("source") != source
+                or meta.get("model") != model or wanted not in ("auto", meta.get("backend"))):
+            return None
+
+        index = cls(model, params)
+        try:
+            index.backend = BACKEND_CLASSES[meta["backend"]].load(path, meta["dim"], params, meta["state"])
+        except ImportError:
+            return None
+        except Exception as e:
+            logger.warning(f"⚠️ Indice ANN salvato non leggibile ({e}), ricostruzione")
+            return None
+        index.dim = meta["dim"]
+        for label, user_id in enumerate(meta["user_ids"]):
+            index._labels[user_id] = label
+            index._user_ids[label] = user_id
+        index.photo_hashes = {user_id: photo_hash for user_id, photo_hash in meta["photo_hashes"]}
+        index.journal_offset = int(meta.get("journal_offset", 0))
+        return index
+
+    def search(self, embeddings: np.ndarray, k: int = 2) -> List[List[Tuple[Any, float]]]:
+        """Per ogni embedding i k studenti più simili (user_id, similarità coseno), dal migliore"""
+        if self.backend is None or len(self.backend) == 0:
+            return [[] for _ in range(len(embeddings))]
+        queries = _normalize(embeddings)
+        labels, sims = self.backend.search(queries, k)
+        return [
+            [(self._user_ids[int(label)], float(sim)) for label, sim in zip(row_labels, row_sims) if label >= 0]
+            for row_labels, row_sims in zip(labels, sims)
+        ]
+
+class GalleryJournal:
+    """Journal JSONL degli aggiornamenti dell'indice, condiviso tra processi
+
+    Ogni riga: {ts, op ("upsert"/"remove"), id, model, photo_hash, embedding float32 base64}.
+    Ogni lettore tiene il proprio offset logico e legge solo le righe complete aggiunte nel
+    frattempo. Dopo una compattazione il file inizia con {op: "base", offset}: l'offset logico
+    della prima voce rimasta (le voci precedenti sono nello snapshot dell'indice).
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self.offset = 0
+        self.base = 0
+        self._header_len = 0
+        self._inode = None
+        os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+
+    @contextmanager
+    def locked(self):
+        """Lock esclusivo tra processi su append e compattazione (file .lock a parte: la
+        compattazione sostituisce il journal e un lock sul vecchio file non escluderebbe nulla)"""
+        with open(f"{self.path}.lock", 'a') as lock:
+            if fcntl is not None:
+                fcntl.flock(lock.fileno(), fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                if fcntl is not None:
+                    fcntl.flock(lock.fileno(), fcntl.LOCK_UN)
+
+    def append(self, entries: List[Dict[str, Any]]):
+        data = "".join(json.dumps(entry) + "\n" for entry in entries).encode('utf-8')
+        with self.locked():
+            with open(self.path, 'ab') as f:
+                f.write(data)
+                f.flush()
+
+    @staticmethod
+    def _read_header(f) -> Tuple[int, int]:
+        """(offset logico della prima voce, lunghezza dell'intestazione in byte)"""
+        f.seek(0)
+        line = f.readline()
+        try:
+            header = json.loads(line)
+        except ValueError:
+            return 0, 0
+        if isinstance(header, dict) and header.get("op") == "base":
+            return int(header["offset"]), len(line)
+        return 0, 0
+
+    def _refresh(self, f):
+        stat = os.fstat(f.fileno())
+        if stat.st_ino != self._inode:
+            self._inode = stat.st_ino
+            self.base, self._header_len = self._read_header(f)
+        return stat.st_size
+
+    def rewind(self):
+        """Offset alla prima voce ancora presente (indice ricostruito senza snapshot)"""
+        try:
+            with open(self.path, 'rb') as f:
+                self._refresh(f)
+        except FileNotFoundError:
+            self.base, self._header_len, self._inode = 0, 0, None
+        self.offset = self.base
+
+    def read_new(self) -> List[Dict[str, Any]]:
+        try:
+            stat = os.stat(self.path)
+        except OSError:
+            return []
+        if stat.st_ino == self._inode and stat.st_size == self._header_len + self.offset - self.base:
+            return []
+
+        with open(self.path, 'rb') as f:
+            size = self._refresh(f)
+            start = self._header_len + self.offset - self.base
+            if self.offset < self.base or start > size:
+                # Voci non ancora lette rimosse dalla compattazione (o journal troncato a mano)
+                raise JournalTruncated(f"offset {self.offset}, journal da {self.base}")
+            if size == start:
+                return []
+            f.seek(start)
+            data = f.read(size - start)
+        end = data.rfind(b'\n') + 1
+        self.offset += end
+
+        entries = []
+        for line in data[:end].splitlines():
+            try:
+                entries.append(json.loads(line))
+            except ValueError:
+                continue
+        return entries
+
+    def compact(self, upto: int, cutoff_ts: float) -> int:
+        """Riscrive il journal senza le voci prima dell'offset logico upto (già nello snapshot)
+        e più vecchie di cutoff_ts; da chiamare con locked(). Byte rimossi"""
+        try:
+            with open(self.path, 'rb') as f:
+                base, header_len = self._read_header(f)
+                f.seek(header_len)
+                data = f.read()
+        except FileNotFoundError:
+            return 0
+
+        # Il journal è in ordine di scrittura: si rimuove il prefisso più lungo ammesso
+        limit = min(len(data), upto - base)
+        pos = 0
+        while pos < limit:
+            newline = data.find(b'\n', pos)
+            if newline < 0 or newline + 1 > limit:
+                break
+            try:
+                ts = json.loads(data[pos:newline]).get("ts", 0)
+            except (ValueError, AttributeError):
+                ts = 0
+            if ts >= cutoff_ts:
+                break
+            pos = newline + 1
+        if pos == 0:
+            return 0
+
+        header = json.dumps({"op": "base", "offset": base + pos, "ts": time.time()}) + "\n"
+        tmp_path = f"{self.path}.tmp.{os.getpid()}"
+        with open(tmp_path, 'wb') as f:
+            f.write(header.encode('utf-8'))
+            f.write(data[pos:])
+        os.replace(tmp_path, self.path)
+        return pos
+
+    @staticmethod
+    def upsert_entry(user_id: Any, model: str, embedding: np.ndarray, photo_hash: Optional[str]) -> Dict[str, Any]:
+        return {
+            "ts": time.time(),
+            "op": "upsert",
+            "id": user_id,
+            "model": model,
+            "photo_hash": photo_hash,
+            "embedding": base64.b64encode(np.asarray(embedding, dtype='<f4').tobytes()).decode('ascii')
+        }
+
+    @staticmethod
+    def remove_entry(user_id: Any) -> Dict[str, Any]:
+        return {"ts": time.time(), "op": "remove", "id": user_id}
+
+    def apply(self, index: StudentAnnIndex, entries: List[Dict[str, Any]], since: float = 0.0) -> int:
+        """Applica all'indice le voci più recenti di since per il suo modello; voci applicate"""
+        applied = 0
+        upserts: Dict[Any, Tuple[np.ndarray, Optional[str]]] = {}
+        for entry in entries:
+            if entry.get("ts", 0) < since:
+                continue
+            if entry.get("op") == "remove":
+                upserts.pop(entry["id"], None)
+                index.remove([entry["id"]])
+                applied += 1
+            elif entry.get("op") == "upsert" and entry.get("model") == index.model:
+                vector = np.frombuffer(base64.b64decode(entry["embedding"]), dtype='<f4')
+                upserts[entry["id"]] = (vector, entry.get("photo_hash"))
+                applied += 1
+        if upserts:
+            user_ids = list(upserts)
+            index.upsert(user_ids, np.stack([upserts[u][0] for u in user_ids]), [upserts[u][1] for u in user_ids])
+        return applied
@@ -0,0 +1,306 @@
+"""
+Verifica di parità TensorFlow ↔ ONNX Runtime su un insieme fisso di volti (e frame)
+Confronta gli embeddings del recognizer (coseno per volto, decisioni di match alla soglia
+configurata, vicino più simile) e, se sono dati dei frame, i volti di RetinaFace (box, confidenza,
+embedding dei ritagli allineati). Misura throughput e memoria residente di ciascun runtime in un
+processo separato. Exit code 2 se la parità è sotto soglia.
+
+Esempi:
+    python scripts/benchmarks/onnx_parity.py --faces data/parity/faces
+    python scripts/benchmarks/onnx_parity.py --faces data/parity/faces --frames data/parity/frames \\
+        --quantized --min-cosine 0.98 --output temp/bench/onnx_parity.json
+"""
+
+import os
+import sys
+import json
+import time
+import argparse
+import resource
+import subprocess
+from typing import Dict, List, Any, Optional, Tuple
+
+import cv2
+import numpy as np
+
+SCRIPTS_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, SCRIPTS_DIR)
+
+from face_detection import FaceDetectionSystem, DeepFace, load_deepface
+from onnx_backend import OnnxModels, DETECTOR_MODEL
+
+IMAGE_EXTENSIONS = ('.jpg', '.jpeg', '.png', '.bmp')
+
+def load_images(directory: str) -> List[Tuple[str, np.ndarray]]:
+    images = []
+    for name in sorted(os.listdir(directory)):
+        if name.lower().endswith(IMAGE_EXTENSIONS):
+            image = cv2.imread(os.path.join(directory, name))
+            if image is not None:
+                images.append((name, image))
+    if not images:
+        raise ValueError(f"Nessuna immagine in {directory}")
+    return images
+
+def build_system(config: Optional[str], quantized: Optional[bool]) -> FaceDetectionSystem:
+    system = FaceDetectionSystem(config_path=config)
+    inference_config = dict(system.config["models"].get("inference", {}), backend="onnx")
+    if quantized is not None:
+        inference_config["quantized"] = quantized
+    system.onnx_models = OnnxModels(inference_config, system.project_root)
+    return system
+
+def keras_recognizer(model_name: str):
+    load_deepface()
+    client = DeepFace.build_model(model_name)
+    return getattr(client, 'model', client)
+
+def embed(model, faces: List[np.ndarray], batch_size: int = 32) -> np.ndarray:
+    input_hw = tuple(int(v) for v in model.input_shape[1:3])
+    rows = []
+    for start in range(0, len(faces), batch_size):
+        tensor = np.stack([
+            FaceDetectionSystem._preprocess_for_recognizer(face, input_hw)
+            for face in faces[start:start + batch_size]
+        ])
+        output = model(tensor, training=False)
+        rows.append(output.numpy() if hasattr(output, 'numpy') else np.asarray(output))
+    return np.vstack(rows).astype(np.float32)
+
+def normalize(matrix: np.ndarray) -> np.ndarray:
+    return matrix / np.maximum(np.linalg.norm(matrix, axis=1, keepdims=True), 1e-12)
+
+def recognizer_parity(reference: np.ndarray, candidate: np.ndarray, threshold: float) -> Dict[str, Any]:
+    """Coseno per volto e coerenza delle decisioni di match tra i due runtime"""
+    ref, cand = normalize(reference), normalize(candidate)
+    cosine = np.sum(ref * cand, axis=1)
+
+    ref_sim, cand_sim = ref @ ref.T, cand @ cand.T
+    pairs = np.triu_indices(len(ref), k=1)
+    flips = int(np.sum((ref_sim[pairs] >= threshold) != (cand_sim[pairs] >= threshold)))
+
+    np.fill_diagonal(ref_sim, -np.inf)
+    np.fill_diagonal(cand_sim, -np.inf)
+    rank1 = float(np.mean(ref_sim.argmax(axis=1) == cand_sim.argmax(axis=1))) if len(ref) > 1 else 1.0
+
+    return {
+        'faces': len(ref),
+        'cosine_min': round(float(cosine.min()), 5),
+        'cosine_mean': round(float(cosine.mean()), 5),
+        'max_similarity_delta': round(float(np.max(np.abs(ref_sim[pairs] - cand_sim[pairs]))) if len(ref) > 1 else 0.0, 5),
+        'pairs': int(len(pairs[0])),
+        'decision_flips': flips,
+        'rank1_agreement': round(rank1, 4)
+    }
+
+def box_iou(a: Dict[str, int], b: Dict[str, int]) -> float:
+    x1, y1 = max(a['x'], b['x']), max(a['y'], b['y'])
+    x2 = min(a['x'] + a['w'], b['x'] + b['w'])
+    y2 = min(a['y'] + a['h'], b['y'] + b['h'])
+    inter = max(0, x2 - x1) * max(0, y2 - y1)
+    union = a['w'] * a['h'] + b['w'] * b['h'] - inter
+    return inter / union if union > 0 else 0.0
+
+def detector_parity(frames: List[Tuple[str, np.ndarray]], onnx_detector, recognizer,
+                    min_iou: float) -> Dict[str, Any]:
+    """Volti TF vs ONNX abbinati per IoU; coseno degli embeddings dei ritagli allineati"""
+    reference_total = candidate_total = 0
+    ious, confidence_deltas, crop_pairs = [], [], []
+
+    for _, frame in frames:
+        reference = [f for f in DeepFace.extract_faces(
+            img_path=frame, detector_backend=DETECTOR_MODEL, enforce_detection=False, align=True
+        ) if f.get('confidence', 0) > 0]
+        candidate = [f for f in onnx_detector.extract_faces(
+            img_path=frame, detector_backend=DETECTOR_MODEL, enforce_detection=False, align=True
+        ) if f['confidence'] > 0]
+        reference_total += len(reference)
+        candidate_total += len(candidate)
+
+        used = set()
+        for ref_face in reference:
+            best, best_iou = None, min_iou
+            for idx, cand_face in enumerate(candidate):
+                iou = box_iou(ref_face['facial_area'], cand_face['facial_area'])
+                if idx not in used and iou >= best_iou:
+                    best, best_iou = idx, iou
+            if best is None:
+                continue
+            used.add(best)
+            ious.append(best_iou)
+            confidence_deltas.append(abs(float(ref_face['confidence']) - candidate[best]['confidence']))
+            crop_pairs.append((ref_face['face'], candidate[best]['face']))
+
+    result = {
+        'frames': len(frames),
+        'faces_tensorflow': reference_total,
+        'faces_onnx': candidate_total,
+        'matched': len(ious),
+        'recall': round(len(ious) / reference_total, 4) if reference_total else 1.0,
+        'precision': round(len(ious) / candidate_total, 4) if candidate_total else 1.0,
+        'iou_mean': round(float(np.mean(ious)), 4) if ious else None,
+        'confidence_delta_max': round(float(np.max(confidence_deltas)), 5) if confidence_deltas else None
+    }
+
+    if crop_pairs:
+        to_bgr = lambda face: cv2.cvtColor((np.clip(face, 0, 1) * 255).astype(np.uint8), cv2.COLOR_RGB2BGR)
+        reference_emb = embed(recognizer, [to_bgr(a) for a, _ in crop_pairs])
+        candidate_emb = embed(recognizer, [to_bgr(b) for _, b in crop_pairs])
+        cosine = np.sum(normalize(reference_emb) * normalize(candidate_emb), axis=1)
+        result['crop_cosine_min'] = round(float(cosine.min()), 5)
+        result['crop_cosine_mean'] = round(float(cosine.mean()), 5)
+    return result
+
+def max_rss_mb() -> float:
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux: KB, macOS: byte
+    return rss / (1024 * 1024) if sys.platform == 'darwin' else rss / 1024
+
+def measure_runtime(runtime: str, args) -> Dict[str, Any]:
+    """Eseguito in un processo dedicato: carica solo il runtime richiesto e misura il throughput"""
+    faces = [image for _, image in load_images(args.faces)]
+    frames = [image for _, image in load_images(args.frames)] if args.frames else []
+
+    load_start = time.perf_counter()
+    system = build_system(args.config, args.quantized)
+    model_name = args.model or system.model_name
+    if runtime == 'onnx':
+        recognizer = system.onnx_models.recognizer(model_name)
+        detector = system.onnx_models.detector() if frames else None
+        if recognizer is None or (frames and detector is None):
+            raise RuntimeError(f"Modelli ONNX non disponibili in {system.onnx_models.model_dir}")
+    else:
+        recognizer = keras_recognizer(model_name)
+        detector = DeepFace
+    embed(recognizer, faces[:1])
+    result = {'runtime': runtime, 'load_ms': round((time.perf_counter() - load_start) * 1000, 1)}
+
+    start = time.perf_counter()
+    for _ in range(args.runs):
+        embed(recognizer, faces)
+    result['faces_per_s'] = round(len(faces) * args.runs / (time.perf_counter() - start), 2)
+
+    if frames:
+        detector.extract_faces(img_path=frames[0], detector_backend=DETECTOR_MODEL, enforce_detection=False)
+        start = time.perf_counter()
+        for _ in range(args.runs):
+            for frame in frames:
+                detector.extract_faces(img_path=frame, detector_backend=DETECTOR_MODEL, enforce_detection=False)
+        result['frames_per_s'] = round(len(frames) * args.runs / (time.perf_counter() - start), 3)
+
+    result['max_rss_mb'] = round(max_rss_mb(), 1)
+    return result
+
+def spawn_measure(runtime: str, argv: List[str], timeout: int) -> Dict[str, Any]:
+    proc = subprocess.run(
+        [sys.executable, os.path.abspath(__file__), '--measure', runtime] + argv,
+        capture_output=True, text=True, timeout=timeout
+    )
+    try:
+        return json.loads(proc.stdout.strip().splitlines()[-1])
+    except (ValueError, IndexError):
+        return {'runtime': runtime, 'error': proc.stderr.strip()[-500:] or f'exit {proc.returncode}'}
+
+def check(report: Dict[str, Any], args) -> List[str]:
+    failures = []
+    recognizer = report['recognizer']
+    if recognizer['cosine_min'] < args.min_cosine:
+        failures.append(f"coseno minimo embeddings {recognizer['cosine_min']} < {args.min_cosine}")
+    if recognizer['decision_flips'] > args.max_flips:
+        failures.append(f"{recognizer['decision_flips']} decisioni di match diverse (max {args.max_flips})")
+
+    detector = report.get('detector')
+    if detector:
+        if detector['recall'] < args.min_recall or detector['precision'] < args.min_recall:
+            failures.append(f"volti abbinati: recall {detector['recall']}, precision {detector['precision']} "
+                            f"< {args.min_recall}")
+        if detector.get('crop_cosine_min') is not None and detector['crop_cosine_min'] < args.min_cosine:
+            failures.append(f"coseno minimo ritagli allineati {detector['crop_cosine_min']} < {args.min_cosine}")
+    return failures
+
+def main():
+    parser = argparse.ArgumentParser(description='Parità e throughput TensorFlow vs ONNX Runtime')
+    parser.add_argument('--faces', required=True, help='Directory con volti ritagliati (insieme fisso)')
+    parser.add_argument('--frames', help='Directory con frame interi per la parità del detector')
+    parser.add_argument('--config', help='File configurazione per face_detection.py')
+    parser.add_argument('--model', help='Recognizer (default: models.recognizer.model_name)')
+    quantization = parser.add_mutually_exclusive_group()
+    quantization.add_argument('--quantized', dest='quantized', action='store_true', default=None,
+                              help='Confronta i modelli int8')
+    quantization.add_argument('--fp32', dest='quantized', action='store_false', help='Confronta i modelli fp32')
+    parser.add_argument('--min-cosine', type=float, default=0.99, help='Coseno minimo TF/ONNX per volto')
+    parser.add_argument('--max-flips', type=int, default=0, help='Decisioni di match diverse ammesse')
+    parser.add_argument('--min-recall', type=float, default=0.98, help='Quota minima di volti abbinati')
+    parser.add_argument('--min-iou', type=float, default=0.5, help='IoU minima per abbinare due volti')
+    parser.add_argument('--runs', type=int, default=3, help='Ripetizioni per la misura di throughput')
+    parser.add_argument('--timeout', type=int, default=1800, help='Timeout processi di misura (s)')
+    parser.add_argument('--skip-throughput', action='store_true', help='Solo parità, senza misure')
+    parser.add_argument('--output', help='File JSON con il report')
+    parser.add_argument('--measure', choices=['tensorflow', 'onnx'], help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.measure:
+        print(json.dumps(measure_runtime(args.measure, args)))
+        return
+
+    try:
+        faces = load_images(args.faces)
+        frames = load_images(args.frames) if args.frames else []
+        system = build_system(args.config, args.quantized)
+        model_name = args.model or system.model_name
+        threshold = system.similarity_threshold
+
+        onnx_recognizer = system.onnx_models.recognizer(model_name)
+        onnx_detector = system.onnx_models.detector() if frames else None
+        if onnx_recognizer is None or (frames and onnx_detector is None):
+            raise RuntimeError(f"Modelli ONNX non disponibili in {system.onnx_models.model_dir}")
+        tf_recognizer = keras_recognizer(model_name)
+    except (RuntimeError, ValueError, OSError) as e:
+        print(json.dumps({'status': 'error', 'error': str(e)}))
+        sys.exit(1)
+
+    face_images = [image for _, image in faces]
+    report = {
+        'model': model_name,
+        'onnx_model': os.path.basename(onnx_recognizer.model_path),
+        'threshold': threshold,
+        'recognizer': recognizer_parity(embed(tf_recognizer, face_images), embed(onnx_recognizer, face_images), threshold)
+    }
+    if frames:
+        report['detector_model'] = os.path.basename(onnx_detector.model_path)
+        report['detector'] = detector_parity(frames, onnx_detector, tf_recognizer, args.min_iou)
+
+    if not args.skip_throughput:
+        argv = ['--faces', args.faces, '--runs', str(args.runs)]
+        for flag, value in (('--frames', args.frames), ('--config', args.config), ('--model', args.model)):
+            if value:
+                argv += [flag, value]
+        if args.quantized is not None:
+            argv.append('--quantized' if args.quantized else '--fp32')
+        runtimes = {runtime: spawn_measure(runtime, argv, args.timeout) for runtime in ('tensorflow', 'onnx')}
+        report['throughput'] = runtimes
+        tf_rate, onnx_rate = runtimes['tensorflow'].get('faces_per_s'), runtimes['onnx'].get('faces_per_s')
+        if tf_rate and onnx_rate:
+            report['speedup'] = round(onnx_rate / tf_rate, 2)
+        tf_rss, onnx_rss = runtimes['tensorflow'].get('max_rss_mb'), runtimes['onnx'].get('max_rss_mb')
+        if tf_rss and onnx_rss:
+            report['rss_ratio'] = round(onnx_rss / tf_rss, 3)
+
+    failures = check(report, args)
+    report['status'] = 'failed' if failures else 'success'
+    report['failures'] = failures
+
+    if args.output:
+        os.makedirs(os.path.dirname(os.path.abspath(args.output)), exist_ok=True)
+        with open(args.output, 'w', encoding='utf-8') as f:
+            json.dump(report, f, indent=2)
+
+    print(json.dumps(report, indent=2))
+
+    if failures:
+        for line in failures:
+            print(f"❌ Parità ONNX: {line}", file=sys.stderr)
+        sys.exit(2)
+
+if __name__ == '__main__':
+    main()
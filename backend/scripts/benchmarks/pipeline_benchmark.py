@@ -0,0 +1,514 @@
+"""
+Benchmark riproducibile della pipeline face detection su fixture sintetiche
+Genera in modo deterministico (seed) frame di classe con volti composti a dimensione e numero
+controllati e gallerie sintetiche di studenti, poi misura separatamente load_students,
+detect_faces, match_faces, generate_report_image e l'analisi completa (process_image).
+Per ogni fase riporta throughput, latenza p50/p95 e picco di memoria residente in JSON;
+il risultato si confronta con una baseline (exit code 2 se una fase peggiora oltre soglia).
+
+Esempi:
+    python scripts/benchmarks/pipeline_benchmark.py
+    python scripts/benchmarks/pipeline_benchmark.py --frames 1920x1080:24:80,3840x2160:40:96 \\
+        --gallery-sizes 50,500,5000 --iterations 10 --history temp/bench/pipeline.jsonl \\
+        --baseline config/pipeline_baseline.json
+    python scripts/benchmarks/pipeline_benchmark.py --faces data/bench/faces --stages detect_faces
+
+Con --faces i volti composti sono ritagli reali (consigliato per valutare anche la recall del
+detector); senza, vengono disegnati volti sintetici: i tempi restano confrontabili tra esecuzioni
+ma la recall non è rappresentativa.
+"""
+
+import os
+import sys
+import copy
+import json
+import time
+import socket
+import logging
+import argparse
+import resource
+from datetime import datetime
+from typing import Dict, List, Any, Optional, Tuple, Callable
+
+import cv2
+import numpy as np
+
+SCRIPTS_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, SCRIPTS_DIR)
+
+from face_detection import FaceDetectionSystem, logger
+from startup_benchmark import git_revision
+from tracing import reset_peak_rss, peak_rss_mb
+
+STAGES = ['load_students', 'detect_faces', 'match_faces', 'generate_report_image', 'process_image']
+DEFAULT_FRAMES = '1280x720:8:96,1920x1080:24:80,3840x2160:40:96'
+DEFAULT_GALLERIES = '50,500,5000'
+IMAGE_EXTENSIONS = ('.jpg', '.jpeg', '.png', '.bmp')
+
+# ----------------------------------------------------------------------
+# Fixture sintetiche
+# ----------------------------------------------------------------------
+
+def parse_frame_specs(spec: str) -> List[Dict[str, int]]:
+    """"1920x1080:24:80" → frame 1920x1080 con 24 volti di circa 80px"""
+    frames = []
+    for item in filter(None, (part.strip() for part in spec.split(','))):
+        size, count, face_size = item.split(':')
+        width, height = size.lower().split('x')
+        frames.append({'width': int(width), 'height': int(height),
+                       'faces': int(count), 'face_size': int(face_size)})
+    return frames
+
+def frame_label(spec: Dict[str, int]) -> str:
+    return f"{spec['width']}x{spec['height']}/{spec['faces']}@{spec['face_size']}px"
+
+def synthetic_face(size: int, rng: np.random.Generator) -> np.ndarray:
+    """Volto disegnato (pelle, capelli, occhi, naso, bocca) in BGR su sfondo scuro"""
+    face = np.zeros((size, size, 3), dtype=np.uint8)
+    skin = tuple(int(v) for v in rng.integers([60, 110, 160], [140, 180, 235]))
+    hair = tuple(int(v) for v in rng.integers(10, 90, size=3))
+    cx, cy = size // 2, size // 2
+    cv2.ellipse(face, (cx, int(cy * 0.8)), (int(size * 0.4), int(size * 0.38)), 0, 180, 360, hair, -1)
+    cv2.ellipse(face, (cx, cy), (int(size * 0.34), int(size * 0.44)), 0, 0, 360, skin, -1)
+
+    eye_y = int(size * 0.42)
+    for side in (-1, 1):
+        ex = cx + side * int(size * 0.14)
+        cv2.ellipse(face, (ex, eye_y), (max(2, size // 14), max(1, size // 28)), 0, 0, 360, (245, 245, 245), -1)
+        cv2.circle(face, (ex, eye_y), max(1, size // 32), (40, 30, 20), -1)
+        cv2.line(face, (ex - size // 12, eye_y - size // 12), (ex + size // 12, eye_y - size // 12),
+                 hair, max(1, size // 40))
+    cv2.line(face, (cx, int(size * 0.47)), (cx - size // 30, int(size * 0.6)),
+             tuple(max(0, c - 40) for c in skin), max(1, size // 50))
+    cv2.ellipse(face, (cx, int(size * 0.7)), (size // 9, max(1, size // 28)), 0, 0, 360, (70, 60, 170), -1)
+    return face
+
+def load_face_sources(directory: Optional[str], rng: np.random.Generator, count: int = 64) -> List[np.ndarray]:
+    if directory:
+        faces = []
+        for name in sorted(os.listdir(directory)):
+            if name.lower().endswith(IMAGE_EXTENSIONS):
+                image = cv2.imread(os.path.join(directory, name))
+                if image is not None:
+                    faces.append(image)
+        if not faces:
+            raise ValueError(f"Nessun volto in {directory}")
+        return faces
+    return [synthetic_face(256, rng) for _ in range(count)]
+
+def classroom_frame(spec: Dict[str, int], sources: List[np.ndarray],
+                    rng: np.random.Generator) -> Tuple[np.ndarray, List[Dict[str, int]]]:
+    """Frame di classe (parete, banchi, rumore) con volti disposti a file e ground truth"""
+    width, height = spec['width'], spec['height']
+    gradient = np.linspace(170, 110, height, dtype=np.float32)[:, None, None]
+    frame = np.broadcast_to(gradient * np.array([0.9, 1.0, 1.05], dtype=np.float32),
+                            (height, width, 3)).copy()
+    frame += rng.normal(0, 6, size=frame.shape).astype(np.float32)
+    frame = np.clip(frame, 0, 255).astype(np.uint8)
+
+    count, base = spec['faces'], spec['face_size']
+    columns = max(1, int(np.ceil(np.sqrt(count * width / height))))
+    rows = max(1, int(np.ceil(count / columns)))
+    cell_w, cell_h = width // columns, height // rows
+    if min(cell_w, cell_h) < base * 1.3:
+        raise ValueError(f"{frame_label(spec)}: volti troppo grandi per il frame")
+
+    boxes = []
+    for index in range(count):
+        row, column = divmod(index, columns)
+        size = int(base * rng.uniform(0.9, 1.1))
+        x = column * cell_w + int(rng.integers(0, cell_w - size))
+        y = row * cell_h + int(rng.integers(0, max(1, cell_h - int(size * 1.25))))
+
+        face = cv2.resize(sources[index % len(sources)], (size, size))
+        mask = np.zeros((size, size), dtype=np.float32)
+        cv2.ellipse(mask, (size // 2, size // 2), (int(size * 0.46), int(size * 0.5)), 0, 0, 360, 1.0, -1)
+        mask = cv2.GaussianBlur(mask, (0, 0), max(1, size / 40))[:, :, None]
+        region = frame[y:y + size, x:x + size].astype(np.float32)
+        frame[y:y + size, x:x + size] = (face * mask + region * (1 - mask)).astype(np.uint8)
+
+        # Banco sotto ogni studente
+        desk_y = min(height - 1, y + int(size * 1.15))
+        cv2.rectangle(frame, (x - size // 4, desk_y), (x + int(size * 1.25), min(height - 1, desk_y + size // 5)),
+                      (60, 90, 130), -1)
+        boxes.append({'x': x, 'y': y, 'w': size, 'h': size})
+    return frame, boxes
+
+def student_portrait(source: np.ndarray, rng: np.random.Generator) -> bytes:
+    """Foto tessera 480x480 con il volto centrato, codificata JPEG"""
+    canvas = np.full((480, 480, 3), int(rng.integers(180, 240)), dtype=np.uint8)
+    canvas[80:400, 80:400] = cv2.resize(source, (320, 320))
+    return cv2.imencode('.jpg', canvas, [cv2.IMWRITE_JPEG_QUALITY, 90])[1].tobytes()
+
+def synthetic_gallery(size: int, dim: int, rng: np.random.Generator) -> Tuple[List[Dict[str, Any]], np.ndarray]:
+    """Manifest studenti senza foto (riferimenti a embedding in cache) e matrice embeddings"""
+    embeddings = rng.normal(0, 1, size=(size, dim)).astype(np.float32)
+    students = [
+        {'id': 100000 + i, 'name': f"Studente{i}", 'surname': "Bench", 'photo_hash': f"bench-{size}-{i}"}
+        for i in range(size)
+    ]
+    return students, embeddings
+
+def box_recall(expected: List[Dict[str, int]], detected: List[Dict[str, Any]], min_iou: float = 0.3) -> float:
+    if not expected:
+        return 1.0
+    matched = 0
+    for box in expected:
+        for face in detected:
+            other = face['bbox']
+            x1, y1 = max(box['x'], other['x']), max(box['y'], other['y'])
+            x2 = min(box['x'] + box['w'], other['x'] + other['w'])
+            y2 = min(box['y'] + box['h'], other['y'] + other['h'])
+            inter = max(0, x2 - x1) * max(0, y2 - y1)
+            union = box['w'] * box['h'] + other['w'] * other['h'] - inter
+            if union > 0 and inter / union >= min_iou:
+                matched += 1
+                break
+    return matched / len(expected)
+
+# ----------------------------------------------------------------------
+# Misure
+# ----------------------------------------------------------------------
+
+def measure(fn: Callable[[], Any], items: int, iterations: int, warmup: int) -> Tuple[Dict[str, Any], Any]:
+    """Latenze di iterations chiamate dopo warmup chiamate di riscaldamento"""
+    result = None
+    for _ in range(warmup):
+        result = fn()
+
+    per_stage_peak = reset_peak_rss()
+    latencies = []
+    for _ in range(iterations):
+        start = time.perf_counter()
+        result = fn()
+        latencies.append((time.perf_counter() - start) * 1000)
+
+    total_s = sum(latencies) / 1000
+    stats = {
+        'iterations': iterations,
+        'items': items,
+        'p50_ms': round(float(np.percentile(latencies, 50)), 2),
+        'p95_ms': round(float(np.percentile(latencies, 95)), 2),
+        'mean_ms': round(float(np.mean(latencies)), 2),
+        'min_ms': round(min(latencies), 2),
+        'max_ms': round(max(latencies), 2),
+        'throughput_per_s': round(items * iterations / total_s, 2) if total_s > 0 else None,
+        'peak_rss_mb': round(peak_rss_mb(), 1),
+        'peak_rss_scope': 'stage' if per_stage_peak else 'process'
+    }
+    return stats, result
+
+class PipelineBenchmark:
+    """Fixture e sistema condivisi tra le fasi; ogni fase misurata sul proprio scenario"""
+
+    def __init__(self, args):
+        self.args = args
+        self.rng = np.random.default_rng(args.seed)
+        self.frame_specs = parse_frame_specs(args.frames)
+        self.gallery_sizes = [int(v) for v in args.gallery_sizes.split(',') if v.strip()]
+
+        self.system = FaceDetectionSystem(config_path=args.config)
+        self.overrides = self._apply_overrides()
+        self.system.warm_up()
+        self.cache_model = self.system._embedding_cache_model()
+
+        sources = load_face_sources(args.faces, self.rng)
+        self.frames = [(spec, *classroom_frame(spec, sources, self.rng)) for spec in self.frame_specs]
+        self.portraits = [student_portrait(sources[i % len(sources)], self.rng) for i in range(args.cold_gallery)]
+
+        probe = self.system._generate_embeddings_batch([sources[0]], self.system.model_name)[0]
+        self.dim = len(probe) if probe is not None else 512
+        self.galleries = {size: synthetic_gallery(size, self.dim, self.rng) for size in self.gallery_sizes}
+
+        if args.save_fixtures:
+            self._save_fixtures(args.save_fixtures)
+
+    def _apply_overrides(self) -> Dict[str, Any]:
+        """Isola il benchmark da stato su disco e output di debug (ripristinabili da CLI)"""
+        system = self.system
+        overrides = {}
+        if not self.args.keep_debug_output:
+            system.config["output"]["save_debug_images"] = False
+            system.save_debug_faces = False
+            overrides['save_debug_images'] = False
+        if not self.args.persistent_cache:
+            system.embedding_cache.store = None
+            overrides['persistent_cache'] = False
+        # La cache in memoria deve contenere la galleria più grande (altrimenti si misura l'evizione)
+        largest = max(self.gallery_sizes + [self.args.e2e_gallery, 0])
+        if largest > system.embedding_cache.max_size:
+            system.embedding_cache.max_size = largest * 2
+            system.embedding_cache.max_bytes = max(system.embedding_cache.max_bytes, largest * 2 * 4096 * 4)
+            overrides['cache_max_size'] = largest * 2
+        return overrides
+
+    def _save_fixtures(self, directory: str):
+        os.makedirs(directory, exist_ok=True)
+        truth = {}
+        for spec, frame, boxes in self.frames:
+            name = f"frame_{spec['width']}x{spec['height']}_{spec['faces']}.jpg"
+            cv2.imwrite(os.path.join(directory, name), frame)
+            truth[name] = boxes
+        for i, portrait in enumerate(self.portraits):
+            with open(os.path.join(directory, f"student_{i:03d}.jpg"), 'wb') as f:
+                f.write(portrait)
+        with open(os.path.join(directory, 'ground_truth.json'), 'w') as f:
+            json.dump(truth, f, indent=2)
+        logger.warning(f"📁 Fixture salvate in {directory}")
+
+    def _prime_cache(self, size: int) -> List[Dict[str, Any]]:
+        """Embeddings della galleria in cache: load_students percorre il ramo senza foto"""
+        students, embeddings = self.galleries[size]
+        for student, embedding in zip(students, embeddings):
+            self.system.embedding_cache.set(student['id'], self.cache_model, embedding, student['photo_hash'])
+        return students
+
+    def _cold_manifest(self) -> List[Dict[str, Any]]:
+        return [
+            {'id': 200000 + i, 'name': f"Nuovo{i}", 'surname': "Bench", 'photo_bytes': portrait}
+            for i, portrait in enumerate(self.portraits)
+        ]
+
+    def _faces_for(self, frame_spec_boxes: List[Dict[str, int]], gallery: np.ndarray) -> List[Dict[str, Any]]:
+        """Volti con embedding vicino a metà della galleria (match reali) e metà sconosciuti"""
+        faces = []
+        for index, box in enumerate(frame_spec_boxes):
+            if index % 2 == 0 and len(gallery) > 0:
+                embedding = gallery[index % len(gallery)] + self.rng.normal(0, 0.3, size=self.dim)
+            else:
+                embedding = self.rng.normal(0, 1, size=self.dim)
+            faces.append({
+                'index': index, 'bbox': dict(box), 'confidence': 0.99,
+                'embedding': embedding.astype(np.float32), 'quality_score': box['w'] * box['h'],
+                'blur_score': 150.0
+            })
+        return faces
+
+    # Fasi -------------------------------------------------------------
+
+    def bench_load_students(self) -> Dict[str, Any]:
+        results = {}
+        iterations, warmup = self.args.iterations, self.args.warmup
+        if self.portraits:
+            cache_enabled = self.system.enable_caching
+            self.system.enable_caching = False
+            stats, loaded = measure(
+                lambda: self.system.load_students(self._cold_manifest()),
+                len(self.portraits), iterations, warmup
+            )
+            self.system.enable_caching = cache_enabled
+            stats['students_loaded'] = len(loaded)
+            results[f"cold/{len(self.portraits)}"] = stats
+
+        for size in self.gallery_sizes:
+            students = self._prime_cache(size)
+            stats, loaded = measure(
+                lambda: self.system.load_students(copy.deepcopy(students)),
+                size, iterations, warmup
+            )
+            stats['students_loaded'] = len(loaded)
+            results[f"cached/{size}"] = stats
+        return results
+
+    def bench_detect_faces(self) -> Dict[str, Any]:
+        results = {}
+        for spec, frame, boxes in self.frames:
+            stats, faces = measure(
+                lambda: self.system.detect_faces(frame_label(spec), image=frame),
+                1, self.args.iterations, self.args.warmup
+            )
+            stats['faces_expected'] = len(boxes)
+            stats['faces_detected'] = len(faces)
+            stats['recall'] = round(box_recall(boxes, faces), 4)
+            stats['detection_mode'] = self.system.metrics.detection_mode
+            results[frame_label(spec)] = stats
+        return results
+
+    def bench_match_faces(self) -> Dict[str, Any]:
+        results = {}
+        _, _, boxes = max(self.frames, key=lambda item: len(item[2]))
+        for size in self.gallery_sizes:
+            students, embeddings = self.galleries[size]
+            gallery = [dict(s, embedding=e) for s, e in zip(students, embeddings)]
+            faces = self._faces_for(boxes, embeddings)
+            stats, recognized = measure(
+                lambda: self.system.match_faces(faces, gallery),
+                len(faces), self.args.iterations, self.args.warmup
+            )
+            stats['recognized'] = len(recognized)
+            results[f"{len(faces)}faces/{size}students"] = stats
+        return results
+
+    def bench_generate_report_image(self) -> Dict[str, Any]:
+        results = {}
+        _, embeddings = self.galleries[self.gallery_sizes[0]] if self.gallery_sizes else (None, np.zeros((0, self.dim)))
+        for spec, frame, boxes in self.frames:
+            faces = self._faces_for(boxes, embeddings)
+            recognized = [
+                {'userId': i, 'name': f"Studente{i}", 'surname': "Bench", 'confidence': 0.8, 'faceIndex': face['index']}
+                for i, face in enumerate(faces) if face['index'] % 2 == 0
+            ]
+            stats, report = measure(
+                lambda: self.system.generate_report_image(frame, faces, recognized, as_bytes=True),
+                1, self.args.iterations, self.args.warmup
+            )
+            stats['report_bytes'] = len(report) if isinstance(report, (bytes, bytearray)) else 0
+            results[frame_label(spec)] = stats
+        return results
+
+    def bench_process_image(self) -> Dict[str, Any]:
+        results = {}
+        size = self.args.e2e_gallery
+        if size not in self.galleries:
+            self.galleries[size] = synthetic_gallery(size, self.dim, self.rng)
+        students = self._prime_cache(size)
+
+        for spec, frame, boxes in self.frames:
+            image_bytes = cv2.imencode('.jpg', frame, [cv2.IMWRITE_JPEG_QUALITY, 90])[1].tobytes()
+            stats, result = measure(
+                lambda: self.system.analyze(image_bytes, copy.deepcopy(students), report_inline=True),
+                1, self.args.iterations, self.args.warmup
+            )
+            stats['status'] = result.get('status')
+            stats['faces_detected'] = result.get('detected_faces', 0)
+            stats['stages_ms'] = result.get('performance_metrics', {}).get('stages_ms', {})
+            results[f"{frame_label(spec)}/{size}students"] = stats
+        return results
+
+    def run(self, stages: List[str]) -> Dict[str, Any]:
+        results = {}
+        for stage in stages:
+            logger.warning(f"⏱️ Benchmark {stage}...")
+            results[stage] = getattr(self, f"bench_{stage}")()
+        return results
+
+    def describe(self) -> Dict[str, Any]:
+        inference = self.system.onnx_models.variant(self.system.model_name) or "tensorflow"
+        return {
+            'detector': self.system.detector_backend,
+            'model': self.system.model_name,
+            'inference_backend': inference,
+            'threshold': self.system.similarity_threshold,
+            'embedding_dim': self.dim,
+            'overrides': self.overrides,
+            'fixtures': {
+                'seed': self.args.seed,
+                'frames': [frame_label(spec) for spec in self.frame_specs],
+                'face_source': self.args.faces or 'synthetic',
+                'gallery_sizes': self.gallery_sizes,
+                'cold_gallery': len(self.portraits),
+                'e2e_gallery': self.args.e2e_gallery
+            }
+        }
+
+# ----------------------------------------------------------------------
+# Baseline
+# ----------------------------------------------------------------------
+
+def compare(stages: Dict[str, Any], baseline: Dict[str, Any], max_regression: float,
+            min_delta_ms: float) -> List[str]:
+    """p50/p95 di ogni scenario oltre baseline * (1 + max_regression) e oltre min_delta_ms"""
+    regressions = []
+    base_stages = baseline.get('stages', {})
+    for stage, scenarios in stages.items():
+        for scenario, stats in scenarios.items():
+            reference = base_stages.get(stage, {}).get(scenario)
+            if not reference:
+                continue
+            for metric in ('p50_ms', 'p95_ms'):
+                current, previous = stats.get(metric), reference.get(metric)
+                if current is None or not previous:
+                    continue
+                if current > previous * (1 + max_regression) and current - previous > min_delta_ms:
+                    regressions.append(
+                        f"{stage} [{scenario}] {metric}: {current:.1f}ms vs baseline {previous:.1f}ms "
+                        f"(+{(current / previous - 1) * 100:.0f}%)"
+                    )
+    return regressions
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark pipeline face detection su fixture sintetiche')
+    parser.add_argument('--config', help='File configurazione per face_detection.py')
+    parser.add_argument('--stages', default=','.join(STAGES), help=f'Fasi da misurare ({",".join(STAGES)})')
+    parser.add_argument('--frames', default=DEFAULT_FRAMES,
+                        help='Scenari frame LARGHEZZAxALTEZZA:VOLTI:LATO_VOLTO separati da virgola')
+    parser.add_argument('--gallery-sizes', default=DEFAULT_GALLERIES, help='Dimensioni gallerie sintetiche')
+    parser.add_argument('--cold-gallery', type=int, default=20,
+                        help='Studenti con foto per load_students senza cache (embedding generati)')
+    parser.add_argument('--e2e-gallery', type=int, default=500, help='Galleria per process_image')
+    parser.add_argument('--faces', help='Directory di ritagli volto reali da comporre nei frame')
+    parser.add_argument('--seed', type=int, default=42)
+    parser.add_argument('--iterations', type=int, default=5)
+    parser.add_argument('--warmup', type=int, default=1)
+    parser.add_argument('--keep-debug-output', action='store_true', help='Non disattivare save_debug_images')
+    parser.add_argument('--persistent-cache', action='store_true', help='Usa lo store embeddings su disco')
+    parser.add_argument('--save-fixtures', help='Salva frame, foto e ground truth in questa directory')
+    parser.add_argument('--output', help='File JSON con il risultato')
+    parser.add_argument('--history', help='File JSONL a cui accodare il risultato')
+    parser.add_argument('--baseline', help='JSON di riferimento (output di --write-baseline)')
+    parser.add_argument('--max-regression', type=float, default=0.2,
+                        help='Peggioramento massimo ammesso su p50/p95 (0.2 = +20%%)')
+    parser.add_argument('--min-delta-ms', type=float, default=5.0,
+                        help='Differenza assoluta minima per segnalare una regressione')
+    parser.add_argument('--write-baseline', help='Salva questo risultato come nuova baseline')
+    parser.add_argument('--verbose', action='store_true', help='Log INFO della pipeline')
+    args = parser.parse_args()
+
+    # I log per volto della pipeline non devono finire nelle misure (né riempire il terminale)
+    if not args.verbose:
+        logger.setLevel(logging.WARNING)
+
+    stages = [stage.strip() for stage in args.stages.split(',') if stage.strip()]
+    unknown = [stage for stage in stages if stage not in STAGES]
+    if unknown:
+        parser.error(f"fasi sconosciute: {', '.join(unknown)}")
+
+    try:
+        bench = PipelineBenchmark(args)
+        started = time.perf_counter()
+        results = bench.run(stages)
+    except (RuntimeError, ValueError, OSError) as e:
+        print(json.dumps({'status': 'error', 'error': str(e)}))
+        sys.exit(1)
+    finally:
+        if 'bench' in locals():
+            bench.system.close()
+
+    record = {
+        'timestamp': datetime.now().isoformat(),
+        'revision': git_revision(),
+        'host': socket.gethostname(),
+        'python': sys.version.split()[0],
+        'duration_s': round(time.perf_counter() - started, 1),
+        'pipeline': bench.describe(),
+        'stages': results,
+        'peak_rss_mb': round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss /
+                             ((1024 * 1024) if sys.platform == 'darwin' else 1024), 1)
+    }
+
+    for path in (args.output, args.write_baseline):
+        if path:
+            os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+            with open(path, 'w', encoding='utf-8') as f:
+                json.dump(record, f, indent=2)
+
+    regressions = []
+    if args.baseline and os.path.exists(args.baseline):
+        with open(args.baseline, 'r', encoding='utf-8') as f:
+            regressions = compare(results, json.load(f), args.max_regression, args.min_delta_ms)
+    record['regressions'] = regressions
+
+    if args.history:
+        os.makedirs(os.path.dirname(os.path.abspath(args.history)), exist_ok=True)
+        with open(args.history, 'a', encoding='utf-8') as f:
+            f.write(json.dumps(record) + '\n')
+
+    print(json.dumps(record, indent=2))
+
+    if regressions:
+        for line in regressions:
+            print(f"❌ Regressione pipeline: {line}", file=sys.stderr)
+        sys.exit(2)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,167 @@
+"""
+Benchmark di avvio di face_detection.py
+Misura in processi nuovi il tempo di --help (solo import leggeri) e il profilo di
+--startup-profile (import TensorFlow/DeepFace, caricamento modelli), salva lo storico
+in JSONL e confronta con una baseline: exit code 2 se un tempo peggiora oltre la soglia.
+
+Esempi:
+    python scripts/benchmarks/startup_benchmark.py --runs 5
+    python scripts/benchmarks/startup_benchmark.py --history temp/bench/startup.jsonl \\
+        --baseline config/startup_baseline.json --max-regression 0.25
+"""
+
+import os
+import sys
+import json
+import time
+import socket
+import argparse
+import statistics
+import subprocess
+from datetime import datetime
+from typing import Dict, List, Any, Optional
+
+SCRIPTS_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+BACKEND_DIR = os.path.dirname(SCRIPTS_DIR)
+FACE_DETECTION = os.path.join(SCRIPTS_DIR, 'face_detection.py')
+
+# Metriche confrontate con la baseline (le altre sono solo informative)
+TRACKED_METRICS = ['help_ms', 'wall_ms', 'tensorflow_import_ms', 'deepface_import_ms', 'models_total_ms']
+
+def run_timed(cmd: List[str], timeout: int) -> Dict[str, Any]:
+    start = time.perf_counter()
+    proc = subprocess.run(cmd, cwd=BACKEND_DIR, capture_output=True, text=True, timeout=timeout)
+    return {
+        'wall_ms': (time.perf_counter() - start) * 1000,
+        'returncode': proc.returncode,
+        'stdout': proc.stdout,
+        'stderr': proc.stderr
+    }
+
+def parse_profile(stdout: str) -> Dict[str, float]:
+    """Estrae il JSON finale di --startup-profile dallo stdout"""
+    start = stdout.find('{')
+    if start < 0:
+        raise ValueError('Nessun JSON nello stdout')
+    data = json.loads(stdout[start:])
+    if data.get('status') != 'success':
+        raise RuntimeError(data.get('error', 'startup profile fallito'))
+    return data['startup_profile']
+
+def measure(python: str, config: Optional[str], runs: int, timeout: int) -> Dict[str, List[float]]:
+    samples: Dict[str, List[float]] = {}
+
+    def add(key: str, value: float):
+        samples.setdefault(key, []).append(round(value, 1))
+
+    for i in range(runs):
+        help_run = run_timed([python, FACE_DETECTION, '--help'], timeout)
+        if help_run['returncode'] != 0:
+            raise RuntimeError(f"--help fallito: {help_run['stderr'][-500:]}")
+        add('help_ms', help_run['wall_ms'])
+
+        cmd = [python, FACE_DETECTION, '--startup-profile']
+        if config:
+            cmd += ['--config', config]
+        profile_run = run_timed(cmd, timeout)
+        if profile_run['returncode'] != 0:
+            raise RuntimeError(f"--startup-profile fallito: {profile_run['stdout'][-500:]}")
+
+        add('wall_ms', profile_run['wall_ms'])
+        for key, value in parse_profile(profile_run['stdout']).items():
+            add(key, value)
+
+        print(f"  run {i + 1}/{runs}: help {help_run['wall_ms']:.0f}ms, "
+              f"startup {profile_run['wall_ms']:.0f}ms", file=sys.stderr)
+
+    return samples
+
+def summarize(samples: Dict[str, List[float]]) -> Dict[str, Dict[str, float]]:
+    return {
+        key: {
+            'median': round(statistics.median(values), 1),
+            'min': min(values),
+            'max': max(values)
+        }
+        for key, values in samples.items()
+    }
+
+def git_revision() -> Optional[str]:
+    try:
+        return subprocess.run(
+            ['git', 'rev-parse', '--short', 'HEAD'], cwd=BACKEND_DIR,
+            capture_output=True, text=True, timeout=10
+        ).stdout.strip() or None
+    except (OSError, subprocess.SubprocessError):
+        return None
+
+def compare(summary: Dict[str, Dict[str, float]], baseline: Dict[str, Any],
+            max_regression: float, min_delta_ms: float) -> List[str]:
+    """Metriche tracciate con mediana oltre baseline * (1 + max_regression) e oltre
+    min_delta_ms in valore assoluto (evita falsi allarmi su tempi di pochi ms)"""
+    regressions = []
+    base_summary = baseline.get('summary', baseline)
+    for key in TRACKED_METRICS:
+        if key not in summary or key not in base_summary:
+            continue
+        current = summary[key]['median']
+        reference = base_summary[key]['median']
+        if current > reference * (1 + max_regression) and current - reference > min_delta_ms:
+            regressions.append(f"{key}: {current:.0f}ms vs baseline {reference:.0f}ms "
+                               f"(+{(current / reference - 1) * 100:.0f}%)")
+    return regressions
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark avvio face_detection.py')
+    parser.add_argument('--runs', type=int, default=5, help='Numero di processi per misura')
+    parser.add_argument('--python', default=sys.executable, help='Interprete Python da misurare')
+    parser.add_argument('--config', help='File configurazione per face_detection.py')
+    parser.add_argument('--timeout', type=int, default=600, help='Timeout per processo (s)')
+    parser.add_argument('--history', help='File JSONL a cui accodare il risultato')
+    parser.add_argument('--baseline', help='JSON di riferimento (output di --write-baseline)')
+    parser.add_argument('--max-regression', type=float, default=0.25,
+                        help='Peggioramento massimo ammesso sulla mediana (0.25 = +25%%)')
+    parser.add_argument('--min-delta-ms', type=float, default=50.0,
+                        help='Differenza assoluta minima per segnalare una regressione')
+    parser.add_argument('--write-baseline', help='Salva questo risultato come nuova baseline')
+    args = parser.parse_args()
+
+    print(f"⏱️ Benchmark avvio ({args.runs} run)...", file=sys.stderr)
+    try:
+        summary = summarize(measure(args.python, args.config, args.runs, args.timeout))
+    except (RuntimeError, ValueError, subprocess.TimeoutExpired) as e:
+        print(json.dumps({'status': 'error', 'error': str(e)}))
+        sys.exit(1)
+
+    record = {
+        'timestamp': datetime.now().isoformat(),
+        'revision': git_revision(),
+        'host': socket.gethostname(),
+        'runs': args.runs,
+        'summary': summary
+    }
+
+    if args.history:
+        os.makedirs(os.path.dirname(os.path.abspath(args.history)), exist_ok=True)
+        with open(args.history, 'a', encoding='utf-8') as f:
+            f.write(json.dumps(record) + '\n')
+
+    if args.write_baseline:
+        with open(args.write_baseline, 'w', encoding='utf-8') as f:
+            json.dump(record, f, indent=2)
+
+    regressions = []
+    if args.baseline and os.path.exists(args.baseline):
+        with open(args.baseline, 'r', encoding='utf-8') as f:
+            regressions = compare(summary, json.load(f), args.max_regression, args.min_delta_ms)
+    record['regressions'] = regressions
+
+    print(json.dumps(record, indent=2))
+
+    if regressions:
+        for line in regressions:
+            print(f"❌ Regressione avvio: {line}", file=sys.stderr)
+        sys.exit(2)
+
+if __name__ == '__main__':
+    main()
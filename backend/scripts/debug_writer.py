@@ -0,0 +1,218 @@
+"""
+Scrittura in background degli artefatti di debug (volti studenti/rilevati, dettagli match,
+immagini di confronto) con save_debug_images attivo (spento nella config distribuita: gli
+artefatti contengono i volti degli studenti, va acceso solo per una diagnosi)
+L'analisi accoda solo una funzione di rendering e i riferimenti agli array già in memoria:
+conversione, composizione, codifica JPEG e scrittura avvengono in un thread dedicato, con coda
+limitata (politica di scarto), quota disco e finestra di retention sulle directory di debug.
+All'uscita del processo la coda viene svuotata e il thread fermato anche senza close(): un
+thread daemon ancora dentro cv2 durante la finalizzazione dell'interprete termina con SIGABRT.
+"""
+
+import os
+import time
+import atexit
+import logging
+import threading
+import weakref
+from collections import deque, OrderedDict
+from typing import List, Dict, Any, Optional, Callable, Tuple, Union
+
+import cv2
+import numpy as np
+
+logger = logging.getLogger('FaceDetectionV4')
+
+# Contenuto prodotto dal rendering: array immagine (codificato secondo l'estensione), testo o byte
+Artifact = Union[np.ndarray, str, bytes, None]
+
+def _close_at_exit(writer_ref: 'weakref.ref[DebugArtifactWriter]'):
+    writer = writer_ref()
+    if writer is not None:
+        writer.close()
+
+class DebugArtifactWriter:
+    """Un solo thread FIFO: l'ordine di scrittura è quello di accodamento (le foto studenti
+    sono su disco prima dei confronti che le rileggono)
+
+    drop_policy: "drop_newest" scarta l'artefatto appena arrivato a coda piena,
+    "drop_oldest" scarta il più vecchio ancora in coda.
+    """
+
+    def __init__(self, writer_config: Dict[str, Any], directories: List[str]):
+        self.queue_size = max(1, int(writer_config.get("queue_size", 256)))
+        self.drop_policy = writer_config.get("drop_policy", "drop_newest")
+        self.max_disk_bytes = int(writer_config.get("max_disk_bytes", 512 * 1024 * 1024))
+        self.retention_s = float(writer_config.get("retention_hours", 72)) * 3600
+        self.sweep_interval_s = float(writer_config.get("sweep_interval_s", 300))
+        self.flush_timeout_s = float(writer_config.get("flush_timeout_s", 10))
+        self.directories = directories
+
+        self._queue: 'deque[Tuple[str, Callable[[], Artifact]]]' = deque()
+        self._cond = threading.Condition()
+        self._busy = False
+        self._closed = False
+        self._thread: Optional[threading.Thread] = None
+        self._atexit_registered = False
+
+        # File gestiti in ordine di scrittura (path -> byte) per la quota
+        self._files: 'OrderedDict[str, int]' = OrderedDict()
+        self._disk_bytes = 0
+        self._last_sweep = 0.0
+
+        self.stats = {"queued": 0, "written": 0, "dropped": 0, "failed": 0, "evicted": 0, "expired": 0}
+
+    def submit(self, path: str, render: Callable[[], Artifact]) -> bool:
+        """Accoda un artefatto; False se scartato per coda piena (o writer chiuso)"""
+        with self._cond:
+            if self._closed:
+                return False
+            if len(self._queue) >= self.queue_size:
+                self.stats["dropped"] += 1
+                if self.drop_policy != "drop_oldest":
+                    return False
+                self._queue.popleft()
+            self._queue.append((path, render))
+            self.stats["queued"] += 1
+            self._cond.notify()
+        self._ensure_thread()
+        return True
+
+    def _ensure_thread(self):
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run, name='debug-writer', daemon=True)
+            self._thread.start()
+            if not self._atexit_registered:
+                # weakref: l'hook non tiene in vita writer (e FaceDetectionSystem) già rilasciati
+                atexit.register(_close_at_exit, weakref.ref(self))
+                self._atexit_registered = True
+
+    def _run(self):
+        self._scan()
+        while True:
+            with self._cond:
+                while not self._queue and not self._closed:
+                    self._cond.wait(timeout=self.sweep_interval_s)
+                    if not self._queue:
+                        break
+                if not self._queue and self._closed:
+                    return
+                job = self._queue.popleft() if self._queue else None
+                self._busy = job is not None
+
+            if job is not None:
+                self._write(*job)
+            if time.time() - self._last_sweep >= self.sweep_interval_s:
+                self._sweep()
+
+            with self._cond:
+                self._busy = False
+                self._cond.notify_all()
+
+    def _write(self, path: str, render: Callable[[], Artifact]):
+        try:
+            content = render()
+            if content is None:
+                return
+            if isinstance(content, np.ndarray):
+                ok, encoded = cv2.imencode(os.path.splitext(path)[1] or '.jpg', content)
+                if not ok:
+                    raise ValueError("codifica immagine fallita")
+                data = encoded.tobytes()
+            elif isinstance(content, str):
+                data = content.encode('utf-8')
+            else:
+                data = bytes(content)
+
+            tmp_path = f"{path}.tmp"
+            with open(tmp_path, 'wb') as f:
+                f.write(data)
+            os.replace(tmp_path, path)
+
+            self._account(path, len(data))
+            self.stats["written"] += 1
+        except Exception as e:
+            self.stats["failed"] += 1
+            logger.warning(f"⚠️ Artefatto di debug non scritto ({os.path.basename(path)}): {e}")
+
+    def _account(self, path: str, size: int):
+        """Registra il file e libera i più vecchi oltre la quota"""
+        self._disk_bytes -= self._files.pop(path, 0)
+        self._files[path] = size
+        self._disk_bytes += size
+
+        while self._disk_bytes > self.max_disk_bytes and len(self._files) > 1:
+            old_path, old_size = self._files.popitem(last=False)
+            self._disk_bytes -= old_size
+            try:
+                os.remove(old_path)
+                self.stats["evicted"] += 1
+            except OSError:
+                pass
+
+    def _scan(self):
+        """File già presenti (esecuzioni precedenti) in ordine di età, per quota e retention"""
+        existing = []
+        for directory in self.directories:
+            try:
+                with os.scandir(directory) as entries:
+                    for entry in entries:
+                        if entry.is_file():
+                            stat = entry.stat()
+                            existing.append((stat.st_mtime, entry.path, stat.st_size))
+            except OSError:
+                continue
+        for _, path, size in sorted(existing):
+            self._account(path, size)
+        self._sweep()
+
+    def _sweep(self):
+        """Rimuove i file più vecchi della finestra di retention"""
+        self._last_sweep = time.time()
+        if self.retention_s <= 0:
+            return
+        cutoff = self._last_sweep - self.retention_s
+        for path in list(self._files):
+            try:
+                expired = os.path.getmtime(path) < cutoff
+            except OSError:
+                self._disk_bytes -= self._files.pop(path)
+                continue
+            if not expired:
+                # Ordine di scrittura ≈ ordine di età: i successivi sono più recenti
+                break
+            self._disk_bytes -= self._files.pop(path)
+            try:
+                os.remove(path)
+                self.stats["expired"] += 1
+            except OSError:
+                pass
+
+    def flush(self, timeout: Optional[float] = None) -> bool:
+        """Attende lo svuotamento della coda (True se completato entro il timeout)"""
+        deadline = time.time() + (self.flush_timeout_s if timeout is None else timeout)
+        with self._cond:
+            while self._queue or self._busy:
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    return False
+                self._cond.wait(timeout=remaining)
+        return True
+
+    def close(self):
+        """Scrive quanto possibile entro flush_timeout_s, poi ferma il thread (attende la fine
+        dell'artefatto in scrittura)"""
+        if self._thread is None:
+            return
+        if not self.flush():
+            logger.warning(f"⚠️ {len(self._queue)} artefatti di debug non scritti alla chiusura")
+        with self._cond:
+            self._closed = True
+            self._queue.clear()
+            self._cond.notify_all()
+        self._thread.join(timeout=max(1.0, self.flush_timeout_s))
+        if self._thread.is_alive():
+            logger.warning("⚠️ Writer di debug ancora occupato alla chiusura")
+        self._thread = None
+        # Riutilizzabile: un submit successivo riavvia il thread
+        self._closed = False
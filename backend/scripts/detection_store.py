@@ -0,0 +1,195 @@
+"""
+Detection Store - rilevamenti per immagine salvati su disco per la rianalisi "rematch"
+Per ogni immagine analizzata: riquadri, confidence, blur e embeddings dei volti validati, in un
+.npz chiave (hash dei pixel, impronta di detector/recognizer/validazione). Una rianalisi dopo un
+cambio di soglia, margine o elenco studenti ricarica i volti e rifà solo il match con la
+galleria corrente, senza rilevamento né embeddings.
+
+Layout: <store_dir>/<impronta>/<hash[:2]>/<hash>.npz
+Una nuova versione di modello o detector cambia l'impronta: i file precedenti non vengono più
+letti e lasciano il posto ai nuovi con la quota disco (i meno usati per primi) e la retention.
+Disattivato di default (detection_store.enabled): senza store le richieste rematch eseguono il
+rilevamento completo.
+"""
+
+import os
+import json
+import time
+import hashlib
+import logging
+from typing import List, Dict, Any, Optional, Tuple
+
+import numpy as np
+
+logger = logging.getLogger('FaceDetectionV4')
+
+STORE_VERSION = 1
+
+def detection_fingerprint(config: Dict[str, Any], detector_backend: str, model_name: str,
+                          inference_variant: Optional[str] = None) -> str:
+    """Impronta di tutto ciò che determina volti ed embeddings salvati (non soglie di match)"""
+    models = config.get("models", {})
+    detector = dict(models.get("detector", {}))
+    detector["backend"] = detector_backend
+    verification = models.get("verification", {})
+    payload = {
+        "version": STORE_VERSION,
+        "detector": detector,
+        "model": model_name,
+        "secondary_model": (verification.get("secondary_model")
+                            if verification.get("enable_double_check", False) else None),
+        "inference": inference_variant or "tensorflow",
+        "validation": {
+            key: config.get("validation", {}).get(key)
+            for key in ("min_face_size", "max_face_size", "min_face_confidence", "blur_threshold")
+        }
+    }
+    return hashlib.sha1(json.dumps(payload, sort_keys=True, default=str).encode('utf-8')).hexdigest()[:16]
+
+def image_hash(image: np.ndarray) -> str:
+    """Hash dei pixel decodificati: stessa chiave per la copia nel DB e quella su disco"""
+    digest = hashlib.blake2b(digest_size=20)
+    digest.update(str(image.shape).encode('ascii'))
+    digest.update(np.ascontiguousarray(image).data)
+    return digest.hexdigest()
+
+def pack_faces(faces: List[Dict[str, Any]]) -> Dict[str, np.ndarray]:
+    """Volti validati (riquadro, confidence, blur, embeddings) come array per np.savez"""
+    arrays = {
+        "bboxes": np.array(
+            [[f['bbox']['x'], f['bbox']['y'], f['bbox']['w'], f['bbox']['h']] for f in faces],
+            dtype=np.int32
+        ).reshape(-1, 4),
+        "confidences": np.array([f.get('confidence', 0) for f in faces], dtype=np.float32),
+        "blur_scores": np.array([f.get('blur_score', 0) for f in faces], dtype=np.float32),
+        "embeddings": (np.stack([np.asarray(f['embedding'], dtype=np.float32) for f in faces])
+                       if faces else np.zeros((0, 0), dtype=np.float32))
+    }
+    if faces and all(f.get('embedding_secondary') is not None for f in faces):
+        arrays["secondary"] = np.stack(
+            [np.asarray(f['embedding_secondary'], dtype=np.float32) for f in faces]
+        )
+    return arrays
+
+def unpack_faces(data) -> List[Dict[str, Any]]:
+    """Volti nel formato di detect_faces da array prodotti da pack_faces"""
+    bboxes = data["bboxes"]
+    confidences = data["confidences"]
+    blur_scores = data["blur_scores"]
+    embeddings = data["embeddings"]
+    secondary = data["secondary"] if "secondary" in data.files else None
+
+    faces = []
+    for i in range(len(bboxes)):
+        x, y, w, h = (int(v) for v in bboxes[i])
+        face = {
+            'index': i,
+            'bbox': {'x': x, 'y': y, 'w': w, 'h': h},
+            'confidence': float(confidences[i]),
+            'embedding': embeddings[i].astype(np.float64),
+            'quality_score': w * h,
+            'blur_score': float(blur_scores[i])
+        }
+        if secondary is not None:
+            face['embedding_secondary'] = secondary[i].astype(np.float64)
+        faces.append(face)
+    return faces
+
+def save_arrays(path: str, arrays: Dict[str, np.ndarray]):
+    """np.savez con scrittura atomica: i lettori degli altri worker non vedono file parziali"""
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    try:
+        with open(tmp_path, 'wb') as f:
+            np.savez(f, **arrays)
+        os.replace(tmp_path, path)
+    except Exception:
+        try:
+            os.remove(tmp_path)
+        except OSError:
+            pass
+        raise
+
+class DetectionStore:
+    """Store su disco dei volti rilevati, condiviso dai worker (scrittura atomica per file)"""
+
+    def __init__(self, store_dir: str, max_bytes: int = 1024 * 1024 * 1024,
+                 retention_days: float = 180, sweep_every: int = 200):
+        self.store_dir = store_dir
+        self.max_bytes = max_bytes
+        self.retention_s = float(retention_days) * 86400
+        self.sweep_every = max(1, int(sweep_every))
+        self._writes_since_sweep = 0
+
+        self.stats = {"hits": 0, "misses": 0, "saved": 0, "evicted": 0, "failed": 0}
+
+        os.makedirs(self.store_dir, exist_ok=True)
+
+    def _path(self, fingerprint: str, key: str) -> str:
+        return os.path.join(self.store_dir, fingerprint, key[:2], f"{key}.npz")
+
+    def get(self, fingerprint: str, key: str) -> Optional[Tuple[List[Dict[str, Any]], int]]:
+        """(volti, volti grezzi del detector) salvati per l'immagine, None se assenti"""
+        path = self._path(fingerprint, key)
+        try:
+            with np.load(path, allow_pickle=False) as data:
+                faces = unpack_faces(data)
+                raw_faces = int(data["raw_faces"])
+        except FileNotFoundError:
+            self.stats["misses"] += 1
+            return None
+        except Exception as e:
+            # File troncato o di un formato diverso: si rileva di nuovo e si sovrascrive
+            logger.warning(f"⚠️ Rilevamento salvato illeggibile ({os.path.basename(path)}): {e}")
+            self.stats["misses"] += 1
+            return None
+
+        # Ultimo uso nel mtime: la quota elimina prima le immagini non più rianalizzate
+        try:
+            os.utime(path, None)
+        except OSError:
+            pass
+
+        self.stats["hits"] += 1
+        return faces, raw_faces
+
+    def put(self, fingerprint: str, key: str, faces: List[Dict[str, Any]], raw_faces: int):
+        """Salva i volti validati di un'immagine (errori di scrittura solo registrati)"""
+        path = self._path(fingerprint, key)
+        try:
+            save_arrays(path, {**pack_faces(faces), "raw_faces": np.array(raw_faces, dtype=np.int32)})
+            self.stats["saved"] += 1
+        except Exception as e:
+            self.stats["failed"] += 1
+            logger.warning(f"⚠️ Rilevamento non salvato ({os.path.basename(path)}): {e}")
+            return
+
+        self._writes_since_sweep += 1
+        if self._writes_since_sweep >= self.sweep_every:
+            self.sweep()
+
+    def sweep(self):
+        """Quota e retention su tutto lo store (tutte le impronte, file scritti da ogni worker)"""
+        self._writes_since_sweep = 0
+        files = []
+        for root, _, names in os.walk(self.store_dir):
+            for name in names:
+                path = os.path.join(root, name)
+                try:
+                    stat = os.stat(path)
+                except OSError:
+                    continue
+                files.append((stat.st_mtime, path, stat.st_size))
+
+        files.sort()
+        total = sum(size for _, _, size in files)
+        cutoff = time.time() - self.retention_s if self.retention_s > 0 else None
+        for mtime, path, size in files:
+            if total <= self.max_bytes and (cutoff is None or mtime >= cutoff):
+                break
+            try:
+                os.remove(path)
+                self.stats["evicted"] += 1
+            except OSError:
+                pass
+            total -= size
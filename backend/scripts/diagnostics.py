@@ -0,0 +1,98 @@
+"""
+Diagnostica a basso costo per i percorsi caldi (matching, embeddings, caricamento studenti)
+I record di dettaglio sono pigri: messaggio e argomenti vengono conservati così come sono in un
+ring buffer limitato e formattati solo al dump, cioè quando un'analisi fallisce o quando il
+trace è richiesto esplicitamente (config, richiesta del worker o --trace). Le righe per volto e
+per studente vanno nel log normale solo a campione.
+"""
+
+import time
+import logging
+from collections import deque
+from datetime import datetime
+from typing import List, Dict, Any, Tuple
+
+logger = logging.getLogger('FaceDetectionV4')
+
+class Diagnostics:
+    """Ring buffer di record pigri con logging campionato per chiave
+
+    Gli argomenti callable vengono valutati solo alla formattazione: usarli per valori costosi
+    (norme, elenchi di nomi) e catturare copie piccole, non matrici intere, perché il record
+    resta in memoria fino a quando il ring non lo scarta.
+    """
+
+    def __init__(self, diagnostics_config: Dict[str, Any]):
+        self.default_trace = bool(diagnostics_config.get("trace", False))
+        self.trace = self.default_trace
+        self.sample_first = max(0, int(diagnostics_config.get("sample_first", 10)))
+        self.sample_every = max(0, int(diagnostics_config.get("sample_every", 50)))
+        self.records: 'deque[Tuple[float, int, str, Tuple[Any, ...]]]' = deque(
+            maxlen=max(1, int(diagnostics_config.get("ring_size", 2000)))
+        )
+        self.evicted = 0
+        self._seen: Dict[str, int] = {}
+        self._logged: Dict[str, int] = {}
+
+    def reset(self, trace: bool = None):
+        """Nuova richiesta: svuota il ring e i contatori di campionamento"""
+        self.records.clear()
+        self.evicted = 0
+        self._seen.clear()
+        self._logged.clear()
+        self.trace = self.default_trace if trace is None else bool(trace)
+
+    def record(self, message: str, *args: Any, level: int = logging.DEBUG):
+        """Aggiunge un record senza formattarlo (con --debug viene anche scritto subito)"""
+        if len(self.records) == self.records.maxlen:
+            self.evicted += 1
+        self.records.append((time.time(), level, message, args))
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.log(level, self._format(message, args))
+
+    def sampled(self, key: str, message: str, *args: Any, level: int = logging.INFO):
+        """Registra il record e lo scrive nel log solo per i primi sample_first eventi di key,
+        poi uno ogni sample_every (le gallerie grandi non producono una riga per studente)"""
+        seen = self._seen.get(key, 0) + 1
+        self._seen[key] = seen
+        if seen <= self.sample_first or (self.sample_every > 0 and seen % self.sample_every == 0):
+            self._logged[key] = self._logged.get(key, 0) + 1
+            if len(self.records) == self.records.maxlen:
+                self.evicted += 1
+            self.records.append((time.time(), level, message, args))
+            if logger.isEnabledFor(level):
+                logger.log(level, self._format(message, args))
+        else:
+            self.record(message, *args, level=level)
+
+    def omitted(self, key: str) -> int:
+        """Eventi di key non scritti nel log (solo nel ring buffer)"""
+        return self._seen.get(key, 0) - self._logged.get(key, 0)
+
+    @staticmethod
+    def _format(message: str, args: Tuple[Any, ...]) -> str:
+        try:
+            values = tuple(arg() if callable(arg) else arg for arg in args)
+            return message % values if values else message
+        except Exception as e:
+            return f"{message} (formattazione fallita: {e})"
+
+    def lines(self, clear: bool = False) -> List[str]:
+        """Record formattati, dal più vecchio"""
+        lines = [
+            f"{datetime.fromtimestamp(ts).strftime('%H:%M:%S.%f')[:-3]} "
+            f"{logging.getLevelName(level)} {self._format(message, args)}"
+            for ts, level, message, args in self.records
+        ]
+        if clear:
+            self.records.clear()
+        return lines
+
+    def dump(self, reason: str, level: int = logging.ERROR):
+        """Scrive il contenuto del ring nel log in un unico messaggio"""
+        if not self.records:
+            return
+        header = f"🧾 Diagnostica ({reason}): ultimi {len(self.records)} record"
+        if self.evicted:
+            header += f", {self.evicted} più vecchi scartati"
+        logger.log(level, header + "\n" + "\n".join(self.lines()))
@@ -0,0 +1,355 @@
+"""
+Embedding Store persistente - livello su disco della cache embeddings
+File float32 memory-mapped + indice JSON per modello, condiviso tra processi worker
+
+
+Attivo con performance.enable_caching e performance.persistent_cache (TTL persistent_cache_ttl).
+Gli studenti iscritti hanno l'embedding su Users (enrollment); lo store evita l'inferenza per le
+foto senza embedding salvato e risolve i riferimenti per hash inviati dal backend anche dopo il
+riavvio di un worker o in un processo singolo.
+Invalidazione: la chiave contiene hash della foto e modello con variante di runtime (TF, ONNX,
+ONNX int8); l'indice registra l'impronta dei pesi del recognizer e un indice scritto con altri
+pesi (ONNX riesportato, aggiornamento DeepFace) non viene letto e viene azzerato alla scrittura.
+"""
+
+import os
+import json
+import time
+import logging
+from typing import Dict, Any, Optional, Tuple, Callable
+
+import numpy as np
+
+try:
+    import fcntl
+except ImportError:  # Windows: nessun lock inter-processo
+    fcntl = None
+
+logger = logging.getLogger('FaceDetectionV4')
+
+INDEX_VERSION = 1
+
+# Formato compatto degli embeddings conservati fuori dal processo (colonna Users, manifest):
+# righe little-endian senza intestazione, la dimensione si ricava dalla lunghezza.
+# int8: scala float32 della riga seguita dai valori quantizzati (x ≈ q * scala)
+EMBEDDING_DTYPES = {"float32": "<f4", "float16": "<f2", "int8": "i1"}
+
+def quantize_rows(matrix: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+    """Quantizzazione int8 simmetrica per riga: (valori int8, scale float32)"""
+    matrix = np.asarray(matrix, dtype=np.float32)
+    scales = np.abs(matrix).max(axis=-1) / 127.0
+    scales = np.where(scales > 0, scales, 1.0).astype(np.float32)
+    quantized = np.clip(np.rint(matrix / scales[..., None]), -127, 127).astype(np.int8)
+    return quantized, scales
+
+def encode_embedding(embedding: np.ndarray, dtype: str = "float32") -> bytes:
+    if dtype not in EMBEDDING_DTYPES:
+        raise ValueError(f"dtype embedding non supportato: {dtype}")
+    if dtype == "int8":
+        quantized, scale = quantize_rows(np.ravel(embedding))
+        return np.asarray(scale, dtype='<f4').tobytes() + quantized.tobytes()
+    return np.asarray(embedding, dtype=EMBEDDING_DTYPES[dtype]).tobytes()
+
+def decode_embedding(data: bytes, dtype: str = "float32") -> np.ndarray:
+    """Embedding float32 da byte prodotti da encode_embedding"""
+    if dtype not in EMBEDDING_DTYPES:
+        raise ValueError(f"dtype embedding non supportato: {dtype}")
+    if dtype == "int8":
+        scale = np.frombuffer(data, dtype='<f4', count=1)[0]
+        return np.frombuffer(data, dtype=np.int8, offset=4).astype(np.float32) * scale
+    return np.frombuffer(data, dtype=EMBEDDING_DTYPES[dtype]).astype(np.float32)
+
+class PersistentEmbeddingStore:
+    """Store embeddings su disco chiave (user_id, modello, hash foto) con TTL e limite in byte
+
+    Per ogni modello esistono:
+      - <modello>.index.json   indice {chiave: [riga, timestamp]} + file dati corrente
+      - <modello>.<gen>.f32    righe float32 contigue, lette via np.memmap
+    weights(modello) restituisce l'impronta dei pesi con cui vengono calcolati gli embeddings:
+    le entry scritte con un'impronta diversa sono ignorate.
+    La compattazione scrive una nuova generazione del file dati e poi sostituisce
+    l'indice in modo atomico, così i lettori non vedono mai indice e dati disallineati.
+    """
+
+    def __init__(self, store_dir: str, ttl_seconds: int = 3600,
+                 max_bytes: int = 256 * 1024 * 1024, refresh_interval: float = 1.0,
+                 weights: Optional[Callable[[str], str]] = None):
+        self.store_dir = store_dir
+        self.ttl = ttl_seconds
+        self.max_bytes = max_bytes
+        self.refresh_interval = refresh_interval
+        self._weights_fn = weights
+        self._weights: Dict[str, Optional[str]] = {}
+
+        self._states: Dict[str, Dict[str, Any]] = {}
+        self._pending: Dict[str, Dict[str, Tuple[np.ndarray, float]]] = {}
+
+        os.makedirs(self.store_dir, exist_ok=True)
+
+    # ------------------------------------------------------------------
+    # Percorsi e lock
+    # ------------------------------------------------------------------
+
+    @staticmethod
+    def _safe_name(model_name: str) -> str:
+        return "".join(c if c.isalnum() or c in '-_' else '_' for c in model_name)
+
+    def _index_path(self, model_name: str) -> str:
+        return os.path.join(self.store_dir, f"{self._safe_name(model_name)}.index.json")
+
+    def _lock_path(self, model_name: str) -> str:
+        return os.path.join(self.store_dir, f"{self._safe_name(model_name)}.lock")
+
+    def _data_path(self, data_file: str) -> str:
+        return os.path.join(self.store_dir, data_file)
+
+    def _acquire_lock(self, model_name: str):
+        handle = open(self._lock_path(model_name), 'a+')
+        if fcntl is not None:
+            fcntl.flock(handle.fileno(), fcntl.LOCK_EX)
+        return handle
+
+    @staticmethod
+    def _release_lock(handle):
+        if fcntl is not None:
+            fcntl.flock(handle.fileno(), fcntl.LOCK_UN)
+        handle.close()
+
+    @staticmethod
+    def _key(user_id: Any, photo_hash: str) -> str:
+        return f"{user_id}:{photo_hash}"
+
+    def _expected_weights(self, model_name: str) -> Optional[str]:
+        """Impronta dei pesi attuali del modello (calcolata una volta per processo)"""
+        if self._weights_fn is None:
+            return None
+        if model_name not in self._weights:
+            self._weights[model_name] = self._weights_fn(model_name)
+        return self._weights[model_name]
+
+    def _current(self, model_name: str, index: Dict[str, Any]) -> bool:
+        expected = self._expected_weights(model_name)
+        return expected is None or index.get('weights') == expected
+
+    # ------------------------------------------------------------------
+    # Lettura indice / memmap
+    # ------------------------------------------------------------------
+
+    def _read_index(self, model_name: str) -> Optional[Dict[str, Any]]:
+        path = self._index_path(model_name)
+        if not os.path.exists(path):
+            return None
+        try:
+            with open(path, 'r') as f:
+                index = json.load(f)
+            if index.get('version') != INDEX_VERSION:
+                logger.warning(f"⚠️ Indice embedding store versione {index.get('version')} ignorato")
+                return None
+            return index
+        except (OSError, ValueError) as e:
+            logger.warning(f"⚠️ Indice embedding store illeggibile ({e}), ricostruzione")
+            return None
+
+    def _open_matrix(self, index: Dict[str, Any]) -> Optional[np.ndarray]:
+        rows, dim = index['rows'], index['dim']
+        if rows == 0:
+            return None
+        data_path = self._data_path(index['data_file'])
+        available = os.path.getsize(data_path) // (dim * 4) if os.path.exists(data_path) else 0
+        if available < rows:
+            logger.warning(f"⚠️ File dati {index['data_file']} troncato ({available}/{rows} righe)")
+            rows = available
+        if rows == 0:
+            return None
+        return np.memmap(data_path, dtype=np.float32, mode='r', shape=(rows, dim))
+
+    def _state(self, model_name: str) -> Optional[Dict[str, Any]]:
+        """Stato in memoria del modello, ricaricato se l'indice su disco è cambiato"""
+        now = time.time()
+        state = self._states.get(model_name)
+        if state is not None and now - state['checked_at'] < self.refresh_interval:
+            return state
+
+        path = self._index_path(model_name)
+        try:
+            mtime_ns = os.stat(path).st_mtime_ns
+        except FileNotFoundError:
+            self._states.pop(model_name, None)
+            return None
+
+        if state is None or state['mtime_ns'] != mtime_ns:
+            index = self._read_index(model_name)
+            if index is None:
+                self._states.pop(model_name, None)
+                return None
+            state = {
+                'index': index,
+                'matrix': self._open_matrix(index),
+                'mtime_ns': mtime_ns
+            }
+            self._states[model_name] = state
+
+        state['checked_at'] = now
+        return state
+
+    # ------------------------------------------------------------------
+    # API
+    # ------------------------------------------------------------------
+
+    def get(self, user_id: Any, model_name: str, photo_hash: str) -> Optional[np.ndarray]:
+        """Embedding salvato per (utente, modello, hash foto) se presente e non scaduto"""
+        key = self._key(user_id, photo_hash)
+
+        pending = self._pending.get(model_name, {}).get(key)
+        if pending is not None:
+            return pending[0]
+
+        state = self._state(model_name)
+        if state is None or state['matrix'] is None or not self._current(model_name, state['index']):
+            return None
+
+        entry = state['index']['entries'].get(key)
+        if entry is None:
+            return None
+
+        row, timestamp = entry
+        if time.time() - timestamp >= self.ttl or row >= state['matrix'].shape[0]:
+            return None
+
+        return np.array(state['matrix'][row], dtype=np.float32)
+
+    def put(self, user_id: Any, model_name: str, photo_hash: str, embedding: np.ndarray):
+        """Accoda un embedding, scritto su disco alla prossima flush()"""
+        vector = np.ascontiguousarray(embedding, dtype=np.float32).ravel()
+        self._pending.setdefault(model_name, {})[self._key(user_id, photo_hash)] = (vector, time.time())
+
+    def flush(self):
+        """Scrive su disco tutti gli embeddings in attesa (un append + un indice per modello)"""
+        for model_name, pending in list(self._pending.items()):
+            if not pending:
+                continue
+            try:
+                self._flush_model(model_name, pending)
+                self._pending[model_name] = {}
+            except Exception as e:
+                logger.error(f"❌ Errore scrittura embedding store {model_name}: {e}")
+
+    def _flush_model(self, model_name: str, pending: Dict[str, Tuple[np.ndarray, float]]):
+        dim = len(next(iter(pending.values()))[0])
+        lock = self._acquire_lock(model_name)
+        try:
+            index = self._read_index(model_name)
+            stale = None
+            if index is not None and index['dim'] != dim:
+                logger.warning(f"⚠️ Dimensione embedding cambiata ({index['dim']} → {dim}), store {model_name} azzerato")
+                stale = index
+            elif index is not None and not self._current(model_name, index):
+                logger.warning(f"⚠️ Pesi del modello cambiati, store {model_name} azzerato")
+                stale = index
+            if index is None or stale is not None:
+                # Nuova generazione: il vecchio file può essere ancora mappato da altri worker
+                generation = stale.get('generation', 0) + 1 if stale else 0
+                index = {
+                    'version': INDEX_VERSION,
+                    'model': model_name,
+                    'weights': self._expected_weights(model_name),
+                    'dim': dim,
+                    'rows': 0,
+                    'generation': generation,
+                    'data_file': f"{self._safe_name(model_name)}.{generation}.f32",
+                    'entries': {}
+                }
+
+            vectors = [(key, vector, ts) for key, (vector, ts) in pending.items() if len(vector) == dim]
+            row_bytes = dim * 4
+
+            if (index['rows'] + len(vectors)) * row_bytes > self.max_bytes:
+                index = self._compact(model_name, index, reserve_rows=len(vectors))
+
+            data_path = self._data_path(index['data_file'])
+            with open(data_path, 'ab') as f:
+                # Scarta righe orfane di una scrittura interrotta prima dell'aggiornamento indice
+                f.truncate(index['rows'] * row_bytes)
+                f.seek(index['rows'] * row_bytes)
+                for key, vector, ts in vectors:
+                    f.write(vector.tobytes())
+                    index['entries'][key] = [index['rows'], ts]
+                    index['rows'] += 1
+
+            self._write_index(model_name, index)
+            self._states.pop(model_name, None)
+            if stale is not None:
+                try:
+                    os.unlink(self._data_path(stale['data_file']))
+                except OSError:
+                    pass
+
+            logger.debug(f"💾 Embedding store {model_name}: +{len(vectors)} righe ({index['rows']} totali)")
+        finally:
+            self._release_lock(lock)
+
+    def _compact(self, model_name: str, index: Dict[str, Any], reserve_rows: int = 0) -> Dict[str, Any]:
+        """Riscrive il file dati tenendo solo le entry valide più recenti entro il limite"""
+        dim = index['dim']
+        row_bytes = dim * 4
+        budget_rows = max(0, int(self.max_bytes * 0.75) // row_bytes - reserve_rows)
+
+        now = time.time()
+        live = [
+            (key, row, ts) for key, (row, ts) in index['entries'].items()
+            if now - ts < self.ttl and row < index['rows']
+        ]
+        live.sort(key=lambda item: item[2], reverse=True)
+        live = live[:budget_rows]
+
+        old_matrix = self._open_matrix(index)
+        generation = index.get('generation', 0) + 1
+        new_data_file = f"{self._safe_name(model_name)}.{generation}.f32"
+
+        entries = {}
+        with open(self._data_path(new_data_file), 'wb') as f:
+            for new_row, (key, row, ts) in enumerate(live):
+                f.write(np.asarray(old_matrix[row], dtype=np.float32).tobytes())
+                entries[key] = [new_row, ts]
+
+        old_data_file = index['data_file']
+        compacted = {
+            **index,
+            'rows': len(live),
+            'generation': generation,
+            'data_file': new_data_file,
+            'entries': entries
+        }
+        self._write_index(model_name, compacted)
+
+        # I lettori con il vecchio file mappato continuano a leggerlo finché non ricaricano l'indice
+        try:
+            os.unlink(self._data_path(old_data_file))
+        except OSError:
+            pass
+
+        logger.info(f"🧹 Embedding store {model_name} compattato: {len(index['entries'])} → {len(live)} entry")
+        return compacted
+
+    def _write_index(self, model_name: str, index: Dict[str, Any]):
+        path = self._index_path(model_name)
+        tmp_path = f"{path}.tmp.{os.getpid()}"
+        with open(tmp_path, 'w') as f:
+            json.dump(index, f)
+        os.replace(tmp_path, path)
+
+    def stats(self) -> Dict[str, Any]:
+        """Statistiche per modello (righe, byte su disco)"""
+        result = {}
+        for name in os.listdir(self.store_dir):
+            if not name.endswith('.index.json'):
+                continue
+            model = name[:-len('.index.json')]
+            index = self._read_index(model)
+            if index:
+                result[index['model']] = {
+                    'entries': len(index['entries']),
+                    'rows': index['rows'],
+                    'bytes': index['rows'] * index['dim'] * 4
+                }
+        return result
@@ -0,0 +1,72 @@
+// backend/scripts/enqueue_backfill.js
+// Accoda la rianalisi massiva delle lezioni (es. un intero semestre) con priorità backfill:
+// i job vengono eseguiti dal backend solo con slot liberi e non ritardano mai una lezione in corso.
+// Le lezioni con un'analisi già in coda vengono accorpate, rilanciare lo script non duplica il lavoro.
+//
+// Uso: node scripts/enqueue_backfill.js [--course <id>] [--from YYYY-MM-DD] [--to YYYY-MM-DD]
+const { QueryTypes } = require('sequelize');
+const { sequelize } = require('../src/config/database');
+const analysisQueueService = require('../src/services/analysisQueueService');
+
+function parseArgs(argv) {
+  const options = { courseId: null, from: null, to: null };
+  for (let i = 0; i < argv.length; i++) {
+    switch (argv[i]) {
+      case '--course': options.courseId = parseInt(argv[++i], 10); break;
+      case '--from': options.from = argv[++i]; break;
+      case '--to': options.to = argv[++i]; break;
+      default: throw new Error(`Opzione sconosciuta: ${argv[i]}`);
+    }
+  }
+  return options;
+}
+
+async function enqueueBackfill({ courseId, from, to }) {
+  const lessons = await sequelize.query(`
+    SELECT id, course_id, lesson_date
+    FROM "Lessons"
+    WHERE 1 = 1
+    ${courseId ? 'AND course_id = :courseId' : ''}
+    ${from ? 'AND lesson_date >= :from' : ''}
+    ${to ? 'AND lesson_date < (:to)::date + 1' : ''}
+    ORDER BY lesson_date
+  `, {
+    replacements: { courseId, from, to },
+    type: QueryTypes.SELECT
+  });
+
+  console.log(`📋 ${lessons.length} lezioni da rianalizzare`);
+
+  let coalesced = 0;
+  for (const lesson of lessons) {
+    const job = await analysisQueueService.enqueue({
+      type: 'lesson',
+      lessonId: lesson.id,
+      priority: 'backfill'
+    });
+    if (job.coalesced) coalesced++;
+  }
+
+  console.log(`✅ Accodate ${lessons.length - coalesced} lezioni (${coalesced} già in coda)`);
+  return { total: lessons.length, coalesced };
+}
+
+// CLI Usage
+if (require.main === module) {
+  let options;
+  try {
+    options = parseArgs(process.argv.slice(2));
+  } catch (error) {
+    console.error('💥 Errore:', error.message);
+    process.exit(1);
+  }
+
+  enqueueBackfill(options)
+    .then(() => process.exit(0))
+    .catch(error => {
+      console.error('💥 Errore:', error.message);
+      process.exit(1);
+    });
+}
+
+module.exports = { enqueueBackfill };
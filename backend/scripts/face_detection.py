@@ -4,17 +4,25 @@ Utilizza RetinaFace + Facenet512 per accuratezza 98%+
 Mantiene compatibilità con interfaccia esistente mentre migra gradualmente a BLOB-native
 """
 
+import time
+_MODULE_START = time.perf_counter()
+
 import os
 import cv2
 import numpy as np
 import json
 import sys
 import argparse
-import time
+import struct
 import hashlib
+import math
+from importlib import metadata
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime, timedelta
+from collections import OrderedDict
 from typing import List, Dict, Any, Optional, Tuple, Union
-from dataclasses import dataclass
+from contextlib import contextmanager
+from dataclasses import dataclass, field
 import logging
 import warnings
 
@@ -30,74 +38,195 @@ logging.basicConfig(
 )
 logger = logging.getLogger('FaceDetectionV4')
 
-try:
-    # Fix per compatibilità TensorFlow
-    import tensorflow as tf
-    if not hasattr(tf, 'keras'):
-        import keras
-        tf.keras = keras
-    
-    from deepface import DeepFace
-    
-    # Con DeepFace 0.0.93, non sono necessari workaround!
-    
-    logger.info("✅ DeepFace importato correttamente")
-except ImportError as e:
-    logger.error(f"❌ DeepFace non disponibile: {e}")
-    print(json.dumps({"error": "DeepFace non installato", "status": "critical_error"}))
-    sys.exit(1)
+from embedding_store import PersistentEmbeddingStore, encode_embedding, decode_embedding
+from gallery_file import PackedGallery, quantize_matrix, quantized_dot
+from ann_index import StudentAnnIndex, GalleryJournal, JournalTruncated
+from detection_store import DetectionStore, detection_fingerprint, image_hash
+from frame_gate import FrameGate
+from tiled_detection import TiledDetector, detect_tile_with, merge_detections
+from onnx_backend import OnnxModels
+from debug_writer import DebugArtifactWriter
+from diagnostics import Diagnostics
+from tracing import MetricsExporter, reset_peak_rss, peak_rss_mb, start_tracemalloc, tracemalloc_peak_mb
+
+# Tempi di avvio in ms (import framework, caricamento modelli) per --startup-profile
+STARTUP_PROFILE: Dict[str, float] = {
+    "light_imports_ms": (time.perf_counter() - _MODULE_START) * 1000
+}
+
+def load_deepface():
+    """Importa TensorFlow e DeepFace al primo utilizzo (--help, errori di config e
+    richieste senza rilevamento non pagano il caricamento dei framework)"""
+    if _LazyDeepFace.module is None:
+        try:
+            import_start = time.perf_counter()
+            # Fix per compatibilità TensorFlow
+            import tensorflow as tf
+            if not hasattr(tf, 'keras'):
+                import keras
+                tf.keras = keras
+            STARTUP_PROFILE["tensorflow_import_ms"] = (time.perf_counter() - import_start) * 1000
+            
+            import_start = time.perf_counter()
+            from deepface import DeepFace as deepface_module
+            STARTUP_PROFILE["deepface_import_ms"] = (time.perf_counter() - import_start) * 1000
+        except ImportError as e:
+            logger.error(f"❌ DeepFace non disponibile: {e}")
+            raise RuntimeError(f"DeepFace non installato: {e}") from e
+        
+        _LazyDeepFace.module = deepface_module
+        logger.info("✅ DeepFace importato correttamente")
+    return _LazyDeepFace.module
+
+class _LazyDeepFace:
+    """Segnaposto per DeepFace: il primo accesso a un attributo importa i framework"""
+    module = None
+    
+    def __getattr__(self, name):
+        return getattr(load_deepface(), name)
+
+DeepFace = _LazyDeepFace()
 
 @dataclass
 class PerformanceMetrics:
-    """Metriche di performance per monitoring"""
+    """Metriche di performance per monitoring: span per fase, contatori e memoria"""
     detection_time_ms: float = 0
     recognition_time_ms: float = 0
     total_time_ms: float = 0
     memory_peak_mb: float = 0
     cache_hit_rate: float = 0
     faces_processed: int = 0
+    detection_mode: str = "full_frame"
+    load_students_time_ms: float = 0
+    model_load_ms: float = 0
+    memory_peak_scope: str = "process"
+    tracemalloc_peak_mb: Optional[float] = None
+    frame_gate: Optional[Dict[str, Any]] = None
+    spans: List[Dict[str, Any]] = field(default_factory=list)
+    counters: Dict[str, int] = field(default_factory=dict)
+    trace_id: str = field(default_factory=lambda: os.urandom(16).hex())
+    started_ns: int = field(default_factory=time.time_ns)
+    _origin: float = field(default_factory=time.perf_counter, repr=False)
+    _open: List[int] = field(default_factory=list, repr=False)
+    
+    @contextmanager
+    def span(self, name: str, **attributes):
+        """Misura un blocco come figlio dello span aperto; il blocco riceve gli attributi
+        e può aggiungerne (conteggi noti solo alla fine)"""
+        record = {
+            "name": name,
+            "span_id": os.urandom(8).hex(),
+            "parent_id": self.spans[self._open[-1]]["span_id"] if self._open else None,
+            "start_ms": round((time.perf_counter() - self._origin) * 1000, 3),
+            "duration_ms": 0.0,
+            "attributes": attributes
+        }
+        self._open.append(len(self.spans))
+        self.spans.append(record)
+        start = time.perf_counter()
+        try:
+            yield attributes
+        except Exception as e:
+            record["error"] = str(e)
+            raise
+        finally:
+            record["duration_ms"] = round((time.perf_counter() - start) * 1000, 3)
+            self._open.pop()
+    
+    def add_span(self, name: str, duration_ms: float, **attributes):
+        """Span già misurato dal chiamante, terminato adesso (figlio dello span aperto)"""
+        end_ms = (time.perf_counter() - self._origin) * 1000
+        self.spans.append({
+            "name": name,
+            "span_id": os.urandom(8).hex(),
+            "parent_id": self.spans[self._open[-1]]["span_id"] if self._open else None,
+            "start_ms": round(max(0.0, end_ms - duration_ms), 3),
+            "duration_ms": round(duration_ms, 3),
+            "attributes": attributes
+        })
+    
+    def count(self, name: str, value: int = 1):
+        self.counters[name] = self.counters.get(name, 0) + value
+    
+    def stage_totals(self) -> Dict[str, float]:
+        """Durata per nome di span (le fasi ripetute, es. fallback, vengono sommate)"""
+        totals: Dict[str, float] = {}
+        for span in self.spans:
+            totals[span["name"]] = round(totals.get(span["name"], 0.0) + span["duration_ms"], 3)
+        return totals
     
 class EmbeddingCache:
-    """Cache intelligente per embeddings con TTL e versioning"""
+    """Cache embeddings a due livelli: LRU O(1) in memoria + store persistente su disco"""
     
-    def __init__(self, ttl_seconds: int = 3600, max_size: int = 1000):
-        self.cache: Dict[str, Tuple[np.ndarray, datetime, str]] = {}
-        self.ttl = timedelta(seconds=ttl_seconds)
+    def __init__(self, ttl_seconds: int = 3600, max_size: int = 1000,
+                 max_bytes: int = 64 * 1024 * 1024,
+                 store: Optional[PersistentEmbeddingStore] = None):
+        self.cache: 'OrderedDict[Tuple[Any, str, str], Tuple[np.ndarray, float]]' = OrderedDict()
+        self.ttl = ttl_seconds
         self.max_size = max_size
+        self.max_bytes = max_bytes
+        self.current_bytes = 0
+        self.store = store
         self.hits = 0
+        self.disk_hits = 0
         self.misses = 0
         
-    def _get_key(self, user_id: int, model_name: str) -> str:
+    def _get_key(self, user_id: int, model_name: str, photo_hash: str) -> Tuple[Any, str, str]:
         """Genera chiave univoca per cache"""
-        return f"{user_id}_{model_name}"
+        return (user_id, model_name, photo_hash)
     
     def get(self, user_id: int, model_name: str, photo_hash: str) -> Optional[np.ndarray]:
-        """Recupera embedding dalla cache se valido"""
-        key = self._get_key(user_id, model_name)
+        """Recupera embedding dalla cache (memoria, poi disco) se valido"""
+        key = self._get_key(user_id, model_name, photo_hash)
         
-        if key in self.cache:
-            embedding, timestamp, cached_hash = self.cache[key]
-            
-            # Verifica TTL e hash foto
-            if (datetime.now() - timestamp < self.ttl and 
-                cached_hash == photo_hash):
+        entry = self.cache.get(key)
+        if entry is not None:
+            embedding, timestamp = entry
+            if time.time() - timestamp < self.ttl:
+                self.cache.move_to_end(key)
                 self.hits += 1
                 logger.debug(f"Cache HIT per user {user_id}")
                 return embedding
+            self._evict(key)
+        
+        if self.store is not None:
+            embedding = self.store.get(user_id, model_name, photo_hash)
+            if embedding is not None:
+                self._insert(key, embedding)
+                self.hits += 1
+                self.disk_hits += 1
+                logger.debug(f"Cache HIT (disco) per user {user_id}")
+                return embedding
         
         self.misses += 1
         return None
     
     def set(self, user_id: int, model_name: str, embedding: np.ndarray, photo_hash: str):
-        """Salva embedding in cache"""
-        # Rimuovi vecchie entry se necessario
-        if len(self.cache) >= self.max_size:
-            oldest_key = min(self.cache.keys(), 
-                           key=lambda k: self.cache[k][1])
-            del self.cache[oldest_key]
+        """Salva embedding in cache (e nello store persistente se presente)"""
+        embedding = np.asarray(embedding, dtype=np.float32)
+        self._insert(self._get_key(user_id, model_name, photo_hash), embedding)
+        if self.store is not None:
+            self.store.put(user_id, model_name, photo_hash, embedding)
+    
+    def _insert(self, key: Tuple[Any, str, str], embedding: np.ndarray):
+        if key in self.cache:
+            self._evict(key)
+        self.cache[key] = (embedding, time.time())
+        self.current_bytes += embedding.nbytes
         
-        key = self._get_key(user_id, model_name)
-        self.cache[key] = (embedding, datetime.now(), photo_hash)
+        # Evizione LRU in O(1) per numero di entry e per byte
+        while self.cache and (len(self.cache) > self.max_size or self.current_bytes > self.max_bytes):
+            _, (evicted, _) = self.cache.popitem(last=False)
+            self.current_bytes -= evicted.nbytes
+    
+    def _evict(self, key: Tuple[Any, str, str]):
+        embedding, _ = self.cache.pop(key)
+        self.current_bytes -= embedding.nbytes
+    
+    def flush(self):
+        """Persiste su disco gli embeddings nuovi"""
+        if self.store is not None:
+            self.store.flush()
         
     def get_hit_rate(self) -> float:
         """Calcola hit rate della cache"""
@@ -106,13 +235,87 @@ class EmbeddingCache:
     
     def clear_expired(self):
         """Rimuovi entry scadute"""
-        now = datetime.now()
+        now = time.time()
         expired_keys = [
-            k for k, (_, timestamp, _) in self.cache.items()
+            k for k, (_, timestamp) in self.cache.items()
             if now - timestamp >= self.ttl
         ]
         for key in expired_keys:
-            del self.cache[key]
+            self._evict(key)
+
+class StudentGallery:
+    """Gallery studenti come matrice contigua pre-normalizzata con array paralleli id/metadati
+
+    storage_dtype "float16"/"int8" conserva le righe quantizzate (int8 con scala per riga) e
+    calcola le similarità a blocchi di block_rows righe: meno memoria per gallerie grandi.
+    """
+    
+    def __init__(self, students: List[Dict[str, Any]], storage_dtype: str = "float32",
+                 block_rows: int = 4096):
+        valid = [s for s in students if s.get('embedding') is not None]
+        dim = len(valid[0]['embedding']) if valid else 0
+        
+        skipped = [s for s in valid if len(s['embedding']) != dim]
+        if skipped:
+            logger.warning(f"⚠️ {len(skipped)} embeddings con dimensione diversa da {dim} esclusi dalla gallery")
+            valid = [s for s in valid if len(s['embedding']) == dim]
+        
+        self.students = valid
+        self.dim = dim
+        self.ids = np.array([s['id'] for s in valid])
+        
+        raw = np.empty((len(valid), dim), dtype=np.float32)
+        for i, s in enumerate(valid):
+            raw[i] = s['embedding']
+        self.norms = np.linalg.norm(raw, axis=1)
+        self.sq_norms = self.norms ** 2
+        self.storage_dtype = storage_dtype
+        self.block_rows = block_rows
+        self.matrix, self.scales = quantize_matrix(self.normalize_rows(raw), storage_dtype)
+        
+        for idx in np.flatnonzero(self.norms < 0.1):
+            logger.error(f"🚨 ZERO/NEAR-ZERO STUDENT EMBEDDING for {valid[idx]['name']}!")
+        
+        # Embeddings secondari (doppia verifica), allineati alle righe principali
+        self.has_secondary = np.array(
+            [s.get('embedding_secondary') is not None for s in valid], dtype=bool
+        )
+        self.secondary_matrix = None
+        if self.has_secondary.any():
+            sec_dim = len(next(s['embedding_secondary'] for s in valid if s.get('embedding_secondary') is not None))
+            secondary = np.zeros((len(valid), sec_dim), dtype=np.float32)
+            for i, s in enumerate(valid):
+                if self.has_secondary[i]:
+                    secondary[i] = s['embedding_secondary']
+            self.secondary_matrix = self.normalize_rows(secondary)
+    
+    def __len__(self) -> int:
+        return len(self.students)
+    
+    @staticmethod
+    def normalize_rows(matrix: np.ndarray) -> np.ndarray:
+        """Normalizza L2 ogni riga (righe nulle restano nulle)"""
+        norms = np.linalg.norm(matrix, axis=1, keepdims=True)
+        return np.ascontiguousarray(matrix / np.maximum(norms, 1e-12), dtype=np.float32)
+    
+    @property
+    def nbytes(self) -> int:
+        return self.matrix.nbytes + (self.scales.nbytes if self.scales is not None else 0)
+    
+    def score(self, face_matrix: np.ndarray, distance_metric: str = "cosine") -> Tuple[np.ndarray, np.ndarray]:
+        """Restituisce (similarità, distanza) di forma volti × studenti"""
+        if distance_metric == "cosine":
+            similarity = quantized_dot(self.normalize_rows(face_matrix), self.matrix, self.scales, self.block_rows)
+            distance = 1 - similarity
+        else:
+            # Euclidea: ||f - s||² = ||f||² + ||s||² - 2 f·s, con s = ||s|| · ŝ
+            face_matrix = face_matrix.astype(np.float32)
+            face_sq = np.sum(face_matrix ** 2, axis=1)
+            dots = quantized_dot(face_matrix, self.matrix, self.scales, self.block_rows) * self.norms[None, :]
+            sq_dist = face_sq[:, None] + self.sq_norms[None, :] - 2 * dots
+            distance = np.sqrt(np.maximum(sq_dist, 0))
+            similarity = 1 / (1 + distance)
+        return similarity, distance
 
 class FaceDetectionSystem:
     """Sistema Face Detection ottimizzato con RetinaFace + Facenet512"""
@@ -134,6 +337,14 @@ class FaceDetectionSystem:
         self.image_path = image_path
         self.students_data_path = students_data_path
         
+        # Frame corrente decodificato una sola volta e condiviso tra le fasi
+        self.current_image: Optional[np.ndarray] = None
+        self.last_report_bytes = b""
+        self.last_report_batch: List[bytes] = []
+        self._tiled_detector: Optional[TiledDetector] = None
+        self.unresolved_students: List[Any] = []
+        self.stale_enrollments: List[Any] = []
+        
         # Carica configurazione
         self.config = self._load_config(config_path)
         
@@ -148,32 +359,118 @@ class FaceDetectionSystem:
         self.output_dir = os.path.join(self.project_root, "temp", "face_output")
         self.debug_dir = os.path.join(self.project_root, "temp", "debug_detection")
         
+        # Modelli ONNX Runtime (models.inference.backend = "onnx"), caricati al primo uso
+        self.onnx_models = OnnxModels(self.config["models"].get("inference", {}), self.project_root)
+        
         # Solo se debug è abilitato
         if self.config["output"]["save_debug_images"]:
             os.makedirs(self.output_dir, exist_ok=True)
             os.makedirs(self.debug_dir, exist_ok=True)
         
-        # Inizializza cache
+        # Inizializza cache (memoria + store persistente condiviso tra esecuzioni)
+        perf_config = self.config["performance"]
+        embedding_store = None
+        if self.enable_caching and perf_config.get("persistent_cache", False):
+            store_dir = perf_config.get("persistent_cache_dir", os.path.join("temp", "embedding_store"))
+            if not os.path.isabs(store_dir):
+                store_dir = os.path.join(self.project_root, store_dir)
+            try:
+                embedding_store = PersistentEmbeddingStore(
+                    store_dir,
+                    ttl_seconds=perf_config.get("persistent_cache_ttl", perf_config["cache_duration"]),
+                    max_bytes=perf_config.get("persistent_cache_max_bytes", 256 * 1024 * 1024),
+                    weights=self._embedding_weights
+                )
+            except OSError as e:
+                logger.warning(f"⚠️ Embedding store non disponibile ({e}), solo cache in memoria")
+        
         self.embedding_cache = EmbeddingCache(
-            ttl_seconds=self.config["performance"]["cache_duration"],
-            max_size=self.config["performance"]["cache_max_size"]
+            ttl_seconds=perf_config["cache_duration"],
+            max_size=perf_config["cache_max_size"],
+            max_bytes=perf_config.get("cache_max_bytes", 64 * 1024 * 1024),
+            store=embedding_store
         )
         
         # Inizializza metriche
         self.metrics = PerformanceMetrics()
         
+        # Export delle metriche per fase (Prometheus / OpenTelemetry), analisi in attesa di export
+        self.metrics_exporter = MetricsExporter(
+            self.config["output"].get("metrics_export", {}),
+            self.project_root,
+            {"detector": self.detector_backend, "model": self.model_name}
+        )
+        self._pending_traces: List[Tuple[PerformanceMetrics, str]] = []
+        
+        # Dettaglio per volto/studente in ring buffer, scritto solo su errore o trace esplicito
+        self.diagnostics = Diagnostics(self.config["output"].get("diagnostics", {}))
+        
+        # Modelli di riconoscimento per l'inferenza batch (caricati al primo uso)
+        self._recognition_models: Dict[str, Tuple[Any, Tuple[int, int]]] = {}
+        
         # Debug mode per salvare immagini
         self.save_debug_faces = self.config["output"].get("save_debug_images", False)
         self.debug_faces_dir = os.path.join(self.project_root, "temp", "debug_faces")
         if self.save_debug_faces:
             os.makedirs(self.debug_faces_dir, exist_ok=True)
         
-        # Pre-carica modelli
-        try:
-            self._initialize_models()
-        except Exception as e:
-            logger.warning(f"⚠️ Pre-caricamento modelli parziale: {e}")
-            logger.info("ℹ️ I modelli verranno caricati al primo utilizzo")
+        # Artefatti di debug scritti da un thread dedicato, fuori dal percorso di analisi
+        self.debug_writer = DebugArtifactWriter(
+            self.config["output"].get("debug_writer", {}), [self.debug_faces_dir]
+        )
+        
+        # Report in memoria: "inline" lo disegna prima di restituire il risultato, "deferred"
+        # restituisce solo i dati per disegnarlo dopo (comando render_report)
+        self.report_mode = self.config["output"].get("report_mode", "inline")
+        self.last_report_format = '.jpg'
+        
+        # Galleria precalcolata in formato compatto (build-gallery), aperta via memmap al primo uso
+        self._packed_gallery: Optional[PackedGallery] = None
+        self._packed_gallery_mtime_ns = None
+        
+        # Indice ANN di tutti gli studenti per i volti fuori dalla galleria del corso (ann_index)
+        self.ann_config = self.config.get("ann_index", {})
+        self._ann_index: Optional[StudentAnnIndex] = None
+        self._ann_source = None
+        self._ann_journal: Optional[GalleryJournal] = None
+        if self.ann_config.get("enabled", False):
+            journal_path = self.ann_config.get("journal_path", os.path.join("temp", "gallery_journal.jsonl"))
+            if not os.path.isabs(journal_path):
+                journal_path = os.path.join(self.project_root, journal_path)
+            self._ann_journal = GalleryJournal(journal_path)
+        
+        # Volti ed embeddings per immagine su disco: una rianalisi "rematch" rifà solo il match
+        self.detection_store: Optional[DetectionStore] = None
+        self.rematch = False
+        store_config = self.config.get("detection_store", {})
+        if store_config.get("enabled", False):
+            store_dir = store_config.get("dir", os.path.join("temp", "detection_store"))
+            if not os.path.isabs(store_dir):
+                store_dir = os.path.join(self.project_root, store_dir)
+            try:
+                self.detection_store = DetectionStore(
+                    store_dir,
+                    max_bytes=int(store_config.get("max_bytes", 1024 * 1024 * 1024)),
+                    retention_days=store_config.get("retention_days", 180)
+                )
+            except OSError as e:
+                logger.warning(f"⚠️ Detection store non disponibile ({e}), rematch disabilitato")
+        
+        # Scatti periodici della stessa aula: scena invariata o cambiata solo in parte (frame_gate)
+        self.frame_gate: Optional[FrameGate] = None
+        self.frame_key: Optional[str] = None
+        gate_config = self.config.get("frame_gate", {})
+        if gate_config.get("enabled", False):
+            state_dir = gate_config.get("dir", os.path.join("temp", "frame_gate"))
+            if not os.path.isabs(state_dir):
+                state_dir = os.path.join(self.project_root, state_dir)
+            try:
+                self.frame_gate = FrameGate(gate_config, state_dir)
+            except OSError as e:
+                logger.warning(f"⚠️ Frame gate non disponibile ({e}), ogni scatto analizzato per intero")
+        
+        # Modelli caricati al primo rilevamento (o da warm_up() nel worker persistente)
+        self._models_ready = False
         
         logger.info(f"📊 Configurazione:")
         logger.info(f"   - Detector: {self.detector_backend}")
@@ -206,12 +503,43 @@ class FaceDetectionSystem:
                     "confidence_threshold": 0.5,
                     "target_size": [224, 224],
                     "enforce_detection": False,
-                    "align": True
+                    "align": True,
+                    "max_image_size": 2048,
+                    "tiling": {
+                        "enabled": False,
+                        "tile_size": 1280,
+                        "overlap": 0.25,
+                        "workers": 0,
+                        "nms_iou_threshold": 0.4,
+                        "containment_threshold": 0.7
+                    },
+                    "cascade": {
+                        "enabled": False,
+                        "proposal_backend": "opencv",
+                        "proposal_max_size": 1280,
+                        "proposal_min_confidence": 0.0,
+                        "padding": 0.6,
+                        "min_crop_size": 160,
+                        "max_proposals": 40,
+                        "max_coverage": 0.6,
+                        "fallback_on_empty": True,
+                        "nms_iou_threshold": 0.4,
+                        "containment_threshold": 0.7
+                    }
                 },
                 "recognizer": {
                     "model_name": "Facenet512",
                     "similarity_threshold": 0.28,
                     "distance_metric": "cosine"
+                },
+                "inference": {
+                    "backend": "tensorflow",
+                    "onnx_dir": "models/onnx",
+                    "quantized": False,
+                    "threads": 0,
+                    "detector": True,
+                    "recognizer": True,
+                    "detector_threshold": 0.9
                 }
             },
             "performance": {
@@ -219,102 +547,493 @@ class FaceDetectionSystem:
                 "enable_caching": True,
                 "cache_duration": 3600,
                 "cache_max_size": 1000,
+                "persistent_cache": True,
+                "persistent_cache_ttl": 604800,
+                "max_batch_size": 50,
+                "batch_prefetch": 2,
+                "batch_min_presence_ratio": 0.0,
                 "memory_limit_mb": 1024
             },
             "output": {
                 "save_debug_images": False,
                 "structured_logging": True,
-                "include_confidence_map": True
+                "include_confidence_map": True,
+                "report_format": "jpeg",
+                "report_mode": "inline",
+                "metrics_export": {
+                    "prometheus_file": None,
+                    "otel_file": None,
+                    "tracemalloc": False
+                },
+                "diagnostics": {
+                    "trace": False,
+                    "ring_size": 2000,
+                    "sample_first": 10,
+                    "sample_every": 50
+                },
+                "debug_writer": {
+                    "queue_size": 256,
+                    "drop_policy": "drop_newest",
+                    "max_disk_bytes": 536870912,
+                    "retention_hours": 72,
+                    "sweep_interval_s": 300,
+                    "flush_timeout_s": 10
+                }
+            },
+            "enrollment": {
+                "embedding_dtype": "float16",
+                "min_face_confidence": 0.9,
+                "reject_multiple_faces": False
+            },
+            "gallery": {
+                "path": None,
+                "storage_dtype": "float32",
+                "block_rows": 4096
+            },
+            "ann_index": {
+                "enabled": False,
+                "backend": "auto",
+                "journal_path": "temp/gallery_journal.jsonl",
+                "M": 32,
+                "ef_construction": 200,
+                "ef_search": 64,
+                "top_k": 2,
+                "min_similarity": None,
+                "journal_compact_bytes": 4194304,
+                "journal_retention_hours": 24
+            },
+            "detection_store": {
+                "enabled": False,
+                "dir": "temp/detection_store",
+                "max_bytes": 1073741824,
+                "retention_days": 180
+            },
+            "frame_gate": {
+                "enabled": False,
+                "dir": "temp/frame_gate",
+                "grid": [32, 18],
+                "cell_threshold": 12,
+                "max_hash_distance": 6,
+                "skip_changed_ratio": 0.02,
+                "partial_max_ratio": 0.35,
+                "region_padding_cells": 1,
+                "min_region_size": 160,
+                "max_consecutive_skips": 10,
+                "max_age_s": 600
             }
         }
     
+    def warm_up(self):
+        """Carica framework e modelli una sola volta (idempotente)"""
+        if self._models_ready:
+            return
+        try:
+            self._initialize_models()
+        except Exception as e:
+            logger.warning(f"⚠️ Pre-caricamento modelli parziale: {e}")
+            logger.info("ℹ️ I modelli verranno caricati al primo utilizzo")
+        self._models_ready = True
+        # Indice costruito all'avvio del worker, non alla prima analisi con volti sconosciuti
+        self._get_ann_index()
+    
+    def _ensure_models(self):
+        """warm_up() misurato come span model_load se i modelli non sono ancora in memoria"""
+        if self._models_ready:
+            return
+        load_start = time.perf_counter()
+        with self.metrics.span("model_load"):
+            self.warm_up()
+        self.metrics.model_load_ms += (time.perf_counter() - load_start) * 1000
+    
+    def _new_metrics(self) -> PerformanceMetrics:
+        """Metriche di una nuova analisi, con picco RSS (e tracemalloc se abilitato) azzerati"""
+        metrics = PerformanceMetrics()
+        metrics.memory_peak_scope = "request" if reset_peak_rss() else "process"
+        if self.metrics_exporter.tracemalloc:
+            start_tracemalloc()
+        return metrics
+    
+    def _finish_metrics(self, status: str):
+        """Chiude le metriche dell'analisi corrente: memoria di picco e accodamento per l'export"""
+        self.metrics.memory_peak_mb = peak_rss_mb()
+        if self.metrics_exporter.tracemalloc:
+            self.metrics.tracemalloc_peak_mb = tracemalloc_peak_mb()
+        if self.metrics_exporter.enabled:
+            self._pending_traces.append((self.metrics, status))
+    
+    def export_metrics(self, serialize_ms: Optional[float] = None):
+        """Esporta le analisi completate dall'ultimo export (no-op senza output.metrics_export)
+        
+        serialize_ms: serializzazione e scrittura della risposta misurate dal chiamante, dopo
+        che il risultato è già stato prodotto; diventa lo span "serialize" dell'ultima analisi
+        """
+        traces, self._pending_traces = self._pending_traces, []
+        if traces and serialize_ms is not None:
+            traces[-1][0].add_span("serialize", serialize_ms)
+        self.metrics_exporter.export(traces)
+    
     def _initialize_models(self):
-        """Pre-carica modelli per evitare latenza al primo uso"""
+        """Pre-carica modelli con warm-up su array in memoria (nessun file temporaneo)"""
         try:
-            init_start = time.time()
+            init_start = time.perf_counter()
+            if self.requires_deepface():
+                load_deepface()
             logger.info("🔄 Pre-caricamento modelli...")
             
-            # Crea dummy image file per warm-up (workaround per numpy array issues)
-            import tempfile
             dummy_img = np.zeros((224, 224, 3), dtype=np.uint8)
             dummy_img[50:150, 50:150] = 255  # Quadrato bianco
             
-            with tempfile.NamedTemporaryFile(suffix='.jpg', delete=False) as tmp:
-                cv2.imwrite(tmp.name, dummy_img)
-                dummy_path = tmp.name
-            
+            # Pre-carica detector
+            logger.info(f"   Loading {self.detector_backend} detector...")
+            step_start = time.perf_counter()
             try:
-                # Pre-carica detector
-                logger.info(f"   Loading {self.detector_backend} detector...")
+                self._detector_engine(self.detector_backend).extract_faces(
+                    img_path=dummy_img,
+                    detector_backend=self.detector_backend,
+                    enforce_detection=False
+                )
+                logger.info(f"   ✅ {self.detector_backend} pronto")
+            except Exception as e:
+                logger.warning(f"⚠️ {self.detector_backend} ha problemi: {e}")
+                # Prova MTCNN come alternativa di alta qualità
                 try:
+                    logger.info("🔄 Tentativo con MTCNN (alta precisione)...")
                     DeepFace.extract_faces(
-                        img_path=dummy_path,
-                        detector_backend=self.detector_backend,
+                        img_path=dummy_img,
+                        detector_backend='mtcnn',
                         enforce_detection=False
                     )
-                    logger.info(f"   ✅ {self.detector_backend} pronto")
-                except Exception as e:
-                    logger.warning(f"⚠️ {self.detector_backend} ha problemi: {e}")
-                    # Prova MTCNN come alternativa di alta qualità
-                    try:
-                        logger.info("🔄 Tentativo con MTCNN (alta precisione)...")
-                        DeepFace.extract_faces(
-                            img_path=dummy_path,
-                            detector_backend='mtcnn',
-                            enforce_detection=False
-                        )
-                        self.detector_backend = 'mtcnn'
-                        logger.info("✅ MTCNN pronto - usando come detector principale")
-                    except:
-                        logger.error(f"❌ Nessun detector di alta precisione disponibile")
-                        raise Exception(f"Nessun detector di alta precisione disponibile")
-                
-                # Pre-carica recognition model
-                logger.info(f"   Loading {self.model_name} model...")
-                try:
+                    self.detector_backend = 'mtcnn'
+                    logger.info("✅ MTCNN pronto - usando come detector principale")
+                except:
+                    logger.error(f"❌ Nessun detector di alta precisione disponibile")
+                    raise Exception(f"Nessun detector di alta precisione disponibile")
+            STARTUP_PROFILE["detector_load_ms"] = (time.perf_counter() - step_start) * 1000
+            
+            # Pre-carica recognition model
+            logger.info(f"   Loading {self.model_name} model...")
+            step_start = time.perf_counter()
+            try:
+                if self.onnx_models.recognizer(self.model_name) is not None:
+                    self._generate_embedding(dummy_img, self.model_name)
+                else:
                     DeepFace.represent(
-                        img_path=dummy_path,
+                        img_path=dummy_img,
                         model_name=self.model_name,
                         enforce_detection=False,
                         detector_backend="skip"
                     )
-                    logger.info(f"   ✅ {self.model_name} pronto")
-                except Exception as e:
-                    logger.warning(f"⚠️ {self.model_name} pre-caricamento fallito: {e}")
-                    logger.info("   Il modello verrà caricato al primo uso")
-            finally:
-                # Cleanup dummy file
-                if os.path.exists(dummy_path):
-                    os.unlink(dummy_path)
+                logger.info(f"   ✅ {self.model_name} pronto")
+            except Exception as e:
+                logger.warning(f"⚠️ {self.model_name} pre-caricamento fallito: {e}")
+                logger.info("   Il modello verrà caricato al primo uso")
+            STARTUP_PROFILE["recognizer_load_ms"] = (time.perf_counter() - step_start) * 1000
             
             # Se abilitata doppia verifica, carica anche modello secondario
             if self.config["models"].get("verification", {}).get("enable_double_check", False):
                 secondary_model = self.config["models"]["verification"]["secondary_model"]
                 logger.info(f"   Loading {secondary_model} (verification)...")
-                with tempfile.NamedTemporaryFile(suffix='.jpg', delete=False) as tmp2:
-                    cv2.imwrite(tmp2.name, dummy_img)
-                    dummy_path2 = tmp2.name
+                step_start = time.perf_counter()
                 try:
-                    DeepFace.represent(
-                        img_path=dummy_path2,
-                        model_name=secondary_model,
-                        enforce_detection=False,
-                        detector_backend="skip"
-                    )
+                    if self.onnx_models.recognizer(secondary_model) is not None:
+                        self._generate_embedding(dummy_img, secondary_model)
+                    else:
+                        DeepFace.represent(
+                            img_path=dummy_img,
+                            model_name=secondary_model,
+                            enforce_detection=False,
+                            detector_backend="skip"
+                        )
                     logger.info(f"   ✅ {secondary_model} pronto")
                 except Exception as e:
                     logger.warning(f"⚠️ {secondary_model} pre-caricamento fallito: {e}")
-                finally:
-                    if os.path.exists(dummy_path2):
-                        os.unlink(dummy_path2)
+                STARTUP_PROFILE["secondary_load_ms"] = (time.perf_counter() - step_start) * 1000
             
-            init_time = (time.time() - init_start) * 1000
+            init_time = (time.perf_counter() - init_start) * 1000
+            STARTUP_PROFILE["models_total_ms"] = init_time
             logger.info(f"✅ Modelli inizializzati in {init_time:.0f}ms")
             
         except Exception as e:
             logger.error(f"❌ Errore inizializzazione modelli: {e}")
             raise
     
+    def requires_deepface(self) -> bool:
+        """True se con la configurazione corrente qualche fase usa ancora DeepFace/TensorFlow"""
+        if self.detector_backend != "retinaface" or self.onnx_models.detector() is None:
+            return True
+        if self.config["models"]["detector"].get("cascade", {}).get("enabled", False):
+            return True
+        models = [self.model_name]
+        verification = self.config["models"].get("verification", {})
+        if verification.get("enable_double_check", False):
+            models.append(verification["secondary_model"])
+        return any(self.onnx_models.recognizer(model) is None for model in models)
+    
+    def _detector_engine(self, backend: str):
+        """Motore con l'interfaccia di DeepFace.extract_faces: RetinaFace ONNX se configurato"""
+        if backend == "retinaface":
+            onnx_detector = self.onnx_models.detector()
+            if onnx_detector is not None:
+                return onnx_detector
+        return DeepFace
+    
+    def _embedding_cache_model(self) -> str:
+        """Nome modello per la cache: embeddings ONNX/int8 separati da quelli TensorFlow"""
+        variant = self.onnx_models.variant(self.model_name)
+        return f"{self.model_name}-{variant}" if variant else self.model_name
+    
+    def _embedding_weights(self, cache_model: str) -> str:
+        """Impronta dei pesi del recognizer per lo store persistente: file ONNX (nome, dimensione,
+        mtime) o versione di DeepFace, così un modello riesportato non riusa embeddings vecchi"""
+        onnx_model = self.onnx_models.recognizer(self.model_name)
+        if onnx_model is not None:
+            stat = os.stat(onnx_model.model_path)
+            return f"{os.path.basename(onnx_model.model_path)}:{stat.st_size}:{stat.st_mtime_ns}"
+        try:
+            return f"deepface-{metadata.version('deepface')}"
+        except metadata.PackageNotFoundError:
+            return "deepface"
+    
+    def _get_packed_gallery(self) -> Optional[PackedGallery]:
+        """Galleria compatta della config (gallery.path), riaperta se il file è stato sostituito;
+        None se assente, illeggibile o calcolata con un altro modello"""
+        path = self.config.get("gallery", {}).get("path")
+        if not path:
+            return None
+        if not os.path.isabs(path):
+            path = os.path.join(self.project_root, path)
+        try:
+            mtime_ns = os.stat(path).st_mtime_ns
+        except OSError:
+            self._packed_gallery = None
+            return None
+        
+        if self._packed_gallery_mtime_ns != mtime_ns:
+            self._packed_gallery_mtime_ns = mtime_ns
+            self._packed_gallery = None
+            try:
+                gallery = PackedGallery.open(path)
+            except (OSError, ValueError) as e:
+                logger.warning(f"⚠️ Galleria {path} non utilizzabile: {e}")
+                return None
+            if gallery.model != self._embedding_cache_model():
+                logger.warning(f"⚠️ Galleria {path} calcolata con {gallery.model}, "
+                               f"modello attuale {self._embedding_cache_model()}: ignorata")
+                return None
+            logger.info(f"🗂️ Galleria {os.path.basename(path)}: {len(gallery)} studenti, "
+                        f"{gallery.dim}×{gallery.dtype} ({gallery.nbytes / 1024 / 1024:.1f}MB)")
+            self._packed_gallery = gallery
+        return self._packed_gallery
+    
+    def _get_ann_index(self) -> Optional[StudentAnnIndex]:
+        """Indice ANN aggiornato: ricaricato se la galleria compatta è cambiata (o il journal è
+        stato compattato da un altro worker), poi allineato alle voci del journal scritte nel
+        frattempo (anche da altri processi)"""
+        if self._ann_journal is None:
+            return None
+        
+        packed = self._get_packed_gallery()
+        source = (packed.source, packed.header.get('created_at')) if packed is not None else None
+        if self._ann_index is not None and self._ann_source == source:
+            try:
+                self._ann_journal.apply(self._ann_index, self._ann_journal.read_new(), since=self._ann_since())
+                self._maybe_snapshot_ann()
+                return self._ann_index
+            except JournalTruncated:
+                logger.info("🧭 Journal indice ANN compattato da un altro worker, ricarico lo snapshot")
+        
+        self._ann_index = self._load_ann_index(packed, source)
+        self._ann_source = source
+        return self._ann_index
+    
+    def _ann_snapshot_path(self) -> str:
+        packed = self._packed_gallery
+        return f"{packed.source}.ann" if packed is not None else f"{self._ann_journal.path}.ann"
+    
+    def _load_ann_index(self, packed: Optional[PackedGallery], source: Any) -> StudentAnnIndex:
+        """Snapshot salvato (galleria + journal fino al suo offset) oppure ricostruzione dalla
+        galleria compatta; poi le voci del journal successive"""
+        start = time.perf_counter()
+        model = self._embedding_cache_model()
+        snapshot_source = list(source) if source is not None else None
+        journal = self._ann_journal
+        applied = 0
+        
+        for _ in range(3):
+            index = StudentAnnIndex.load(self._ann_snapshot_path(), model, self.ann_config, snapshot_source)
+            rebuilt = index is None
+            if rebuilt:
+                index = StudentAnnIndex(model, self.ann_config)
+                if packed is not None and len(packed) > 0:
+                    # Righe già normalizzate: basta de-quantizzarle, a blocchi
+                    for first in range(0, len(packed), 4096):
+                        rows = packed.matrix[first:first + 4096].astype(np.float32)
+                        if packed.scales is not None:
+                            rows *= packed.scales[first:first + 4096, None]
+                        index.upsert(packed.ids[first:first + 4096], rows, packed.photo_hashes[first:first + 4096])
+                journal.rewind()
+                if journal.base > 0:
+                    logger.warning(f"⚠️ Indice ANN ricostruito senza snapshot: le voci del journal "
+                                   f"prima dell'offset {journal.base} sono già state compattate")
+            else:
+                journal.offset = index.journal_offset
+            try:
+                applied = journal.apply(index, journal.read_new(), since=self._ann_since())
+                break
+            except JournalTruncated:
+                # Snapshot e compattazione più recenti salvati nel frattempo da un altro worker
+                continue
+        else:
+            logger.warning("⚠️ Indice ANN caricato senza le ultime voci del journal (compattazioni concorrenti)")
+        
+        logger.info(f"🧭 Indice ANN {index.backend_in_use}: {len(index)} studenti "
+                    f"({applied} aggiornamenti dal journal) in {(time.perf_counter() - start) * 1000:.0f}ms")
+        if rebuilt:
+            self._snapshot_ann(index, snapshot_source)
+        return index
+    
+    def _maybe_snapshot_ann(self):
+        """Nuovo snapshot quando il journal da rileggere all'avvio supera journal_compact_bytes"""
+        compact_bytes = int(self.ann_config.get("journal_compact_bytes", 4 * 1024 * 1024))
+        if self._ann_journal.offset - self._ann_index.journal_offset >= compact_bytes:
+            source = list(self._ann_source) if self._ann_source is not None else None
+            self._snapshot_ann(self._ann_index, source)
+    
+    def _snapshot_ann(self, index: StudentAnnIndex, source: Any):
+        """Salva l'indice con l'offset del journal e compatta il journal a quell'offset
+        (sotto lock: nessun append nel frattempo, snapshot mai sostituito da uno più vecchio)"""
+        journal = self._ann_journal
+        path = self._ann_snapshot_path()
+        retention_s = float(self.ann_config.get("journal_retention_hours", 24)) * 3600
+        try:
+            with journal.locked():
+                journal.apply(index, journal.read_new(), since=self._ann_since())
+                saved = StudentAnnIndex.saved_offset(path, source)
+                if saved is not None and saved >= journal.offset:
+                    index.journal_offset = journal.offset
+                elif not index.save(path, source, journal_offset=journal.offset):
+                    # Indice ancora vuoto: niente da salvare, nessuna compattazione
+                    index.journal_offset = journal.offset
+                    return
+                # Le voci recenti restano per una galleria compatta ancora in costruzione
+                removed = journal.compact(journal.offset, max(self._ann_since(), time.time() - retention_s))
+            if removed:
+                logger.info(f"🧭 Journal indice ANN compattato: {removed / 1024:.0f}KB rimossi "
+                            f"(snapshot all'offset {journal.offset})")
+        except JournalTruncated:
+            # Indice di questo worker superato da uno snapshot più recente: la prossima lettura
+            # del journal solleva di nuovo JournalTruncated e lo ricarica
+            pass
+        except OSError as e:
+            logger.warning(f"⚠️ Snapshot indice ANN non salvato in {path}: {e}")
+    
+    def _ann_since(self) -> float:
+        """Le voci del journal anteriori alla galleria compatta sono già incluse nella galleria"""
+        packed = self._packed_gallery
+        return float(packed.header.get('created_at', 0)) if packed is not None else 0.0
+    
+    def _index_embeddings(self, entries: List[Tuple[Any, np.ndarray, str]]):
+        """Registra nel journal gli embeddings nuovi o cambiati (user_id, embedding, hash foto)"""
+        index = self._get_ann_index()
+        if index is None:
+            return
+        model = self._embedding_cache_model()
+        changed = [
+            GalleryJournal.upsert_entry(user_id, model, embedding, photo_hash)
+            for user_id, embedding, photo_hash in entries
+            if user_id is not None and index.photo_hashes.get(user_id, '') != photo_hash
+        ]
+        if not changed:
+            return
+        try:
+            self._ann_journal.append(changed)
+            self._get_ann_index()
+        except OSError as e:
+            logger.warning(f"⚠️ Journal indice ANN non aggiornato: {e}")
+    
+    def ann_index_size(self) -> int:
+        return len(self._ann_index) if self._ann_index is not None else 0
+    
+    def remove_from_index(self, user_ids: List[Any]) -> int:
+        """Toglie gli studenti dall'indice di tutti i worker (voce di rimozione nel journal)"""
+        index = self._get_ann_index()
+        if index is None or not user_ids:
+            return 0
+        self._ann_journal.append([GalleryJournal.remove_entry(user_id) for user_id in user_ids])
+        self._get_ann_index()
+        return len(user_ids)
+    
+    def identify_guests(self, faces: List[Dict[str, Any]], recognized: List[Dict[str, Any]],
+                        students: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+        """Volti non riconosciuti nella galleria del corso cercati nell'indice di tutti gli studenti
+        
+        Un volto è attribuito a uno studente esterno al corso se il suo vicino più prossimo supera
+        la soglia (ann_index.min_similarity, altrimenti quella del riconoscitore con metrica
+        coseno) con il margine minimo della verifica; se il vicino è uno studente del corso il
+        volto resta non riconosciuto.
+        """
+        index = self._get_ann_index()
+        if index is None or len(index) == 0:
+            return []
+        
+        matched_faces = {r['faceIndex'] for r in recognized}
+        candidates = [f for f in faces if f['index'] not in matched_faces and f.get('embedding') is not None]
+        if not candidates:
+            return []
+        
+        threshold = self.ann_config.get("min_similarity")
+        if threshold is None:
+            if self.config["models"]["recognizer"].get("distance_metric", "cosine") != "cosine":
+                logger.warning("⚠️ Indice ANN: impostare ann_index.min_similarity con metrica non coseno")
+                return []
+            threshold = self.similarity_threshold
+        min_margin = self.config["models"].get("verification", {}).get("min_confidence_margin", 0.05)
+        course_ids = {s['id'] for s in students}
+        
+        with self.metrics.span("guest_search", faces=len(candidates), indexed=len(index),
+                               backend=index.backend_in_use) as search_span:
+            hits = index.search(
+                np.asarray([f['embedding'] for f in candidates], dtype=np.float32),
+                k=max(2, int(self.ann_config.get("top_k", 2)))
+            )
+            
+            guests = []
+            taken = set()
+            # I volti più sicuri scelgono per primi
+            order = sorted(range(len(candidates)), key=lambda i: -(hits[i][0][1] if hits[i] else -1))
+            for i in order:
+                if not hits[i]:
+                    continue
+                user_id, similarity = hits[i][0]
+                if user_id in course_ids or user_id in taken or similarity <= threshold:
+                    continue
+                if len(hits[i]) > 1 and similarity - hits[i][1][1] < min_margin:
+                    continue
+                taken.add(user_id)
+                guests.append({
+                    'userId': user_id,
+                    'confidence': similarity,
+                    'faceIndex': candidates[i]['index']
+                })
+                self.diagnostics.sampled(
+                    "guest", "🧭 Volto %d: studente esterno al corso ID %s - confidence %.3f",
+                    candidates[i]['index'] + 1, user_id, similarity
+                )
+            search_span["guests"] = len(guests)
+        
+        self.metrics.count("guests_recognized", len(guests))
+        if guests:
+            logger.info(f"🧭 Studenti esterni al corso riconosciuti: {len(guests)}")
+        return guests
+    
+    def _build_gallery(self, students: List[Dict[str, Any]]) -> StudentGallery:
+        gallery_config = self.config.get("gallery", {})
+        return StudentGallery(
+            students,
+            storage_dtype=gallery_config.get("storage_dtype", "float32"),
+            block_rows=int(gallery_config.get("block_rows", 4096))
+        )
+    
     def _calculate_photo_hash(self, photo_data: Union[str, bytes, np.ndarray]) -> str:
         """Calcola hash univoco per foto (per cache invalidation)"""
         if isinstance(photo_data, str):
@@ -331,337 +1050,847 @@ class FaceDetectionSystem:
             
         return hashlib.md5(data).hexdigest()
     
-    def load_students(self) -> List[Dict[str, Any]]:
-        """Carica studenti con generazione batch embeddings"""
-        if not self.students_data_path or not os.path.exists(self.students_data_path):
-            logger.warning("⚠️ Nessun file studenti trovato")
-            return []
+    def load_students(self, students: Optional[List[Dict[str, Any]]] = None) -> List[Dict[str, Any]]:
+        """Carica studenti con generazione batch embeddings (da JSON legacy o manifest in memoria)"""
+        self.unresolved_students = []
+        self.stale_enrollments = []
+        
+        if students is None:
+            if not self.students_data_path or not os.path.exists(self.students_data_path):
+                logger.warning("⚠️ Nessun file studenti trovato")
+                return []
+            source = self.students_data_path
+        else:
+            source = "manifest in memoria"
         
         logger.info(f"\n{'='*60}")
         logger.info(f"🎓 CARICAMENTO STUDENTI")
-        logger.info(f"📂 File: {self.students_data_path}")
+        logger.info(f"📂 Sorgente: {source}")
         logger.info(f"{'='*60}")
         
         try:
             load_start = time.time()
             
-            with open(self.students_data_path, 'r', encoding='utf-8') as f:
-                students = json.load(f)
+            if students is None:
+                with open(self.students_data_path, 'r', encoding='utf-8') as f:
+                    students = json.load(f)
             
-            logger.info(f"👥 Caricati {len(students)} studenti dal JSON")
+            logger.info(f"👥 Caricati {len(students)} studenti")
             
             # Prepara batch per embedding generation
             valid_students = []
             embeddings_to_generate = []
+            packed_gallery = self._get_packed_gallery()
             
             for student in students:
-                if 'photoPath' not in student or not os.path.exists(student['photoPath']):
+                # Foto inline (manifest binario) oppure file su disco (legacy)
+                photo_bytes = student.pop('photo_bytes', None)
+                if photo_bytes is None and student.get('photoPath') and os.path.exists(student['photoPath']):
+                    # Legge la foto una sola volta: stessi byte per hash e decodifica
+                    with open(student['photoPath'], 'rb') as f:
+                        photo_bytes = f.read()
+                
+                if photo_bytes is None and not student.get('photo_hash'):
                     logger.warning(f"⚠️ Foto mancante per {student.get('name', 'Unknown')}")
                     continue
                 
-                # Calcola hash foto per cache validation
-                photo_hash = self._calculate_photo_hash(student['photoPath'])
+                # Calcola hash foto per cache validation (senza foto: riferimento a embedding in cache)
+                photo_hash = self._calculate_photo_hash(photo_bytes) if photo_bytes is not None else student['photo_hash']
                 student['photo_hash'] = photo_hash
                 
+                # Riga della galleria compatta calcolata dalla stessa foto: nessuna decodifica
+                row = packed_gallery.find(student['id'], photo_hash) if packed_gallery is not None else None
+                if row is not None:
+                    student.pop('embedding_bytes', None)
+                    student.pop('embedding_meta', None)
+                    student['embedding'] = packed_gallery.vector(row)
+                    student['embedding_cached'] = True
+                    student['embedding_source'] = 'gallery'
+                    valid_students.append(student)
+                    continue
+                
+                # Embedding calcolato all'iscrizione (comando enroll): nessuna inferenza sulla foto
+                enrolled_bytes = student.pop('embedding_bytes', None)
+                enrolled_meta = student.pop('embedding_meta', None) or {}
+                if enrolled_bytes is not None:
+                    if enrolled_meta.get('model') == self._embedding_cache_model():
+                        student['embedding'] = decode_embedding(
+                            enrolled_bytes, enrolled_meta.get('dtype', 'float32')
+                        )
+                        student['embedding_cached'] = True
+                        student['embedding_source'] = 'enrollment'
+                        valid_students.append(student)
+                        continue
+                    # Iscrizione con un altro modello: si ricade su cache/foto, il chiamante può rifarla
+                    self.stale_enrollments.append(student['id'])
+                
                 # Controlla cache
                 if self.enable_caching:
                     cached_embedding = self.embedding_cache.get(
                         student['id'], 
-                        self.model_name,
+                        self._embedding_cache_model(),
                         photo_hash
                     )
                     
                     if cached_embedding is not None:
-                        student['embedding'] = cached_embedding.tolist()
+                        student['embedding'] = cached_embedding
                         student['embedding_cached'] = True
                         valid_students.append(student)
                         continue
                 
+                if photo_bytes is None:
+                    logger.warning(f"⚠️ Embedding in cache non trovato per {student.get('name', 'Unknown')}, serve la foto")
+                    self.unresolved_students.append(student['id'])
+                    continue
+                
                 # Aggiungi a batch per generazione
-                embeddings_to_generate.append(student)
+                embeddings_to_generate.append((student, photo_bytes))
             
             # Genera embeddings in batch
             if embeddings_to_generate:
                 logger.info(f"🔄 Generazione embeddings per {len(embeddings_to_generate)} studenti...")
                 
-                batch_size = self.config["models"]["recognizer"].get("batch_size", 32)
+                enable_double_check = self.config["models"].get("verification", {}).get("enable_double_check", False)
+                self._ensure_models()
                 
-                for i in range(0, len(embeddings_to_generate), batch_size):
-                    batch = embeddings_to_generate[i:i + batch_size]
-                    
-                    for student in batch:
-                        try:
-                            # Verifica validità foto
-                            logger.debug(f"📸 Verificando foto: {student['photoPath']}")
-                            
-                            # Prima verifica che il file esista e sia leggibile
-                            test_img = cv2.imread(student['photoPath'])
-                            if test_img is None:
-                                logger.error(f"❌ Impossibile leggere foto di {student['name']}")
-                                continue
-                            
-                            logger.debug(f"   Dimensioni foto: {test_img.shape}")
-                            
-                            # Prova con il detector configurato
-                            try:
-                                faces = DeepFace.extract_faces(
-                                    img_path=student['photoPath'],
-                                    detector_backend=self.detector_backend,
-                                    enforce_detection=False,
-                                    align=True
-                                )
-                            except AttributeError as e:
-                                # Se RetinaFace fallisce con l'errore tuple, prova MTCNN
-                                if "'tuple' object has no attribute 'shape'" in str(e) and self.detector_backend != 'mtcnn':
-                                    logger.warning(f"⚠️ {self.detector_backend} ha problemi con questa versione di DeepFace, uso MTCNN")
-                                    faces = DeepFace.extract_faces(
-                                        img_path=student['photoPath'],
-                                        detector_backend='mtcnn',
-                                        enforce_detection=False,
-                                        align=True
-                                    )
-                                else:
-                                    raise
-                            
-                            if not faces:
-                                logger.warning(f"⚠️ Nessun volto in foto di {student['name']}")
-                                continue
-                            
-                            # Gestisci diversi formati di output di extract_faces
-                            if isinstance(faces, list) and len(faces) > 0:
-                                # Nuovo formato: lista di dizionari
-                                if isinstance(faces[0], dict) and 'face' in faces[0]:
-                                    face_image = faces[0]['face']
-                                    confidence = faces[0].get('confidence', 0)
-                                else:
-                                    # Formato alternativo: lista di array numpy
-                                    face_image = faces[0]
-                                    confidence = 1.0
-                            elif isinstance(faces, tuple):
-                                # Vecchio formato: tupla
-                                face_image = faces[0] if len(faces) > 0 else None
-                                confidence = 1.0
-                            else:
-                                logger.warning(f"⚠️ Formato faces non riconosciuto per {student['name']}")
-                                continue
-                            
-                            if face_image is None:
-                                logger.warning(f"⚠️ Nessun volto estratto per {student['name']}")
-                                continue
-                                
-                            logger.debug(f"   Volto estratto: shape={getattr(face_image, 'shape', 'N/A')}, confidence={confidence:.3f}")
-                            
-                            # Salva volto per debug
-                            if self.save_debug_faces:
-                                debug_filename = f"student_{student['id']}_{student['name']}_{student.get('surname', '')}.jpg"
-                                debug_path = os.path.join(self.debug_faces_dir, debug_filename)
-                                
-                                # Converti in uint8 se necessario
-                                if face_image.dtype != np.uint8:
-                                    if face_image.max() <= 1.0:
-                                        face_to_save = (face_image * 255).astype(np.uint8)
-                                    else:
-                                        face_to_save = face_image.astype(np.uint8)
-                                else:
-                                    face_to_save = face_image
-                                
-                                cv2.imwrite(debug_path, face_to_save)
-                                logger.info(f"📸 Volto studente salvato: {debug_filename}")
-                                
-                                # Verifica che l'immagine non sia nera
-                                if np.mean(face_to_save) < 5:
-                                    logger.error(f"⚠️ ATTENZIONE: Volto di {student['name']} sembra essere nero/vuoto!")
-                            
-                            # Genera embedding principale
-                            logger.info(f"🔄 Generando embedding per {student['name']} {student.get('surname', '')}")
-                            
-                            # 🚨 RADICAL FIX: Use original photo instead of extracted face
-                            logger.error(f"🔥 USING ORIGINAL PHOTO: {student['photoPath']}")
-                            
-                            embedding = self._generate_embedding(
-                                student['photoPath'],  # Usa la foto originale completa
-                                self.model_name
+                # 1. Decodifica e verifica foto, raccolta in memoria per l'inferenza batch
+                step_start = time.perf_counter()
+                prepared = []
+                for student, photo_bytes in embeddings_to_generate:
+                    try:
+                        # Verifica validità foto
+                        logger.debug("📸 Verificando foto: %s", student.get('photoPath', 'inline'))
+                        
+                        # Decodifica dai byte già letti
+                        photo_img = cv2.imdecode(np.frombuffer(photo_bytes, dtype=np.uint8), cv2.IMREAD_COLOR)
+                        if photo_img is None:
+                            logger.error(f"❌ Impossibile leggere foto di {student['name']}")
+                            continue
+                        
+                        logger.debug("   Dimensioni foto: %s", photo_img.shape)
+                        
+                        # Prova con il detector configurato, sulla foto già decodificata
+                        extracted = self._extract_student_face(photo_img, student['name'])
+                        if extracted is None:
+                            continue
+                        face_image, confidence, _ = extracted
+                        
+                        # Salva volto per debug
+                        if self.save_debug_faces:
+                            debug_filename = f"student_{student['id']}_{student['name']}_{student.get('surname', '')}.jpg"
+                            self._submit_debug_face(
+                                debug_filename, face_image, f"Volto di {student['name']}"
                             )
-                            
-                            if embedding is not None:
-                                student['embedding'] = embedding.tolist()
-                                student['embedding_cached'] = False
-                                
-                                # Salva in cache
-                                if self.enable_caching:
-                                    self.embedding_cache.set(
-                                        student['id'],
-                                        self.model_name,
-                                        embedding,
-                                        student['photo_hash']
-                                    )
-                                
-                                # Se doppia verifica abilitata
-                                if self.config["models"].get("verification", {}).get("enable_double_check", False):
-                                    secondary_model = self.config["models"]["verification"]["secondary_model"]
-                                    face_image_copy2 = face_image.copy() if isinstance(face_image, np.ndarray) else face_image
-                                    secondary_embedding = self._generate_embedding(
-                                        face_image_copy2,  # Usa una copia anche qui
-                                        secondary_model
-                                    )
-                                    if secondary_embedding is not None:
-                                        student['embedding_secondary'] = secondary_embedding.tolist()
-                                
-                                valid_students.append(student)
-                                logger.info(f"✅ {student['name']} {student.get('surname', '')} - embedding generato con successo")
-                                
-                        except Exception as e:
-                            logger.error(f"❌ ERRORE CRITICO per {student['name']} {student.get('surname', '')}: {str(e)}")
-                            import traceback
-                            logger.error(traceback.format_exc())
+                        
+                        # L'embedding principale usa la foto originale completa (già decodificata)
+                        prepared.append((student, photo_img, face_image))
+                        
+                    except Exception as e:
+                        logger.error(f"❌ ERRORE CRITICO per {student['name']} {student.get('surname', '')}: {str(e)}")
+                        import traceback
+                        logger.error(traceback.format_exc())
+                
+                self.metrics.add_span(
+                    "student_detection", (time.perf_counter() - step_start) * 1000,
+                    photos=len(embeddings_to_generate), faces=len(prepared)
+                )
+                
+                # 2. Inferenza batch: un forward pass per gruppo di foto
+                with self.metrics.span("student_embedding", photos=len(prepared), model=self.model_name):
+                    embeddings = self._generate_embeddings_batch(
+                        [photo_img for _, photo_img, _ in prepared],
+                        self.model_name
+                    )
+                    
+                    secondary_embeddings = [None] * len(prepared)
+                    if enable_double_check:
+                        secondary_model = self.config["models"]["verification"]["secondary_model"]
+                        secondary_embeddings = self._generate_embeddings_batch(
+                            [self._face_to_bgr(face_image) for _, _, face_image in prepared],
+                            secondary_model
+                        )
+                
+                for (student, _, _), embedding, secondary_embedding in zip(prepared, embeddings, secondary_embeddings):
+                    if embedding is None:
+                        logger.error(f"❌ Embedding non generato per {student['name']} {student.get('surname', '')}")
+                        continue
+                    
+                    student['embedding'] = np.asarray(embedding, dtype=np.float32)
+                    student['embedding_cached'] = False
+                    
+                    # Salva in cache
+                    if self.enable_caching:
+                        self.embedding_cache.set(
+                            student['id'],
+                            self._embedding_cache_model(),
+                            embedding,
+                            student['photo_hash']
+                        )
+                    
+                    if secondary_embedding is not None:
+                        student['embedding_secondary'] = np.asarray(secondary_embedding, dtype=np.float32)
+                    
+                    valid_students.append(student)
+                    self.diagnostics.sampled(
+                        "student", "✅ %s %s - embedding generato con successo",
+                        student['name'], student.get('surname', '')
+                    )
+                
+                if self.enable_caching:
+                    self.embedding_cache.flush()
+                # Foto nuove o cambiate: l'indice di tutti gli studenti resta allineato
+                self._index_embeddings([
+                    (s['id'], s['embedding'], s['photo_hash'])
+                    for s in valid_students if not s.get('embedding_cached')
+                ])
             
             load_time = (time.time() - load_start) * 1000
             cache_rate = self.embedding_cache.get_hit_rate() if self.enable_caching else 0
             
+            enrolled_count = sum(1 for s in valid_students if s.get('embedding_source') == 'enrollment')
+            gallery_count = sum(1 for s in valid_students if s.get('embedding_source') == 'gallery')
+            cached_count = sum(1 for s in valid_students if s.get('embedding_cached')) - enrolled_count - gallery_count
+            self.metrics.count("students.enrolled", enrolled_count)
+            self.metrics.count("students.gallery", gallery_count)
+            self.metrics.count("students.cached", cached_count)
+            self.metrics.count("students.embedded", len(valid_students) - cached_count - enrolled_count - gallery_count)
+            self.metrics.count("students.unresolved", len(self.unresolved_students))
+            self.metrics.count("students.failed", len(students) - len(valid_students) - len(self.unresolved_students))
+            
             logger.info(f"✅ Studenti processati in {load_time:.0f}ms")
             logger.info(f"   - Validi: {len(valid_students)}/{len(students)}")
             logger.info(f"   - Cache hit rate: {cache_rate:.1%}")
+            if gallery_count:
+                logger.info(f"   - Embeddings dalla galleria compatta: {gallery_count}")
+            if enrolled_count or self.stale_enrollments:
+                logger.info(f"   - Embeddings da iscrizione: {enrolled_count} "
+                            f"({len(self.stale_enrollments)} di un altro modello)")
+            if self.diagnostics.omitted("student"):
+                logger.info(f"   - {self.diagnostics.omitted('student')} righe per studente omesse dal log")
             
             return valid_students
             
         except Exception as e:
             logger.error(f"❌ Errore caricamento studenti: {e}")
+            self.diagnostics.dump("caricamento studenti fallito")
             return []
     
-    def _generate_embedding(self, image_path: Union[str, np.ndarray], 
-                          model_name: str) -> Optional[np.ndarray]:
-        """Genera embedding con modello specificato"""
+    def enroll(self, photo_bytes: bytes, user_id: Any = None,
+               label: str = "studente") -> Tuple[Dict[str, Any], bytes]:
+        """Embedding di una foto studente calcolato una volta, al caricamento della foto
+        
+        Stessa procedura di load_students (rilevamento sulla foto, embedding della foto intera),
+        con validazione più severa secondo la sezione "enrollment" della config.
+        Restituisce (metadati, embedding in formato compatto); ValueError se la foto non è valida.
+        """
+        outcome = self.enroll_many([(user_id, photo_bytes, label)])[0]
+        if isinstance(outcome, Exception):
+            raise outcome
+        return outcome
+    
+    def enroll_many(self, items: List[Tuple[Any, bytes, str]]) -> List[Union[Tuple[Dict[str, Any], bytes], Exception]]:
+        """enroll() su più foto (user_id, byte, etichetta) con un forward pass per batch;
+        per ogni foto (metadati, embedding) oppure l'eccezione che la rende non valida"""
+        enrollment_config = self.config.get("enrollment", {})
+        dtype = enrollment_config.get("embedding_dtype", "float16")
+        min_confidence = float(enrollment_config.get("min_face_confidence", 0.9))
+        self._ensure_models()
+        
+        outcomes: List[Any] = [None] * len(items)
+        prepared = []
+        for position, (user_id, photo_bytes, label) in enumerate(items):
+            try:
+                photo_img = self._decode_image(photo_bytes)
+                if photo_img is None:
+                    raise ValueError("Foto non decodificabile")
+                
+                extracted = self._extract_student_face(photo_img, label)
+                if extracted is None:
+                    raise ValueError("Nessun volto nella foto")
+                face_image, confidence, faces_found = extracted
+                if confidence < min_confidence:
+                    raise ValueError(f"Volto poco affidabile (confidence {confidence:.2f} < {min_confidence:.2f})")
+                if faces_found > 1 and enrollment_config.get("reject_multiple_faces", False):
+                    raise ValueError(f"Più volti nella foto ({faces_found})")
+                
+                if self.save_debug_faces and user_id is not None:
+                    self._submit_debug_face(f"enroll_{user_id}.jpg", face_image, f"Iscrizione {label}")
+                prepared.append((position, photo_img, confidence, faces_found))
+            except Exception as e:
+                outcomes[position] = e if isinstance(e, ValueError) else ValueError(str(e))
+        
+        embeddings = self._generate_embeddings_batch([photo_img for _, photo_img, _, _ in prepared], self.model_name)
+        
+        model = self._embedding_cache_model()
+        indexed = []
+        for (position, _, confidence, faces_found), embedding in zip(prepared, embeddings):
+            user_id, photo_bytes, label = items[position]
+            if embedding is None:
+                outcomes[position] = ValueError("Embedding non generato")
+                continue
+            
+            photo_hash = self._calculate_photo_hash(photo_bytes)
+            # Le analisi successive trovano l'embedding anche nella cache condivisa
+            if user_id is not None and self.enable_caching:
+                self.embedding_cache.set(user_id, model, embedding, photo_hash)
+            indexed.append((user_id, embedding, photo_hash))
+            
+            logger.debug("🪪 Iscrizione %s: embedding %s (%d, %s), confidence %.3f, volti %d",
+                         label, model, len(embedding), dtype, confidence, faces_found)
+            outcomes[position] = ({
+                "model": model,
+                "dtype": dtype,
+                "dim": int(len(embedding)),
+                "photo_hash": photo_hash,
+                "face_confidence": confidence,
+                "faces_found": faces_found
+            }, encode_embedding(embedding, dtype))
+        
+        if self.enable_caching:
+            self.embedding_cache.flush()
+        self._index_embeddings(indexed)
+        
+        enrolled = sum(1 for outcome in outcomes if not isinstance(outcome, Exception))
+        logger.info(f"🪪 Iscrizioni: {enrolled}/{len(items)} embeddings {model} ({dtype})")
+        return outcomes
+    
+    def _extract_student_face(self, photo_img: np.ndarray,
+                              label: str) -> Optional[Tuple[np.ndarray, float, int]]:
+        """Volto principale di una foto studente: (volto, confidence, volti trovati) o None"""
         try:
-            logger.error(f"🔥 GENERATING EMBEDDING con {model_name}")
-            
-            # Se è un numpy array, salvalo temporaneamente come file
-            # Questo evita il problema di resize_image con la versione corrente di DeepFace
-            temp_path = None
-            if isinstance(image_path, np.ndarray):
-                logger.debug(f"   Input: numpy array {image_path.shape}")
-                import tempfile
-                with tempfile.NamedTemporaryFile(suffix='.jpg', delete=False) as tmp:
-                    # Assicurati che l'immagine sia in formato BGR per cv2
-                    if len(image_path.shape) == 3 and image_path.shape[2] == 3:
-                        cv2.imwrite(tmp.name, image_path)
-                    else:
-                        cv2.imwrite(tmp.name, image_path)
-                    temp_path = tmp.name
-                    image_path = temp_path
-            else:
-                if not os.path.exists(image_path):
-                    logger.error(f"❌ File non trovato per embedding: {image_path}")
-                    return None
-                logger.debug(f"   Path: {image_path}")
-            
-            # Usa direttamente il percorso file se disponibile
-            if isinstance(image_path, str) and os.path.exists(image_path):
-                # 🚨 FORCE FRESH MODEL LOADING - use exact same params as manual test
-                result = DeepFace.represent(
-                    img_path=image_path,
-                    model_name=model_name,
+            faces = self._detector_engine(self.detector_backend).extract_faces(
+                img_path=photo_img,
+                detector_backend=self.detector_backend,
+                enforce_detection=False,
+                align=True
+            )
+        except AttributeError as e:
+            # Se RetinaFace fallisce con l'errore tuple, prova MTCNN
+            if "'tuple' object has no attribute 'shape'" in str(e) and self.detector_backend != 'mtcnn':
+                logger.warning(f"⚠️ {self.detector_backend} ha problemi con questa versione di DeepFace, uso MTCNN")
+                faces = DeepFace.extract_faces(
+                    img_path=photo_img,
+                    detector_backend='mtcnn',
                     enforce_detection=False,
-                    detector_backend="skip"  # Removed align parameter
+                    align=True
                 )
             else:
-                # Se è un numpy array, usa il percorso temporaneo già creato
-                result = DeepFace.represent(
-                    img_path=temp_path if 'temp_path' in locals() else image_path,
-                    model_name=model_name,
-                    enforce_detection=False,
-                    detector_backend="skip"
-                )
-            
-            if isinstance(result, list) and len(result) > 0:
-                embedding = np.array(result[0]['embedding'])
-                logger.debug(f"   ✅ Embedding generato: shape {embedding.shape}, norm {np.linalg.norm(embedding):.3f}")
-                
-                # 🔥 CRITICAL DEBUG: Log final embedding
-                logger.error(f"🔥 RAW EMBEDDING: shape={embedding.shape}, norm={np.linalg.norm(embedding):.3f}, first3={embedding[:3]}")
-                
-                # Return raw embedding without forced normalization
-                return embedding
+                raise
+        
+        if not faces:
+            logger.warning(f"⚠️ Nessun volto in foto di {label}")
+            return None
+        
+        # Gestisci diversi formati di output di extract_faces
+        if isinstance(faces, list) and len(faces) > 0:
+            # Nuovo formato: lista di dizionari
+            if isinstance(faces[0], dict) and 'face' in faces[0]:
+                face_image = faces[0]['face']
+                confidence = faces[0].get('confidence', 0)
             else:
-                logger.warning(f"   ⚠️ Nessun embedding restituito da {model_name}")
-                return None
-            
-        except Exception as e:
-            logger.error(f"❌ Errore generazione embedding {model_name}: {e}")
-            import traceback
-            logger.debug(traceback.format_exc())
+                # Formato alternativo: lista di array numpy
+                face_image = faces[0]
+                confidence = 1.0
+        elif isinstance(faces, tuple):
+            # Vecchio formato: tupla
+            face_image = faces[0] if len(faces) > 0 else None
+            confidence = 1.0
+        else:
+            logger.warning(f"⚠️ Formato faces non riconosciuto per {label}")
             return None
-        finally:
-            # Pulisci file temporaneo se creato
-            if 'temp_path' in locals() and temp_path and os.path.exists(temp_path):
-                try:
-                    os.unlink(temp_path)
-                except:
-                    pass
+        
+        if face_image is None:
+            logger.warning(f"⚠️ Nessun volto estratto per {label}")
+            return None
+        
+        logger.debug("   Volto estratto: shape=%s, confidence=%.3f",
+                     getattr(face_image, 'shape', 'N/A'), confidence)
+        return face_image, float(confidence or 0), len(faces)
     
-    def detect_faces(self, image_path: str) -> List[Dict[str, Any]]:
-        """Rileva volti con RetinaFace e validazione avanzata"""
-        try:
-            detect_start = time.time()
-            logger.info(f"🔍 Rilevamento volti con {self.detector_backend}")
-            
-            if not os.path.exists(image_path):
-                logger.error(f"❌ File non trovato: {image_path}")
+    @staticmethod
+    def _to_uint8(image: np.ndarray) -> np.ndarray:
+        """Converte un volto in uint8 (DeepFace restituisce float in [0,1])"""
+        if image.dtype == np.uint8:
+            return image
+        if image.max() <= 1.0:
+            return (image * 255).astype(np.uint8)
+        return image.astype(np.uint8)
+    
+    def _face_to_bgr(self, face_img: np.ndarray) -> np.ndarray:
+        """Volto estratto da DeepFace (RGB, float [0,1]) → BGR uint8 come da cv2"""
+        face = self._to_uint8(face_img)
+        if face.ndim == 3 and face.shape[2] == 3:
+            face = cv2.cvtColor(face, cv2.COLOR_RGB2BGR)
+        return face
+    
+    def _get_recognition_model(self, model_name: str) -> Tuple[Any, Tuple[int, int]]:
+        """Restituisce (modello Keras o ONNX, (altezza, larghezza) di input), caricato una sola volta"""
+        if model_name not in self._recognition_models:
+            keras_model = self.onnx_models.recognizer(model_name)
+            if keras_model is None:
+                client = DeepFace.build_model(model_name)
+                # DeepFace >= 0.0.80 restituisce un wrapper con l'attributo .model
+                keras_model = getattr(client, 'model', client)
+            input_hw = tuple(int(v) for v in keras_model.input_shape[1:3])
+            self._recognition_models[model_name] = (keras_model, input_hw)
+        return self._recognition_models[model_name]
+    
+    @staticmethod
+    def _preprocess_for_recognizer(image_bgr: np.ndarray, target_hw: Tuple[int, int]) -> np.ndarray:
+        """Stesso preprocessing di DeepFace.represent: RGB, resize con aspect ratio, padding, [0,1]"""
+        img = image_bgr[:, :, ::-1]
+        target_h, target_w = target_hw
+        
+        if img.shape[0] > 0 and img.shape[1] > 0:
+            factor = min(target_h / img.shape[0], target_w / img.shape[1])
+            dsize = (max(1, int(img.shape[1] * factor)), max(1, int(img.shape[0] * factor)))
+            img = cv2.resize(img, dsize)
+            
+            diff_h = target_h - img.shape[0]
+            diff_w = target_w - img.shape[1]
+            img = np.pad(
+                img,
+                ((diff_h // 2, diff_h - diff_h // 2), (diff_w // 2, diff_w - diff_w // 2), (0, 0)),
+                'constant'
+            )
+        
+        if img.shape[:2] != (target_h, target_w):
+            img = cv2.resize(img, (target_w, target_h))
+        
+        return img.astype(np.float32) / 255.0
+    
+    def _generate_embeddings_batch(self, images: List[np.ndarray], 
+                                   model_name: str) -> List[Optional[np.ndarray]]:
+        """Genera embeddings per più immagini BGR in memoria con un forward pass per batch"""
+        if not images:
+            return []
+        
+        batch_size = max(1, int(self.config["models"]["recognizer"].get("batch_size", 32)))
+        embeddings: List[Optional[np.ndarray]] = [None] * len(images)
+        
+        try:
+            keras_model, input_hw = self._get_recognition_model(model_name)
+        except Exception as e:
+            logger.warning(f"⚠️ Modello {model_name} non disponibile per batch ({e}), uso inferenza singola")
+            return [self._generate_embedding(img, model_name) for img in images]
+        
+        for start in range(0, len(images), batch_size):
+            chunk = images[start:start + batch_size]
+            try:
+                tensor = np.stack([
+                    self._preprocess_for_recognizer(img, input_hw) for img in chunk
+                ])
+                output = keras_model(tensor, training=False)
+                output = output.numpy() if hasattr(output, 'numpy') else np.asarray(output)
+                
+                for offset, row in enumerate(output):
+                    embeddings[start + offset] = np.asarray(row, dtype=np.float64)
+                
+                logger.debug("   ✅ Batch %s: %d embeddings in un forward pass", model_name, len(chunk))
+            except Exception as e:
+                logger.warning(f"⚠️ Batch {model_name} fallito ({e}), fallback inferenza singola")
+                for offset, img in enumerate(chunk):
+                    embeddings[start + offset] = self._generate_embedding(img, model_name)
+        
+        return embeddings
+    
+    def _generate_embedding(self, image_path: Union[str, np.ndarray], 
+                          model_name: str) -> Optional[np.ndarray]:
+        """Genera embedding singolo con DeepFace.represent (path o array BGR in memoria)"""
+        try:
+            if isinstance(image_path, np.ndarray):
+                self.diagnostics.record("🔄 Embedding %s da array %s", model_name, image_path.shape)
+            elif not os.path.exists(image_path):
+                logger.error(f"❌ File non trovato per embedding: {image_path}")
+                return None
+            else:
+                self.diagnostics.record("🔄 Embedding %s da %s", model_name, image_path)
+            
+            onnx_model = self.onnx_models.recognizer(model_name) if isinstance(image_path, np.ndarray) else None
+            if onnx_model is not None:
+                tensor = self._preprocess_for_recognizer(image_path, onnx_model.input_shape[1:3])[None]
+                return np.asarray(onnx_model(tensor)[0], dtype=np.float64)
+            
+            result = DeepFace.represent(
+                img_path=image_path,
+                model_name=model_name,
+                enforce_detection=False,
+                detector_backend="skip"
+            )
+            
+            if isinstance(result, list) and len(result) > 0:
+                embedding = np.array(result[0]['embedding'])
+                self.diagnostics.record(
+                    "   ✅ Embedding generato: shape %s, norm %.3f",
+                    embedding.shape, lambda: float(np.linalg.norm(embedding))
+                )
+                
+                # Return raw embedding without forced normalization
+                return embedding
+            else:
+                logger.warning(f"   ⚠️ Nessun embedding restituito da {model_name}")
+                return None
+            
+        except Exception as e:
+            logger.error(f"❌ Errore generazione embedding {model_name}: {e}")
+            import traceback
+            logger.debug(traceback.format_exc())
+            return None
+    
+    def _get_tiled_detector(self) -> TiledDetector:
+        """Detector a tasselli con pool di processi, creato al primo frame che lo richiede"""
+        if self._tiled_detector is None:
+            detector_config = self.config["models"]["detector"]
+            onnx_path = self.onnx_models.detector_path() if self.detector_backend == "retinaface" else None
+            self._tiled_detector = TiledDetector(detector_config.get("tiling", {}), detector_config, onnx_path)
+        return self._tiled_detector
+    
+    def close(self):
+        """Rilascia le risorse esterne (pool di processi per i tasselli, writer di debug)"""
+        if self._tiled_detector is not None:
+            self._tiled_detector.close()
+            self._tiled_detector = None
+        self.debug_writer.close()
+    
+    def _propose_regions(self, image: np.ndarray, cascade_config: Dict[str, Any]) -> List[Tuple[int, int, int, int]]:
+        """Primo stadio della cascata: box (x, y, w, h) in coordinate frame dal detector veloce"""
+        height, width = image.shape[:2]
+        max_size = int(cascade_config.get("proposal_max_size", 1280))
+        scale = min(1.0, max_size / max(width, height))
+        small = cv2.resize(image, (int(width * scale), int(height * scale))) if scale < 1.0 else image
+        
+        proposals = DeepFace.extract_faces(
+            img_path=small,
+            detector_backend=cascade_config.get("proposal_backend", "opencv"),
+            enforce_detection=False,
+            align=False
+        )
+        
+        min_confidence = float(cascade_config.get("proposal_min_confidence", 0.0))
+        small_h, small_w = small.shape[:2]
+        boxes = []
+        for proposal in proposals or []:
+            area = proposal.get('facial_area', {}) if isinstance(proposal, dict) else {}
+            x, y, w, h = (int(area.get(k, 0)) for k in ('x', 'y', 'w', 'h'))
+            # Con enforce_detection=False DeepFace restituisce l'intera immagine se non trova nulla
+            if w <= 0 or h <= 0 or (w >= small_w * 0.95 and h >= small_h * 0.95):
+                continue
+            if float(proposal.get('confidence', 0) or 0) < min_confidence:
+                continue
+            boxes.append((int(x / scale), int(y / scale), int(w / scale), int(h / scale)))
+        return boxes
+    
+    @staticmethod
+    def _merge_regions(regions: List[Tuple[int, int, int, int]]) -> List[Tuple[int, int, int, int]]:
+        """Unisce ritagli sovrapposti in rettangoli unione (ogni volto analizzato una volta)"""
+        merged = [list(r) for r in regions]
+        changed = True
+        while changed:
+            changed = False
+            for i in range(len(merged)):
+                for j in range(i + 1, len(merged)):
+                    ax, ay, aw, ah = merged[i]
+                    bx, by, bw, bh = merged[j]
+                    if ax < bx + bw and bx < ax + aw and ay < by + bh and by < ay + ah:
+                        x1, y1 = min(ax, bx), min(ay, by)
+                        x2, y2 = max(ax + aw, bx + bw), max(ay + ah, by + bh)
+                        merged[i] = [x1, y1, x2 - x1, y2 - y1]
+                        del merged[j]
+                        changed = True
+                        break
+                if changed:
+                    break
+        return [tuple(r) for r in merged]
+    
+    def _cascade_detect(self, image: np.ndarray) -> Optional[List[Dict[str, Any]]]:
+        """Cascata a due stadi; None se le proposte non sono affidabili (→ passata sull'intero frame)"""
+        detector_config = self.config["models"]["detector"]
+        cascade_config = detector_config.get("cascade", {})
+        height, width = image.shape[:2]
+        cascade_start = time.time()
+        
+        try:
+            proposals = self._propose_regions(image, cascade_config)
+        except Exception as e:
+            logger.warning(f"⚠️ Detector proposte fallito ({e}), passata sull'intero frame")
+            return None
+        
+        if not proposals and cascade_config.get("fallback_on_empty", True):
+            logger.info("🔁 Cascata: nessuna proposta, passata sull'intero frame")
+            return None
+        
+        max_proposals = int(cascade_config.get("max_proposals", 40))
+        if len(proposals) > max_proposals:
+            logger.info(f"🔁 Cascata: {len(proposals)} proposte > {max_proposals}, passata sull'intero frame")
+            return None
+        
+        # Ritagli con margine attorno a ogni proposta (il detector veloce sbaglia scala e posizione)
+        padding = float(cascade_config.get("padding", 0.6))
+        min_crop = int(cascade_config.get("min_crop_size", 160))
+        regions = []
+        for x, y, w, h in proposals:
+            pad = int(max(w, h) * padding)
+            side_w, side_h = max(w + 2 * pad, min_crop), max(h + 2 * pad, min_crop)
+            cx, cy = x + w // 2, y + h // 2
+            x1, y1 = max(0, cx - side_w // 2), max(0, cy - side_h // 2)
+            x2, y2 = min(width, x1 + side_w), min(height, y1 + side_h)
+            regions.append((x1, y1, x2 - x1, y2 - y1))
+        regions = self._merge_regions(regions)
+        
+        coverage = sum(w * h for _, _, w, h in regions) / float(width * height)
+        max_coverage = float(cascade_config.get("max_coverage", 0.6))
+        if coverage > max_coverage:
+            logger.info(f"🔁 Cascata: ritagli su {coverage:.0%} del frame > {max_coverage:.0%}, passata sull'intero frame")
+            return None
+        
+        try:
+            merged = self._detect_in_regions(image, regions, cascade_config)
+        except Exception as e:
+            logger.warning(f"⚠️ {self.detector_backend} sui ritagli fallito ({e}), passata sull'intero frame")
+            return None
+        
+        logger.info(
+            f"🪜 Cascata {cascade_config.get('proposal_backend', 'opencv')} → {self.detector_backend}: "
+            f"{len(proposals)} proposte, {len(regions)} ritagli ({coverage:.0%} del frame), "
+            f"{len(merged)} volti ({(time.time() - cascade_start) * 1000:.0f}ms)"
+        )
+        return merged
+    
+    def _detect_in_regions(self, image: np.ndarray, regions: List[Tuple[int, int, int, int]],
+                           merge_config: Dict[str, Any]) -> List[Dict[str, Any]]:
+        """Detector preciso solo sui ritagli (x, y, w, h), coordinate riportate al frame intero"""
+        detector_config = self.config["models"]["detector"]
+        faces = []
+        for x, y, w, h in regions:
+            crop = np.ascontiguousarray(image[y:y + h, x:x + w])
+            faces.extend(detect_tile_with(
+                self._detector_engine(self.detector_backend), crop, (x, y), self.detector_backend,
+                detector_config.get("enforce_detection", False),
+                detector_config.get("align", True)
+            ))
+        
+        # enforce_detection=False: un ritaglio senza volti torna intero con confidenza 0
+        faces = [f for f in faces if f['confidence'] > 0]
+        return merge_detections(
+            faces,
+            float(merge_config.get("nms_iou_threshold", 0.4)),
+            float(merge_config.get("containment_threshold", 0.7))
+        )
+    
+    def _extract_faces(self, image: np.ndarray, backend: str) -> List[Dict[str, Any]]:
+        """DeepFace.extract_faces su array BGR in memoria, output normalizzato a lista di dict"""
+        detector_config = self.config["models"]["detector"]
+        faces_data = self._detector_engine(backend).extract_faces(
+            img_path=image,
+            detector_backend=backend,
+            enforce_detection=detector_config.get("enforce_detection", False),
+            align=detector_config.get("align", True)
+        )
+        
+        # Normalizza faces_data in un formato consistente
+        normalized_faces = []
+        if isinstance(faces_data, (list, tuple)):
+            for item in faces_data:
+                if isinstance(item, dict):
+                    normalized_faces.append(item)
+                elif hasattr(item, 'shape'):
+                    # Se è un numpy array (vecchio formato), crea un dict
+                    normalized_faces.append({
+                        'face': item,
+                        'facial_area': {'x': 0, 'y': 0, 'w': item.shape[1], 'h': item.shape[0]},
+                        'confidence': 1.0
+                    })
+        return normalized_faces
+    
+    def detect_faces(self, image_path: str, image: Optional[np.ndarray] = None,
+                     regions: Optional[List[Tuple[int, int, int, int]]] = None) -> List[Dict[str, Any]]:
+        """Rileva volti con RetinaFace e validazione avanzata (immagine decodificata una sola volta)
+        
+        regions: solo queste regioni del frame (frame gate); il risultato parziale non va nel detection store
+        """
+        try:
+            detection = self._detect_candidates(image_path, image, regions)
+            if detection is None:
+                self.metrics.count("detection.failed")
                 return []
             
-            # Carica e valida immagine
+            embed_start = time.perf_counter()
+            with self.metrics.span("embedding", faces=len(detection['candidates']), model=self.model_name):
+                embeddings, secondary_embeddings = self._embed_candidates(
+                    [c['face_bgr'] for c in detection['candidates']]
+                )
+            faces = self._collect_faces(
+                detection, embeddings, secondary_embeddings, (time.perf_counter() - embed_start) * 1000
+            )
+            if regions is None:
+                self._save_detection(image if image is not None else self.current_image, faces, detection['raw_faces'])
+            return faces
+            
+        except Exception as e:
+            self._detection_failed(e)
+            return []
+    
+    def _detection_fingerprint(self) -> str:
+        return detection_fingerprint(
+            self.config, self.detector_backend, self.model_name, self.onnx_models.variant(self.model_name)
+        )
+    
+    def _stored_faces(self, image: np.ndarray) -> Optional[List[Dict[str, Any]]]:
+        """Volti di un'analisi precedente della stessa immagine (modalità rematch), None se
+        assenti: in quel caso il chiamante esegue il rilevamento completo"""
+        if self.detection_store is None:
+            return None
+        with self.metrics.span("detection_store") as store_span:
+            stored = self.detection_store.get(self._detection_fingerprint(), image_hash(image))
+            store_span["hit"] = stored is not None
+        if stored is None:
+            self.metrics.count("detection_store.miss")
+            logger.info("ℹ️ Nessun rilevamento salvato per l'immagine: rilevamento completo")
+            return None
+        
+        faces, raw_faces = stored
+        self.metrics.detection_mode = "stored"
+        self.metrics.detection_time_ms = self.metrics.stage_totals()["detection_store"]
+        self.metrics.count("detection_store.hit")
+        self.metrics.count("faces_detected_raw", raw_faces)
+        self.metrics.count("faces_validated", len(faces))
+        logger.info(f"♻️ Rematch: {len(faces)} volti dal detection store in {self.metrics.detection_time_ms:.0f}ms")
+        return faces
+    
+    def _save_detection(self, image: Optional[np.ndarray], faces: List[Dict[str, Any]], raw_faces: int):
+        """Salva i volti validati per le rianalisi successive (solo rilevamenti riusciti)"""
+        if self.detection_store is None or image is None:
+            return
+        with self.metrics.span("detection_store_save", faces=len(faces)):
+            self.detection_store.put(self._detection_fingerprint(), image_hash(image), faces, raw_faces)
+    
+    def _gate_plan(self, image: np.ndarray) -> Optional[Dict[str, Any]]:
+        """Piano del frame gate per lo scatto di un'aula (richieste con frame_key), None se
+        il gate non si applica"""
+        if self.frame_gate is None or not self.frame_key:
+            return None
+        with self.metrics.span("frame_gate") as gate_span:
+            plan = self.frame_gate.plan(self.frame_key, image, self._detection_fingerprint())
+            gate_span.update(mode=plan["mode"], changed_ratio=plan["changed_ratio"], regions=len(plan["regions"]))
+        
+        self.metrics.count(f"frame_gate.{plan['mode']}")
+        self.metrics.frame_gate = {
+            "mode": plan["mode"],
+            "changed_ratio": plan["changed_ratio"],
+            "hash_distance": plan["hash_distance"],
+            "regions": len(plan["regions"]),
+            "reused_faces": len(plan["faces"]),
+            "consecutive_skips": plan["skips"] + (1 if plan["mode"] == "skip" else 0),
+            "reason": plan.get("reason")
+        }
+        if plan["mode"] == "skip":
+            self.metrics.detection_mode = "gated_skip"
+            self.metrics.detection_time_ms = self.metrics.stage_totals()["frame_gate"]
+            logger.info(f"⏭️ Frame gate {self.frame_key}: scena invariata, riuso {len(plan['faces'])} volti")
+        elif plan["mode"] == "partial":
+            logger.info(f"🧩 Frame gate {self.frame_key}: {plan['changed_ratio']:.0%} della scena cambiata, "
+                        f"{len(plan['regions'])} regioni da rianalizzare, {len(plan['faces'])} volti riusati")
+        return plan
+    
+    def _apply_gate(self, plan: Dict[str, Any], new_faces: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+        """Volti del frame secondo il piano (salvati, salvati + regioni cambiate o nuovi) e
+        stato dell'aula aggiornato; un rilevamento fallito non diventa il nuovo riferimento"""
+        if plan["mode"] == "skip":
+            faces = plan["faces"]
+        elif plan["mode"] == "partial":
+            faces = plan["faces"] + new_faces
+        else:
+            faces = new_faces
+        for i, face in enumerate(faces):
+            face['index'] = i
+        
+        if not self.metrics.counters.get("detection.failed"):
+            self.frame_gate.commit(plan, faces)
+        return faces
+    
+    def _detection_failed(self, error: Exception):
+        self.metrics.count("detection.failed")
+        logger.error(f"❌ Errore rilevamento volti: {error}")
+        import traceback
+        logger.error(traceback.format_exc())
+        self.diagnostics.dump("rilevamento fallito")
+    
+    def _detect_candidates(self, image_path: str, image: Optional[np.ndarray] = None,
+                           regions: Optional[List[Tuple[int, int, int, int]]] = None) -> Optional[Dict[str, Any]]:
+        """Rilevamento e filtro qualità, senza embeddings: volti allineati (BGR) pronti per il
+        recognizer, da soli o in un batch condiviso con altre richieste (analyze_multi)
+        
+        regions: rileva solo nelle regioni cambiate indicate dal frame gate (a piena risoluzione)
+        
+        Returns:
+            {'candidates', 'raw_faces', 'elapsed_ms'} oppure None se l'immagine non è utilizzabile
+        """
+        self._ensure_models()
+        detect_start = time.time()
+        logger.info(f"🔍 Rilevamento volti con {self.detector_backend}")
+        
+        # Carica e valida immagine solo se il chiamante non l'ha già decodificata
+        if image is None:
+            if not os.path.exists(image_path):
+                logger.error(f"❌ File non trovato: {image_path}")
+                return None
+            
             image = cv2.imread(image_path)
             if image is None:
                 logger.error("❌ Impossibile caricare immagine")
-                return []
-            
-            height, width = image.shape[:2]
-            logger.info(f"✅ Immagine caricata: {width}x{height}")
-            
-            # Controlla se immagine è troppo grande
-            max_size = 2048
-            if width > max_size or height > max_size:
+                return None
+            self.current_image = image
+        
+        height, width = image.shape[:2]
+        logger.info(f"✅ Immagine caricata: {width}x{height}")
+        
+        detector_config = self.config["models"]["detector"]
+        max_size = int(detector_config.get("max_image_size", 2048))
+        tiling_config = detector_config.get("tiling", {})
+        
+        # Rilevamento grezzo (cascata, tasselli o frame intero/ridimensionato)
+        with self.metrics.span("detector", backend=self.detector_backend) as detector_span:
+            normalized_faces = None
+            scale = 1.0
+            image_resized = image
+        
+            # Frame gate: solo le regioni cambiate rispetto all'ultimo frame analizzato dell'aula
+            if regions is not None:
+                normalized_faces = self._detect_in_regions(
+                    image, self._merge_regions(regions), detector_config.get("cascade", {})
+                )
+                self.metrics.detection_mode = "gated_regions"
+        
+            # Cascata: detector veloce propone le regioni, quello preciso gira solo sui ritagli
+            if normalized_faces is None and detector_config.get("cascade", {}).get("enabled", False):
+                normalized_faces = self._cascade_detect(image)
+                if normalized_faces is not None:
+                    self.metrics.detection_mode = "cascade"
+        
+            # Frame oltre max_size: a tasselli a piena risoluzione se abilitato, altrimenti ridimensionato
+            if normalized_faces is None and tiling_config.get("enabled", False) and max(width, height) > max_size:
+                try:
+                    normalized_faces = self._get_tiled_detector().detect(
+                        image, self.detector_backend, self._detector_engine(self.detector_backend)
+                    )
+                    self.metrics.detection_mode = "tiled"
+                except Exception as e:
+                    logger.error(f"❌ Rilevamento a tasselli fallito: {e}, uso immagine ridimensionata")
+                    normalized_faces = None
+        
+            if normalized_faces is None and (width > max_size or height > max_size):
                 scale = max_size / max(width, height)
                 new_width = int(width * scale)
                 new_height = int(height * scale)
                 image_resized = cv2.resize(image, (new_width, new_height))
                 logger.info(f"📐 Immagine ridimensionata: {new_width}x{new_height}")
-            else:
-                image_resized = image
-                scale = 1.0
-            
-            # Rilevamento con backend configurato
-            faces_detected = []
-            detector_config = self.config["models"]["detector"]
-            
+        
+            # Rilevamento con backend configurato, direttamente sull'array in memoria
             try:
-                # IMPORTANTE: DeepFace si aspetta un path, non un numpy array per alcuni backends
-                # Salviamo temporaneamente l'immagine ridimensionata se necessario
-                if scale != 1.0:
-                    import tempfile
-                    with tempfile.NamedTemporaryFile(suffix='.jpg', delete=False) as tmp:
-                        cv2.imwrite(tmp.name, image_resized)
-                        temp_path = tmp.name
-                    
-                    faces_data = DeepFace.extract_faces(
-                        img_path=temp_path,
-                        detector_backend=self.detector_backend,
-                        enforce_detection=detector_config["enforce_detection"],
-                        align=detector_config["align"]
-                    )
-                    
-                    # Rimuovi file temporaneo
-                    os.unlink(temp_path)
-                else:
-                    # Usa il path originale se non ridimensionato
-                    faces_data = DeepFace.extract_faces(
-                        img_path=image_path,
-                        detector_backend=self.detector_backend,
-                        enforce_detection=detector_config["enforce_detection"],
-                        align=detector_config["align"]
-                    )
-                
-                logger.info(f"✅ {self.detector_backend}: {len(faces_data)} volti rilevati")
-                
+                if normalized_faces is None:
+                    normalized_faces = self._extract_faces(image_resized, self.detector_backend)
+                logger.info(f"✅ {self.detector_backend}: {len(normalized_faces)} volti rilevati")
+            
             except Exception as e:
                 logger.error(f"❌ {self.detector_backend} fallito: {e}")
                 # Se il detector principale fallisce, non compromettiamo sulla qualità
@@ -669,379 +1898,316 @@ class FaceDetectionSystem:
                 if self.detector_backend != 'mtcnn':
                     logger.warning("🔄 Tentativo con MTCNN (alta precisione)...")
                     try:
-                        faces_data = DeepFace.extract_faces(
-                            img_path=image_path,
-                            detector_backend='mtcnn',
-                            enforce_detection=detector_config["enforce_detection"],
-                            align=detector_config["align"]
-                        )
-                        logger.info(f"✅ MTCNN: {len(faces_data)} volti rilevati")
+                        normalized_faces = self._extract_faces(image_resized, 'mtcnn')
+                        logger.info(f"✅ MTCNN: {len(normalized_faces)} volti rilevati")
                         self.detector_backend = 'mtcnn'  # Usa MTCNN per questa sessione
                     except Exception as e2:
                         logger.error(f"❌ Anche MTCNN fallito: {e2}")
                         logger.error("⛔ ERRORE CRITICO: Nessun detector di alta precisione disponibile")
-                        return []  # Restituisce lista vuota invece di crashare
+                        return None  # Nessun volto invece di crashare
                 else:
                     logger.error("⛔ ERRORE CRITICO: Rilevamento volti impossibile")
-                    return []  # Restituisce lista vuota invece di crashare
-            
-            # Processa e valida ogni volto
-            validation_config = self.config.get("validation", {})
-            min_face_size = validation_config.get("min_face_size", [80, 80])
-            max_face_size = validation_config.get("max_face_size", [500, 500])
-            min_confidence = validation_config.get("min_face_confidence", 0.90)
-            
-            # Normalizza faces_data in un formato consistente
-            normalized_faces = []
-            if isinstance(faces_data, list):
-                for item in faces_data:
-                    if isinstance(item, dict):
-                        normalized_faces.append(item)
-                    else:
-                        # Se è un numpy array, crea un dict
-                        normalized_faces.append({
-                            'face': item,
-                            'facial_area': {'x': 0, 'y': 0, 'w': item.shape[1], 'h': item.shape[0]},
-                            'confidence': 1.0
-                        })
-            elif isinstance(faces_data, tuple):
-                # Vecchio formato tupla
-                for item in faces_data:
-                    if hasattr(item, 'shape'):
-                        normalized_faces.append({
-                            'face': item,
-                            'facial_area': {'x': 0, 'y': 0, 'w': item.shape[1], 'h': item.shape[0]},
-                            'confidence': 1.0
-                        })
+                    return None  # Nessun volto invece di crashare
+        
             
+            detector_span.update(mode=self.metrics.detection_mode, raw_faces=len(normalized_faces))
+            self.metrics.count("faces_detected_raw", len(normalized_faces))
+        
+        # Processa e valida ogni volto
+        validation_config = self.config.get("validation", {})
+        min_face_size = validation_config.get("min_face_size", [80, 80])
+        max_face_size = validation_config.get("max_face_size", [500, 500])
+        min_confidence = validation_config.get("min_face_confidence", 0.90)
+        
+        with self.metrics.span("quality_filter", faces=len(normalized_faces)) as filter_span:
+            candidates = []
             for i, face_obj in enumerate(normalized_faces):
                 try:
                     if not isinstance(face_obj, dict):
+                        self.metrics.count("faces_dropped.invalid")
                         continue
-                    
+                
                     face_img = face_obj.get('face')
                     if face_img is None:
+                        self.metrics.count("faces_dropped.invalid")
                         continue
-                    
+                
                     facial_area = face_obj.get('facial_area', {})
                     confidence = face_obj.get('confidence', 0)
-                    
+                
                     # Scala coordinate se immagine era ridimensionata
                     if scale != 1.0:
                         for key in ['x', 'y', 'w', 'h']:
                             if key in facial_area:
                                 facial_area[key] = int(facial_area[key] / scale)
-                    
+                
                     # Validazioni
                     if confidence < min_confidence:
-                        logger.debug(f"Volto {i+1} scartato: confidence {confidence:.2f} < {min_confidence}")
+                        logger.debug("Volto %d scartato: confidence %.2f < %s", i + 1, confidence, min_confidence)
+                        self.metrics.count("faces_dropped.low_confidence")
                         continue
-                    
+                
                     if (facial_area.get('w', 0) < min_face_size[0] or 
                         facial_area.get('h', 0) < min_face_size[1]):
-                        logger.debug(f"Volto {i+1} troppo piccolo")
+                        logger.debug("Volto %d troppo piccolo", i + 1)
+                        self.metrics.count("faces_dropped.too_small")
                         continue
-                    
+                
                     if (facial_area.get('w', 0) > max_face_size[0] or 
                         facial_area.get('h', 0) > max_face_size[1]):
-                        logger.debug(f"Volto {i+1} troppo grande")
+                        logger.debug("Volto %d troppo grande", i + 1)
+                        self.metrics.count("faces_dropped.too_large")
                         continue
-                    
+                
                     # Analisi qualità (blur detection)
+                    blur_score = 0
                     face_region = image[
                         facial_area['y']:facial_area['y']+facial_area['h'],
                         facial_area['x']:facial_area['x']+facial_area['w']
                     ]
-                    
+                
                     if face_region.size > 0:
                         gray = cv2.cvtColor(face_region, cv2.COLOR_BGR2GRAY)
                         blur_score = cv2.Laplacian(gray, cv2.CV_64F).var()
-                        
+                    
                         blur_threshold = validation_config.get("blur_threshold", 100)
                         if blur_score < blur_threshold:
-                            logger.debug(f"Volto {i+1} troppo sfocato: {blur_score:.1f}")
+                            logger.debug("Volto %d troppo sfocato: %.1f", i + 1, blur_score)
+                            self.metrics.count("faces_dropped.blurry")
                             continue
-                    
+                
                     # Salva volto rilevato per debug
                     if self.save_debug_faces:
                         debug_filename = f"detected_face_{i+1}_{datetime.now().strftime('%Y%m%d_%H%M%S')}.jpg"
-                        debug_path = os.path.join(self.debug_faces_dir, debug_filename)
-                        
-                        # Converti in uint8 se necessario
-                        if face_img.dtype != np.uint8:
-                            if face_img.max() <= 1.0:
-                                face_to_save = (face_img * 255).astype(np.uint8)
-                            else:
-                                face_to_save = face_img.astype(np.uint8)
-                        else:
-                            face_to_save = face_img
-                        
-                        cv2.imwrite(debug_path, face_to_save)
-                        logger.info(f"📸 Volto rilevato salvato: {debug_filename}")
-                        
-                        # Verifica che l'immagine non sia nera
-                        if np.mean(face_to_save) < 5:
-                            logger.error(f"⚠️ ATTENZIONE: Volto rilevato {i+1} sembra essere nero/vuoto!")
-                    
-                    # Genera embeddings  
-                    logger.info(f"🚀 Generando embeddings per volto {i+1}...")
-                    
-                    # 🚨 CRITICAL FIX: Use extracted face image with maximum quality
-                    # Salva temporaneamente il volto estratto con qualità massima
-                    import tempfile
-                    with tempfile.NamedTemporaryFile(suffix='.jpg', delete=False) as tmp:
-                        # Converti face_img da [0,1] a [0,255] se necessario
-                        if face_img.max() <= 1.0:
-                            face_to_process = (face_img * 255).astype(np.uint8)
-                        else:
-                            face_to_process = face_img.astype(np.uint8)
-                        
-                        # DeepFace extract_faces restituisce RGB, ma cv2.imwrite si aspetta BGR
-                        # Converti solo se l'immagine ha 3 canali
-                        if len(face_to_process.shape) == 3 and face_to_process.shape[2] == 3:
-                            # DeepFace extract_faces usa RGB, convertiamo a BGR per cv2
-                            face_to_process = cv2.cvtColor(face_to_process, cv2.COLOR_RGB2BGR)
-                        
-                        # Salva con qualità massima (100% JPEG)
-                        cv2.imwrite(tmp.name, face_to_process, [cv2.IMWRITE_JPEG_QUALITY, 100])
-                        temp_face_path = tmp.name
-                    
-                    logger.error(f"🔥 USING EXTRACTED FACE for face {i+1}: {temp_face_path}")
-                    logger.error(f"🔥 Face shape: {face_to_process.shape}, dtype: {face_to_process.dtype}")
-                    
-                    embedding = self._generate_embedding(temp_face_path, self.model_name)
-                    
-                    # Cleanup temp file
-                    os.unlink(temp_face_path)
-                    if embedding is None:
-                        continue
-                    
-                    face_data = {
-                        'index': len(faces_detected),
+                        self._submit_debug_face(debug_filename, face_img, f"Volto rilevato {i+1}")
+                
+                    # Volto allineato in BGR uint8, embedding generato in batch più avanti
+                    candidates.append({
+                        'number': i + 1,
+                        'face_bgr': self._face_to_bgr(face_img),
                         'bbox': facial_area,
                         'confidence': confidence,
-                        'embedding': embedding,
-                        'quality_score': facial_area['w'] * facial_area['h'],
-                        'blur_score': blur_score if 'blur_score' in locals() else 0
-                    }
-                    
-                    # Embedding secondario per doppia verifica
-                    if self.config["models"].get("verification", {}).get("enable_double_check", False):
-                        secondary_model = self.config["models"]["verification"]["secondary_model"]
-                        secondary_embedding = self._generate_embedding(face_img, secondary_model)
-                        if secondary_embedding is not None:
-                            face_data['embedding_secondary'] = secondary_embedding
-                    
-                    faces_detected.append(face_data)
-                    logger.info(f"✅ Volto {i+1} validato e processato")
-                    
+                        'blur_score': blur_score
+                    })
+                
                 except Exception as e:
                     logger.error(f"❌ Errore processamento volto {i+1}: {e}")
+                    self.metrics.count("faces_dropped.error")
                     continue
+        
             
-            detect_time = (time.time() - detect_start) * 1000
-            self.metrics.detection_time_ms = detect_time
-            
-            logger.info(f"📊 Rilevamento completato in {detect_time:.0f}ms")
-            logger.info(f"   - Volti trovati: {len(faces_data)}")
-            logger.info(f"   - Volti validati: {len(faces_detected)}")
+            filter_span["candidates"] = len(candidates)
+        
+        return {
+            'candidates': candidates,
+            'raw_faces': len(normalized_faces),
+            'elapsed_ms': (time.time() - detect_start) * 1000
+        }
+    
+    def _embed_candidates(self, crops: List[np.ndarray]) -> Tuple[List[Optional[np.ndarray]], List[Optional[np.ndarray]]]:
+        """Embeddings (primario e, con la doppia verifica, secondario) dei volti allineati con
+        forward pass batch; i volti possono provenire da più richieste"""
+        logger.info(f"🚀 Generando embeddings per {len(crops)} volti (batch)...")
+        embeddings = self._generate_embeddings_batch(crops, self.model_name)
+        
+        secondary_embeddings: List[Optional[np.ndarray]] = [None] * len(crops)
+        if self.config["models"].get("verification", {}).get("enable_double_check", False):
+            secondary_model = self.config["models"]["verification"]["secondary_model"]
+            secondary_embeddings = self._generate_embeddings_batch(crops, secondary_model)
+        return embeddings, secondary_embeddings
+    
+    def _collect_faces(self, detection: Dict[str, Any], embeddings: List[Optional[np.ndarray]],
+                       secondary_embeddings: List[Optional[np.ndarray]], embedding_ms: float) -> List[Dict[str, Any]]:
+        """Volti validati con i rispettivi embeddings (scarta quelli senza embedding)"""
+        faces_detected = []
+        for candidate, embedding, secondary_embedding in zip(detection['candidates'], embeddings, secondary_embeddings):
+            if embedding is None:
+                self.metrics.count("faces_dropped.embedding_failed")
+                continue
+            
+            facial_area = candidate['bbox']
+            face_data = {
+                'index': len(faces_detected),
+                'bbox': facial_area,
+                'confidence': candidate['confidence'],
+                'embedding': embedding,
+                'quality_score': facial_area['w'] * facial_area['h'],
+                'blur_score': candidate['blur_score']
+            }
             
-            return faces_detected
+            # Embedding secondario per doppia verifica
+            if secondary_embedding is not None:
+                face_data['embedding_secondary'] = secondary_embedding
             
-        except Exception as e:
-            logger.error(f"❌ Errore rilevamento volti: {e}")
-            import traceback
-            logger.error(traceback.format_exc())
-            return []
+            faces_detected.append(face_data)
+            self.diagnostics.sampled("face", "✅ Volto %d validato e processato", candidate['number'])
+        
+        detect_time = detection['elapsed_ms'] + embedding_ms
+        self.metrics.detection_time_ms = detect_time
+        self.metrics.count("faces_validated", len(faces_detected))
+        
+        logger.info(f"📊 Rilevamento completato in {detect_time:.0f}ms")
+        logger.info(f"   - Volti trovati: {detection['raw_faces']}")
+        logger.info(f"   - Volti validati: {len(faces_detected)}")
+        
+        return faces_detected
     
-    def match_faces(self, faces: List[Dict], students: List[Dict]) -> List[Dict]:
-        """Match volti con studenti usando Facenet512 e verifica avanzata"""
+    def match_faces(self, faces: List[Dict], students: Union[List[Dict], 'StudentGallery']) -> List[Dict]:
+        """Match volti con studenti: un'unica moltiplicazione matriciale sulla gallery"""
         try:
             match_start = time.time()
             recognized = []
-            already_recognized_students = set()  # Track already recognized student IDs
             
-            logger.info(f"\n🎯 MATCHING VOLTI (Facenet512)")
+            gallery = students if isinstance(students, StudentGallery) else self._build_gallery(students)
+            
+            logger.info(f"\n🎯 MATCHING VOLTI ({self.model_name})")
             logger.info(f"   Volti: {len(faces)}")
-            logger.info(f"   Studenti: {len(students)}")
+            logger.info(f"   Studenti: {len(gallery)}")
             logger.info(f"   Soglia: {self.similarity_threshold}")
             
             distance_metric = self.config["models"]["recognizer"].get("distance_metric", "cosine")
             enable_double_check = self.config["models"].get("verification", {}).get("enable_double_check", False)
-            min_margin = self.config["models"]["verification"].get("min_confidence_margin", 0.05)
+            min_margin = self.config["models"].get("verification", {}).get("min_confidence_margin", 0.05)
+            
+            if not faces or len(gallery) == 0:
+                logger.info("❌ NESSUN MATCH (volti o gallery vuoti)")
+                return []
+            
+            face_matrix = np.asarray([f['embedding'] for f in faces], dtype=np.float32)
+            if face_matrix.shape[1] != gallery.dim:
+                raise ValueError(
+                    f"Dimensione embedding volti {face_matrix.shape[1]} != gallery {gallery.dim}"
+                )
+            
+            # Similarità di tutti i volti contro tutti gli studenti in un colpo solo
+            similarity, distance = gallery.score(face_matrix, distance_metric)
+            combined = similarity
+            similarity_secondary = None
+            
+            if enable_double_check and gallery.secondary_matrix is not None:
+                face_has_sec = np.array(['embedding_secondary' in f for f in faces])
+                if face_has_sec.any():
+                    sec_dim = gallery.secondary_matrix.shape[1]
+                    face_sec = np.zeros((len(faces), sec_dim), dtype=np.float32)
+                    for i, f in enumerate(faces):
+                        if face_has_sec[i]:
+                            face_sec[i] = f['embedding_secondary']
+                    face_sec = StudentGallery.normalize_rows(face_sec)
+                    similarity_secondary = face_sec @ gallery.secondary_matrix.T
+                    # Media ponderata solo dove entrambi gli embeddings secondari esistono
+                    pair_mask = face_has_sec[:, None] & gallery.has_secondary[None, :]
+                    combined = np.where(
+                        pair_mask,
+                        0.7 * similarity + 0.3 * similarity_secondary,
+                        similarity
+                    )
+            
+            # Controlli di sanità vettoriali (una riga di log per anomalia, non per coppia)
+            face_norms = np.linalg.norm(face_matrix, axis=1)
+            for face_idx in np.flatnonzero(face_norms < 0.1):
+                logger.error(f"🚨 ZERO/NEAR-ZERO FACE EMBEDDING (volto {face_idx + 1})!")
+            if distance_metric == "cosine":
+                identical = (similarity > 1 - 1e-6) & np.isclose(
+                    face_norms[:, None], gallery.norms[None, :], atol=1e-6
+                )
+                for face_idx, student_idx in zip(*np.nonzero(identical)):
+                    logger.error(
+                        f"🚨 IDENTICAL EMBEDDINGS DETECTED for {gallery.students[student_idx]['name']}!"
+                    )
+            
+            # Gli studenti già riconosciuti vengono esclusi dai volti successivi
+            available = np.ones(len(gallery), dtype=bool)
+            report_k = 10 if self.save_debug_faces else 5
             
             for face_idx, face in enumerate(faces):
-                logger.info(f"\n{'='*50}")
-                logger.info(f"MATCHING VOLTO {face_idx + 1}")
+                n_available = int(available.sum())
+                if n_available == 0:
+                    self.diagnostics.sampled("match", "❌ Volto %d: NESSUN MATCH (studenti esauriti)", face_idx + 1)
+                    continue
                 
-                face_embedding = np.array(face['embedding']).copy()  # Force copy
-                matches = []
+                scores = np.where(available, combined[face_idx], -np.inf)
                 
-                # 🚨 CRITICAL DEBUG LOGGING
-                logger.error(f"🔥 FACE_EMB: {face_embedding[:3]} norm={np.linalg.norm(face_embedding):.3f}")
+                # Top-k con selezione parziale invece di un ordinamento completo
+                k = min(report_k, n_available)
+                top = np.argpartition(-scores, k - 1)[:k]
+                top = top[np.argsort(-scores[top], kind='stable')]
                 
-                # Confronta con tutti gli studenti (esclusi quelli già riconosciuti)
-                for student in students:
-                    if 'embedding' not in student:
-                        continue
-                    
-                    # 🚨 Skip students already recognized
-                    if student['id'] in already_recognized_students:
-                        logger.debug(f"⏭️ Skip {student['name']} - già riconosciuto")
-                        continue
-                    
-                    try:
-                        student_embedding = np.array(student['embedding']).copy()  # Force copy
-                        
-                        # 🚨 CRITICAL DEBUG LOGGING
-                        logger.error(f"🔥 STUD_EMB {student['name']}: {student_embedding[:3]} norm={np.linalg.norm(student_embedding):.3f}")
-                        
-                        # Calcola distanza/similarità
-                        if distance_metric == "cosine":
-                            # Normalize embeddings for cosine similarity
-                            face_norm = face_embedding / np.linalg.norm(face_embedding)
-                            student_norm = student_embedding / np.linalg.norm(student_embedding)
-                            similarity = np.dot(face_norm, student_norm)
-                            distance = 1 - similarity
-                            
-                            # 🚨 CRITICAL DEBUG LOGGING
-                            logger.error(f"🔥 SIMILARITY {student['name']}: {similarity:.6f}")
-                        elif distance_metric == "euclidean":
-                            distance = np.linalg.norm(face_embedding - student_embedding)
-                            similarity = 1 / (1 + distance)
-                        else:
-                            # Euclidean L2
-                            distance = np.linalg.norm(face_embedding - student_embedding)
-                            similarity = 1 / (1 + distance)
-                        
+                # Top 5 formattato solo al dump della diagnostica: il record tiene copie piccole
+                top5 = top[:5].copy()
+                self.diagnostics.record(
+                    "📊 Volto %d top %d: %s", face_idx + 1, len(top5),
+                    lambda top5=top5, sims=scores[top5].copy(), dists=distance[face_idx, top5].copy(): ", ".join(
+                        f"{gallery.students[idx]['name']} {gallery.students[idx].get('surname', '')} "
+                        f"sim={sim:.3f} dist={dist:.3f}"
+                        for idx, sim, dist in zip(top5, sims, dists)
+                    )
+                )
+                
+                # Dettagli match e confronto per debug, composti e scritti in background
+                if self.save_debug_faces:
+                    matches = []
+                    for student_idx in top:
                         match_data = {
-                            'student': student,
-                            'similarity': similarity,
-                            'distance': distance
+                            'student': gallery.students[student_idx],
+                            'similarity': float(similarity[face_idx, student_idx]),
+                            'distance': float(distance[face_idx, student_idx]),
+                            'combined_similarity': float(scores[student_idx])
                         }
-                        
-                        # Additional validation checks
-                        if np.allclose(face_embedding, student_embedding, atol=1e-6):
-                            logger.error(f"🚨 IDENTICAL EMBEDDINGS DETECTED for {student['name']}!")
-                            
-                        if np.linalg.norm(face_embedding) < 0.1:
-                            logger.error(f"🚨 ZERO/NEAR-ZERO FACE EMBEDDING!")
-                            
-                        if np.linalg.norm(student_embedding) < 0.1:
-                            logger.error(f"🚨 ZERO/NEAR-ZERO STUDENT EMBEDDING for {student['name']}!")
-                        
-                        # Doppia verifica se abilitata
-                        if enable_double_check and 'embedding_secondary' in face:
-                            student_embedding_sec = np.array(student.get('embedding_secondary', []))
-                            if student_embedding_sec.size > 0:
-                                face_embedding_sec = face['embedding_secondary']
-                                # Gli embeddings secondari sono già normalizzati
-                                similarity_sec = np.dot(face_embedding_sec, student_embedding_sec)
-                                match_data['similarity_secondary'] = similarity_sec
-                                # Media ponderata
-                                match_data['combined_similarity'] = (
-                                    0.7 * similarity + 0.3 * similarity_sec
-                                )
-                                logger.debug(f"    Secondary sim: {similarity_sec:.6f}, Combined: {match_data['combined_similarity']:.6f}")
-                            else:
-                                match_data['combined_similarity'] = similarity
-                        else:
-                            match_data['combined_similarity'] = similarity
-                        
+                        if similarity_secondary is not None and gallery.has_secondary[student_idx]:
+                            match_data['similarity_secondary'] = float(similarity_secondary[face_idx, student_idx])
                         matches.append(match_data)
-                        
-                    except Exception as e:
-                        logger.debug(f"Errore confronto con {student.get('name')}: {e}")
-                        continue
-                
-                # Ordina per similarità combinata
-                matches.sort(key=lambda x: x['combined_similarity'], reverse=True)
-                
-                # Log top matches
-                logger.info(f"\n📊 TOP 5 MATCHES:")
-                for i, match in enumerate(matches[:5]):
-                    student = match['student']
-                    sim = match['combined_similarity']
-                    dist = match['distance']
-                    logger.info(
-                        f"   {i+1}. {student['name']} {student.get('surname', '')} - "
-                        f"Similarity: {sim:.3f} - Distance: {dist:.3f}"
-                    )
                     
-                # Salva dettagli match per debug
-                if self.save_debug_faces:
-                    match_details_file = f"match_details_face{face_idx+1}_{datetime.now().strftime('%Y%m%d_%H%M%S')}.txt"
-                    match_details_path = os.path.join(self.debug_faces_dir, match_details_file)
-                    with open(match_details_path, 'w') as f:
-                        f.write(f"DETTAGLI MATCH VOLTO {face_idx + 1}\n")
-                        f.write(f"{'='*50}\n\n")
-                        f.write(f"Threshold configurato: {self.similarity_threshold}\n")
-                        f.write(f"Metrica distanza: {distance_metric}\n\n")
-                        
-                        for i, match in enumerate(matches[:10]):
-                            student = match['student']
-                            f.write(f"{i+1}. {student['name']} {student.get('surname', '')}\n")
-                            f.write(f"   - Similarity: {match['combined_similarity']:.6f}\n")
-                            f.write(f"   - Distance: {match['distance']:.6f}\n")
-                            f.write(f"   - Supera threshold: {'SI' if match['combined_similarity'] > self.similarity_threshold else 'NO'}\n")
-                            if 'similarity_secondary' in match:
-                                f.write(f"   - Secondary similarity: {match['similarity_secondary']:.6f}\n")
-                            f.write("\n")
+                    timestamp = datetime.now().strftime('%Y%m%d_%H%M%S')
+                    self._submit_debug(
+                        f"match_details_face{face_idx+1}_{timestamp}.txt",
+                        lambda number=face_idx + 1, matches=matches, threshold=self.similarity_threshold:
+                            self._format_match_details(number, matches, distance_metric, threshold)
+                    )
+                    if matches:
+                        self._submit_debug(
+                            f"comparison_face{face_idx+1}_vs_top_matches_{timestamp}.jpg",
+                            lambda face=face, matches=matches[:3], image=self.current_image:
+                                self._create_comparison_image(face, matches, image)
+                        )
                 
-                # Salva immagine di confronto per debug
-                if self.save_debug_faces and matches:
-                    comparison_filename = f"comparison_face{face_idx+1}_vs_top_matches_{datetime.now().strftime('%Y%m%d_%H%M%S')}.jpg"
-                    comparison_path = os.path.join(self.debug_faces_dir, comparison_filename)
-                    
-                    # Crea immagine di confronto
-                    self._create_comparison_image(face, matches[:3], comparison_path)
-                    logger.info(f"📸 Confronto salvato: {comparison_filename}")
+                best_idx = top[0]
+                best_score = scores[best_idx]
                 
                 # Verifica best match
-                if matches and matches[0]['combined_similarity'] > self.similarity_threshold:
-                    best_match = matches[0]
-                    
+                if best_score > self.similarity_threshold:
                     # Verifica margine con secondo miglior match
-                    if len(matches) > 1:
-                        margin = best_match['combined_similarity'] - matches[1]['combined_similarity']
+                    if k > 1:
+                        margin = best_score - scores[top[1]]
                         if margin < min_margin:
-                            logger.warning(
-                                f"⚠️ Match incerto - margine {margin:.3f} < {min_margin}"
+                            self.diagnostics.sampled(
+                                "match", "⚠️ Volto %d: match incerto - margine %.3f < %s",
+                                face_idx + 1, margin, min_margin, level=logging.WARNING
                             )
                             continue
                     
                     # Match confermato
-                    student = best_match['student']
+                    student = gallery.students[best_idx]
                     student_id = student['id']
+                    available[best_idx] = False
                     
-                    # 🚨 Check if student already recognized
-                    if student_id in already_recognized_students:
-                        logger.warning(f"⚠️ STUDENTE GIÀ RICONOSCIUTO: {student['name']} {student.get('surname', '')} - Skip")
-                        continue
-                    
-                    # Add to recognized students set
-                    already_recognized_students.add(student_id)
-                    
-                    logger.info(f"\n✅ RICONOSCIUTO: {student['name']} {student.get('surname', '')}")
-                    logger.info(f"   Confidence: {best_match['combined_similarity']:.3f}")
-                    logger.info(f"   🔒 Studente marcato come riconosciuto (ID: {student_id})")
+                    self.diagnostics.sampled(
+                        "match", "✅ Volto %d RICONOSCIUTO: %s %s (ID %s) - confidence %.3f",
+                        face_idx + 1, student['name'], student.get('surname', ''), student_id, best_score
+                    )
                     
                     recognized.append({
                         'userId': student_id,
                         'name': student['name'],
                         'surname': student.get('surname', ''),
-                        'confidence': float(best_match['combined_similarity']),
+                        'confidence': float(best_score),
                         'faceIndex': face['index'],
                         'embedding_cached': student.get('embedding_cached', False)
                     })
                 else:
-                    if matches:
-                        logger.info(
-                            f"\n❌ NON RICONOSCIUTO - "
-                            f"Best: {matches[0]['combined_similarity']:.3f} < {self.similarity_threshold}"
-                        )
-                    else:
-                        logger.info(f"\n❌ NESSUN MATCH")
+                    self.diagnostics.sampled(
+                        "match", "❌ Volto %d NON RICONOSCIUTO - best %.3f < %s",
+                        face_idx + 1, best_score, self.similarity_threshold
+                    )
             
             match_time = (time.time() - match_start) * 1000
             self.metrics.recognition_time_ms = match_time
@@ -1050,29 +2216,48 @@ class FaceDetectionSystem:
             logger.info(f"\n{'='*50}")
             logger.info(f"MATCHING COMPLETATO in {match_time:.0f}ms")
             logger.info(f"Riconosciuti: {len(recognized)}/{len(faces)}")
+            if self.diagnostics.omitted("match"):
+                logger.info(f"{self.diagnostics.omitted('match')} esiti per volto omessi dal log (trace per il dettaglio)")
             
             return recognized
             
         except Exception as e:
             logger.error(f"❌ Errore matching: {e}")
+            self.diagnostics.dump("matching fallito")
             return []
     
+
     def generate_report_image(self, image: np.ndarray, faces: List[Dict], 
-                            recognized: List[Dict]) -> str:
-        """Genera report immagine con annotazioni (legacy support)"""
+                            recognized: List[Dict], as_bytes: bool = False,
+                            perf: Optional[Dict[str, float]] = None) -> Union[str, bytes]:
+        """Genera report immagine con annotazioni (path su disco, o byte codificati con as_bytes)
+        
+        Il frame viene ridotto a report_image_max_size prima di disegnare: header, footer e
+        riquadri sono tracciati solo sulla tela di uscita, con coordinate e font scalati.
+        perf: tempi per il footer (default: metriche dell'analisi corrente, vedi _report_perf)
+        """
         try:
-            report_img = image.copy()
-            height, width = report_img.shape[:2]
+            height, width = image.shape[:2]
+            max_size = self.config["output"].get("report_image_max_size", [1920, 1080])
+            scale = min(1.0, max_size[0] / width, max_size[1] / height)
+            
+            if scale < 1.0:
+                new_size = (max(1, int(width * scale)), max(1, int(height * scale)))
+                report_img = self._downscale(image, new_size)
+            else:
+                report_img = image.copy()
+            out_height, out_width = report_img.shape[:2]
+            
+            # Font e spessori come su frame originale, riportati alla scala della tela
+            font_scale = max(0.5, min(1.5, width / 1000)) * scale
+            thickness = max(1, int(width / 500 * scale))
             
-            # Scala font in base a dimensione immagine
-            font_scale = max(0.5, min(1.5, width / 1000))
-            thickness = max(1, int(width / 500))
+            def px(value: float) -> int:
+                return int(value * font_scale)
             
-            # Header con statistiche
-            header_height = int(50 * font_scale)
-            overlay = report_img.copy()
-            cv2.rectangle(overlay, (0, 0), (width, header_height), (0, 0, 0), -1)
-            report_img = cv2.addWeighted(report_img, 0.7, overlay, 0.3, 0)
+            # Header con statistiche (banda scurita al 70%, solo le righe interessate)
+            header_height = min(out_height, px(50))
+            self._darken_band(report_img, 0, header_height)
             
             stats_text = (
                 f"Face Detection v4.0 | "
@@ -1081,7 +2266,7 @@ class FaceDetectionSystem:
                 f"Faces: {len(faces)} | "
                 f"Recognized: {len(recognized)}"
             )
-            cv2.putText(report_img, stats_text, (10, int(30 * font_scale)),
+            cv2.putText(report_img, stats_text, (10, px(30)),
                        cv2.FONT_HERSHEY_SIMPLEX, font_scale * 0.6, 
                        (255, 255, 255), thickness)
             
@@ -1091,13 +2276,14 @@ class FaceDetectionSystem:
             # Annota volti
             for face in faces:
                 bbox = face['bbox']
-                x, y, w, h = bbox['x'], bbox['y'], bbox['w'], bbox['h']
+                x, y = int(bbox['x'] * scale), int(bbox['y'] * scale)
+                w, h = int(bbox['w'] * scale), int(bbox['h'] * scale)
                 
                 # Assicura che bbox sia dentro i limiti
-                x = max(0, min(x, width - 1))
-                y = max(0, min(y, height - 1))
-                w = min(w, width - x)
-                h = min(h, height - y)
+                x = max(0, min(x, out_width - 1))
+                y = max(0, min(y, out_height - 1))
+                w = min(w, out_width - x)
+                h = min(h, out_height - y)
                 
                 if face['index'] in recognized_map:
                     # Verde per riconosciuti
@@ -1110,19 +2296,18 @@ class FaceDetectionSystem:
                     cached = "📦" if rec.get('embedding_cached', False) else "🔄"
                     
                     # Background per testo
-                    label_height = int(60 * font_scale)
                     cv2.rectangle(report_img, 
-                                (x, y - label_height), 
-                                (x + int(250 * font_scale), y), 
+                                (x, y - px(60)), 
+                                (x + px(250), y), 
                                 (0, 200, 0), -1)
                     
                     cv2.putText(report_img, label, 
-                              (x + 5, y - int(35 * font_scale)),
+                              (x + 5, y - px(35)),
                               cv2.FONT_HERSHEY_SIMPLEX, font_scale * 0.7, 
                               (255, 255, 255), thickness)
                     
                     cv2.putText(report_img, f"{confidence} {cached}", 
-                              (x + 5, y - int(10 * font_scale)),
+                              (x + 5, y - px(10)),
                               cv2.FONT_HERSHEY_SIMPLEX, font_scale * 0.6, 
                               (255, 255, 255), thickness)
                 else:
@@ -1138,7 +2323,7 @@ class FaceDetectionSystem:
                         label_text += f" | Blur: {blur:.0f}"
                     
                     cv2.putText(report_img, label_text,
-                              (x + 5, y - 10),
+                              (x + 5, y - max(4, int(10 * scale))),
                               cv2.FONT_HERSHEY_SIMPLEX, font_scale * 0.5,
                               color, thickness)
                 
@@ -1148,28 +2333,34 @@ class FaceDetectionSystem:
                 
                 # Numero volto
                 cv2.putText(report_img, f"#{face['index'] + 1}", 
-                          (x + w - int(40 * font_scale), y + int(25 * font_scale)),
+                          (x + w - px(40), y + px(25)),
                           cv2.FONT_HERSHEY_SIMPLEX, font_scale * 0.6, 
                           color, thickness)
             
             # Footer con performance metrics
             if self.config["output"].get("include_performance_metrics", True):
-                footer_height = int(30 * font_scale)
-                overlay = report_img.copy()
-                cv2.rectangle(overlay, (0, height - footer_height), 
-                            (width, height), (0, 0, 0), -1)
-                report_img = cv2.addWeighted(report_img, 0.7, overlay, 0.3, 0)
+                perf = perf if perf is not None else self._report_perf()
+                footer_height = min(out_height, px(30))
+                self._darken_band(report_img, out_height - footer_height, out_height)
                 
                 perf_text = (
-                    f"Detection: {self.metrics.detection_time_ms:.0f}ms | "
-                    f"Recognition: {self.metrics.recognition_time_ms:.0f}ms | "
-                    f"Cache Hit: {self.embedding_cache.get_hit_rate():.0%}"
+                    f"Detection: {perf['detection_time_ms']:.0f}ms | "
+                    f"Recognition: {perf['recognition_time_ms']:.0f}ms | "
+                    f"Cache Hit: {perf['cache_hit_rate']:.0%}"
                 )
                 cv2.putText(report_img, perf_text, 
-                          (10, height - int(10 * font_scale)),
+                          (10, out_height - px(10)),
                           cv2.FONT_HERSHEY_SIMPLEX, font_scale * 0.5, 
                           (255, 255, 255), thickness)
             
+            encoded, extension = self._encode_report(report_img)
+            self.last_report_format = extension
+            
+            # Consegna in memoria: nessun file intermedio
+            if as_bytes:
+                logger.info(f"📊 Report generato in memoria: {len(encoded)} bytes ({extension})")
+                return encoded
+            
             # Salva report
             timestamp = datetime.now().strftime('%Y%m%d_%H%M%S')
             
@@ -1181,150 +2372,725 @@ class FaceDetectionSystem:
             
             os.makedirs(reports_dir, exist_ok=True)
             
-            # Comprimi se necessario
-            quality = self.config["output"].get("report_image_quality", 85)
-            max_size = self.config["output"].get("report_image_max_size", [1920, 1080])
-            
-            if width > max_size[0] or height > max_size[1]:
-                scale = min(max_size[0] / width, max_size[1] / height)
-                new_size = (int(width * scale), int(height * scale))
-                report_img = cv2.resize(report_img, new_size)
-            
-            report_path = os.path.join(reports_dir, f"report_v4_{timestamp}.jpg")
-            cv2.imwrite(report_path, report_img, [cv2.IMWRITE_JPEG_QUALITY, quality])
+            report_path = os.path.join(reports_dir, f"report_v4_{timestamp}{extension}")
+            with open(report_path, 'wb') as f:
+                f.write(encoded)
             
             logger.info(f"📊 Report salvato: {report_path}")
             return report_path
             
         except Exception as e:
             logger.error(f"❌ Errore generazione report: {e}")
-            return ""
+            return b"" if as_bytes else ""
+    
+    @staticmethod
+    def _downscale(image: np.ndarray, new_size: Tuple[int, int]) -> np.ndarray:
+        """INTER_AREA con fattore intero (percorso veloce di OpenCV), poi lineare per il resto:
+        qualità da media d'area a una frazione del costo di INTER_AREA con fattore arbitrario"""
+        height, width = image.shape[:2]
+        factor = int(min(width / new_size[0], height / new_size[1]))
+        if factor >= 2:
+            image = cv2.resize(image, (width // factor, height // factor), interpolation=cv2.INTER_AREA)
+        if (image.shape[1], image.shape[0]) == new_size:
+            return image
+        return cv2.resize(image, new_size, interpolation=cv2.INTER_LINEAR)
+    
+    @staticmethod
+    def _darken_band(report_img: np.ndarray, top: int, bottom: int):
+        """Equivale al rettangolo nero fuso con addWeighted(0.7, 0.3), ma solo sulle righe della banda"""
+        if bottom > top:
+            report_img[top:bottom] = cv2.convertScaleAbs(report_img[top:bottom], alpha=0.7)
+    
+    def _encode_report(self, report_img: np.ndarray) -> Tuple[bytes, str]:
+        """Codifica secondo output.report_format ("jpeg" o "webp"); restituisce (byte, estensione)"""
+        quality = int(self.config["output"].get("report_image_quality", 85))
+        if self.config["output"].get("report_format", "jpeg") == "webp":
+            ok, encoded = cv2.imencode('.webp', report_img, [cv2.IMWRITE_WEBP_QUALITY, quality])
+            if ok:
+                return encoded.tobytes(), '.webp'
+            logger.warning("⚠️ Codifica WebP non disponibile, report in JPEG")
+        ok, encoded = cv2.imencode('.jpg', report_img, [cv2.IMWRITE_JPEG_QUALITY, quality])
+        if not ok:
+            raise Exception("Codifica JPEG report fallita")
+        return encoded.tobytes(), '.jpg'
+    
+    def _report_perf(self) -> Dict[str, float]:
+        return {
+            "detection_time_ms": self.metrics.detection_time_ms,
+            "recognition_time_ms": self.metrics.recognition_time_ms,
+            "cache_hit_rate": self.embedding_cache.get_hit_rate()
+        }
+    
+    def _report_job(self, faces: List[Dict], recognized: List[Dict]) -> Dict[str, Any]:
+        """Quanto serve per disegnare il report in seguito (comando render_report), senza l'immagine"""
+        return {
+            "faces": [
+                {
+                    "index": face['index'],
+                    "bbox": face['bbox'],
+                    "confidence": face.get('confidence', 0),
+                    "blur_score": face.get('blur_score', 0)
+                }
+                for face in faces
+            ],
+            "recognized": [
+                {
+                    "faceIndex": r['faceIndex'],
+                    "name": r['name'],
+                    "surname": r['surname'],
+                    "confidence": r['confidence'],
+                    "embedding_cached": r.get('embedding_cached', False)
+                }
+                for r in recognized
+            ],
+            "perf": self._report_perf()
+        }
+    
+    def render_report(self, image_bytes: bytes, job: Dict[str, Any]) -> bytes:
+        """Report differito: ridisegna su un frame ricevuto di nuovo, da un _report_job"""
+        image = self._decode_image(image_bytes)
+        if image is None:
+            raise ValueError("Immagine report non decodificabile")
+        return self.generate_report_image(
+            image, job.get('faces', []), job.get('recognized', []),
+            as_bytes=True, perf=job.get('perf')
+        )
+    
+    def reset_request(self, image_path: Optional[str], students_data_path: Optional[str] = None):
+        """Prepara il sistema per una nuova richiesta riusando i modelli già caricati"""
+        self.image_path = image_path
+        self.students_data_path = students_data_path
+        self.current_image = None
+        self.start_time = time.time()
+        self.metrics = PerformanceMetrics()
+        self.diagnostics.reset()
+        self.similarity_threshold = self.config["models"]["recognizer"]["similarity_threshold"]
+        self.enable_caching = self.config["performance"]["enable_caching"]
+        self.report_mode = self.config["output"].get("report_mode", "inline")
+        self.rematch = False
+        self.frame_key = None
     
     def process_image(self) -> str:
         """Processa immagine completa (legacy interface)"""
+        result = self.analyze()
+        serialize_start = time.perf_counter()
+        output = json.dumps(result, indent=2)
+        self.export_metrics((time.perf_counter() - serialize_start) * 1000)
+        return output
+    
+    def analyze(self, image_bytes: Optional[bytes] = None,
+                students_manifest: Optional[List[Dict[str, Any]]] = None,
+                report_inline: bool = False) -> Dict[str, Any]:
+        """Processa immagine completa e restituisce il risultato strutturato
+        
+        Args:
+            image_bytes: Immagine codificata in memoria (alternativa a self.image_path)
+            students_manifest: Studenti in memoria (alternativa al JSON su disco)
+            report_inline: Se True il report resta in self.last_report_bytes invece che su disco
+                (con report_mode "deferred" il risultato porta invece report_job)
+        """
+        self.last_report_bytes = b""
         try:
             # Tracking tempo totale
             process_start = time.time()
+            self.metrics = self._new_metrics()
             
             # 1. Carica immagine
-            if not os.path.exists(self.image_path):
-                raise Exception(f"Immagine non trovata: {self.image_path}")
+            with self.metrics.span("decode", source="bytes" if image_bytes is not None else "file") as decode_span:
+                if image_bytes is not None:
+                    decode_span["bytes"] = len(image_bytes)
+                    image = self._decode_image(image_bytes)
+                else:
+                    if not self.image_path or not os.path.exists(self.image_path):
+                        raise Exception(f"Immagine non trovata: {self.image_path}")
+                    image = cv2.imread(self.image_path)
             
-            image = cv2.imread(self.image_path)
             if image is None:
                 raise Exception("Errore caricamento immagine")
             
-            logger.info(f"✅ Immagine caricata: {image.shape}")
-            
             # 2. Carica studenti
-            students = self.load_students()
-            
-            # 3. Rileva volti
-            faces = self.detect_faces(self.image_path)
-            
-            # 4. Match volti
-            recognized = []
-            if len(faces) > 0 and len(students) > 0:
-                recognized = self.match_faces(faces, students)
-            
-            # 5. Genera report
-            report_path = ""
-            if self.config["output"].get("save_debug_images", True) or True:  # Sempre per legacy
-                report_path = self.generate_report_image(image, faces, recognized)
-            
-            # Calcola metriche finali
-            total_time = (time.time() - process_start) * 1000
-            self.metrics.total_time_ms = total_time
-            self.metrics.cache_hit_rate = self.embedding_cache.get_hit_rate()
-            
-            # Prepara confidence distribution
-            confidence_dist = {
-                "high_confidence": len([r for r in recognized if r['confidence'] > 0.8]),
-                "medium_confidence": len([r for r in recognized if 0.4 <= r['confidence'] <= 0.8]),
-                "low_confidence": len([r for r in recognized if r['confidence'] < 0.4])
-            }
-            
-            # Calcola studenti assenti
-            recognized_ids = {r['userId'] for r in recognized}
-            absent_students = [
-                {
-                    'userId': student['id'],
-                    'name': student['name'],
-                    'surname': student.get('surname', ''),
-                    'reason': 'not_detected'
-                }
-                for student in students 
-                if student['id'] not in recognized_ids
-            ]
-            
-            # Risultato strutturato
-            result = {
-                "timestamp": datetime.now().isoformat(),
-                "image_file": os.path.basename(self.image_path),
-                "detected_faces": len(faces),
-                "recognized_students": recognized,
-                "absent_students": absent_students,
-                "report_image": report_path,
-                "attendance_stats": {
-                    "total_students": len(students),
-                    "present_count": len(recognized),
-                    "absent_count": len(absent_students),
-                    "attendance_rate": (len(recognized) / len(students) * 100) if students else 0
-                },
-                "processing_info": {
-                    "processing_time": total_time / 1000,  # secondi per legacy
-                    "model_used": self.model_name,
-                    "detector_used": self.detector_backend,
-                    "threshold": self.similarity_threshold,
-                    "version": "4.0-optimized"
-                },
-                "performance_metrics": {
-                    "detection_time_ms": self.metrics.detection_time_ms,
-                    "recognition_time_ms": self.metrics.recognition_time_ms,
-                    "total_time_ms": total_time,
-                    "cache_hit_rate": self.metrics.cache_hit_rate,
-                    "faces_processed": self.metrics.faces_processed
-                },
-                "confidence_distribution": confidence_dist,
-                "quality_metrics": {
-                    "faces_with_high_confidence": len([f for f in faces if f.get('confidence', 0) > 0.95]),
-                    "average_match_confidence": np.mean([r['confidence'] for r in recognized]) if recognized else 0,
-                    "min_match_confidence": min([r['confidence'] for r in recognized]) if recognized else 0,
-                    "max_match_confidence": max([r['confidence'] for r in recognized]) if recognized else 0
-                },
-                "status": "success"
-            }
-            
-            logger.info(f"\n{'='*60}")
-            logger.info(f"✅ ELABORAZIONE COMPLETATA")
-            logger.info(f"{'='*60}")
-            logger.info(f"⏱️  Tempo totale: {total_time:.0f}ms")
-            logger.info(f"👥 Studenti: {len(students)}")
-            logger.info(f"🔍 Volti rilevati: {len(faces)}")
-            logger.info(f"✅ Riconosciuti: {len(recognized)}")
-            logger.info(f"📊 Accuratezza: {(len(recognized)/len(faces)*100) if faces else 0:.1f}%")
-            logger.info(f"💾 Cache hit rate: {self.metrics.cache_hit_rate:.1%}")
-            
-            return json.dumps(result, indent=2)
+            with self.metrics.span("load_students") as students_span:
+                students = self.load_students(students_manifest)
+                students_span["students"] = len(students)
+            self.metrics.load_students_time_ms = self.metrics.stage_totals()["load_students"]
+            
+            # 3-5. Rilevamento, match e report
+            result = self._analyze_loaded_image(
+                image, students, report_inline, process_start, metrics=self.metrics
+            )
+            self.last_report_bytes = result.pop("_report_bytes", b"")
+            return result
             
         except Exception as e:
             logger.error(f"❌ Errore elaborazione: {str(e)}")
             import traceback
             logger.error(traceback.format_exc())
+            self.metrics.total_time_ms = (time.time() - process_start) * 1000
+            self._finish_metrics("error")
+            self.diagnostics.dump("analisi fallita")
             
             # Anche in caso di errore, restituisci JSON strutturato
-            return json.dumps({
-                "error": str(e),
-                "timestamp": datetime.now().isoformat(),
-                "processing_time": (time.time() - self.start_time),
-                "detected_faces": 0,
-                "recognized_students": [],
-                "status": "error",
+            return self._error_result(e)
+    
+    def analyze_batch(self, images: List[Tuple[str, Any]],
+                      students_manifest: Optional[List[Dict[str, Any]]] = None,
+                      report_inline: bool = False) -> Dict[str, Any]:
+        """Analizza più immagini della stessa lezione caricando la galleria studenti una sola volta
+        
+        Args:
+            images: Lista di (nome, sorgente) con sorgente bytes codificati o path su disco
+            students_manifest: Studenti in memoria (alternativa al JSON su disco)
+            report_inline: Se True i report JPEG restano in self.last_report_batch
+        
+        La decodifica delle immagini successive avviene in un thread di prefetch mentre
+        l'immagine corrente è in rilevamento/riconoscimento (cv2.imdecode rilascia il GIL).
+        """
+        self.last_report_batch = []
+        batch_start = time.time()
+        
+        max_batch = int(self.config["performance"].get("max_batch_size", 50))
+        if len(images) > max_batch:
+            raise ValueError(f"Batch troppo grande: {len(images)} immagini (max {max_batch})")
+        
+        load_start = time.perf_counter()
+        students = self.load_students(students_manifest)
+        load_students_ms = (time.perf_counter() - load_start) * 1000
+        # Matrice galleria costruita una volta per tutto il batch
+        gallery = self._build_gallery(students) if students else None
+        
+        def decode(source):
+            if isinstance(source, (bytes, bytearray, memoryview)):
+                return self._decode_image(bytes(source))
+            return cv2.imread(source) if source and os.path.exists(source) else None
+        
+        prefetch = max(1, int(self.config["performance"].get("batch_prefetch", 2)))
+        results = []
+        
+        logger.info(f"\n📚 ANALISI BATCH: {len(images)} immagini, {len(students)} studenti")
+        
+        with ThreadPoolExecutor(max_workers=1, thread_name_prefix='decode') as decoder:
+            pending = [decoder.submit(decode, source) for _, source in images[:prefetch]]
+            
+            for i, (name, _) in enumerate(images):
+                image_start = time.time()
+                self.metrics = self._new_metrics()
+                # Decodifica già avviata in prefetch: lo span misura solo l'attesa residua
+                with self.metrics.span("decode", source="prefetch"):
+                    image = pending[i].result()
+                
+                # Accoda la decodifica della prossima immagine prima di occupare il modello
+                if i + prefetch < len(images):
+                    pending.append(decoder.submit(decode, images[i + prefetch][1]))
+                
+                try:
+                    if image is None:
+                        raise Exception(f"Errore caricamento immagine {name}")
+                    result = self._analyze_loaded_image(
+                        image, students, report_inline, image_start,
+                        image_name=name, gallery=gallery, metrics=self.metrics
+                    )
+                    report_bytes = result.pop("_report_bytes", b"")
+                except Exception as e:
+                    logger.error(f"❌ Errore immagine {name}: {e}")
+                    self.metrics.total_time_ms = (time.time() - image_start) * 1000
+                    self._finish_metrics("error")
+                    self.diagnostics.dump(f"immagine {name} fallita")
+                    result = self._error_result(e)
+                    result["image_file"] = name
+                    report_bytes = b""
+                
+                # Libera il riferimento all'immagine decodificata prima della successiva
+                pending[i] = None
+                self.last_report_batch.append(report_bytes)
+                results.append(result)
+        
+        total_time = (time.time() - batch_start) * 1000
+        merged = self.merge_attendance(results, students)
+        
+        logger.info(f"✅ Batch completato in {total_time:.0f}ms: "
+                    f"{merged['attendance_stats']['present_count']}/{len(students)} presenti")
+        
+        return {
+            "timestamp": datetime.now().isoformat(),
+            "images": results,
+            "merged": merged,
+            "unresolved_students": self.unresolved_students,
+            "stale_enrollments": self.stale_enrollments,
+            "gallery_cached_ids": [s['id'] for s in students] if self.enable_caching else [],
+            "processing_info": {
+                "images": len(images),
+                "processing_time": total_time / 1000,
+                "average_image_ms": total_time / len(images) if images else 0,
+                "load_students_time_ms": load_students_ms,
+                "model_used": self.model_name,
+                "detector_used": self.detector_backend,
+                "threshold": self.similarity_threshold,
                 "version": "4.0-optimized"
-            }, indent=2)
+            },
+            "status": "success"
+        }
+    
+    def _request_state(self) -> Dict[str, Any]:
+        """Stato per richiesta (override, metriche, esito caricamento studenti) da ripristinare
+        quando più richieste si alternano sullo stesso detector (analyze_multi)"""
+        return {
+            "similarity_threshold": self.similarity_threshold,
+            "enable_caching": self.enable_caching,
+            "report_mode": self.report_mode,
+            "rematch": self.rematch,
+            "frame_key": self.frame_key,
+            "trace": self.diagnostics.trace,
+            "metrics": self.metrics,
+            "start_time": self.start_time,
+            "unresolved_students": self.unresolved_students,
+            "stale_enrollments": self.stale_enrollments
+        }
+    
+    def _restore_request_state(self, state: Dict[str, Any]):
+        self.similarity_threshold = state["similarity_threshold"]
+        self.enable_caching = state["enable_caching"]
+        self.report_mode = state["report_mode"]
+        self.rematch = state["rematch"]
+        self.frame_key = state["frame_key"]
+        self.diagnostics.trace = state["trace"]
+        self.metrics = state["metrics"]
+        self.start_time = state["start_time"]
+        self.unresolved_students = state["unresolved_students"]
+        self.stale_enrollments = state["stale_enrollments"]
+    
+    def analyze_multi(self, items: List[Dict[str, Any]]) -> Tuple[List[Dict[str, Any]], List[bytes]]:
+        """Analizza richieste indipendenti (lezioni e studenti diversi) arrivate insieme
+        
+        Rilevamento e match restano per richiesta; i volti di tutte le richieste passano nel
+        recognizer in un unico batch, così le acquisizioni simultanee di più aule condividono
+        i forward pass invece di contendersi i core uno alla volta.
+        
+        Args:
+            items: Lista di {'request', 'image_bytes', 'students_manifest', 'report_inline'}
+                con request = payload analyze_blob originale (override per richiesta)
+        
+        Returns:
+            (risultati, report) nello stesso ordine di items
+        """
+        prepared: List[Optional[Dict[str, Any]]] = []
+        results: List[Optional[Dict[str, Any]]] = [None] * len(items)
+        
+        # 1. Per richiesta: decodifica, studenti, rilevamento e filtro qualità
+        for i, item in enumerate(items):
+            self.reset_request(None)
+            _apply_request_overrides(self, item['request'])
+            process_start = time.time()
+            self.metrics = self._new_metrics()
+            try:
+                with self.metrics.span("decode", source="bytes", bytes=len(item['image_bytes'])):
+                    image = self._decode_image(item['image_bytes'])
+                if image is None:
+                    raise Exception("Errore caricamento immagine")
+                
+                with self.metrics.span("load_students") as students_span:
+                    students = self.load_students(item.get('students_manifest'))
+                    students_span["students"] = len(students)
+                self.metrics.load_students_time_ms = self.metrics.stage_totals()["load_students"]
+                
+                # Rematch o scena invariata: volti già salvati, la richiesta non entra nel batch
+                # del recognizer; scena cambiata in parte: rilevamento solo nelle regioni cambiate
+                stored_faces = self._stored_faces(image) if self.rematch else None
+                gate = self._gate_plan(image) if stored_faces is None else None
+                if gate is not None and gate["mode"] == "skip":
+                    stored_faces = self._apply_gate(gate, [])
+                    gate = None
+                detection = None
+                detection_span = None
+                if stored_faces is None:
+                    regions = gate["regions"] if gate is not None and gate["mode"] == "partial" else None
+                    with self.metrics.span("detection", width=int(image.shape[1]), height=int(image.shape[0])) as detection_span:
+                        try:
+                            detection = self._detect_candidates(None, image, regions)
+                            if detection is None:
+                                self.metrics.count("detection.failed")
+                        except Exception as e:
+                            self._detection_failed(e)
+                
+                prepared.append({
+                    "image": image,
+                    "students": students,
+                    "process_start": process_start,
+                    "detection": detection,
+                    "stored_faces": stored_faces,
+                    "gate": gate,
+                    "detection_span": detection_span,
+                    "state": self._request_state()
+                })
+            except Exception as e:
+                logger.error(f"❌ Errore richiesta {i + 1}/{len(items)} del batch: {e}")
+                self.metrics.total_time_ms = (time.time() - process_start) * 1000
+                self._finish_metrics("error")
+                results[i] = self._error_result(e)
+                prepared.append(None)
+        
+        # 2. Un solo passaggio nel recognizer per i volti di tutte le richieste
+        crops = []
+        for entry in prepared:
+            if entry is not None and entry["detection"] is not None:
+                crops.extend(c['face_bgr'] for c in entry["detection"]["candidates"])
+        requests_with_faces = sum(
+            1 for entry in prepared if entry is not None and entry["detection"] and entry["detection"]["candidates"]
+        )
+        
+        embed_start = time.perf_counter()
+        embeddings, secondary_embeddings = self._embed_candidates(crops) if crops else ([], [])
+        embedding_ms = (time.perf_counter() - embed_start) * 1000
+        if crops:
+            logger.info(f"🧺 Micro-batch: {len(crops)} volti da {requests_with_faces} richieste in {embedding_ms:.0f}ms")
+        
+        # 3. Per richiesta: match, ospiti, report e risultato
+        reports: List[bytes] = [b""] * len(items)
+        offset = 0
+        for i, entry in enumerate(prepared):
+            if entry is None:
+                continue
+            self._restore_request_state(entry["state"])
+            detection = entry["detection"]
+            
+            faces: List[Dict[str, Any]] = entry["stored_faces"] or []
+            if detection is not None:
+                count = len(detection["candidates"])
+                # Quota della richiesta sul batch condiviso: la somma sulle richieste è il tempo
+                # reale del recognizer, non N volte il batch (durata intera in batch_ms)
+                own_ms = embedding_ms * count / len(crops) if crops else 0.0
+                self.metrics.add_span(
+                    "embedding", own_ms, faces=count, model=self.model_name,
+                    batch_faces=len(crops), batch_requests=requests_with_faces,
+                    batch_ms=round(embedding_ms, 3)
+                )
+                self.metrics.count("embedding.micro_batched", count)
+                faces = self._collect_faces(
+                    detection,
+                    embeddings[offset:offset + count],
+                    secondary_embeddings[offset:offset + count],
+                    own_ms
+                )
+                if entry["gate"] is None or entry["gate"]["mode"] == "full":
+                    self._save_detection(entry["image"], faces, detection["raw_faces"])
+                offset += count
+            if entry["gate"] is not None:
+                faces = self._apply_gate(entry["gate"], faces)
+            if entry["detection_span"] is not None:
+                entry["detection_span"]["faces"] = len(faces)
+            
+            try:
+                result = self._analyze_loaded_image(
+                    entry["image"], entry["students"], items[i].get('report_inline', False),
+                    entry["process_start"], metrics=self.metrics, faces=faces
+                )
+                reports[i] = result.pop("_report_bytes", b"")
+            except Exception as e:
+                logger.error(f"❌ Errore richiesta {i + 1}/{len(items)} del batch: {e}")
+                self.metrics.total_time_ms = (time.time() - entry["process_start"]) * 1000
+                self._finish_metrics("error")
+                self.diagnostics.dump("analisi fallita")
+                result = self._error_result(e)
+            results[i] = result
+            # L'immagine decodificata non serve più
+            entry["image"] = None
+        
+        return results, reports
     
-    def _create_comparison_image(self, face_data: Dict, top_matches: List[Dict], output_path: str):
-        """Crea un'immagine di confronto per debug"""
+    def merge_attendance(self, results: List[Dict[str, Any]], 
+                         students: List[Dict[str, Any]]) -> Dict[str, Any]:
+        """Verdetto di presenza unico per la lezione a partire dai risultati delle singole immagini
+        
+        Uno studente è presente se riconosciuto in almeno
+        ceil(batch_min_presence_ratio * immagini analizzate) immagini (minimo 1);
+        per ciascuno si tiene il match con confidenza più alta.
+        """
+        analyzed = [r for r in results if r.get("status") == "success"]
+        ratio = float(self.config["performance"].get("batch_min_presence_ratio", 0.0))
+        min_images = max(1, math.ceil(ratio * len(analyzed)))
+        
+        best: Dict[Any, Dict[str, Any]] = {}
+        seen_in: Dict[Any, List[str]] = {}
+        for result in analyzed:
+            for match in result.get("recognized_students", []):
+                user_id = match['userId']
+                seen_in.setdefault(user_id, []).append(result.get("image_file"))
+                if user_id not in best or match['confidence'] > best[user_id]['confidence']:
+                    best[user_id] = match
+        
+        recognized = []
+        for user_id, match in best.items():
+            if len(seen_in[user_id]) >= min_images:
+                recognized.append({
+                    **match,
+                    "images_seen": len(seen_in[user_id]),
+                    "presence_ratio": len(seen_in[user_id]) / len(analyzed),
+                    "seen_in": seen_in[user_id]
+                })
+        recognized.sort(key=lambda r: r['confidence'], reverse=True)
+        
+        # Studenti esterni al corso: stessa soglia di presenza sulle immagini
+        best_guest: Dict[Any, Dict[str, Any]] = {}
+        guest_seen_in: Dict[Any, List[str]] = {}
+        for result in analyzed:
+            for match in result.get("guest_students", []):
+                user_id = match['userId']
+                guest_seen_in.setdefault(user_id, []).append(result.get("image_file"))
+                if user_id not in best_guest or match['confidence'] > best_guest[user_id]['confidence']:
+                    best_guest[user_id] = match
+        guests = [
+            {**match, "images_seen": len(guest_seen_in[user_id]), "seen_in": guest_seen_in[user_id]}
+            for user_id, match in best_guest.items()
+            if len(guest_seen_in[user_id]) >= min_images
+        ]
+        guests.sort(key=lambda r: r['confidence'], reverse=True)
+        
+        recognized_ids = {r['userId'] for r in recognized}
+        absent_students = [
+            {
+                'userId': student['id'],
+                'name': student['name'],
+                'surname': student.get('surname', ''),
+                'reason': 'below_presence_threshold' if student['id'] in best else 'not_detected'
+            }
+            for student in students
+            if student['id'] not in recognized_ids
+        ]
+        
+        return {
+            "recognized_students": recognized,
+            "guest_students": guests,
+            "absent_students": absent_students,
+            "images_analyzed": len(analyzed),
+            "images_failed": len(results) - len(analyzed),
+            "min_images_required": min_images,
+            "detected_faces": sum(r.get("detected_faces", 0) for r in analyzed),
+            "attendance_stats": {
+                "total_students": len(students),
+                "present_count": len(recognized),
+                "absent_count": len(absent_students),
+                "attendance_rate": (len(recognized) / len(students) * 100) if students else 0
+            }
+        }
+    
+    def _error_result(self, error: Exception) -> Dict[str, Any]:
+        return {
+            "error": str(error),
+            "timestamp": datetime.now().isoformat(),
+            "processing_time": (time.time() - self.start_time),
+            "detected_faces": 0,
+            "recognized_students": [],
+            "status": "error",
+            "version": "4.0-optimized"
+        }
+    
+    @staticmethod
+    def _decode_image(image_bytes: bytes) -> Optional[np.ndarray]:
+        return cv2.imdecode(np.frombuffer(image_bytes, dtype=np.uint8), cv2.IMREAD_COLOR)
+    
+    def _analyze_loaded_image(self, image: np.ndarray, students: List[Dict[str, Any]],
+                              report_inline: bool, process_start: float,
+                              image_name: Optional[str] = None,
+                              gallery: Optional['StudentGallery'] = None,
+                              metrics: Optional[PerformanceMetrics] = None,
+                              faces: Optional[List[Dict[str, Any]]] = None) -> Dict[str, Any]:
+        """Rilevamento, match e report su un'immagine già decodificata e una galleria già caricata
+        
+        metrics: metriche dell'analisi già avviate dal chiamante (decodifica, studenti)
+        faces: volti già rilevati dal chiamante (analyze_multi), altrimenti rilevati qui
+        """
+        logger.info(f"✅ Immagine caricata: {image.shape}")
+        self.current_image = image
+        self.metrics = metrics if metrics is not None else self._new_metrics()
+        
+        # 3. Rileva volti (sull'immagine già decodificata), in rematch dal detection store;
+        #    scatti periodici di un'aula: solo se la scena è cambiata, e solo dove è cambiata
+        if faces is None and self.rematch:
+            faces = self._stored_faces(image)
+        gate = self._gate_plan(image) if faces is None else None
+        if gate is not None and gate["mode"] == "skip":
+            faces = self._apply_gate(gate, [])
+        if faces is None:
+            with self.metrics.span("detection", width=int(image.shape[1]), height=int(image.shape[0])) as detection_span:
+                faces = self.detect_faces(
+                    image_name or self.image_path, image=image,
+                    regions=gate["regions"] if gate is not None and gate["mode"] == "partial" else None
+                )
+                if gate is not None:
+                    faces = self._apply_gate(gate, faces)
+                detection_span["faces"] = len(faces)
+        
+        # 4. Match volti
+        recognized = []
+        if len(faces) > 0 and len(students) > 0:
+            with self.metrics.span("matching", faces=len(faces), students=len(students)) as matching_span:
+                recognized = self.match_faces(faces, gallery if gallery is not None else students)
+                matching_span["recognized"] = len(recognized)
+        self.metrics.count("students_recognized", len(recognized))
+        
+        # 4b. Volti rimasti: studenti di altri corsi (lezioni condivise, ospiti) dall'indice ANN
+        guests = self.identify_guests(faces, recognized, students) if faces else []
+        
+        # 5. Genera report
+        report_path = ""
+        report_bytes = b""
+        report_job = None
+        deferred = report_inline and self.report_mode == "deferred"
+        with self.metrics.span("report", inline=report_inline, deferred=deferred):
+            if deferred:
+                # Fuori dal percorso critico: il chiamante lo farà disegnare con render_report
+                report_job = self._report_job(faces, recognized)
+            elif report_inline:
+                report_bytes = self.generate_report_image(image, faces, recognized, as_bytes=True)
+            else:  # Sempre per legacy
+                report_path = self.generate_report_image(image, faces, recognized)
+        # Calcola metriche finali
+        total_time = (time.time() - process_start) * 1000
+        self.metrics.total_time_ms = total_time
+        self.metrics.cache_hit_rate = self.embedding_cache.get_hit_rate()
+        self._finish_metrics("success")
+        
+        # Prepara confidence distribution
+        confidence_dist = {
+            "high_confidence": len([r for r in recognized if r['confidence'] > 0.8]),
+            "medium_confidence": len([r for r in recognized if 0.4 <= r['confidence'] <= 0.8]),
+            "low_confidence": len([r for r in recognized if r['confidence'] < 0.4])
+        }
+        
+        # Calcola studenti assenti
+        recognized_ids = {r['userId'] for r in recognized}
+        absent_students = [
+            {
+                'userId': student['id'],
+                'name': student['name'],
+                'surname': student.get('surname', ''),
+                'reason': 'not_detected'
+            }
+            for student in students 
+            if student['id'] not in recognized_ids
+        ]
+        
+        # Risultato strutturato
+        result = {
+            "timestamp": datetime.now().isoformat(),
+            "image_file": image_name or (os.path.basename(self.image_path) if self.image_path else "inline"),
+            "detected_faces": len(faces),
+            "recognized_students": recognized,
+            "guest_students": guests,
+            "absent_students": absent_students,
+            "report_image": report_path,
+            "attendance_stats": {
+                "total_students": len(students),
+                "present_count": len(recognized),
+                "absent_count": len(absent_students),
+                "attendance_rate": (len(recognized) / len(students) * 100) if students else 0
+            },
+            "processing_info": {
+                "processing_time": total_time / 1000,  # secondi per legacy
+                "model_used": self.model_name,
+                "detector_used": self.detector_backend,
+                "threshold": self.similarity_threshold,
+                "version": "4.0-optimized"
+            },
+            "performance_metrics": {
+                "detection_time_ms": self.metrics.detection_time_ms,
+                "recognition_time_ms": self.metrics.recognition_time_ms,
+                "total_time_ms": total_time,
+                "cache_hit_rate": self.metrics.cache_hit_rate,
+                "faces_processed": self.metrics.faces_processed,
+                "detection_mode": self.metrics.detection_mode,
+                "frame_gate": self.metrics.frame_gate,
+                "inference_backend": self.onnx_models.variant(self.model_name) or "tensorflow",
+                "load_students_time_ms": self.metrics.load_students_time_ms,
+                "model_load_ms": self.metrics.model_load_ms,
+                "memory_peak_mb": round(self.metrics.memory_peak_mb, 1),
+                "memory_peak_scope": self.metrics.memory_peak_scope,
+                "tracemalloc_peak_mb": (round(self.metrics.tracemalloc_peak_mb, 1)
+                                        if self.metrics.tracemalloc_peak_mb is not None else None),
+                "stages_ms": self.metrics.stage_totals(),
+                "counters": dict(self.metrics.counters),
+                "trace_id": self.metrics.trace_id,
+                "spans": [dict(span) for span in self.metrics.spans],
+                "debug_artifacts": dict(self.debug_writer.stats) if self.save_debug_faces else None
+            },
+            "confidence_distribution": confidence_dist,
+            "unresolved_students": self.unresolved_students,
+            "stale_enrollments": self.stale_enrollments,
+            "gallery_cached_ids": [s['id'] for s in students] if self.enable_caching else [],
+            "quality_metrics": {
+                "faces_with_high_confidence": len([f for f in faces if f.get('confidence', 0) > 0.95]),
+                "average_match_confidence": float(np.mean([r['confidence'] for r in recognized])) if recognized else 0,
+                "min_match_confidence": min([r['confidence'] for r in recognized]) if recognized else 0,
+                "max_match_confidence": max([r['confidence'] for r in recognized]) if recognized else 0
+            },
+            "status": "success"
+        }
+        
+        logger.info(f"\n{'='*60}")
+        logger.info(f"✅ ELABORAZIONE COMPLETATA")
+        logger.info(f"{'='*60}")
+        logger.info(f"⏱️  Tempo totale: {total_time:.0f}ms")
+        logger.info(f"👥 Studenti: {len(students)}")
+        logger.info(f"🔍 Volti rilevati: {len(faces)}")
+        logger.info(f"✅ Riconosciuti: {len(recognized)}")
+        logger.info(f"📊 Accuratezza: {(len(recognized)/len(faces)*100) if faces else 0:.1f}%")
+        logger.info(f"💾 Cache hit rate: {self.metrics.cache_hit_rate:.1%}")
+        logger.info("⏱️  Fasi: " + " | ".join(
+            f"{name} {ms:.0f}ms" for name, ms in self.metrics.stage_totals().items()
+        ))
+        
+        # Trace esplicito: il dettaglio accumulato finisce nel risultato (e nel log)
+        if self.diagnostics.trace:
+            self.diagnostics.dump("trace", level=logging.INFO)
+            result["diagnostics"] = self.diagnostics.lines(clear=True)
+        
+        if report_job is not None:
+            result["report_job"] = report_job
+        result["_report_bytes"] = report_bytes
+        return result
+    
+    def _submit_debug(self, filename: str, render) -> bool:
+        """Accoda un artefatto di debug al writer in background (lo scarto è solo contato)"""
+        if self.debug_writer.submit(os.path.join(self.debug_faces_dir, filename), render):
+            return True
+        self.metrics.count("debug_artifacts.dropped")
+        return False
+    
+    def _submit_debug_face(self, filename: str, face_img: np.ndarray, label: str):
+        """Volto di debug: conversione uint8 e controllo immagine nera nel thread del writer"""
+        def render():
+            face_to_save = self._to_uint8(face_img)
+            if np.mean(face_to_save) < 5:
+                logger.error(f"⚠️ ATTENZIONE: {label} sembra essere nero/vuoto!")
+            return face_to_save
+        self._submit_debug(filename, render)
+    
+    @staticmethod
+    def _format_match_details(face_number: int, matches: List[Dict], distance_metric: str,
+                              threshold: float) -> str:
+        """Testo dei dettagli match di un volto (top 10) per debug"""
+        lines = [
+            f"DETTAGLI MATCH VOLTO {face_number}",
+            "=" * 50,
+            "",
+            f"Threshold configurato: {threshold}",
+            f"Metrica distanza: {distance_metric}",
+            ""
+        ]
+        for i, match in enumerate(matches[:10]):
+            student = match['student']
+            lines.append(f"{i+1}. {student['name']} {student.get('surname', '')}")
+            lines.append(f"   - Similarity: {match['combined_similarity']:.6f}")
+            lines.append(f"   - Distance: {match['distance']:.6f}")
+            lines.append(f"   - Supera threshold: {'SI' if match['combined_similarity'] > threshold else 'NO'}")
+            if 'similarity_secondary' in match:
+                lines.append(f"   - Secondary similarity: {match['similarity_secondary']:.6f}")
+            lines.append("")
+        return "\n".join(lines) + "\n"
+    
+    def _create_comparison_image(self, face_data: Dict, top_matches: List[Dict],
+                                 image: Optional[np.ndarray]) -> Optional[np.ndarray]:
+        """Crea un'immagine di confronto per debug (eseguita nel thread del writer, sul frame
+        catturato all'accodamento)"""
         try:
             # Dimensioni per ogni volto
             face_size = 150
@@ -1340,9 +3106,8 @@ class FaceDetectionSystem:
             comparison_img = np.ones((height, width, 3), dtype=np.uint8) * 255
             
             # Aggiungi volto rilevato
-            if 'bbox' in face_data:
-                # Estrai volto dall'immagine originale
-                image = cv2.imread(self.image_path)
+            if 'bbox' in face_data and image is not None:
+                # Estrai volto dall'immagine originale già in memoria (slice, nessuna rilettura)
                 bbox = face_data['bbox']
                 face_region = image[bbox['y']:bbox['y']+bbox['h'], bbox['x']:bbox['x']+bbox['w']]
                 face_resized = cv2.resize(face_region, (face_size, face_size))
@@ -1379,18 +3144,385 @@ class FaceDetectionSystem:
                 cv2.putText(comparison_img, text[:15], (x_pos, height-25), font, 0.4, (0, 0, 0), 1)
                 cv2.putText(comparison_img, f"Sim: {sim:.3f}", (x_pos, height-10), font, 0.4, (0, 128, 0), 1)
             
-            # Salva immagine
-            cv2.imwrite(output_path, comparison_img)
+            return comparison_img
             
         except Exception as e:
             logger.error(f"Errore creazione immagine confronto: {e}")
+            return None
+
+# ============================================================
+# WORKER PERSISTENTE (modalità serve) e handoff binario (--framed)
+# Protocollo: ogni frame è un intero big-endian a 4 byte con la
+# lunghezza del payload, seguito dal payload. Un messaggio è un frame
+# JSON in UTF-8; se contiene "attachments": N è seguito da N frame
+# binari grezzi (immagine, foto studenti, report JPEG).
+# ============================================================
+
+FRAME_HEADER = struct.Struct('>I')
+MAX_FRAME_SIZE = 256 * 1024 * 1024
+
+def read_frame(stream) -> Optional[bytes]:
+    """Legge un frame length-prefixed, None se lo stream è chiuso"""
+    header = stream.read(FRAME_HEADER.size)
+    if not header:
+        return None
+    if len(header) < FRAME_HEADER.size:
+        raise EOFError("Header frame incompleto")
+    
+    (length,) = FRAME_HEADER.unpack(header)
+    if length > MAX_FRAME_SIZE:
+        raise ValueError(f"Frame troppo grande: {length} bytes")
+    
+    payload = stream.read(length)
+    if len(payload) < length:
+        raise EOFError("Payload frame incompleto")
+    return payload
+
+def write_frame(stream, payload: bytes, flush: bool = True):
+    """Scrive un frame length-prefixed"""
+    stream.write(FRAME_HEADER.pack(len(payload)))
+    stream.write(payload)
+    if flush:
+        stream.flush()
+
+def read_message(stream) -> Tuple[Optional[Dict[str, Any]], List[bytes]]:
+    """Legge un messaggio JSON e i suoi allegati binari, (None, []) se lo stream è chiuso"""
+    payload = read_frame(stream)
+    if payload is None:
+        return None, []
+    message = json.loads(payload.decode('utf-8'))
+    
+    attachments = []
+    for _ in range(int(message.get('attachments', 0))):
+        blob = read_frame(stream)
+        if blob is None:
+            raise EOFError("Allegato mancante")
+        attachments.append(blob)
+    return message, attachments
+
+def write_message(stream, message: Dict[str, Any], attachments: Optional[List[bytes]] = None):
+    """Scrive un messaggio JSON seguito dagli allegati binari"""
+    attachments = attachments or []
+    message = {**message, "attachments": len(attachments)}
+    write_frame(stream, json.dumps(message).encode('utf-8'), flush=not attachments)
+    for i, blob in enumerate(attachments):
+        write_frame(stream, blob, flush=(i == len(attachments) - 1))
+
+def open_protocol_streams():
+    """Canale binario dedicato su stdin/stdout, stdout "umano" ridiretto su stderr"""
+    # Qualunque print delle librerie (es. progress bar Keras) finirebbe nel
+    # canale del protocollo: teniamo un fd dedicato e ridirigiamo stdout su stderr
+    protocol_out = os.fdopen(os.dup(sys.stdout.fileno()), 'wb')
+    os.dup2(sys.stderr.fileno(), sys.stdout.fileno())
+    sys.stdout = sys.stderr
+    return sys.stdin.buffer, protocol_out
+
+def _manifest_students(manifest: List[Dict[str, Any]], attachments: List[bytes]) -> List[Dict[str, Any]]:
+    """Risolve i riferimenti agli allegati nel manifest studenti"""
+    students = []
+    for entry in manifest:
+        student = dict(entry)
+        photo_ref = student.pop('photo', None)
+        if photo_ref is not None:
+            student['photo_bytes'] = attachments[photo_ref['attachment']]
+        embedding_ref = student.pop('embedding', None)
+        if embedding_ref is not None:
+            student['embedding_bytes'] = attachments[embedding_ref['attachment']]
+            student['embedding_meta'] = {k: v for k, v in embedding_ref.items() if k != 'attachment'}
+        students.append(student)
+    return students
+
+def handle_worker_request(detector: 'FaceDetectionSystem', request: Dict[str, Any],
+                          attachments: Optional[List[bytes]] = None) -> Tuple[Dict[str, Any], List[bytes]]:
+    """Esegue un singolo comando; restituisce (risposta, allegati)"""
+    command = request.get('command', 'analyze')
+    attachments = attachments or []
+    
+    if command == 'ping':
+        return {
+            "status": "ok",
+            "pong": True,
+            "uptime_s": time.time() - detector.worker_started_at,
+            "requests_served": detector.requests_served
+        }, []
+    
+    if command in ('analyze', 'analyze_blob'):
+        image_bytes = None
+        students_manifest = None
+        
+        if command == 'analyze_blob':
+            image_bytes = attachments[request['image']['attachment']]
+            students_manifest = _manifest_students(request.get('students', []), attachments)
+            detector.reset_request(None)
+        else:
+            image_path = request.get('image_path')
+            if not image_path:
+                raise ValueError("image_path mancante")
+            detector.reset_request(image_path, request.get('students_path'))
+        
+        _apply_request_overrides(detector, request)
+        
+        report_inline = command == 'analyze_blob' and request.get('return_report', True)
+        result = detector.analyze(
+            image_bytes=image_bytes,
+            students_manifest=students_manifest,
+            report_inline=report_inline
+        )
+        detector.requests_served += 1
+        
+        output_path = request.get('output_path')
+        if output_path:
+            with open(output_path, 'w', encoding='utf-8') as f:
+                json.dump(result, f, indent=2)
+        
+        response_attachments = []
+        if report_inline and detector.last_report_bytes:
+            result['report_attachment'] = 0
+            result['report_format'] = detector.last_report_format.lstrip('.')
+            response_attachments.append(detector.last_report_bytes)
+        
+        return {"status": "ok", "result": result}, response_attachments
+    
+    if command == 'analyze_batch':
+        # Immagini come allegati binari oppure path su disco, galleria caricata una volta
+        images = []
+        for i, item in enumerate(request.get('images', [])):
+            source = attachments[item['attachment']] if 'attachment' in item else item.get('path')
+            images.append((item.get('name') or f"image_{i}", source))
+        if not images:
+            raise ValueError("Nessuna immagine nel batch")
+        
+        students_manifest = None
+        if 'students' in request:
+            students_manifest = _manifest_students(request['students'], attachments)
+        detector.reset_request(None, request.get('students_path'))
+        _apply_request_overrides(detector, request)
+        
+        report_inline = request.get('return_report', False)
+        result = detector.analyze_batch(images, students_manifest, report_inline=report_inline)
+        detector.requests_served += 1
+        
+        response_attachments = []
+        for image_result, report_bytes in zip(result['images'], detector.last_report_batch):
+            if report_inline and report_bytes:
+                image_result['report_attachment'] = len(response_attachments)
+                image_result['report_format'] = detector.last_report_format.lstrip('.')
+                response_attachments.append(report_bytes)
+        
+        return {"status": "ok", "result": result}, response_attachments
+    
+    if command == 'analyze_multi':
+        # Richieste analyze_blob indipendenti accorpate dal pool: ogni elemento porta la propria
+        # richiesta e i propri allegati (offset/count nella lista complessiva)
+        items = []
+        for item in request.get('items', []):
+            item_request = item['request']
+            offset = item.get('attachment_offset', 0)
+            item_attachments = attachments[offset:offset + item.get('attachment_count', 0)]
+            items.append({
+                "request": item_request,
+                "image_bytes": item_attachments[item_request['image']['attachment']],
+                "students_manifest": _manifest_students(item_request.get('students', []), item_attachments),
+                "report_inline": item_request.get('return_report', True)
+            })
+        if not items:
+            raise ValueError("Nessuna richiesta in analyze_multi")
+        
+        results, reports = detector.analyze_multi(items)
+        detector.requests_served += len(items)
+        
+        responses = []
+        response_attachments = []
+        for result, report_bytes in zip(results, reports):
+            # Come analyze_blob: un'analisi fallita è un risultato con status "error", non un errore del comando
+            item_response = {"status": "ok", "result": result,
+                             "attachment_offset": len(response_attachments), "attachment_count": 0}
+            if report_bytes:
+                result['report_attachment'] = 0
+                result['report_format'] = detector.last_report_format.lstrip('.')
+                response_attachments.append(report_bytes)
+                item_response["attachment_count"] = 1
+            responses.append(item_response)
+        
+        return {"status": "ok", "results": responses}, response_attachments
+    
+    if command == 'enroll':
+        # Allegato 0 = foto studente; risposta con l'embedding compatto come allegato 0
+        if not attachments:
+            raise ValueError("enroll richiede la foto come allegato")
+        detector.reset_request(None)
+        label = " ".join(p for p in (request.get('name'), request.get('surname')) if p) or "studente"
+        metadata, embedding_bytes = detector.enroll(
+            attachments[request.get('photo', {}).get('attachment', 0)],
+            user_id=request.get('user_id'),
+            label=label
+        )
+        detector.requests_served += 1
+        return {"status": "ok", "result": {**metadata, "embedding_attachment": 0}}, [embedding_bytes]
+    
+    if command == 'index_remove':
+        # Studenti eliminati o disattivati: fuori dall'indice ANN di tutti i worker
+        removed = detector.remove_from_index(request.get('user_ids') or [])
+        return {"status": "ok", "result": {"removed": removed, "indexed": detector.ann_index_size()}}, []
+    
+    if command == 'render_report':
+        # Report differito: allegato 0 = frame originale, job = report_job di un'analisi precedente
+        job = request.get('job')
+        if not job or not attachments:
+            raise ValueError("render_report richiede job e immagine")
+        start = time.perf_counter()
+        report_bytes = detector.render_report(attachments[request.get('image', {}).get('attachment', 0)], job)
+        if not report_bytes:
+            raise ValueError("Generazione report fallita")
+        return {
+            "status": "ok",
+            "result": {
+                "report_attachment": 0,
+                "report_format": detector.last_report_format.lstrip('.'),
+                "render_ms": (time.perf_counter() - start) * 1000
+            }
+        }, [report_bytes]
+    
+    raise ValueError(f"Comando sconosciuto: {command}")
+
+def _apply_request_overrides(detector: 'FaceDetectionSystem', request: Dict[str, Any]):
+    """Override per singola richiesta (soglia, cache) sui valori di config"""
+    if request.get('threshold') is not None:
+        detector.similarity_threshold = float(request['threshold'])
+    if request.get('no_cache'):
+        detector.enable_caching = False
+    if request.get('trace'):
+        detector.diagnostics.trace = True
+    if request.get('report_mode'):
+        detector.report_mode = request['report_mode']
+    if request.get('rematch'):
+        detector.rematch = True
+    if request.get('frame_key'):
+        detector.frame_key = str(request['frame_key'])
+
+def serve(args):
+    """Loop del worker: modelli residenti, richieste via stdin/stdout a frame"""
+    protocol_in, protocol_out = open_protocol_streams()
+    
+    logger.info(f"🛰️ Avvio worker persistente (pid {os.getpid()})")
+    
+    detector = FaceDetectionSystem(config_path=args.config)
+    # Il worker dichiara "ready" solo con framework e modelli già in memoria
+    if detector.requires_deepface():
+        load_deepface()
+    detector.warm_up()
+    detector.worker_started_at = time.time()
+    detector.requests_served = 0
+    
+    write_message(protocol_out, {
+        "type": "ready",
+        "pid": os.getpid(),
+        "detector": detector.detector_backend,
+        "model": detector.model_name,
+        "startup_ms": (time.time() - detector.start_time) * 1000,
+        "startup_profile": startup_profile()
+    })
+    
+    try:
+        while True:
+            try:
+                request, attachments = read_message(protocol_in)
+            except (EOFError, ValueError) as e:
+                logger.error(f"❌ Frame non valido, chiusura worker: {e}")
+                break
+            
+            if request is None:
+                logger.info("🛑 stdin chiuso, arresto worker")
+                break
+            
+            request_id = request.get('id')
+            
+            if request.get('command') == 'shutdown':
+                write_message(protocol_out, {"type": "response", "id": request_id, "status": "ok"})
+                logger.info("🛑 Shutdown richiesto, arresto worker")
+                break
+            
+            try:
+                response, response_attachments = handle_worker_request(detector, request, attachments)
+            except Exception as e:
+                logger.error(f"❌ Errore richiesta {request_id}: {e}")
+                response, response_attachments = {"status": "error", "error": str(e)}, []
+            
+            response.update({"type": "response", "id": request_id})
+            serialize_start = time.perf_counter()
+            write_message(protocol_out, response, response_attachments)
+            detector.export_metrics((time.perf_counter() - serialize_start) * 1000)
+    finally:
+        detector.close()
+
+def serve_framed_once(args):
+    """Una singola richiesta a frame su stdin, risposta a frame su stdout (nessun file temporaneo)"""
+    protocol_in, protocol_out = open_protocol_streams()
+    
+    request, attachments = read_message(protocol_in)
+    if request is None:
+        write_message(protocol_out, {"type": "response", "status": "error", "error": "Nessuna richiesta su stdin"})
+        return
+    
+    detector = FaceDetectionSystem(config_path=args.config)
+    detector.worker_started_at = time.time()
+    detector.requests_served = 0
+    
+    try:
+        try:
+            response, response_attachments = handle_worker_request(detector, request, attachments)
+        except Exception as e:
+            logger.error(f"❌ Errore richiesta: {e}")
+            response, response_attachments = {"status": "error", "error": str(e)}, []
+        
+        response.update({"type": "response", "id": request.get('id')})
+        serialize_start = time.perf_counter()
+        write_message(protocol_out, response, response_attachments)
+        detector.export_metrics((time.perf_counter() - serialize_start) * 1000)
+    finally:
+        detector.close()
+
+def startup_profile() -> Dict[str, float]:
+    """Profilo di avvio corrente, con il tempo totale dall'inizio dell'import del modulo"""
+    return {
+        **{key: round(value, 1) for key, value in STARTUP_PROFILE.items()},
+        "total_ms": round((time.perf_counter() - _MODULE_START) * 1000, 1)
+    }
+
+def serve_main(argv: List[str]):
+    """Entry point del sottocomando serve"""
+    parser = argparse.ArgumentParser(
+        prog='face_detection.py serve',
+        description='Worker persistente: modelli residenti, protocollo JSON length-prefixed su stdin/stdout'
+    )
+    parser.add_argument('--config', help='File configurazione custom')
+    parser.add_argument('--debug', action='store_true', help='Modalità debug')
+    
+    args = parser.parse_args(argv)
+    
+    if args.debug:
+        logger.setLevel(logging.DEBUG)
+    
+    serve(args)
 
 def main():
     """Entry point con supporto CLI"""
+    if len(sys.argv) > 1 and sys.argv[1] == 'serve':
+        serve_main(sys.argv[2:])
+        return
+    if len(sys.argv) > 1 and sys.argv[1] == 'build-gallery':
+        from gallery_build import main as build_gallery_main
+        build_gallery_main(sys.argv[2:])
+        return
+    
     parser = argparse.ArgumentParser(
         description='Face Detection System v4.0 - Optimized with RetinaFace + Facenet512'
     )
-    parser.add_argument('image_path', help='Path immagine da analizzare')
+    parser.add_argument('image_path', nargs='?', help='Path immagine da analizzare')
+    parser.add_argument('--framed', action='store_true',
+                       help='Richiesta a frame binari su stdin, risposta a frame su stdout')
+    parser.add_argument('--images', nargs='+',
+                       help='Batch: più immagini della stessa lezione, galleria caricata una volta')
     parser.add_argument('--output', help='File output JSON')
     parser.add_argument('--students', help='File JSON con dati studenti')
     parser.add_argument('--config', help='File configurazione custom')
@@ -1399,17 +3531,47 @@ def main():
     parser.add_argument('--detector', choices=['retinaface', 'mtcnn', 'opencv'], 
                        help='Override detector backend')
     parser.add_argument('--no-cache', action='store_true', help='Disabilita cache embeddings')
+    parser.add_argument('--trace', action='store_true',
+                       help='Diagnostica completa per volto/studente nel log e nel risultato JSON')
+    parser.add_argument('--rematch', action='store_true',
+                       help='Volti ed embeddings dal detection store se già salvati: rifà solo il match')
+    parser.add_argument('--startup-profile', action='store_true',
+                       help='Tempi di import e caricamento modelli (da solo: carica i modelli ed esce)')
     
     args = parser.parse_args()
     
     if args.debug:
         logger.setLevel(logging.DEBUG)
     
+    if args.framed:
+        serve_framed_once(args)
+        return
+    
+    if args.startup_profile and not args.image_path and not args.images:
+        # Solo profilo di avvio: framework + modelli, nessuna analisi
+        try:
+            constructor_start = time.perf_counter()
+            detector = FaceDetectionSystem(config_path=args.config)
+            STARTUP_PROFILE["constructor_ms"] = (time.perf_counter() - constructor_start) * 1000
+            if detector.requires_deepface():
+                load_deepface()
+            detector.warm_up()
+            detector.close()
+            print(json.dumps({"startup_profile": startup_profile(), "status": "success"}, indent=2))
+        except Exception as e:
+            print(json.dumps({"startup_profile": startup_profile(), "error": str(e), "status": "critical_error"}))
+            sys.exit(1)
+        return
+    
+    if not args.image_path and not args.images:
+        parser.error("image_path richiesto (oppure --images / --framed)")
+    
     print("=" * 70)
     print("FACE DETECTION SYSTEM v4.0 - PRODUCTION OPTIMIZED")
     print("Models: RetinaFace + Facenet512")
     print("=" * 70)
     
+    detector = None
     try:
         # Crea sistema
         detector = FaceDetectionSystem(
@@ -1431,8 +3593,24 @@ def main():
             detector.enable_caching = False
             logger.info("🎯 Cache disabilitata")
         
+        if args.trace:
+            detector.diagnostics.trace = True
+        
+        if args.rematch:
+            detector.rematch = True
+        
         # Processa
-        result = detector.process_image()
+        if args.images:
+            images = [(os.path.basename(path), path) for path in args.images]
+            result_data = detector.analyze_batch(images)
+        else:
+            result_data = detector.analyze()
+        
+        if args.startup_profile:
+            result_data["startup_profile"] = startup_profile()
+        serialize_start = time.perf_counter()
+        result = json.dumps(result_data, indent=2)
+        detector.export_metrics((time.perf_counter() - serialize_start) * 1000)
         
         # Output
         if args.output:
@@ -1451,6 +3629,10 @@ def main():
         })
         print(error_result)
         sys.exit(1)
+    finally:
+        # Anche con sys.exit: artefatti di debug in coda scritti e thread fermato prima dell'uscita
+        if detector is not None:
+            detector.close()
 
 if __name__ == "__main__":
     main()
\ No newline at end of file
@@ -0,0 +1,196 @@
+"""
+Frame Gate - filtro pre-analisi per gli scatti periodici della stessa aula
+Per ogni aula resta su disco la firma dell'ultimo frame analizzato: dHash a 64 bit e mappa in
+scala di grigi sottocampionata (griglia di celle), insieme ai volti validati di quel frame.
+Un nuovo scatto viene confrontato con la firma:
+  - "skip": scena invariata, si riusano i volti salvati e si rifà solo il match
+  - "partial": poche celle cambiate, il detector gira solo sulle regioni cambiate e i volti
+    fuori da quelle regioni restano quelli salvati
+  - "full": scena cambiata (o nessuna firma, frame di altra dimensione, troppi skip di fila,
+    ultima analisi completa più vecchia di max_age_s)
+La differenza per cella è calcolata al netto della variazione mediana, così l'esposizione
+automatica della telecamera non fa sembrare cambiata l'intera scena.
+"""
+
+import os
+import re
+import time
+import logging
+from typing import List, Dict, Any, Optional, Tuple
+
+import cv2
+import numpy as np
+
+from detection_store import pack_faces, unpack_faces, save_arrays
+
+logger = logging.getLogger('FaceDetectionV4')
+
+def frame_signature(image: np.ndarray, grid: Tuple[int, int]) -> Tuple[np.ndarray, np.ndarray]:
+    """(dHash 64 bit come 8 byte, mappa grigi grid_w × grid_h uint8)"""
+    gray = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY) if image.ndim == 3 else image
+    small = cv2.resize(gray, (9, 8), interpolation=cv2.INTER_AREA)
+    dhash = np.packbits(small[:, 1:] > small[:, :-1])
+    cells = cv2.resize(gray, (int(grid[0]), int(grid[1])), interpolation=cv2.INTER_AREA)
+    return dhash, cells
+
+def hash_distance(a: np.ndarray, b: np.ndarray) -> int:
+    return int(np.unpackbits(np.bitwise_xor(a, b)).sum())
+
+def _intersects(bbox: Dict[str, int], region: Tuple[int, int, int, int]) -> bool:
+    x, y, w, h = region
+    return (bbox['x'] < x + w and x < bbox['x'] + bbox['w'] and
+            bbox['y'] < y + h and y < bbox['y'] + bbox['h'])
+
+class FrameGate:
+    """Decisione skip/partial/full per aula, stato condiviso dai worker (un .npz per aula)"""
+
+    def __init__(self, gate_config: Dict[str, Any], state_dir: str):
+        self.grid = tuple(gate_config.get("grid", [32, 18]))
+        self.cell_threshold = float(gate_config.get("cell_threshold", 12))
+        self.max_hash_distance = int(gate_config.get("max_hash_distance", 6))
+        self.skip_changed_ratio = float(gate_config.get("skip_changed_ratio", 0.02))
+        self.partial_max_ratio = float(gate_config.get("partial_max_ratio", 0.35))
+        self.region_padding = int(gate_config.get("region_padding_cells", 1))
+        self.min_region_size = int(gate_config.get("min_region_size", 160))
+        self.max_consecutive_skips = int(gate_config.get("max_consecutive_skips", 10))
+        self.max_age_s = float(gate_config.get("max_age_s", 600))
+        self.state_dir = state_dir
+
+        self.stats = {"skip": 0, "partial": 0, "full": 0}
+
+        os.makedirs(self.state_dir, exist_ok=True)
+
+    def _path(self, frame_key: str) -> str:
+        return os.path.join(self.state_dir, f"{re.sub(r'[^A-Za-z0-9_.-]', '_', str(frame_key))}.npz")
+
+    def plan(self, frame_key: str, image: np.ndarray, fingerprint: str) -> Dict[str, Any]:
+        """Confronta il frame con l'ultimo analizzato dell'aula (fingerprint: impronta di
+        detector e modelli, i volti salvati con un'altra impronta non vengono riusati)
+
+        Returns:
+            {'mode', 'faces' (volti salvati da riusare), 'regions' (x, y, w, h in pixel per
+             partial), 'changed_ratio', 'hash_distance', 'skips', 'signature', 'key'}
+        """
+        dhash, cells = frame_signature(image, self.grid)
+        plan = {
+            "key": frame_key, "mode": "full", "faces": [], "regions": [],
+            "changed_ratio": None, "hash_distance": None, "skips": 0,
+            "signature": (dhash, cells), "shape": image.shape, "fingerprint": fingerprint
+        }
+
+        state = self._load(frame_key)
+        if state is None:
+            plan["reason"] = "nessun frame di riferimento"
+            return self._count(plan)
+        if tuple(state["shape"]) != tuple(image.shape) or state["cells"].shape != cells.shape:
+            plan["reason"] = "risoluzione cambiata"
+            return self._count(plan)
+        if state["fingerprint"] != fingerprint:
+            plan["reason"] = "modelli cambiati"
+            return self._count(plan)
+
+        # Celle cambiate al netto della variazione globale di luminosità
+        diff = cells.astype(np.int16) - state["cells"].astype(np.int16)
+        diff -= int(np.median(diff))
+        changed = np.abs(diff) > self.cell_threshold
+        changed_ratio = float(changed.mean())
+        distance = hash_distance(dhash, state["dhash"])
+        plan.update(changed_ratio=changed_ratio, hash_distance=distance, skips=state["skips"],
+                    analyzed_at=state["analyzed_at"])
+
+        if time.time() - state["analyzed_at"] > self.max_age_s:
+            plan["reason"] = "riferimento troppo vecchio"
+        elif distance <= self.max_hash_distance and changed_ratio <= self.skip_changed_ratio:
+            if state["skips"] < self.max_consecutive_skips:
+                plan.update(mode="skip", faces=state["faces"])
+            else:
+                plan["reason"] = "troppi skip consecutivi"
+        elif changed_ratio <= self.partial_max_ratio:
+            regions = self._changed_regions(changed, image.shape)
+            plan.update(
+                mode="partial",
+                regions=regions,
+                faces=[f for f in state["faces"] if not any(_intersects(f['bbox'], r) for r in regions)]
+            )
+        else:
+            plan["reason"] = "scena cambiata"
+        return self._count(plan)
+
+    def _count(self, plan: Dict[str, Any]) -> Dict[str, Any]:
+        self.stats[plan["mode"]] += 1
+        return plan
+
+    def _changed_regions(self, changed: np.ndarray, shape: Tuple[int, ...]) -> List[Tuple[int, int, int, int]]:
+        """Regioni in pixel delle celle cambiate (componenti connesse, con margine in celle)"""
+        height, width = shape[:2]
+        grid_h, grid_w = changed.shape
+        cell_w, cell_h = width / grid_w, height / grid_h
+        count, _, stats, _ = cv2.connectedComponentsWithStats(changed.astype(np.uint8), connectivity=8)
+
+        regions = []
+        for label in range(1, count):
+            cx, cy, cw, ch = stats[label][:4]
+            x1 = max(0, cx - self.region_padding)
+            y1 = max(0, cy - self.region_padding)
+            x2 = min(grid_w, cx + cw + self.region_padding)
+            y2 = min(grid_h, cy + ch + self.region_padding)
+            px1, py1 = int(x1 * cell_w), int(y1 * cell_h)
+            px2, py2 = min(width, int(np.ceil(x2 * cell_w))), min(height, int(np.ceil(y2 * cell_h)))
+            # Regione minima attorno al centro: il detector ha bisogno di contesto attorno al volto
+            if px2 - px1 < self.min_region_size:
+                center = (px1 + px2) // 2
+                px1 = max(0, min(center - self.min_region_size // 2, width - self.min_region_size))
+                px2 = min(width, px1 + self.min_region_size)
+            if py2 - py1 < self.min_region_size:
+                center = (py1 + py2) // 2
+                py1 = max(0, min(center - self.min_region_size // 2, height - self.min_region_size))
+                py2 = min(height, py1 + self.min_region_size)
+            regions.append((px1, py1, px2 - px1, py2 - py1))
+        return regions
+
+    def commit(self, plan: Dict[str, Any], faces: List[Dict[str, Any]]):
+        """Aggiorna lo stato dell'aula dopo l'analisi: uno skip incrementa solo il contatore,
+        partial e full sostituiscono firma e volti (nuovo frame di riferimento). Solo un full
+        aggiorna analyzed_at: i volti riusati da un partial non sono stati riverificati, e
+        max_age_s impone comunque un'analisi completa anche a una scena che cambia di poco"""
+        path = self._path(plan["key"])
+        try:
+            if plan["mode"] == "skip":
+                with np.load(path, allow_pickle=False) as data:
+                    arrays = {name: data[name] for name in data.files}
+                arrays["skips"] = np.array(int(arrays["skips"]) + 1, dtype=np.int32)
+            else:
+                dhash, cells = plan["signature"]
+                arrays = {
+                    **pack_faces(faces),
+                    "dhash": dhash,
+                    "cells": cells,
+                    "shape": np.array(plan["shape"], dtype=np.int32),
+                    "fingerprint": np.array(plan["fingerprint"]),
+                    "skips": np.array(0, dtype=np.int32),
+                    "analyzed_at": np.array(
+                        plan["analyzed_at"] if plan["mode"] == "partial" else time.time(),
+                        dtype=np.float64
+                    )
+                }
+            save_arrays(path, arrays)
+        except Exception as e:
+            logger.warning(f"⚠️ Stato frame gate non salvato ({plan['key']}): {e}")
+
+    def _load(self, frame_key: str) -> Optional[Dict[str, Any]]:
+        try:
+            with np.load(self._path(frame_key), allow_pickle=False) as data:
+                return {
+                    "dhash": data["dhash"],
+                    "cells": data["cells"],
+                    "shape": data["shape"].tolist(),
+                    "fingerprint": str(data["fingerprint"]),
+                    "skips": int(data["skips"]),
+                    "analyzed_at": float(data["analyzed_at"]),
+                    "faces": unpack_faces(data)
+                }
+        except FileNotFoundError:
+            return None
+        except Exception as e:
+            logger.warning(f"⚠️ Stato frame gate illeggibile ({frame_key}): {e}")
+            return None
@@ -0,0 +1,284 @@
+"""
+Ricostruzione massiva della galleria studenti (cambio di modello o di versione DeepFace)
+Il manifest JSONL ({id, name, surname, photo[, photo_hash]}) viene diviso in blocchi elaborati
+da un pool di processi, ognuno con i modelli caricati una sola volta; i blocchi passano da
+enroll_many, quindi stessa validazione e stesso formato compatto del comando enroll.
+results.jsonl fa da checkpoint (una riga per studente, l'ultima vince): un'esecuzione interrotta
+riprende dagli studenti mancanti. Lo scambio con la galleria in uso è del chiamante
+(scripts/rebuild_gallery.js, una sola transazione): fino ad allora restano validi gli
+embeddings del modello precedente.
+A ricostruzione completa viene scritto anche gallery.gal (formato di gallery_file), utilizzabile
+dai worker tramite gallery.path della config.
+"""
+
+import os
+import sys
+import json
+import time
+import base64
+import logging
+import argparse
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor, FIRST_COMPLETED, wait
+from concurrent.futures.process import BrokenProcessPool
+from typing import List, Dict, Any, Optional
+
+import numpy as np
+
+from embedding_store import decode_embedding
+from gallery_file import PackedGallery
+
+logger = logging.getLogger('FaceDetectionV4')
+
+# Detector del processo worker, creato dall'initializer del pool
+_worker_detector = None
+
+def _init_worker(config_path: Optional[str]):
+    global _worker_detector
+    from face_detection import FaceDetectionSystem, load_deepface
+    _worker_detector = FaceDetectionSystem(config_path=config_path)
+    # Niente indice ANN né journal: la galleria ricostruita li sostituisce entrambi
+    _worker_detector._ann_journal = None
+    if _worker_detector.requires_deepface():
+        load_deepface()
+    _worker_detector.warm_up()
+
+def _enroll_chunk(entries: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+    """Eseguito nel worker: un record di risultato per ogni voce del blocco"""
+    start = time.perf_counter()
+    records: List[Optional[Dict[str, Any]]] = [None] * len(entries)
+    items, positions = [], []
+
+    for i, entry in enumerate(entries):
+        label = " ".join(p for p in (entry.get('name'), entry.get('surname')) if p) or str(entry['id'])
+        try:
+            with open(entry['photo'], 'rb') as f:
+                items.append((entry['id'], f.read(), label))
+            positions.append(i)
+        except OSError as e:
+            records[i] = {"id": entry['id'], "status": "failed", "error": f"Foto non leggibile: {e}"}
+
+    outcomes = _worker_detector.enroll_many(items) if items else []
+    for i, outcome in zip(positions, outcomes):
+        if isinstance(outcome, Exception):
+            records[i] = {"id": entries[i]['id'], "status": "failed", "error": str(outcome)}
+        else:
+            metadata, embedding = outcome
+            records[i] = {
+                "id": entries[i]['id'],
+                "status": "ok",
+                **metadata,
+                "embedding": base64.b64encode(embedding).decode('ascii')
+            }
+
+    per_photo_ms = (time.perf_counter() - start) * 1000 / max(1, len(entries))
+    for record in records:
+        record["ms"] = round(per_photo_ms, 1)
+    return records
+
+def load_checkpoint(results_path: str) -> Dict[Any, Dict[str, Any]]:
+    """Ultimo record per studente (le righe troncate da un'interruzione vengono ignorate)"""
+    done: Dict[Any, Dict[str, Any]] = {}
+    if not os.path.exists(results_path):
+        return done
+    with open(results_path, 'r', encoding='utf-8') as f:
+        for line in f:
+            try:
+                record = json.loads(line)
+            except ValueError:
+                continue
+            done[record['id']] = record
+    return done
+
+def _truncate_partial_line(results_path: str):
+    """Rimuove l'ultima riga se incompleta, così le nuove righe non le si accodano"""
+    if not os.path.exists(results_path):
+        return
+    with open(results_path, 'rb+') as f:
+        data = f.read()
+        if data and not data.endswith(b'\n'):
+            f.truncate(data.rfind(b'\n') + 1)
+
+def _needs_processing(entry: Dict[str, Any], record: Optional[Dict[str, Any]], retry_failed: bool) -> bool:
+    """Studente da (ri)elaborare: assente dal checkpoint, fallito con retry_failed, oppure
+    con foto cambiata rispetto al record (photo_hash opzionale nel manifest)"""
+    if record is None:
+        return True
+    if record['status'] != 'ok':
+        return retry_failed
+    return bool(entry.get('photo_hash')) and record.get('photo_hash') != entry['photo_hash']
+
+def write_packed_gallery(records: List[Dict[str, Any]], path: str, dtype: str) -> Dict[str, Any]:
+    """Galleria compatta dai record ok del checkpoint (un solo modello)"""
+    models = {record['model'] for record in records}
+    if len(models) != 1:
+        raise ValueError(f"Record di {len(models)} modelli diversi ({', '.join(sorted(models))})")
+    embeddings = np.stack([
+        decode_embedding(base64.b64decode(record['embedding']), record['dtype']) for record in records
+    ])
+    size = PackedGallery.write(
+        path, [record['id'] for record in records], embeddings, models.pop(), dtype,
+        [record['photo_hash'] for record in records]
+    )
+    return {"path": path, "rows": len(records), "dtype": dtype, "bytes": size}
+
+def _gallery_dtype(config_path: Optional[str]) -> str:
+    """dtype del file galleria: gallery.storage_dtype della config (float32 se assente)"""
+    if config_path and os.path.exists(config_path):
+        with open(config_path, 'r') as f:
+            return json.load(f).get("gallery", {}).get("storage_dtype", "float32")
+    return "float32"
+
+def build_gallery(manifest_path: str, output_dir: str, config_path: Optional[str] = None,
+                  workers: Optional[int] = None, chunk_size: int = 16,
+                  retry_failed: bool = False, gallery_dtype: Optional[str] = None) -> Dict[str, Any]:
+    """Elabora gli studenti del manifest non ancora presenti nel checkpoint; restituisce il riepilogo"""
+    with open(manifest_path, 'r', encoding='utf-8') as f:
+        entries = [json.loads(line) for line in f if line.strip()]
+
+    os.makedirs(output_dir, exist_ok=True)
+    results_path = os.path.join(output_dir, 'results.jsonl')
+    _truncate_partial_line(results_path)
+    done = load_checkpoint(results_path)
+    pending = [entry for entry in entries if _needs_processing(entry, done.get(entry['id']), retry_failed)]
+    skipped = len(entries) - len(pending)
+
+    workers = workers or max(1, (os.cpu_count() or 2) - 1)
+    chunk_size = max(1, chunk_size)
+    chunks = [pending[i:i + chunk_size] for i in range(0, len(pending), chunk_size)]
+    workers = max(1, min(workers, len(chunks)))
+
+    logger.info(f"🏗️ Galleria: {len(entries)} studenti, {skipped} già nel checkpoint, "
+                f"{len(pending)} da elaborare su {workers} processi (blocchi da {chunk_size})")
+
+    stats = {"ok": 0, "failed": 0}
+    failures: List[Dict[str, Any]] = []
+    models = set()
+    start = time.perf_counter()
+    interrupted = None
+
+    if chunks:
+        # spawn: nessun processo figlio eredita thread o stato dei framework dal padre
+        context = multiprocessing.get_context('spawn')
+        with open(results_path, 'a', encoding='utf-8') as out, \
+                ProcessPoolExecutor(max_workers=workers, mp_context=context,
+                                    initializer=_init_worker, initargs=(config_path,)) as pool:
+            queue = iter(chunks)
+            in_flight = set()
+            processed = 0
+            try:
+                while True:
+                    # Al più due blocchi in coda per processo: progresso e checkpoint regolari
+                    while len(in_flight) < workers * 2:
+                        chunk = next(queue, None)
+                        if chunk is None:
+                            break
+                        in_flight.add(pool.submit(_enroll_chunk, chunk))
+                    if not in_flight:
+                        break
+
+                    completed, in_flight = wait(in_flight, return_when=FIRST_COMPLETED)
+                    for future in completed:
+                        records = future.result()
+                        for record in records:
+                            out.write(json.dumps(record) + '\n')
+                            stats[record['status']] += 1
+                            if record['status'] == 'ok':
+                                models.add(record['model'])
+                            else:
+                                failures.append({"id": record['id'], "error": record['error']})
+                                logger.warning(f"⚠️ Studente {record['id']}: {record['error']}")
+                        out.flush()
+                        os.fsync(out.fileno())
+
+                        processed += len(records)
+                        elapsed = time.perf_counter() - start
+                        rate = processed / elapsed if elapsed > 0 else 0
+                        eta = (len(pending) - processed) / rate if rate > 0 else 0
+                        logger.info(f"📈 {processed}/{len(pending)} foto, {rate:.1f} foto/s, ETA {eta:.0f}s")
+            except (BrokenProcessPool, KeyboardInterrupt) as e:
+                # Il checkpoint ha già tutti i blocchi completati: basta rilanciare
+                interrupted = str(e) or type(e).__name__
+                logger.error(f"❌ Ricostruzione interrotta ({interrupted}), riprende dal checkpoint")
+                for future in in_flight:
+                    future.cancel()
+
+    elapsed = time.perf_counter() - start
+    processed = stats["ok"] + stats["failed"]
+    final = load_checkpoint(results_path)
+    complete = all(entry['id'] in final for entry in entries)
+
+    packed = None
+    ok_records = [final[entry['id']] for entry in entries
+                  if entry['id'] in final and final[entry['id']]['status'] == 'ok']
+    if not interrupted and complete and ok_records:
+        try:
+            packed = write_packed_gallery(
+                ok_records, os.path.join(output_dir, 'gallery.gal'), gallery_dtype or _gallery_dtype(config_path)
+            )
+            logger.info(f"🗂️ Galleria compatta: {packed['rows']} righe {packed['dtype']} "
+                        f"({packed['bytes'] / 1024:.0f}KB) in {packed['path']}")
+        except (OSError, ValueError) as e:
+            logger.warning(f"⚠️ Galleria compatta non scritta: {e}")
+
+    summary = {
+        "status": "interrupted" if interrupted else "success",
+        "error": interrupted,
+        "total": len(entries),
+        "skipped": skipped,
+        "processed": processed,
+        "ok": stats["ok"],
+        "failed": stats["failed"],
+        "complete": complete,
+        "models": sorted(models),
+        "workers": workers,
+        "elapsed_s": round(elapsed, 2),
+        "photos_per_s": round(processed / elapsed, 2) if elapsed > 0 else 0,
+        "failures": failures,
+        "results_path": results_path,
+        "gallery": packed
+    }
+
+    tmp_path = os.path.join(output_dir, 'summary.json.tmp')
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+        json.dump(summary, f, indent=2)
+    os.replace(tmp_path, os.path.join(output_dir, 'summary.json'))
+
+    logger.info(f"✅ Galleria: {stats['ok']} ok, {stats['failed']} falliti in {elapsed:.1f}s "
+                f"({summary['photos_per_s']} foto/s)")
+    return summary
+
+def main(argv: List[str]):
+    """Entry point del sottocomando build-gallery"""
+    parser = argparse.ArgumentParser(
+        prog='face_detection.py build-gallery',
+        description='Ricostruzione embeddings studenti su un pool di processi, con checkpoint'
+    )
+    parser.add_argument('--manifest', required=True, help='JSONL {id, name, surname, photo[, photo_hash]}')
+    parser.add_argument('--output-dir', required=True, help='Directory di results.jsonl (checkpoint) e summary.json')
+    parser.add_argument('--config', help='File configurazione custom (modello di destinazione)')
+    parser.add_argument('--workers', type=int, help='Processi (default: CPU - 1)')
+    parser.add_argument('--chunk-size', type=int, default=16, help='Foto per blocco / forward pass')
+    parser.add_argument('--retry-failed', action='store_true', help='Rielabora anche le foto già fallite')
+    parser.add_argument('--gallery-dtype', choices=['float32', 'float16', 'int8'],
+                        help='dtype di gallery.gal (default: gallery.storage_dtype della config)')
+    parser.add_argument('--debug', action='store_true', help='Modalità debug')
+
+    args = parser.parse_args(argv)
+
+    if not logger.handlers and not logging.getLogger().handlers:
+        logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+    if args.debug:
+        logger.setLevel(logging.DEBUG)
+
+    summary = build_gallery(
+        args.manifest, args.output_dir, args.config,
+        workers=args.workers, chunk_size=args.chunk_size, retry_failed=args.retry_failed,
+        gallery_dtype=args.gallery_dtype
+    )
+    print(json.dumps(summary))
+    if summary["status"] != "success":
+        sys.exit(1)
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
@@ -0,0 +1,217 @@
+"""
+Formato binario compatto della galleria studenti (file .gal)
+Una galleria di istituto intera in un unico file: righe L2-normalizzate contigue in float32,
+float16 oppure int8 con scala per riga, più la norma originale di ogni riga (serve alla
+distanza euclidea). Il file si apre via np.memmap senza copie: un'analisi di corso legge solo
+le righe dei propri studenti. Il prodotto scalare con le righe quantizzate avviene a blocchi,
+senza mai decomprimere l'intera matrice.
+
+Layout (little-endian, sezioni allineate a 64 byte):
+  magic "FDGAL001" | uint32 lunghezza intestazione | intestazione JSON
+  (versione, modello, dim, dtype, righe, ids, photo_hashes, offset delle sezioni)
+  | norme float32[righe] | scale float32[righe] (solo int8) | righe dtype[righe × dim]
+"""
+
+import os
+import json
+import time
+import struct
+import logging
+from typing import List, Dict, Any, Optional, Sequence, Tuple, Union
+
+import numpy as np
+
+from embedding_store import EMBEDDING_DTYPES, quantize_rows
+
+logger = logging.getLogger('FaceDetectionV4')
+
+GALLERY_MAGIC = b'FDGAL001'
+GALLERY_VERSION = 1
+ALIGNMENT = 64
+
+def _align(offset: int) -> int:
+    return (offset + ALIGNMENT - 1) // ALIGNMENT * ALIGNMENT
+
+def quantize_matrix(matrix: np.ndarray, dtype: str) -> Tuple[np.ndarray, Optional[np.ndarray]]:
+    """Righe (già normalizzate) nel dtype di conservazione: (matrice, scale o None)"""
+    if dtype not in EMBEDDING_DTYPES:
+        raise ValueError(f"dtype galleria non supportato: {dtype}")
+    if dtype == "int8":
+        return quantize_rows(matrix)
+    return np.ascontiguousarray(matrix, dtype=EMBEDDING_DTYPES[dtype]), None
+
+def quantized_dot(queries: np.ndarray, matrix: np.ndarray, scales: Optional[np.ndarray] = None,
+                  block_rows: int = 4096) -> np.ndarray:
+    """queries (q × dim, float32) · matrix.T con matrix float32/float16/int8 (× scale per riga)
+
+    Le righe non float32 vengono convertite un blocco alla volta: memoria aggiuntiva limitata
+    a block_rows × dim float32 qualunque sia la dimensione della galleria.
+    """
+    queries = np.asarray(queries, dtype=np.float32)
+    if matrix.dtype == np.float32 and scales is None:
+        return queries @ matrix.T
+
+    rows = matrix.shape[0]
+    result = np.empty((queries.shape[0], rows), dtype=np.float32)
+    block_rows = max(1, block_rows)
+    for start in range(0, rows, block_rows):
+        block = matrix[start:start + block_rows].astype(np.float32)
+        result[:, start:start + block_rows] = queries @ block.T
+    if scales is not None:
+        result *= scales[None, :]
+    return result
+
+class PackedGallery:
+    """Galleria letta da un file o buffer nel formato compatto (viste senza copia)"""
+
+    def __init__(self, header: Dict[str, Any], buffer: Union[bytes, memoryview, np.ndarray],
+                 source: str = "buffer"):
+        self.header = header
+        self.source = source
+        self.model: str = header['model']
+        self.dim: int = header['dim']
+        self.dtype: str = header['dtype']
+        self.ids: List[Any] = header['ids']
+        self.photo_hashes: List[Optional[str]] = header['photo_hashes']
+        count = header['rows']
+
+        self.norms = np.frombuffer(buffer, dtype='<f4', count=count, offset=header['norms_offset'])
+        self.scales = (
+            np.frombuffer(buffer, dtype='<f4', count=count, offset=header['scales_offset'])
+            if header.get('scales_offset') is not None else None
+        )
+        self.matrix = np.frombuffer(
+            buffer, dtype=EMBEDDING_DTYPES[self.dtype], count=count * self.dim, offset=header['data_offset']
+        ).reshape(count, self.dim)
+
+        self._rows_by_id: Optional[Dict[Any, int]] = None
+
+    def __len__(self) -> int:
+        return len(self.ids)
+
+    @property
+    def nbytes(self) -> int:
+        return self.matrix.nbytes + self.norms.nbytes + (self.scales.nbytes if self.scales is not None else 0)
+
+    # ------------------------------------------------------------------
+    # Scrittura
+    # ------------------------------------------------------------------
+
+    @staticmethod
+    def pack(ids: Sequence[Any], embeddings: np.ndarray, model: str, dtype: str = "float32",
+             photo_hashes: Optional[Sequence[Optional[str]]] = None) -> bytes:
+        """Serializza embeddings (righe × dim, non normalizzati) nel formato compatto"""
+        embeddings = np.asarray(embeddings, dtype=np.float32)
+        if embeddings.ndim != 2 or embeddings.shape[0] != len(ids):
+            raise ValueError(f"Embeddings {embeddings.shape} non allineati a {len(ids)} id")
+        count, dim = embeddings.shape
+
+        norms = np.linalg.norm(embeddings, axis=1).astype(np.float32)
+        normalized = embeddings / np.maximum(norms, 1e-12)[:, None]
+        matrix, scales = quantize_matrix(normalized, dtype)
+
+        header = {
+            "version": GALLERY_VERSION,
+            "model": model,
+            "dim": dim,
+            "dtype": dtype,
+            "rows": count,
+            "created_at": time.time(),
+            "ids": list(ids),
+            "photo_hashes": list(photo_hashes) if photo_hashes is not None else [None] * count
+        }
+        # Gli offset dipendono dalla lunghezza dell'intestazione che li contiene: si stimano con
+        # cifre abbondanti e si completa l'intestazione con spazi fino all'allineamento
+        for key in ("norms_offset", "scales_offset", "data_offset"):
+            header[key] = 10 ** 15
+        prefix = _align(len(GALLERY_MAGIC) + 4 + len(json.dumps(header).encode('utf-8')))
+
+        header["norms_offset"] = prefix
+        offset = _align(prefix + norms.nbytes)
+        header["scales_offset"] = offset if scales is not None else None
+        if scales is not None:
+            offset = _align(offset + scales.nbytes)
+        header["data_offset"] = offset
+
+        header_bytes = json.dumps(header).encode('utf-8')
+        header_bytes += b' ' * (prefix - len(GALLERY_MAGIC) - 4 - len(header_bytes))
+
+        out = bytearray(offset + matrix.nbytes)
+        out[:len(GALLERY_MAGIC)] = GALLERY_MAGIC
+        out[len(GALLERY_MAGIC):len(GALLERY_MAGIC) + 4] = struct.pack('<I', len(header_bytes))
+        out[len(GALLERY_MAGIC) + 4:prefix] = header_bytes
+        out[prefix:prefix + norms.nbytes] = norms.astype('<f4').tobytes()
+        if scales is not None:
+            out[header["scales_offset"]:header["scales_offset"] + scales.nbytes] = scales.astype('<f4').tobytes()
+        out[offset:] = matrix.tobytes()
+        return bytes(out)
+
+    @classmethod
+    def write(cls, path: str, ids: Sequence[Any], embeddings: np.ndarray, model: str,
+              dtype: str = "float32", photo_hashes: Optional[Sequence[Optional[str]]] = None) -> int:
+        """Scrive il file in modo atomico (i processi con il vecchio file mappato non vedono
+        scritture parziali); restituisce i byte scritti"""
+        data = cls.pack(ids, embeddings, model, dtype, photo_hashes)
+        tmp_path = f"{path}.tmp.{os.getpid()}"
+        with open(tmp_path, 'wb') as f:
+            f.write(data)
+        os.replace(tmp_path, path)
+        return len(data)
+
+    # ------------------------------------------------------------------
+    # Lettura
+    # ------------------------------------------------------------------
+
+    @staticmethod
+    def _read_header(buffer: Union[bytes, memoryview, np.ndarray]) -> Dict[str, Any]:
+        prefix = bytes(buffer[:len(GALLERY_MAGIC) + 4])
+        if len(prefix) < len(GALLERY_MAGIC) + 4 or prefix[:len(GALLERY_MAGIC)] != GALLERY_MAGIC:
+            raise ValueError("Non è un file galleria (magic errato)")
+        (length,) = struct.unpack('<I', prefix[len(GALLERY_MAGIC):])
+        start = len(GALLERY_MAGIC) + 4
+        header = json.loads(bytes(buffer[start:start + length]).decode('utf-8'))
+        if header.get('version') != GALLERY_VERSION:
+            raise ValueError(f"Versione galleria {header.get('version')} non supportata")
+
+        expected = header['data_offset'] + header['rows'] * header['dim'] * np.dtype(EMBEDDING_DTYPES[header['dtype']]).itemsize
+        if len(buffer) < expected:
+            raise ValueError(f"File galleria troncato ({len(buffer)}/{expected} byte)")
+        return header
+
+    @classmethod
+    def from_bytes(cls, data: Union[bytes, memoryview]) -> 'PackedGallery':
+        """Galleria da un buffer in memoria (es. allegato del protocollo), senza copie"""
+        return cls(cls._read_header(data), data)
+
+    @classmethod
+    def open(cls, path: str) -> 'PackedGallery':
+        """Galleria da file via memmap: le pagine vengono lette solo quando servono"""
+        mapped = np.memmap(path, dtype=np.uint8, mode='r')
+        return cls(cls._read_header(mapped), mapped, source=path)
+
+    # ------------------------------------------------------------------
+    # Accesso
+    # ------------------------------------------------------------------
+
+    def find(self, user_id: Any, photo_hash: Optional[str] = None) -> Optional[int]:
+        """Riga dello studente; None se assente o calcolata da un'altra foto"""
+        if self._rows_by_id is None:
+            self._rows_by_id = {user_id: row for row, user_id in enumerate(self.ids)}
+        row = self._rows_by_id.get(user_id)
+        if row is None:
+            return None
+        stored_hash = self.photo_hashes[row]
+        if photo_hash is not None and stored_hash is not None and stored_hash != photo_hash:
+            return None
+        return row
+
+    def vector(self, row: int) -> np.ndarray:
+        """Embedding float32 originale (de-quantizzato) della riga"""
+        values = self.matrix[row].astype(np.float32)
+        if self.scales is not None:
+            values *= self.scales[row]
+        return values * self.norms[row]
+
+    def dot(self, queries: np.ndarray, block_rows: int = 4096) -> np.ndarray:
+        """Prodotto scalare tra queries e le righe normalizzate (volti × righe)"""
+        return quantized_dot(queries, self.matrix, self.scales, block_rows)
@@ -0,0 +1,453 @@
+"""
+Backend di inferenza ONNX Runtime (solo CPU) per detector RetinaFace e recognizer
+Modelli esportati da TensorFlow con tf2onnx, opzionalmente quantizzati int8 (quantizzazione
+dinamica). A runtime serve solo onnxruntime: se detector e recognizer sono entrambi ONNX
+il processo non importa TensorFlow.
+
+Esportazione e quantizzazione (una tantum, nell'ambiente con TensorFlow + tf2onnx):
+    python scripts/onnx_backend.py export Facenet512 retinaface --output models/onnx
+    python scripts/onnx_backend.py quantize models/onnx/Facenet512.onnx models/onnx/retinaface.onnx
+
+Prima di abilitarlo in produzione verificare la parità con scripts/benchmarks/onnx_parity.py.
+"""
+
+import os
+import sys
+import math
+import logging
+import argparse
+from typing import List, Dict, Any, Optional, Tuple
+
+import cv2
+import numpy as np
+
+logger = logging.getLogger('FaceDetectionV4')
+
+DETECTOR_MODEL = "retinaface"
+
+# Ancore RetinaFace (mobilenet/resnet insightface) per stride, 2 ancore per cella
+RETINAFACE_STRIDES = [32, 16, 8]
+RETINAFACE_ANCHORS = {
+    32: np.array([[-248., -248., 263., 263.], [-120., -120., 135., 135.]], dtype=np.float32),
+    16: np.array([[-56., -56., 71., 71.], [-24., -24., 39., 39.]], dtype=np.float32),
+    8: np.array([[-8., -8., 23., 23.], [0., 0., 15., 15.]], dtype=np.float32)
+}
+RETINAFACE_NMS_THRESHOLD = 0.4
+# Lato corto portato a 1024px, lato lungo al massimo 1980px (come il pacchetto retinaface)
+RETINAFACE_SCALES = (1024, 1980)
+
+def load_onnxruntime():
+    """Importa onnxruntime al primo utilizzo"""
+    try:
+        import onnxruntime
+    except ImportError as e:
+        raise RuntimeError(f"onnxruntime non installato: {e}") from e
+    return onnxruntime
+
+def model_filename(model_name: str, quantized: bool = False) -> str:
+    return f"{model_name}.int8.onnx" if quantized else f"{model_name}.onnx"
+
+def create_session(model_path: str, threads: int = 0):
+    """Sessione ONNX Runtime su CPU con ottimizzazioni grafo complete"""
+    ort = load_onnxruntime()
+    options = ort.SessionOptions()
+    options.graph_optimization_level = ort.GraphOptimizationLevel.ORT_ENABLE_ALL
+    if threads > 0:
+        options.intra_op_num_threads = threads
+        options.inter_op_num_threads = 1
+    return ort.InferenceSession(model_path, sess_options=options, providers=['CPUExecutionProvider'])
+
+class OnnxRecognizer:
+    """Recognizer ONNX con la stessa interfaccia chiamabile del modello Keras
+    (input NHWC float32 in [0,1], output embeddings per riga)"""
+
+    def __init__(self, model_path: str, threads: int = 0):
+        self.model_path = model_path
+        self.session = create_session(model_path, threads)
+        model_input = self.session.get_inputs()[0]
+        self.input_name = model_input.name
+        self.output_name = self.session.get_outputs()[0].name
+
+        height, width = model_input.shape[1:3]
+        if not isinstance(height, int) or not isinstance(width, int):
+            raise ValueError(f"{model_path}: dimensione input non fissa {model_input.shape}")
+        self.input_shape = (None, height, width, 3)
+
+    def __call__(self, tensor: np.ndarray, training: bool = False) -> np.ndarray:
+        return self.session.run(
+            [self.output_name],
+            {self.input_name: np.ascontiguousarray(tensor, dtype=np.float32)}
+        )[0]
+
+def fit_to_size(image: np.ndarray, target_hw: Tuple[int, int]) -> np.ndarray:
+    """Resize con aspect ratio e padding nero al centro (come DeepFace.extract_faces)"""
+    target_h, target_w = target_hw
+    if image.shape[0] > 0 and image.shape[1] > 0:
+        factor = min(target_h / image.shape[0], target_w / image.shape[1])
+        dsize = (max(1, int(image.shape[1] * factor)), max(1, int(image.shape[0] * factor)))
+        image = cv2.resize(image, dsize)
+        diff_h = target_h - image.shape[0]
+        diff_w = target_w - image.shape[1]
+        image = np.pad(
+            image,
+            ((diff_h // 2, diff_h - diff_h // 2), (diff_w // 2, diff_w - diff_w // 2), (0, 0)),
+            'constant'
+        )
+    if image.shape[:2] != (target_h, target_w):
+        image = cv2.resize(image, (target_w, target_h))
+    return image
+
+def align_face(face: np.ndarray, right_eye: Tuple[float, float], left_eye: Tuple[float, float]) -> np.ndarray:
+    """Ruota il ritaglio attorno al centro portando gli occhi in orizzontale"""
+    dx = left_eye[0] - right_eye[0]
+    dy = left_eye[1] - right_eye[1]
+    if (dx == 0 and dy == 0) or face.size == 0:
+        return face
+    angle = math.degrees(math.atan2(dy, dx))
+    height, width = face.shape[:2]
+    rotation = cv2.getRotationMatrix2D((width / 2, height / 2), angle, 1.0)
+    return cv2.warpAffine(face, rotation, (width, height), flags=cv2.INTER_LINEAR,
+                          borderMode=cv2.BORDER_CONSTANT, borderValue=0)
+
+def _anchors_plane(height: int, width: int, stride: int, base_anchors: np.ndarray) -> np.ndarray:
+    shift_x = np.arange(width, dtype=np.float32) * stride
+    shift_y = np.arange(height, dtype=np.float32) * stride
+    shift_x, shift_y = np.meshgrid(shift_x, shift_y)
+    shifts = np.stack([shift_x, shift_y, shift_x, shift_y], axis=-1)[:, :, None, :]
+    return (shifts + base_anchors[None, None, :, :]).reshape(-1, 4)
+
+def _anchor_geometry(anchors: np.ndarray) -> Tuple[np.ndarray, np.ndarray, np.ndarray, np.ndarray]:
+    widths = anchors[:, 2] - anchors[:, 0] + 1.0
+    heights = anchors[:, 3] - anchors[:, 1] + 1.0
+    ctr_x = anchors[:, 0] + 0.5 * (widths - 1.0)
+    ctr_y = anchors[:, 1] + 0.5 * (heights - 1.0)
+    return widths, heights, ctr_x, ctr_y
+
+def _decode_boxes(anchors: np.ndarray, deltas: np.ndarray) -> np.ndarray:
+    widths, heights, ctr_x, ctr_y = _anchor_geometry(anchors)
+    pred_ctr_x = deltas[:, 0] * widths + ctr_x
+    pred_ctr_y = deltas[:, 1] * heights + ctr_y
+    pred_w = np.exp(deltas[:, 2]) * widths
+    pred_h = np.exp(deltas[:, 3]) * heights
+    return np.stack([
+        pred_ctr_x - 0.5 * (pred_w - 1.0),
+        pred_ctr_y - 0.5 * (pred_h - 1.0),
+        pred_ctr_x + 0.5 * (pred_w - 1.0),
+        pred_ctr_y + 0.5 * (pred_h - 1.0)
+    ], axis=1)
+
+def _decode_landmarks(anchors: np.ndarray, deltas: np.ndarray) -> np.ndarray:
+    widths, heights, ctr_x, ctr_y = _anchor_geometry(anchors)
+    landmarks = np.empty_like(deltas)
+    landmarks[:, :, 0] = deltas[:, :, 0] * widths[:, None] + ctr_x[:, None]
+    landmarks[:, :, 1] = deltas[:, :, 1] * heights[:, None] + ctr_y[:, None]
+    return landmarks
+
+def _nms(dets: np.ndarray, threshold: float) -> List[int]:
+    x1, y1, x2, y2, scores = dets[:, 0], dets[:, 1], dets[:, 2], dets[:, 3], dets[:, 4]
+    areas = (x2 - x1 + 1) * (y2 - y1 + 1)
+    order = scores.argsort()[::-1]
+    keep = []
+    while order.size > 0:
+        i = order[0]
+        keep.append(int(i))
+        xx1 = np.maximum(x1[i], x1[order[1:]])
+        yy1 = np.maximum(y1[i], y1[order[1:]])
+        xx2 = np.minimum(x2[i], x2[order[1:]])
+        yy2 = np.minimum(y2[i], y2[order[1:]])
+        inter = np.maximum(0.0, xx2 - xx1 + 1) * np.maximum(0.0, yy2 - yy1 + 1)
+        overlap = inter / (areas[i] + areas[order[1:]] - inter)
+        order = order[np.where(overlap <= threshold)[0] + 1]
+    return keep
+
+class OnnxRetinaFace:
+    """RetinaFace su ONNX Runtime con pre/post-processing in numpy (ancore, decodifica, NMS)
+
+    Espone extract_faces con la firma di DeepFace.extract_faces, così può sostituire
+    DeepFace ovunque la pipeline rileva volti (frame intero, ritagli della cascata, tasselli).
+    """
+
+    def __init__(self, model_path: str, threads: int = 0, threshold: float = 0.9):
+        self.model_path = model_path
+        self.threshold = threshold
+        self.session = create_session(model_path, threads)
+        self.input_name = self.session.get_inputs()[0].name
+        self.output_names = [o.name for o in self.session.get_outputs()]
+
+    def _preprocess(self, image: np.ndarray) -> Tuple[np.ndarray, Tuple[int, int], float]:
+        height, width = image.shape[:2]
+        target_size, max_size = RETINAFACE_SCALES
+        scale = target_size / float(min(height, width))
+        if round(scale * max(height, width)) > max_size:
+            scale = max_size / float(max(height, width))
+        if scale != 1.0:
+            image = cv2.resize(image, None, None, fx=scale, fy=scale, interpolation=cv2.INTER_LINEAR)
+        # BGR → RGB, valori 0-255 senza normalizzazione
+        tensor = np.ascontiguousarray(image[:, :, ::-1], dtype=np.float32)[None]
+        return tensor, image.shape[:2], scale
+
+    def _outputs_by_stride(self, outputs: List[np.ndarray]) -> Dict[int, Tuple[np.ndarray, np.ndarray, np.ndarray]]:
+        """(score, box, landmark) per stride, riconosciuti da canali e risoluzione
+        (l'ordine degli output dipende dalla conversione)"""
+        groups: Dict[Tuple[int, int], Dict[int, np.ndarray]] = {}
+        for output in outputs:
+            groups.setdefault(output.shape[1:3], {})[output.shape[3]] = output
+        # Griglia più piccola = stride più grande
+        by_size = sorted(groups.items(), key=lambda item: item[0][0] * item[0][1])
+        if len(by_size) != len(RETINAFACE_STRIDES):
+            raise ValueError(f"Output RetinaFace inattesi: {[o.shape for o in outputs]}")
+        return {
+            stride: (channels[4], channels[8], channels[20])
+            for stride, (_, channels) in zip(RETINAFACE_STRIDES, by_size)
+        }
+
+    def detect(self, image: np.ndarray, threshold: Optional[float] = None) -> List[Dict[str, Any]]:
+        """Box [x1, y1, x2, y2], score e 5 landmark in coordinate immagine"""
+        threshold = self.threshold if threshold is None else threshold
+        tensor, (scaled_h, scaled_w), scale = self._preprocess(image)
+        outputs = self.session.run(self.output_names, {self.input_name: tensor})
+
+        proposals, scores, landmarks = [], [], []
+        for stride, (score_map, box_map, landmark_map) in self._outputs_by_stride(outputs).items():
+            base_anchors = RETINAFACE_ANCHORS[stride]
+            num_anchors = base_anchors.shape[0]
+            height, width = box_map.shape[1:3]
+            anchors = _anchors_plane(height, width, stride, base_anchors)
+
+            # Primi num_anchors canali = sfondo, successivi = volto
+            stride_scores = score_map[:, :, :, num_anchors:].reshape(-1)
+            keep = np.flatnonzero(stride_scores >= threshold)
+            if keep.size == 0:
+                continue
+
+            boxes = _decode_boxes(anchors[keep], box_map.reshape(-1, 4)[keep])
+            boxes[:, 0::2] = np.clip(boxes[:, 0::2], 0, scaled_w - 1)
+            boxes[:, 1::2] = np.clip(boxes[:, 1::2], 0, scaled_h - 1)
+            points = _decode_landmarks(anchors[keep], landmark_map.reshape(-1, 5, 2)[keep])
+
+            proposals.append(boxes / scale)
+            scores.append(stride_scores[keep])
+            landmarks.append(points / scale)
+
+        if not proposals:
+            return []
+
+        dets = np.hstack([np.vstack(proposals), np.concatenate(scores)[:, None]]).astype(np.float32)
+        landmarks = np.vstack(landmarks)
+        keep = _nms(dets, RETINAFACE_NMS_THRESHOLD)
+
+        return [
+            {
+                'box': dets[i, :4].astype(int).tolist(),
+                'score': float(dets[i, 4]),
+                'right_eye': tuple(float(v) for v in landmarks[i, 0]),
+                'left_eye': tuple(float(v) for v in landmarks[i, 1])
+            }
+            for i in keep
+        ]
+
+    def extract_faces(self, img_path, detector_backend: str = DETECTOR_MODEL,
+                      enforce_detection: bool = True, align: bool = True,
+                      target_size: Tuple[int, int] = (224, 224)) -> List[Dict[str, Any]]:
+        """Stesso formato di DeepFace.extract_faces: volto RGB float [0,1], facial_area, confidence"""
+        if detector_backend != DETECTOR_MODEL:
+            raise ValueError(f"Detector ONNX disponibile solo per {DETECTOR_MODEL}, non {detector_backend}")
+
+        image = cv2.imread(img_path) if isinstance(img_path, str) else img_path
+        if image is None:
+            raise ValueError(f"Immagine non leggibile: {img_path}")
+
+        faces = []
+        for detection in self.detect(image):
+            x1, y1, x2, y2 = detection['box']
+            if x2 <= x1 or y2 <= y1:
+                continue
+            face = image[y1:y2, x1:x2]
+            if align:
+                face = align_face(face, detection['right_eye'], detection['left_eye'])
+            faces.append({
+                'face': self._to_face_pixels(face, target_size),
+                'facial_area': {
+                    'x': x1, 'y': y1, 'w': x2 - x1, 'h': y2 - y1,
+                    'left_eye': tuple(int(v) for v in detection['left_eye']),
+                    'right_eye': tuple(int(v) for v in detection['right_eye'])
+                },
+                'confidence': detection['score']
+            })
+
+        if not faces:
+            if enforce_detection:
+                raise ValueError("Face could not be detected. Please confirm that the picture is a face photo "
+                                 "or consider to set enforce_detection param to False.")
+            # Come DeepFace: immagine intera con confidenza 0
+            height, width = image.shape[:2]
+            faces.append({
+                'face': self._to_face_pixels(image, target_size),
+                'facial_area': {'x': 0, 'y': 0, 'w': width, 'h': height},
+                'confidence': 0
+            })
+        return faces
+
+    @staticmethod
+    def _to_face_pixels(face_bgr: np.ndarray, target_size: Tuple[int, int]) -> np.ndarray:
+        face = fit_to_size(face_bgr, tuple(target_size))
+        return face[:, :, ::-1].astype(np.float32) / 255.0
+
+class OnnxModels:
+    """Risoluzione e caricamento lazy dei modelli ONNX da models.inference
+
+    Un modello mancante o non caricabile non blocca l'analisi: il chiamante ricade
+    sul percorso TensorFlow/DeepFace (il fallimento viene registrato una sola volta).
+    """
+
+    def __init__(self, inference_config: Dict[str, Any], project_root: str):
+        self.enabled = inference_config.get("backend", "tensorflow") == "onnx"
+        self.quantized = bool(inference_config.get("quantized", False))
+        self.threads = int(inference_config.get("threads", 0))
+        self.use_detector = self.enabled and inference_config.get("detector", True)
+        self.use_recognizer = self.enabled and inference_config.get("recognizer", True)
+        self.detector_threshold = float(inference_config.get("detector_threshold", 0.9))
+
+        model_dir = inference_config.get("onnx_dir", os.path.join("models", "onnx"))
+        self.model_dir = model_dir if os.path.isabs(model_dir) else os.path.join(project_root, model_dir)
+
+        self._detector: Optional[OnnxRetinaFace] = None
+        self._recognizers: Dict[str, OnnxRecognizer] = {}
+        self._failed: Dict[str, str] = {}
+
+    def model_path(self, model_name: str) -> Optional[str]:
+        """File del modello: int8 se richiesto (fp32 come ripiego), altrimenti fp32"""
+        candidates = [model_filename(model_name, quantized=True)] if self.quantized else []
+        candidates.append(model_filename(model_name))
+        for filename in candidates:
+            path = os.path.join(self.model_dir, filename)
+            if os.path.exists(path):
+                if self.quantized and not filename.endswith('.int8.onnx'):
+                    logger.warning(f"⚠️ {model_filename(model_name, True)} non trovato, uso {filename}")
+                return path
+        return None
+
+    def _load(self, model_name: str, factory):
+        if model_name in self._failed:
+            return None
+        path = self.model_path(model_name)
+        if path is None:
+            self._failed[model_name] = "modello non esportato"
+            logger.warning(f"⚠️ Modello ONNX {model_name} non trovato in {self.model_dir}, uso TensorFlow")
+            return None
+        try:
+            model = factory(path)
+            logger.info(f"⚡ {model_name} su ONNX Runtime ({os.path.basename(path)})")
+            return model
+        except Exception as e:
+            self._failed[model_name] = str(e)
+            logger.error(f"❌ Caricamento ONNX {model_name} fallito ({e}), uso TensorFlow")
+            return None
+
+    def detector(self) -> Optional[OnnxRetinaFace]:
+        if not self.use_detector:
+            return None
+        if self._detector is None:
+            self._detector = self._load(
+                DETECTOR_MODEL,
+                lambda path: OnnxRetinaFace(path, self.threads, self.detector_threshold)
+            )
+        return self._detector
+
+    def detector_path(self) -> Optional[str]:
+        """Percorso del detector ONNX per i processi figli (None se non utilizzabile)"""
+        return self._detector.model_path if self.detector() is not None else None
+
+    def recognizer(self, model_name: str) -> Optional[OnnxRecognizer]:
+        if not self.use_recognizer:
+            return None
+        if model_name not in self._recognizers:
+            model = self._load(model_name, lambda path: OnnxRecognizer(path, self.threads))
+            if model is None:
+                return None
+            self._recognizers[model_name] = model
+        return self._recognizers[model_name]
+
+    def variant(self, model_name: str) -> Optional[str]:
+        """Suffisso per le chiavi di cache: embeddings ONNX/int8 non si mescolano con quelli TF"""
+        model = self.recognizer(model_name)
+        if model is None:
+            return None
+        return "onnx-int8" if model.model_path.endswith('.int8.onnx') else "onnx"
+
+# ----------------------------------------------------------------------
+# Esportazione e quantizzazione (richiedono TensorFlow + tf2onnx)
+# ----------------------------------------------------------------------
+
+def _build_keras_model(model_name: str):
+    """Modello Keras e firma di input per tf2onnx"""
+    import tensorflow as tf
+    if not hasattr(tf, 'keras'):
+        import keras
+        tf.keras = keras
+
+    if model_name == DETECTOR_MODEL:
+        from retinaface import RetinaFace
+        model = RetinaFace.build_model()
+        spec = (tf.TensorSpec((1, None, None, 3), tf.float32, name='input'),)
+    else:
+        from deepface import DeepFace
+        client = DeepFace.build_model(model_name)
+        model = getattr(client, 'model', client)
+        height, width = (int(v) for v in model.input_shape[1:3])
+        spec = (tf.TensorSpec((None, height, width, 3), tf.float32, name='input'),)
+    return model, spec
+
+def export_model(model_name: str, output_dir: str, opset: int = 13) -> str:
+    """Esporta il modello Keras di DeepFace/retinaface in ONNX fp32"""
+    import tf2onnx
+
+    os.makedirs(output_dir, exist_ok=True)
+    output_path = os.path.join(output_dir, model_filename(model_name))
+    model, spec = _build_keras_model(model_name)
+    tf2onnx.convert.from_keras(model, input_signature=spec, opset=opset, output_path=output_path)
+    logger.info(f"📦 {model_name} esportato in {output_path} ({os.path.getsize(output_path) / 1e6:.1f}MB)")
+    return output_path
+
+def quantize_model(model_path: str, output_path: Optional[str] = None, per_channel: bool = False) -> str:
+    """Quantizzazione dinamica int8 dei pesi (attivazioni quantizzate a runtime, nessun dataset)"""
+    from onnxruntime.quantization import quantize_dynamic, QuantType
+
+    if output_path is None:
+        base = model_path[:-len('.onnx')] if model_path.endswith('.onnx') else model_path
+        output_path = f"{base}.int8.onnx"
+    quantize_dynamic(model_path, output_path, weight_type=QuantType.QInt8, per_channel=per_channel)
+    logger.info(
+        f"🗜️ {os.path.basename(model_path)} → {os.path.basename(output_path)} "
+        f"({os.path.getsize(model_path) / 1e6:.1f}MB → {os.path.getsize(output_path) / 1e6:.1f}MB)"
+    )
+    return output_path
+
+def main():
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+    parser = argparse.ArgumentParser(description='Esportazione e quantizzazione modelli ONNX')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    export_parser = subparsers.add_parser('export', help='Esporta modelli Keras in ONNX')
+    export_parser.add_argument('models', nargs='+', help=f'Nomi modello DeepFace o "{DETECTOR_MODEL}"')
+    export_parser.add_argument('--output', default=os.path.join('models', 'onnx'), help='Directory di output')
+    export_parser.add_argument('--opset', type=int, default=13)
+
+    quantize_parser = subparsers.add_parser('quantize', help='Quantizzazione dinamica int8')
+    quantize_parser.add_argument('models', nargs='+', help='File .onnx fp32')
+    quantize_parser.add_argument('--per-channel', action='store_true', help='Scale per canale (più accurato)')
+
+    args = parser.parse_args()
+    try:
+        if args.command == 'export':
+            for model_name in args.models:
+                export_model(model_name, args.output, args.opset)
+        else:
+            for model_path in args.models:
+                quantize_model(model_path, per_channel=args.per_channel)
+    except ImportError as e:
+        logger.error(f"❌ Dipendenza mancante: {e}")
+        sys.exit(1)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,251 @@
+// backend/scripts/rebuild_gallery.js
+// Ricostruzione massiva degli embeddings studenti (nuovo modello, backend o versione DeepFace).
+// 1. esporta le foto in temp/gallery_build/<corso|all> con un manifest JSONL
+// 2. esegue face_detection.py build-gallery (pool di processi, checkpoint in results.jsonl:
+//    rilanciando lo script si riprende dagli studenti mancanti)
+// 3. sostituisce le colonne face_embedding* in un'unica transazione: fino al commit le analisi
+//    continuano a usare gli embeddings precedenti; una foto cambiata nel frattempo non viene toccata
+//
+// Uso: node scripts/rebuild_gallery.js [--course <id>] [--workers N] [--fresh] [--retry-failed]
+const fs = require('fs');
+const path = require('path');
+const crypto = require('crypto');
+const { spawn } = require('child_process');
+const { QueryTypes } = require('sequelize');
+const { sequelize } = require('../src/config/database');
+const faceDetectionService = require('../src/services/faceDetectionService');
+
+const BACKEND_DIR = path.join(__dirname, '..');
+const EXPORT_PAGE_SIZE = 200;
+const UPDATE_BATCH_SIZE = 500;
+
+function parseArgs(argv) {
+  const options = { courseId: null, workers: null, fresh: false, retryFailed: false };
+  for (let i = 0; i < argv.length; i++) {
+    switch (argv[i]) {
+      case '--course': options.courseId = parseInt(argv[++i], 10); break;
+      case '--workers': options.workers = parseInt(argv[++i], 10); break;
+      case '--fresh': options.fresh = true; break;
+      case '--retry-failed': options.retryFailed = true; break;
+      default: throw new Error(`Opzione sconosciuta: ${argv[i]}`);
+    }
+  }
+  return options;
+}
+
+/**
+ * Scrive le foto degli studenti su disco (a pagine, senza tenere in memoria tutte le foto)
+ * e il manifest per build-gallery; le foto già esportate e invariate non vengono riscritte
+ */
+async function exportPhotos(courseId, workDir) {
+  const photosDir = path.join(workDir, 'photos');
+  fs.mkdirSync(photosDir, { recursive: true });
+
+  const manifest = [];
+  let lastId = 0;
+  for (;;) {
+    const rows = await sequelize.query(`
+      SELECT id, name, surname, "photoPath"
+      FROM "Users"
+      WHERE role = 'student'
+      AND "photoPath" IS NOT NULL
+      AND id > :lastId
+      ${courseId ? 'AND "courseId" = :courseId' : ''}
+      ORDER BY id
+      LIMIT :limit
+    `, {
+      replacements: { lastId, courseId, limit: EXPORT_PAGE_SIZE },
+      type: QueryTypes.SELECT
+    });
+    if (rows.length === 0) break;
+
+    for (const row of rows) {
+      lastId = row.id;
+      const photo = Buffer.isBuffer(row.photoPath) ? row.photoPath : Buffer.from(row.photoPath || '');
+      if (photo.length === 0) continue;
+
+      const photoFile = path.join(photosDir, `${row.id}.jpg`);
+      const photoHash = crypto.createHash('md5').update(photo).digest('hex');
+      const current = fs.existsSync(photoFile)
+        ? crypto.createHash('md5').update(fs.readFileSync(photoFile)).digest('hex')
+        : null;
+      if (current !== photoHash) {
+        fs.writeFileSync(photoFile, photo);
+      }
+
+      manifest.push({ id: row.id, name: row.name, surname: row.surname, photo: photoFile, photo_hash: photoHash });
+    }
+  }
+
+  fs.writeFileSync(
+    path.join(workDir, 'manifest.jsonl'),
+    manifest.map(entry => JSON.stringify(entry)).join('\n') + '\n'
+  );
+  return manifest.length;
+}
+
+/**
+ * Esegue build-gallery mostrando il progresso; restituisce il riepilogo JSON (stdout)
+ */
+function runBuild(workDir, options) {
+  const args = [
+    'scripts/face_detection.py', 'build-gallery',
+    '--manifest', path.join(workDir, 'manifest.jsonl'),
+    '--output-dir', workDir
+  ];
+  if (fs.existsSync(faceDetectionService.configPath)) args.push('--config', faceDetectionService.configPath);
+  if (options.workers) args.push('--workers', String(options.workers));
+  if (options.retryFailed) args.push('--retry-failed');
+
+  return new Promise((resolve, reject) => {
+    const child = spawn(faceDetectionService.pythonExecutable, args, {
+      cwd: BACKEND_DIR,
+      env: { ...process.env, PYTHONUNBUFFERED: '1' }
+    });
+
+    let stdout = '';
+    child.stdout.on('data', chunk => { stdout += chunk.toString(); });
+    child.stderr.on('data', chunk => {
+      for (const line of chunk.toString().split('\n')) {
+        if (line.trim() && !line.includes('tensorflow')) console.log(`   ${line}`);
+      }
+    });
+
+    child.on('error', reject);
+    child.on('close', code => {
+      try {
+        const summary = JSON.parse(stdout.trim().split('\n').pop());
+        resolve(summary);
+      } catch (e) {
+        reject(new Error(`build-gallery terminato con codice ${code} senza riepilogo`));
+      }
+    });
+  });
+}
+
+/**
+ * Ultimo record ok per studente dal checkpoint
+ */
+function readResults(resultsPath) {
+  const records = new Map();
+  for (const line of fs.readFileSync(resultsPath, 'utf8').split('\n')) {
+    if (!line.trim()) continue;
+    try {
+      const record = JSON.parse(line);
+      records.set(record.id, record);
+    } catch (e) {
+      continue;
+    }
+  }
+  return [...records.values()].filter(record => record.status === 'ok');
+}
+
+/**
+ * Sostituzione atomica: tutti gli embeddings nuovi o nessuno
+ */
+async function swapEmbeddings(records) {
+  let updated = 0;
+  let changedPhotos = 0;
+  const now = new Date();
+
+  await sequelize.transaction(async (transaction) => {
+    for (let i = 0; i < records.length; i += UPDATE_BATCH_SIZE) {
+      for (const record of records.slice(i, i + UPDATE_BATCH_SIZE)) {
+        const [, affected] = await sequelize.query(`
+          UPDATE "Users"
+          SET face_embedding = :embedding,
+              face_embedding_model = :model,
+              face_embedding_dtype = :dtype,
+              face_embedding_photo_hash = :photoHash,
+              face_embedding_updated_at = :now
+          WHERE id = :id
+          AND md5("photoPath") = :photoHash
+        `, {
+          replacements: {
+            id: record.id,
+            embedding: Buffer.from(record.embedding, 'base64'),
+            model: record.model,
+            dtype: record.dtype,
+            photoHash: record.photo_hash,
+            now
+          },
+          type: QueryTypes.UPDATE,
+          transaction
+        });
+        if (affected > 0) updated++;
+        else changedPhotos++;
+      }
+      console.log(`   💾 ${Math.min(i + UPDATE_BATCH_SIZE, records.length)}/${records.length}`);
+    }
+  });
+
+  return { updated, changedPhotos };
+}
+
+async function rebuildGallery(options) {
+  const workDir = path.join(BACKEND_DIR, 'temp/gallery_build', options.courseId ? `course_${options.courseId}` : 'all');
+  if (options.fresh) {
+    fs.rmSync(workDir, { recursive: true, force: true });
+  }
+  fs.mkdirSync(workDir, { recursive: true });
+
+  console.log(`🏗️ Ricostruzione galleria ${options.courseId ? `corso ${options.courseId}` : 'completa'} in ${workDir}`);
+
+  const exported = await exportPhotos(options.courseId, workDir);
+  console.log(`📤 ${exported} foto studenti esportate`);
+  if (exported === 0) {
+    return null;
+  }
+
+  const summary = await runBuild(workDir, options);
+  console.log(`\n📊 ${summary.ok} ok, ${summary.failed} falliti, ${summary.skipped} dal checkpoint ` +
+              `in ${summary.elapsed_s}s (${summary.photos_per_s} foto/s, ${summary.workers} processi)`);
+  for (const failure of summary.failures) {
+    console.warn(`   ⚠️ Studente ${failure.id}: ${failure.error}`);
+  }
+
+  if (summary.status !== 'success') {
+    throw new Error(`Ricostruzione interrotta (${summary.error}): rilanciare per riprendere dal checkpoint`);
+  }
+
+  const records = readResults(summary.results_path);
+  const models = [...new Set(records.map(record => record.model))];
+  if (models.length > 1) {
+    // Checkpoint con record di configurazioni diverse: non mescolare modelli nella galleria
+    throw new Error(`Checkpoint con più modelli (${models.join(', ')}): rilanciare con --fresh`);
+  }
+
+  const { updated, changedPhotos } = await swapEmbeddings(records);
+  console.log(`✅ Embeddings aggiornati: ${updated} (${models.join(', ') || 'n/d'})`);
+  if (summary.gallery) {
+    console.log(`🗂️ Galleria compatta (${summary.gallery.dtype}): ${summary.gallery.path} → gallery.path nella config`);
+  }
+  if (changedPhotos > 0) {
+    console.log(`ℹ️ ${changedPhotos} studenti con foto cambiata durante la ricostruzione: restano all'iscrizione normale`);
+  }
+
+  return { ...summary, updated, changedPhotos };
+}
+
+// CLI Usage
+if (require.main === module) {
+  let options;
+  try {
+    options = parseArgs(process.argv.slice(2));
+  } catch (error) {
+    console.error('💥 Errore:', error.message);
+    process.exit(1);
+  }
+
+  rebuildGallery(options)
+    .then(() => {
+      console.log('\n🎉 Ricostruzione completata!');
+      process.exit(0);
+    })
+    .catch(error => {
+      console.error('💥 Errore:', error.message);
+      process.exit(1);
+    });
+}
+
+module.exports = { rebuildGallery };
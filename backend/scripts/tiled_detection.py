@@ -0,0 +1,240 @@
+"""
+Rilevamento a tasselli per frame ad alta risoluzione (camere 4K/8MP panoramiche)
+Il frame a piena risoluzione viene diviso in tasselli sovrapposti, rilevati in parallelo
+su un pool di processi e ricomposti in coordinate del frame con NMS.
+"""
+
+import os
+import time
+import logging
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from typing import List, Dict, Any, Optional, Tuple
+
+import numpy as np
+
+logger = logging.getLogger('FaceDetectionV4')
+
+# Stato del processo worker (inizializzato una volta per processo)
+_worker_engine = None
+
+def _init_worker(onnx_detector_path: Optional[str] = None):
+    """Inizializzazione del processo worker: detector caricato una volta, a thread singolo
+    (RetinaFace ONNX se esportato, altrimenti DeepFace su TensorFlow)"""
+    global _worker_engine
+    if onnx_detector_path:
+        from onnx_backend import OnnxRetinaFace
+        _worker_engine = OnnxRetinaFace(onnx_detector_path, threads=1)
+        return
+
+    os.environ['TF_CPP_MIN_LOG_LEVEL'] = '3'
+    os.environ['CUDA_VISIBLE_DEVICES'] = '-1'
+
+    import tensorflow as tf
+    if not hasattr(tf, 'keras'):
+        import keras
+        tf.keras = keras
+    try:
+        # Un thread per worker: il parallelismo viene dai processi, non dai core di TF
+        tf.config.threading.set_intra_op_parallelism_threads(1)
+        tf.config.threading.set_inter_op_parallelism_threads(1)
+    except (RuntimeError, AttributeError):
+        pass
+
+    from deepface import DeepFace
+    _worker_engine = DeepFace
+
+def _detect_tile(tile: np.ndarray, origin: Tuple[int, int], backend: str,
+                 enforce_detection: bool, align: bool) -> List[Dict[str, Any]]:
+    """Eseguito nel worker: rileva i volti di un tassello e li riporta in coordinate frame"""
+    if _worker_engine is None:
+        _init_worker()
+    return detect_tile_with(_worker_engine, tile, origin, backend, enforce_detection, align)
+
+def detect_tile_with(deepface, tile: np.ndarray, origin: Tuple[int, int], backend: str,
+                     enforce_detection: bool, align: bool) -> List[Dict[str, Any]]:
+    faces = deepface.extract_faces(
+        img_path=tile,
+        detector_backend=backend,
+        enforce_detection=enforce_detection,
+        align=align
+    )
+    return offset_faces(faces, origin, tile.shape[:2])
+
+def offset_faces(faces: List[Any], origin: Tuple[int, int],
+                 tile_hw: Tuple[int, int]) -> List[Dict[str, Any]]:
+    """Trasla facial_area (e occhi) dal tassello al frame, segnando i volti sul bordo"""
+    ox, oy = origin
+    tile_h, tile_w = tile_hw
+    result = []
+    for face in faces or []:
+        if not isinstance(face, dict) or face.get('face') is None:
+            continue
+        area = dict(face.get('facial_area', {}))
+        x, y, w, h = (int(area.get(k, 0)) for k in ('x', 'y', 'w', 'h'))
+        if w <= 0 or h <= 0:
+            continue
+
+        # Volto tagliato dal bordo interno del tassello: il tassello vicino lo vede intero
+        touches_edge = (x <= 1 or y <= 1 or x + w >= tile_w - 1 or y + h >= tile_h - 1)
+
+        area.update({'x': x + ox, 'y': y + oy, 'w': w, 'h': h})
+        for eye in ('left_eye', 'right_eye'):
+            point = area.get(eye)
+            if point is not None and len(point) == 2:
+                area[eye] = (int(point[0]) + ox, int(point[1]) + oy)
+
+        result.append({
+            'face': face['face'],
+            'facial_area': area,
+            'confidence': float(face.get('confidence', 0) or 0),
+            'touches_tile_edge': touches_edge
+        })
+    return result
+
+def compute_tiles(width: int, height: int, tile_size: int, overlap: float) -> List[Tuple[int, int, int, int]]:
+    """Tasselli (x, y, w, h) sovrapposti che coprono tutto il frame
+
+    La sovrapposizione deve essere maggiore del volto più grande atteso, così ogni
+    volto è interamente contenuto in almeno un tassello.
+    """
+    tile_size = max(64, int(tile_size))
+    step = max(1, int(tile_size * (1.0 - overlap)))
+
+    def starts(length: int) -> List[int]:
+        if length <= tile_size:
+            return [0]
+        positions = list(range(0, length - tile_size, step))
+        positions.append(length - tile_size)
+        return positions
+
+    return [
+        (x, y, min(tile_size, width - x), min(tile_size, height - y))
+        for y in starts(height)
+        for x in starts(width)
+    ]
+
+def merge_detections(faces: List[Dict[str, Any]], iou_threshold: float = 0.4,
+                     containment_threshold: float = 0.7) -> List[Dict[str, Any]]:
+    """NMS sui volti di tutti i tasselli
+
+    Un box viene soppresso se ha IoU > iou_threshold con uno già tenuto, oppure se è
+    contenuto per più di containment_threshold della sua area (volto tagliato dal bordo
+    del tassello rispetto allo stesso volto intero nel tassello vicino).
+    Priorità: volti non sul bordo, poi confidenza, poi area.
+    """
+    if not faces:
+        return []
+
+    boxes = np.array([
+        [f['facial_area']['x'], f['facial_area']['y'],
+         f['facial_area']['x'] + f['facial_area']['w'],
+         f['facial_area']['y'] + f['facial_area']['h']]
+        for f in faces
+    ], dtype=np.float32)
+    areas = (boxes[:, 2] - boxes[:, 0]) * (boxes[:, 3] - boxes[:, 1])
+    edge = np.array([f.get('touches_tile_edge', False) for f in faces])
+    scores = np.array([f['confidence'] for f in faces], dtype=np.float32)
+
+    order = np.lexsort((-areas, -scores, edge))
+    keep = []
+    suppressed = np.zeros(len(faces), dtype=bool)
+
+    for idx in order:
+        if suppressed[idx]:
+            continue
+        keep.append(idx)
+
+        xx1 = np.maximum(boxes[idx, 0], boxes[:, 0])
+        yy1 = np.maximum(boxes[idx, 1], boxes[:, 1])
+        xx2 = np.minimum(boxes[idx, 2], boxes[:, 2])
+        yy2 = np.minimum(boxes[idx, 3], boxes[:, 3])
+        inter = np.clip(xx2 - xx1, 0, None) * np.clip(yy2 - yy1, 0, None)
+
+        iou = inter / (areas[idx] + areas - inter + 1e-6)
+        containment = inter / (areas + 1e-6)
+        suppressed |= (iou > iou_threshold) | (containment > containment_threshold)
+
+    merged = []
+    for idx in sorted(keep, key=lambda i: (boxes[i, 1], boxes[i, 0])):
+        face = dict(faces[idx])
+        face.pop('touches_tile_edge', None)
+        merged.append(face)
+    return merged
+
+class TiledDetector:
+    """Rilevamento a tasselli su pool di processi (contesto spawn, sicuro con TensorFlow)
+
+    Il pool è creato al primo uso e riusato tra le richieste: nel worker persistente
+    i processi figli tengono il detector caricato come il processo principale.
+    """
+
+    def __init__(self, tiling_config: Dict[str, Any], detector_config: Dict[str, Any],
+                 onnx_detector_path: Optional[str] = None):
+        self.tile_size = int(tiling_config.get("tile_size", 1280))
+        self.overlap = float(tiling_config.get("overlap", 0.25))
+        self.iou_threshold = float(tiling_config.get("nms_iou_threshold", 0.4))
+        self.containment_threshold = float(tiling_config.get("containment_threshold", 0.7))
+        self.enforce_detection = detector_config.get("enforce_detection", False)
+        self.align = detector_config.get("align", True)
+        self.onnx_detector_path = onnx_detector_path
+
+        workers = int(tiling_config.get("workers", 0))
+        if workers <= 0:
+            workers = max(1, (os.cpu_count() or 2) - 1)
+        self.workers = workers
+
+        self._executor: Optional[ProcessPoolExecutor] = None
+
+    def _get_executor(self) -> ProcessPoolExecutor:
+        if self._executor is None:
+            logger.info(f"🧩 Avvio pool detection a tasselli ({self.workers} processi)")
+            self._executor = ProcessPoolExecutor(
+                max_workers=self.workers,
+                mp_context=multiprocessing.get_context('spawn'),
+                initializer=_init_worker,
+                initargs=(self.onnx_detector_path,)
+            )
+        return self._executor
+
+    def detect(self, image: np.ndarray, backend: str, local_engine=None) -> List[Dict[str, Any]]:
+        """Volti del frame a piena risoluzione in coordinate frame, già deduplicati
+
+        local_engine: motore del processo principale usato se il pool non è disponibile
+        """
+        height, width = image.shape[:2]
+        tiles = compute_tiles(width, height, self.tile_size, self.overlap)
+        tile_start = time.time()
+
+        args = [
+            (np.ascontiguousarray(image[y:y + h, x:x + w]), (x, y), backend,
+             self.enforce_detection, self.align)
+            for x, y, w, h in tiles
+        ]
+
+        try:
+            executor = self._get_executor()
+            futures = [executor.submit(_detect_tile, *a) for a in args]
+            per_tile = [f.result() for f in futures]
+        except BrokenProcessPool as e:
+            logger.error(f"❌ Pool tasselli non disponibile ({e}), rilevamento nel processo principale")
+            self.close()
+            if local_engine is None:
+                from deepface import DeepFace
+                local_engine = DeepFace
+            per_tile = [detect_tile_with(local_engine, *a) for a in args]
+
+        faces = [face for tile_faces in per_tile for face in tile_faces]
+        merged = merge_detections(faces, self.iou_threshold, self.containment_threshold)
+
+        logger.info(
+            f"🧩 {len(tiles)} tasselli {self.tile_size}px: {len(faces)} rilevamenti → "
+            f"{len(merged)} volti dopo NMS ({(time.time() - tile_start) * 1000:.0f}ms)"
+        )
+        return merged
+
+    def close(self):
+        if self._executor is not None:
+            self._executor.shutdown(wait=False, cancel_futures=True)
+            self._executor = None
@@ -0,0 +1,268 @@
+"""
+Strumentazione dell'analisi: memoria di processo ed esportazione delle metriche per fase
+Gli span e i contatori raccolti in PerformanceMetrics finiscono nel blocco performance_metrics
+del risultato e, se configurato (output.metrics_export), in un file Prometheus in formato
+testo (textfile collector di node_exporter) e/o in JSONL compatibile OTLP/JSON di OpenTelemetry.
+"""
+
+import os
+import sys
+import json
+import logging
+import resource
+import threading
+import tracemalloc
+from typing import List, Dict, Any, Optional, Tuple
+
+logger = logging.getLogger('FaceDetectionV4')
+
+def reset_peak_rss() -> bool:
+    """Azzera VmHWM (Linux >= 4.0) per misurare il picco della singola analisi"""
+    try:
+        with open('/proc/self/clear_refs', 'w') as f:
+            f.write('5')
+        return True
+    except OSError:
+        return False
+
+def peak_rss_mb() -> float:
+    """Picco RSS da VmHWM, oppure ru_maxrss (picco dell'intero processo) fuori da Linux"""
+    try:
+        with open('/proc/self/status') as f:
+            for line in f:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        pass
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return rss / (1024 * 1024) if sys.platform == 'darwin' else rss / 1024
+
+def start_tracemalloc() -> None:
+    """Avvia tracemalloc al primo uso e azzera il picco (costo non trascurabile: solo su richiesta)"""
+    if not tracemalloc.is_tracing():
+        tracemalloc.start()
+    tracemalloc.reset_peak()
+
+def tracemalloc_peak_mb() -> Optional[float]:
+    if not tracemalloc.is_tracing():
+        return None
+    return tracemalloc.get_traced_memory()[1] / (1024 * 1024)
+
+# ----------------------------------------------------------------------
+# Prometheus (formato testo)
+# ----------------------------------------------------------------------
+
+def _escape_label(value: Any) -> str:
+    return str(value).replace('\\', '\\\\').replace('\n', '\\n').replace('"', '\\"')
+
+def _labels(labels: Dict[str, Any]) -> str:
+    if not labels:
+        return ''
+    return '{' + ','.join(f'{key}="{_escape_label(value)}"' for key, value in sorted(labels.items())) + '}'
+
+class PrometheusTextfile:
+    """Metriche cumulative del processo riscritte in modo atomico a ogni analisi
+
+    Nel worker persistente i totali crescono per tutta la vita del processo (contatori
+    e summary senza quantili); i gauge riportano l'ultima analisi.
+    """
+
+    PREFIX = 'face_pipeline'
+
+    def __init__(self, path: str, labels: Dict[str, Any]):
+        self.path = path
+        self.labels = labels
+        self.analyses: Dict[str, int] = {}
+        self.stage_sum: Dict[str, float] = {}
+        self.stage_count: Dict[str, int] = {}
+        self.counters: Dict[str, int] = {}
+        self.last: Dict[str, float] = {}
+
+    def observe(self, metrics: Any, status: str):
+        self.analyses[status] = self.analyses.get(status, 0) + 1
+        for stage, ms in metrics.stage_totals().items():
+            self.stage_sum[stage] = self.stage_sum.get(stage, 0.0) + ms / 1000
+            self.stage_count[stage] = self.stage_count.get(stage, 0) + 1
+        for name, value in metrics.counters.items():
+            self.counters[name] = self.counters.get(name, 0) + value
+
+        self.last = {
+            'total': metrics.total_time_ms / 1000,
+            'memory_peak_bytes': metrics.memory_peak_mb * 1024 * 1024,
+            'model_load': metrics.model_load_ms / 1000
+        }
+        if metrics.tracemalloc_peak_mb is not None:
+            self.last['tracemalloc_peak_bytes'] = metrics.tracemalloc_peak_mb * 1024 * 1024
+
+    def render(self) -> str:
+        p = self.PREFIX
+        lines: List[str] = []
+
+        def family(name: str, kind: str, help_text: str, samples: List[Tuple[str, Dict[str, Any], float]]):
+            lines.append(f'# HELP {p}_{name} {help_text}')
+            lines.append(f'# TYPE {p}_{name} {kind}')
+            for suffix, labels, value in samples:
+                lines.append(f'{p}_{name}{suffix}{_labels({**self.labels, **labels})} {value:.6g}')
+
+        family('analyses_total', 'counter', 'Analisi completate per esito',
+               [('', {'status': status}, count) for status, count in sorted(self.analyses.items())])
+        family('stage_seconds', 'summary', 'Durata delle fasi della pipeline',
+               [(suffix, {'stage': stage}, value)
+                for stage in sorted(self.stage_sum)
+                for suffix, value in (('_sum', self.stage_sum[stage]), ('_count', self.stage_count[stage]))])
+
+        dropped = {k: v for k, v in self.counters.items() if k.startswith('faces_dropped.')}
+        family('faces_dropped_total', 'counter', 'Volti scartati per regola di validazione',
+               [('', {'rule': name.split('.', 1)[1]}, value) for name, value in sorted(dropped.items())])
+        family('events_total', 'counter', 'Altri contatori della pipeline',
+               [('', {'name': name}, value) for name, value in sorted(self.counters.items())
+                if name not in dropped])
+
+        family('last_analysis_seconds', 'gauge', "Durata totale dell'ultima analisi",
+               [('', {}, self.last.get('total', 0))])
+        family('memory_peak_bytes', 'gauge', "Picco RSS durante l'ultima analisi",
+               [('', {}, self.last.get('memory_peak_bytes', 0))])
+        if 'tracemalloc_peak_bytes' in self.last:
+            family('tracemalloc_peak_bytes', 'gauge', "Picco allocazioni Python (tracemalloc) dell'ultima analisi",
+                   [('', {}, self.last['tracemalloc_peak_bytes'])])
+        family('model_load_seconds', 'gauge', "Caricamento modelli pagato dall'ultima analisi",
+               [('', {}, self.last.get('model_load', 0))])
+        return '\n'.join(lines) + '\n'
+
+    def write(self):
+        tmp_path = f'{self.path}.{os.getpid()}.tmp'
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            f.write(self.render())
+        os.replace(tmp_path, self.path)
+
+# ----------------------------------------------------------------------
+# OpenTelemetry (OTLP/JSON)
+# ----------------------------------------------------------------------
+
+def _otel_value(value: Any) -> Dict[str, Any]:
+    if isinstance(value, bool):
+        return {'boolValue': value}
+    if isinstance(value, int):
+        return {'intValue': str(value)}
+    if isinstance(value, float):
+        return {'doubleValue': value}
+    return {'stringValue': str(value)}
+
+def _otel_attributes(attributes: Dict[str, Any]) -> List[Dict[str, Any]]:
+    return [{'key': key, 'value': _otel_value(value)} for key, value in attributes.items() if value is not None]
+
+def otel_trace(metrics: Any, status: str, resource_attributes: Dict[str, Any]) -> Dict[str, Any]:
+    """Una analisi come ExportTraceServiceRequest OTLP/JSON, con span radice "analyze"
+    che porta contatori e memoria come attributi"""
+    root_id = os.urandom(8).hex()
+
+    def nanos(offset_ms: float) -> str:
+        return str(metrics.started_ns + int(offset_ms * 1e6))
+
+    root_attributes = {
+        'face.detection_mode': metrics.detection_mode,
+        'face.faces_processed': metrics.faces_processed,
+        'face.memory_peak_mb': round(metrics.memory_peak_mb, 1),
+        'face.tracemalloc_peak_mb': metrics.tracemalloc_peak_mb,
+        'face.model_load_ms': metrics.model_load_ms,
+        **{f'face.counter.{name}': value for name, value in metrics.counters.items()}
+    }
+    end_ms = max([metrics.total_time_ms] + [s['start_ms'] + s['duration_ms'] for s in metrics.spans])
+    spans = [{
+        'traceId': metrics.trace_id,
+        'spanId': root_id,
+        'name': 'analyze',
+        'kind': 1,
+        'startTimeUnixNano': nanos(0),
+        'endTimeUnixNano': nanos(end_ms),
+        'attributes': _otel_attributes(root_attributes),
+        'status': {'code': 1 if status == 'success' else 2}
+    }]
+    for span in metrics.spans:
+        record = {
+            'traceId': metrics.trace_id,
+            'spanId': span['span_id'],
+            'parentSpanId': span['parent_id'] or root_id,
+            'name': span['name'],
+            'kind': 1,
+            'startTimeUnixNano': nanos(span['start_ms']),
+            'endTimeUnixNano': nanos(span['start_ms'] + span['duration_ms']),
+            'attributes': _otel_attributes(span['attributes']),
+            'status': {'code': 1}
+        }
+        if 'error' in span:
+            record['status'] = {'code': 2, 'message': span['error']}
+        spans.append(record)
+
+    return {
+        'resourceSpans': [{
+            'resource': {'attributes': _otel_attributes(resource_attributes)},
+            'scopeSpans': [{
+                'scope': {'name': 'face_detection', 'version': '4.0'},
+                'spans': spans
+            }]
+        }]
+    }
+
+# ----------------------------------------------------------------------
+# Esportazione
+# ----------------------------------------------------------------------
+
+class MetricsExporter:
+    """Esporta le metriche delle analisi secondo output.metrics_export
+
+    prometheus_file e otel_file sono relativi alla root del backend; "{pid}" nel nome
+    separa i file dei worker concorrenti. Gli errori di scrittura non fanno fallire l'analisi.
+    """
+
+    def __init__(self, export_config: Dict[str, Any], project_root: str, labels: Dict[str, Any]):
+        self.tracemalloc = bool(export_config.get("tracemalloc", False))
+        self.prometheus: Optional[PrometheusTextfile] = None
+        self.otel_path: Optional[str] = None
+        self.resource_attributes = {
+            'service.name': 'face-detection',
+            'service.version': '4.0',
+            'process.pid': os.getpid(),
+            **{f'face.{key}': value for key, value in labels.items()}
+        }
+        self._lock = threading.Lock()
+
+        prometheus_file = self._resolve(export_config.get("prometheus_file"), project_root)
+        if prometheus_file:
+            self.prometheus = PrometheusTextfile(prometheus_file, labels)
+        self.otel_path = self._resolve(export_config.get("otel_file"), project_root)
+
+    @staticmethod
+    def _resolve(path: Optional[str], project_root: str) -> Optional[str]:
+        if not path:
+            return None
+        path = path.replace('{pid}', str(os.getpid()))
+        if not os.path.isabs(path):
+            path = os.path.join(project_root, path)
+        try:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        except OSError as e:
+            logger.warning(f"⚠️ Directory metriche non disponibile ({e}): {path} ignorato")
+            return None
+        return path
+
+    @property
+    def enabled(self) -> bool:
+        return self.prometheus is not None or self.otel_path is not None
+
+    def export(self, traces: List[Tuple[Any, str]]):
+        """traces: lista di (PerformanceMetrics, esito) delle analisi da esportare"""
+        if not self.enabled or not traces:
+            return
+        with self._lock:
+            try:
+                if self.prometheus is not None:
+                    for metrics, status in traces:
+                        self.prometheus.observe(metrics, status)
+                    self.prometheus.write()
+                if self.otel_path is not None:
+                    with open(self.otel_path, 'a', encoding='utf-8') as f:
+                        for metrics, status in traces:
+                            f.write(json.dumps(otel_trace(metrics, status, self.resource_attributes)) + '\n')
+            except OSError as e:
+                logger.warning(f"⚠️ Esportazione metriche fallita: {e}")
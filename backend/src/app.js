@@ -12,6 +12,8 @@ const db = require(path.join(__dirname, 'models/index'));
 
 // Servizi
 const fileAnalysisService = require('./services/fileAnalysisService');
+const faceDetectionService = require('./services/faceDetectionService');
+const analysisQueueService = require('./services/analysisQueueService');
 const lessonScheduler = require('./services/lessonSchedulerService');
 
 // ========================================
@@ -111,6 +113,12 @@ db.sequelize.authenticate()
   // Start lesson scheduler service
   lessonScheduler.start();
   
+  // Avvia i worker face detection (modelli residenti)
+  faceDetectionService.warmUp();
+
+  // Avvia la coda persistente delle analisi (live > rianalisi > backfill)
+  analysisQueueService.start();
+  
   console.log('🚀 Sistema BLOB pronto al 100%! 🎉');
   console.log('⏰ Lesson scheduler attivo per auto-completamento lezioni');
   console.log('');
@@ -121,4 +129,12 @@ db.sequelize.authenticate()
 })
 .catch((err) => console.error('❌ Errore connessione PostgreSQL:', err));
 
+['SIGINT', 'SIGTERM'].forEach(signal => {
+  process.on(signal, () => {
+    analysisQueueService.stop();
+    faceDetectionService.shutdown();
+    process.exit(0);
+  });
+});
+
 module.exports = app;
\ No newline at end of file
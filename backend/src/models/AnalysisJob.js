@@ -0,0 +1,138 @@
+module.exports = (sequelize, DataTypes) => {
+  const AnalysisJob = sequelize.define('AnalysisJob', {
+    id: {
+      type: DataTypes.INTEGER,
+      primaryKey: true,
+      autoIncrement: true,
+      allowNull: false
+    },
+    type: {
+      type: DataTypes.ENUM('image', 'lesson'),
+      allowNull: false
+    },
+    lesson_id: {
+      type: DataTypes.INTEGER,
+      allowNull: false,
+      references: {
+        model: 'Lessons',
+        key: 'id'
+      }
+    },
+    image_id: {
+      type: DataTypes.INTEGER,
+      allowNull: true,
+      references: {
+        model: 'LessonImages',
+        key: 'id'
+      }
+    },
+    priority: {
+      type: DataTypes.INTEGER,
+      allowNull: false,
+      defaultValue: 10
+    },
+    status: {
+      type: DataTypes.ENUM('queued', 'running', 'completed', 'failed', 'cancelled'),
+      allowNull: false,
+      defaultValue: 'queued'
+    },
+    coalesce_key: {
+      type: DataTypes.STRING(64),
+      allowNull: false
+    },
+    coalesced: {
+      type: DataTypes.INTEGER,
+      allowNull: false,
+      defaultValue: 0
+    },
+    payload: {
+      type: DataTypes.JSONB,
+      allowNull: true
+    },
+    result: {
+      type: DataTypes.JSONB,
+      allowNull: true
+    },
+    error: {
+      type: DataTypes.TEXT,
+      allowNull: true
+    },
+    attempts: {
+      type: DataTypes.INTEGER,
+      allowNull: false,
+      defaultValue: 0
+    },
+    max_attempts: {
+      type: DataTypes.INTEGER,
+      allowNull: false,
+      defaultValue: 3
+    },
+    run_at: {
+      type: DataTypes.DATE,
+      allowNull: false,
+      defaultValue: DataTypes.NOW
+    },
+    locked_by: {
+      type: DataTypes.STRING(128),
+      allowNull: true
+    },
+    locked_at: {
+      type: DataTypes.DATE,
+      allowNull: true
+    },
+    started_at: {
+      type: DataTypes.DATE,
+      allowNull: true
+    },
+    finished_at: {
+      type: DataTypes.DATE,
+      allowNull: true
+    },
+    requested_by: {
+      type: DataTypes.INTEGER,
+      allowNull: true,
+      references: {
+        model: 'Users',
+        key: 'id'
+      }
+    },
+    created_at: {
+      type: DataTypes.DATE,
+      allowNull: false,
+      defaultValue: DataTypes.NOW,
+      field: 'created_at'
+    },
+    updated_at: {
+      type: DataTypes.DATE,
+      allowNull: false,
+      defaultValue: DataTypes.NOW,
+      field: 'updated_at'
+    }
+  }, {
+    tableName: 'AnalysisJobs',
+    timestamps: true,
+    createdAt: 'created_at',
+    updatedAt: 'updated_at',
+    indexes: [
+      { name: 'analysis_jobs_claim_idx', fields: ['status', 'priority', 'run_at'] },
+      { name: 'analysis_jobs_queued_key_idx', fields: ['coalesce_key'], unique: true, where: { status: 'queued' } },
+      { name: 'analysis_jobs_lesson_idx', fields: ['lesson_id', 'created_at'] }
+    ]
+  });
+
+  AnalysisJob.associate = function(models) {
+    AnalysisJob.belongsTo(models.Lesson, {
+      foreignKey: 'lesson_id',
+      as: 'lesson'
+    });
+
+    if (models.LessonImage) {
+      AnalysisJob.belongsTo(models.LessonImage, {
+        foreignKey: 'image_id',
+        as: 'image'
+      });
+    }
+  };
+
+  return AnalysisJob;
+};
@@ -78,6 +78,33 @@ module.exports = (sequelize) => {
       }
     },
     
+    face_embedding: {
+      type: DataTypes.BLOB,
+      allowNull: true,
+      field: 'face_embedding',
+      comment: 'Embedding del volto calcolato all\'iscrizione (formato compatto)'
+    },
+    face_embedding_model: {
+      type: DataTypes.STRING(64),
+      allowNull: true,
+      field: 'face_embedding_model'
+    },
+    face_embedding_dtype: {
+      type: DataTypes.STRING(10),
+      allowNull: true,
+      field: 'face_embedding_dtype'
+    },
+    face_embedding_photo_hash: {
+      type: DataTypes.STRING(32),
+      allowNull: true,
+      field: 'face_embedding_photo_hash'
+    },
+    face_embedding_updated_at: {
+      type: DataTypes.DATE,
+      allowNull: true,
+      field: 'face_embedding_updated_at'
+    },
+    
     is_active: {
       type: DataTypes.BOOLEAN,
       allowNull: false,
@@ -128,6 +155,7 @@ module.exports = (sequelize) => {
     delete values.reset_token_expiry;
     
     delete values.photoPath;
+    delete values.face_embedding;
     
     values.hasPhoto = this.hasValidPhoto();
     
@@ -18,7 +18,8 @@ const modelOrder = [
   'Attendance',
   'StudentSubject',
   'LessonImage',
-  'CameraLog'
+  'CameraLog',
+  'AnalysisJob'
 ];
 
 modelOrder.forEach(modelName => {
@@ -4,6 +4,7 @@ const multer = require('multer');
 const { LessonImage, Screenshot, Lesson, User } = require('../models');
 const authMiddleware = require('../middleware/authMiddleware');
 const roleMiddleware = require('../middleware/roleMiddleware');
+const faceDetectionService = require('../services/faceDetectionService');
 
 const upload = multer({
   storage: multer.memoryStorage(),
@@ -26,6 +27,12 @@ router.get('/lesson/:imageId', async (req, res) => {
     console.log(`📸 Richiesta immagine lezione ID: ${imageId}`);
     console.log(`📸 User-Agent: ${req.get('User-Agent')}`);
     
+    // Report differito ancora da disegnare: lo genera ora (o attende quello già avviato)
+    if (faceDetectionService.hasPendingReport(imageId)) {
+      console.log(`🕒 Report differito per immagine ${imageId}, generazione...`);
+      await faceDetectionService.ensureReport(imageId);
+    }
+    
     const image = await LessonImage.findByPk(imageId);
     
     if (!image) {
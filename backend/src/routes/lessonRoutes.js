@@ -11,6 +11,10 @@ const fileAnalysisService = require('../services/fileAnalysisService');
 const multer = require('multer');
 const imageStorageService = require('../services/imageStorageService');
 const enhancedCameraService = require('../services/enhancedCameraService');
+const analysisQueueService = require('../services/analysisQueueService');
+
+// Attesa massima del risultato nella richiesta HTTP; oltre, 202 con l'id del job
+const ANALYZE_WAIT_MS = 110000;
 
 const router = express.Router();
 
@@ -645,83 +649,46 @@ router.post('/:id/analyze', authenticate, async (req, res) => {
         console.log(`Storage mode: ${process.env.IMAGE_STORAGE_MODE || 'hybrid'}`);
         console.log(`=====================================`);
         
-        const [lesson] = await sequelize.query(`
-            SELECT l.id, l.name as lesson_name, l.course_id, c.name as course_name
-            FROM "Lessons" l
-            LEFT JOIN "Courses" c ON l.course_id = c.id
-            WHERE l.id = :id
-        `, {
-            replacements: { id },
-            type: QueryTypes.SELECT
-        });
-        
+        const lesson = await Lesson.findByPk(id, { attributes: ['id'] });
         if (!lesson) {
             console.error(`❌ Lezione con ID ${id} non trovata`);
             return res.status(404).json({ message: 'Lezione non trovata' });
         }
         
-        console.log(`📚 Lezione trovata:`, {
-            id: lesson.id,
-            lesson_name: lesson.lesson_name,
-            course_id: lesson.course_id,
-            course_name: lesson.course_name
+        // Rianalisi in coda dietro le lezioni in corso; richieste ripetute sulla stessa lezione
+        // ancora in coda vengono accorpate nello stesso job
+        const priority = req.body && req.body.priority === 'backfill' ? 'backfill' : 'reanalysis';
+        const job = await analysisQueueService.enqueue({
+            type: 'lesson',
+            lessonId: lesson.id,
+            priority,
+            payload: req.body && req.body.redetect ? { rematch: false } : {},
+            requestedBy: req.user ? req.user.id : null
         });
         
-        let imageInfo = null;
-        let analysisResult = null;
-        
+        let jobResult;
         try {
-            console.log('🔄 Tentativo recupero immagine dal database...');
-            imageInfo = await imageStorageService.getImageForAnalysis(id);
-            console.log(`✅ Immagine recuperata da: ${imageInfo.source}`);
-            
-            analysisResult = await fileAnalysisService.analyzeLessonImages(
-                id, 
-                lesson.course_name,
-                lesson.lesson_name,
-                imageInfo.imagePath
-            );
-            
-            if (imageInfo.isTemporary) {
-                await imageStorageService.cleanupTemporaryFiles(imageInfo.imagePath);
-                console.log('🧹 File temporaneo pulito');
-            }
-            
-            if (imageInfo.source === 'database' && imageInfo.imageId) {
-                const { LessonImage } = require('../models');
-                await LessonImage.update(
-                    { is_analyzed: true },
-                    { where: { id: imageInfo.imageId } }
-                );
-                console.log(`✅ Immagine ${imageInfo.imageId} marcata come analizzata`);
+            jobResult = await analysisQueueService.waitFor(job.id, ANALYZE_WAIT_MS);
+        } catch (waitError) {
+            if (waitError.code === 'JOB_PENDING') {
+                // Il job prosegue in background: stato su GET /lessons/:id/analysis-jobs
+                return res.status(202).json({
+                    message: 'Analisi in coda',
+                    jobId: job.id,
+                    coalesced: job.coalesced
+                });
             }
-            
-        } catch (dbError) {
-            console.log('⚠️ Database fallito, provo filesystem tradizionale...');
-            console.log('   Errore database:', dbError.message);
-            
-            analysisResult = await fileAnalysisService.analyzeLessonImages(
-                id, 
-                lesson.course_name,
-                lesson.lesson_name
-            );
+            throw waitError;
         }
         
-        if (!analysisResult) {
-            return res.status(500).json({
-                success: false,
-                message: 'Errore durante l\'analisi',
-                error: 'Nessun risultato dall\'analisi'
-            });
-        }
-        
-        console.log(`✅ Analisi completata con successo`);
+        console.log(`✅ Analisi completata con successo (job ${job.id})`);
         
         res.json({
             message: 'Analisi completata',
-            results: analysisResult,
-            source: imageInfo ? imageInfo.source : 'filesystem',
-            hybrid_mode: true
+            results: jobResult.results,
+            source: jobResult.source,
+            hybrid_mode: true,
+            jobId: job.id
         });
         
     } catch (error) {
@@ -733,6 +700,16 @@ router.post('/:id/analyze', authenticate, async (req, res) => {
     }
 });
 
+router.get('/:id/analysis-jobs', authenticate, async (req, res) => {
+    try {
+        const jobs = await analysisQueueService.getLessonJobs(req.params.id);
+        res.json({ success: true, jobs });
+    } catch (error) {
+        console.error('❌ Errore lettura job analisi:', error);
+        res.status(500).json({ success: false, error: error.message });
+    }
+});
+
 router.get('/:id/directories', authenticate, async (req, res) => {
     try {
         const { id } = req.params;
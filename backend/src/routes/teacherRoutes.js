@@ -6,6 +6,10 @@ const { Op } = require('sequelize');
 
 const enhancedCameraService = require('../services/enhancedCameraService');
 const faceDetectionService = require('../services/faceDetectionService');
+const analysisQueueService = require('../services/analysisQueueService');
+
+// Attesa del risultato dell'analisi di uno scatto (timeout HTTP della route: 120s)
+const LIVE_ANALYSIS_WAIT_MS = 100000;
 const emailService = require('../services/emailService');
 
 router.use(authenticate);
@@ -517,81 +521,40 @@ router.post('/lessons/:id/capture-and-analyze', async (req, res) => {
         // Non usiamo più reportImageId separato - l'immagine con i riquadri è ora savedImage
 
         try {
-            console.log('🔍 Avvio analisi face detection...');
-            
-            analysisResult = await faceDetectionService.analyzeImageBlob(
-                captureResult.imageData,
-                lessonId,
-                { debugMode: true, imageId: savedImage.id }
-            );
-
-            console.log(`✅ Analisi completata: ${analysisResult.detected_faces} volti, ${analysisResult.recognized_students?.length || 0} riconosciuti`);
-
-            await savedImage.update({
-                is_analyzed: true,
-                detected_faces: analysisResult.detected_faces || 0,
-                recognized_faces: analysisResult.recognized_students?.length || 0,
-                processing_status: analysisResult.success ? 'completed' : 'failed',
-                analyzed_at: new Date()
+            // Analisi nella coda persistente con priorità di lezione in corso: passa davanti a
+            // rianalisi e backfill; il job aggiorna l'immagine (riquadri, stato) anche se la
+            // richiesta HTTP scade prima della fine
+            console.log('🔍 Avvio analisi face detection (coda, priorità lezione in corso)...');
+            const job = await analysisQueueService.enqueue({
+                type: 'image',
+                lessonId: lesson.id,
+                imageId: savedImage.id,
+                priority: 'live',
+                // Firma per aula dell'ultimo scatto analizzato: scena invariata → solo match
+                payload: {
+                    debugMode: true,
+                    frameKey: lesson.classroom_id ? `classroom:${lesson.classroom_id}` : `lesson:${lesson.id}`
+                },
+                requestedBy: req.user.id,
+                maxAttempts: 2
             });
+            analysisResult = await analysisQueueService.waitFor(job.id, LIVE_ANALYSIS_WAIT_MS);
 
-            console.log(`\n💾 === SALVATAGGIO IMMAGINE REPORT ===`);
-            console.log(`📊 Has reportImageBlob: ${!!analysisResult.reportImageBlob}`);
-            if (analysisResult.reportImageBlob) {
-                console.log(`📊 ReportImageBlob size: ${analysisResult.reportImageBlob.length} bytes`);
-            }
-            console.log(`📊 Has reportImagePath: ${!!analysisResult.reportImagePath}`);
-            if (analysisResult.reportImagePath) {
-                console.log(`📂 ReportImagePath: ${analysisResult.reportImagePath}`);
+            console.log(`✅ Analisi completata: ${analysisResult.detected_faces} volti, ${analysisResult.recognized_students?.length || 0} riconosciuti`);
+            if (analysisResult.reportPending) {
+                console.log(`🕒 Report con riquadri in preparazione: ID ${savedImage.id}`);
             }
+
+        } catch (analysisError) {
+            console.error('❌ Errore face detection:', analysisError.message);
             
-            // Se l'analisi ha generato un'immagine con riquadri, sostituisci quella base
-            if (analysisResult.reportImageBlob) {
-                try {
-                    await savedImage.update({
-                        image_data: analysisResult.reportImageBlob,
-                        file_size: analysisResult.reportImageBlob.length,
-                        source: 'report',
-                        is_analyzed: true,
-                        detected_faces: analysisResult.detected_faces || 0,
-                        recognized_faces: analysisResult.recognized_students?.length || 0,
-                        processing_status: 'completed',
-                        analyzed_at: new Date()
-                    });
-                    
-                    console.log(`✅ Immagine aggiornata con riquadri: ID ${savedImage.id}`);
-                } catch (reportError) {
-                    console.error('❌ Errore aggiornamento immagine con riquadri:', reportError.message);
-                    // Manteniamo l'immagine originale se l'update fallisce
-                    await savedImage.update({
-                        is_analyzed: true,
-                        processing_status: 'completed',
-                        detected_faces: analysisResult.detected_faces || 0,
-                        recognized_faces: analysisResult.recognized_students?.length || 0,
-                        analyzed_at: new Date()
-                    });
-                }
-            } else {
-                // Nessuna immagine report - aggiorna solo i metadati
+            if (analysisError.code !== 'JOB_PENDING') {
                 await savedImage.update({
                     is_analyzed: true,
-                    processing_status: 'completed',
-                    detected_faces: analysisResult.detected_faces || 0,
-                    recognized_faces: analysisResult.recognized_students?.length || 0,
-                    analyzed_at: new Date()
+                    processing_status: 'failed',
+                    error_message: analysisError.message
                 });
-                console.log(`⚠️ Mantenuta immagine originale: ID ${savedImage.id}`);
             }
-
-        } catch (analysisError) {
-            console.error('❌ Errore face detection:', analysisError);
-            
-            // savedImage esiste sempre ora, aggiorna solo lo stato di errore
-            await savedImage.update({
-                is_analyzed: true,
-                processing_status: 'error',
-                error_message: analysisError.message
-            });
         }
 
         // Screenshot rimosso - già salvato in LessonImage sopra per evitare duplicati
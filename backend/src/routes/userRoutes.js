@@ -7,6 +7,7 @@ const { authenticate } = require('../middleware/authMiddleware');
 const { User, Course } = require('../models');
 const { sequelize } = require('../config/database');
 const { QueryTypes, Op } = require('sequelize');
+const faceDetectionService = require('../services/faceDetectionService');
 
 const storage = multer.memoryStorage();
 const upload = multer({
@@ -315,6 +316,9 @@ router.post('/register-student', authenticate, upload.single('photo'), async (re
 
     console.log(`✅ Studente creato con ID: ${newStudent.id}`);
 
+    // Embedding del volto calcolato ora, una volta: le analisi non rielaborano la foto
+    const faceEnrollment = await faceDetectionService.enrollStudentPhoto(newStudent.id, photoFile.buffer, newStudent);
+
     res.status(201).json({
       success: true,
       message: 'Studente registrato con successo',
@@ -327,7 +331,8 @@ router.post('/register-student', authenticate, upload.single('photo'), async (re
         courseId: newStudent.courseId,
         hasPhoto: true,
         createdAt: newStudent.createdAt
-      }
+      },
+      faceEnrollment
     });
 
     console.log('🎉 Registrazione studente completata!');
@@ -436,6 +441,9 @@ router.put('/students/:id', authenticate, async (req, res) => {
     
     // Ricarica lo studente per ottenere i dati aggiornati
     await student.reload();
+    if (updateData.is_active === false) {
+      faceDetectionService.removeStudentFromIndex(student.id);
+    }
     
     const updatedStudent = {
       id: student.id,
@@ -492,6 +500,7 @@ router.delete('/students/:id', authenticate, async (req, res) => {
 
     // VERA eliminazione dal database
     await student.destroy();
+    faceDetectionService.removeStudentFromIndex(studentId);
 
     res.json({
       success: true,
@@ -593,6 +602,8 @@ router.post('/students/:id/photo', authenticate, upload.single('photo'), async (
       photoPath: photoFile.buffer
     });
 
+    const faceEnrollment = await faceDetectionService.enrollStudentPhoto(student.id, photoFile.buffer, student);
+
     res.json({
       success: true,
       message: 'Foto aggiornata con successo',
@@ -600,7 +611,8 @@ router.post('/students/:id/photo', authenticate, upload.single('photo'), async (
         size: photoFile.size,
         mimeType: photoFile.mimetype,
         originalName: photoFile.originalname
-      }
+      },
+      faceEnrollment
     });
 
   } catch (error) {
@@ -0,0 +1,619 @@
+// backend/src/services/analysisQueueService.js
+// Coda persistente delle analisi di riconoscimento (tabella AnalysisJobs)
+// - priorità: lezione in corso (live) > rianalisi del docente > backfill massivo
+// - richieste duplicate ancora in coda accorpate per chiave (stessa immagine / stessa lezione)
+// - concorrenza limitata ai worker Python, con uno slot sempre riservato alle lezioni in corso
+// - tentativi con backoff esponenziale; i job di un processo terminato tornano in coda a fine lease
+//   (rinnovato durante l'esecuzione: un'analisi lunga non viene mai presa da un secondo worker)
+// Il prelievo usa FOR UPDATE SKIP LOCKED: più istanze del backend possono servire la stessa coda.
+
+const os = require('os');
+const { QueryTypes } = require('sequelize');
+const { sequelize } = require('../config/database');
+const faceDetectionService = require('./faceDetectionService');
+
+const PRIORITIES = {
+    live: 0,
+    reanalysis: 10,
+    backfill: 20
+};
+
+// Errore non recuperabile (lezione o immagine eliminate): nessun nuovo tentativo
+class PermanentJobError extends Error {}
+
+class AnalysisQueueService {
+    constructor() {
+        this.workerId = `${os.hostname()}:${process.pid}`;
+
+        // Un job occupa un worker Python: tanti job quanti processi nel pool
+        const poolSize = faceDetectionService.workerPool ? faceDetectionService.workerPool.size : 1;
+        this.concurrency = parseInt(process.env.ANALYSIS_QUEUE_CONCURRENCY, 10) || poolSize;
+        // Rianalisi e backfill non occupano mai tutti gli slot: una lezione in corso parte subito
+        this.reservedLiveSlots = 1;
+
+        this.pollInterval = parseInt(process.env.ANALYSIS_QUEUE_POLL_MS, 10) || 1000;
+        this.backoffBase = 2000;
+        this.backoffMax = 5 * 60 * 1000;
+        this.leaseMs = 5 * 60 * 1000;
+        this.leaseRenewInterval = 60 * 1000;
+        this.recoverInterval = 60 * 1000;
+        this.waitPollInterval = 2000;
+
+        this.running = new Map();
+        this.waiters = new Map();
+        this.timer = null;
+        this.started = false;
+        this.claiming = false;
+        this.claimAgain = false;
+        this.lastRecover = 0;
+
+        this.handlers = {
+            image: (job) => this._runImageJob(job),
+            lesson: (job) => this._runLessonJob(job)
+        };
+
+        this.stats = {
+            enqueued: 0,
+            coalesced: 0,
+            completed: 0,
+            failed: 0,
+            retried: 0
+        };
+    }
+
+    start() {
+        if (this.started) return;
+        this.started = true;
+
+        console.log(`🧾 Coda analisi avviata (${this.concurrency} slot, ${this.reservedLiveSlots} riservato alle lezioni in corso, worker ${this.workerId})`);
+        this._schedule(0);
+    }
+
+    stop() {
+        this.started = false;
+        clearTimeout(this.timer);
+        this.timer = null;
+    }
+
+    /**
+     * Accoda un'analisi; con un job equivalente ancora in coda restituisce quello
+     * (priorità e scadenza portate al valore più urgente)
+     *
+     * @param {Object} job - type ('image' | 'lesson'), lessonId, imageId, priority ('live' |
+     *                       'reanalysis' | 'backfill' o numero), payload, requestedBy, maxAttempts
+     */
+    async enqueue({ type, lessonId, imageId = null, priority = 'reanalysis', payload = {}, requestedBy = null, maxAttempts = 3 }) {
+        if (!this.handlers[type]) {
+            throw new Error(`Tipo di job sconosciuto: ${type}`);
+        }
+        const priorityValue = typeof priority === 'number' ? priority : PRIORITIES[priority];
+        if (priorityValue === undefined) {
+            throw new Error(`Priorità sconosciuta: ${priority}`);
+        }
+        const coalesceKey = type === 'image' ? `image:${imageId}` : `lesson:${lessonId}`;
+
+        const [rows] = await sequelize.query(`
+            INSERT INTO "AnalysisJobs"
+                (type, lesson_id, image_id, priority, status, coalesce_key, payload,
+                 max_attempts, run_at, requested_by, created_at, updated_at)
+            VALUES
+                (:type, :lessonId, :imageId, :priority, 'queued', :coalesceKey, :payload,
+                 :maxAttempts, NOW(), :requestedBy, NOW(), NOW())
+            ON CONFLICT (coalesce_key) WHERE status = 'queued'
+            DO UPDATE SET
+                priority = LEAST("AnalysisJobs".priority, EXCLUDED.priority),
+                run_at = LEAST("AnalysisJobs".run_at, EXCLUDED.run_at),
+                coalesced = "AnalysisJobs".coalesced + 1,
+                updated_at = NOW()
+            RETURNING id, priority, coalesced, (xmax::text <> '0') AS was_coalesced
+        `, {
+            replacements: {
+                type,
+                lessonId,
+                imageId,
+                priority: priorityValue,
+                coalesceKey,
+                payload: JSON.stringify(payload),
+                maxAttempts,
+                requestedBy
+            }
+        });
+        const job = rows[0];
+
+        if (job.was_coalesced) {
+            this.stats.coalesced++;
+            console.log(`🧾 Richiesta ${coalesceKey} accorpata al job ${job.id} già in coda (${job.coalesced} duplicati)`);
+        } else {
+            this.stats.enqueued++;
+            console.log(`🧾 Job ${job.id} in coda: ${coalesceKey} (priorità ${job.priority})`);
+        }
+
+        this._schedule(0);
+        return { id: job.id, priority: job.priority, coalesced: job.was_coalesced };
+    }
+
+    /**
+     * Attende la fine di un job: risolve con il riepilogo del risultato, rifiuta se il job
+     * fallisce dopo l'ultimo tentativo o non termina entro timeout (code JOB_PENDING: il job
+     * prosegue in background)
+     */
+    waitFor(jobId, timeout = 120000) {
+        return new Promise((resolve, reject) => {
+            const waiter = { resolve, reject };
+            const finish = () => {
+                clearTimeout(waiter.timer);
+                clearInterval(waiter.poll);
+                this._removeWaiter(waiter.jobId, waiter);
+            };
+            waiter.jobId = jobId;
+            waiter.resolve = (value) => { finish(); resolve(value); };
+            waiter.reject = (error) => { finish(); reject(error); };
+            waiter.timer = setTimeout(() => {
+                const error = new Error(`Analisi non completata entro ${Math.round(timeout / 1000)}s (job ${waiter.jobId} ancora in corso)`);
+                error.code = 'JOB_PENDING';
+                error.jobId = waiter.jobId;
+                waiter.reject(error);
+            }, timeout);
+            // Il job può essere eseguito da un'altra istanza: controllo periodico sul database
+            waiter.poll = setInterval(() => this._pollWaiter(waiter), this.waitPollInterval);
+
+            this._addWaiter(jobId, waiter);
+        });
+    }
+
+    _addWaiter(jobId, waiter) {
+        waiter.jobId = jobId;
+        if (!this.waiters.has(jobId)) this.waiters.set(jobId, []);
+        this.waiters.get(jobId).push(waiter);
+    }
+
+    _removeWaiter(jobId, waiter) {
+        const list = (this.waiters.get(jobId) || []).filter(w => w !== waiter);
+        if (list.length > 0) this.waiters.set(jobId, list);
+        else this.waiters.delete(jobId);
+    }
+
+    async _pollWaiter(waiter) {
+        try {
+            const [job] = await sequelize.query(
+                `SELECT status, result, error FROM "AnalysisJobs" WHERE id = :id`,
+                { replacements: { id: waiter.jobId }, type: QueryTypes.SELECT }
+            );
+            if (!job) {
+                waiter.reject(new Error(`Job ${waiter.jobId} non trovato`));
+            } else if (job.status === 'completed') {
+                waiter.resolve(job.result);
+            } else if (job.status === 'failed') {
+                waiter.reject(new Error(job.error || 'Analisi fallita'));
+            } else if (job.status === 'cancelled' && job.result && job.result.coalesced_into) {
+                this._removeWaiter(waiter.jobId, waiter);
+                this._addWaiter(job.result.coalesced_into, waiter);
+            }
+        } catch (error) {
+            console.warn(`⚠️ Stato job ${waiter.jobId} non leggibile: ${error.message}`);
+        }
+    }
+
+    _notify(jobId, error, result) {
+        for (const waiter of this.waiters.get(jobId) || []) {
+            if (error) waiter.reject(error);
+            else waiter.resolve(result);
+        }
+    }
+
+    _schedule(delay) {
+        if (!this.started) return;
+        clearTimeout(this.timer);
+        this.timer = setTimeout(() => this._tick(), delay);
+    }
+
+    async _tick() {
+        if (this.claiming) {
+            this.claimAgain = true;
+            return;
+        }
+        this.claiming = true;
+        this.claimAgain = false;
+        try {
+            if (Date.now() - this.lastRecover > this.recoverInterval) {
+                this.lastRecover = Date.now();
+                await this._recoverExpired();
+            }
+
+            while (this.running.size < this.concurrency + this.reservedLiveSlots) {
+                // Oltre la quota dei job ordinari si prelevano solo lezioni in corso
+                const nonLiveRunning = [...this.running.values()].filter(job => job.priority > PRIORITIES.live).length;
+                const nonLiveLimit = Math.max(1, this.concurrency - this.reservedLiveSlots);
+                const maxPriority = nonLiveRunning >= nonLiveLimit || this.running.size >= this.concurrency
+                    ? PRIORITIES.live
+                    : Number.MAX_SAFE_INTEGER;
+
+                const job = await this._claim(maxPriority);
+                if (!job) break;
+                this._execute(job);
+            }
+        } catch (error) {
+            console.error('❌ Errore coda analisi:', error.message);
+        } finally {
+            this.claiming = false;
+            // Un job accodato o terminato durante il prelievo: nuovo giro subito
+            this._schedule(this.claimAgain ? 0 : this.pollInterval);
+        }
+    }
+
+    async _claim(maxPriority) {
+        const [rows] = await sequelize.query(`
+            UPDATE "AnalysisJobs"
+            SET status = 'running', locked_by = :workerId, locked_at = NOW(), started_at = NOW(),
+                attempts = attempts + 1, updated_at = NOW()
+            WHERE id = (
+                SELECT id FROM "AnalysisJobs"
+                WHERE status = 'queued' AND run_at <= NOW() AND priority <= :maxPriority
+                ORDER BY priority, run_at, id
+                FOR UPDATE SKIP LOCKED
+                LIMIT 1
+            )
+            RETURNING *
+        `, {
+            replacements: { workerId: this.workerId, maxPriority }
+        });
+        return rows[0] || null;
+    }
+
+    async _execute(job) {
+        this.running.set(job.id, job);
+        const start = Date.now();
+        console.log(`▶️ Job ${job.id} ${job.coalesce_key} (priorità ${job.priority}, tentativo ${job.attempts}/${job.max_attempts})`);
+
+        const leaseTimer = setInterval(() => this._renewLease(job), this.leaseRenewInterval);
+        try {
+            const result = await this.handlers[job.type](job);
+            clearInterval(leaseTimer);
+            const [, updated] = await sequelize.query(`
+                UPDATE "AnalysisJobs"
+                SET status = 'completed', result = :result, error = NULL, locked_by = NULL,
+                    finished_at = NOW(), updated_at = NOW()
+                WHERE ${this._ownedBy()}
+            `, { replacements: { ...this._owner(job), result: JSON.stringify(result) } });
+
+            if (this._rowCount(updated) === 0) {
+                // Lease perso (job rimesso in coda e preso da un altro tentativo): l'esito è di quello
+                console.warn(`⚠️ Job ${job.id} completato dopo la perdita del lease, risultato non registrato`);
+                return;
+            }
+
+            this.stats.completed++;
+            console.log(`✅ Job ${job.id} completato in ${Date.now() - start}ms`);
+            this._notify(job.id, null, result);
+        } catch (error) {
+            clearInterval(leaseTimer);
+            await this._handleFailure(job, error).catch(updateError => {
+                console.error(`❌ Stato del job ${job.id} non aggiornato: ${updateError.message}`);
+                this._notify(job.id, error);
+            });
+        } finally {
+            clearInterval(leaseTimer);
+            this.running.delete(job.id);
+            this._schedule(0);
+        }
+    }
+
+    /**
+     * Condizione sul tentativo in corso: stesso worker e stesso numero di tentativo, così un'esecuzione
+     * superata (lease scaduto e job ripreso, anche da questo stesso processo) non sovrascrive l'altra
+     */
+    _ownedBy() {
+        return `id = :id AND status = 'running' AND locked_by = :workerId AND attempts = :attempts`;
+    }
+
+    _owner(job) {
+        return { id: job.id, workerId: this.workerId, attempts: job.attempts };
+    }
+
+    _rowCount(metadata) {
+        // UPDATE senza RETURNING: sequelize (postgres) restituisce il risultato di pg con rowCount
+        return metadata && typeof metadata.rowCount === 'number' ? metadata.rowCount : 1;
+    }
+
+    async _renewLease(job) {
+        try {
+            const [, updated] = await sequelize.query(`
+                UPDATE "AnalysisJobs" SET locked_at = NOW(), updated_at = NOW()
+                WHERE ${this._ownedBy()}
+            `, { replacements: this._owner(job) });
+            if (this._rowCount(updated) === 0) {
+                console.warn(`⚠️ Lease del job ${job.id} non più valido (tentativo ${job.attempts})`);
+            }
+        } catch (error) {
+            console.warn(`⚠️ Lease del job ${job.id} non rinnovato: ${error.message}`);
+        }
+    }
+
+    async _handleFailure(job, error) {
+        const retry = !(error instanceof PermanentJobError) && job.attempts < job.max_attempts;
+
+        if (!retry) {
+            const [, updated] = await sequelize.query(`
+                UPDATE "AnalysisJobs"
+                SET status = 'failed', error = :error, locked_by = NULL, finished_at = NOW(), updated_at = NOW()
+                WHERE ${this._ownedBy()}
+            `, { replacements: { ...this._owner(job), error: error.message } });
+
+            if (this._rowCount(updated) === 0) {
+                console.warn(`⚠️ Job ${job.id} fallito dopo la perdita del lease, esito lasciato al tentativo in corso`);
+                return;
+            }
+
+            this.stats.failed++;
+            console.error(`❌ Job ${job.id} fallito definitivamente (${job.attempts} tentativi): ${error.message}`);
+            this._notify(job.id, error);
+            return;
+        }
+
+        const delay = Math.min(this.backoffMax, this.backoffBase * Math.pow(2, job.attempts - 1));
+        try {
+            const [, updated] = await sequelize.query(`
+                UPDATE "AnalysisJobs"
+                SET status = 'queued', error = :error, locked_by = NULL, locked_at = NULL,
+                    run_at = NOW() + (:delay * INTERVAL '1 millisecond'), updated_at = NOW()
+                WHERE ${this._ownedBy()}
+            `, { replacements: { ...this._owner(job), error: error.message, delay } });
+
+            if (this._rowCount(updated) === 0) {
+                console.warn(`⚠️ Job ${job.id} fallito dopo la perdita del lease, esito lasciato al tentativo in corso`);
+                return;
+            }
+
+            this.stats.retried++;
+            console.warn(`🔁 Job ${job.id} fallito (${error.message}), nuovo tentativo tra ${Math.round(delay / 1000)}s`);
+        } catch (requeueError) {
+            // Nel frattempo è arrivata una richiesta equivalente: proseguirà quella
+            const [queued] = await sequelize.query(
+                `SELECT id FROM "AnalysisJobs" WHERE coalesce_key = :key AND status = 'queued'`,
+                { replacements: { key: job.coalesce_key }, type: QueryTypes.SELECT }
+            );
+            if (!queued) throw requeueError;
+
+            await sequelize.query(`
+                UPDATE "AnalysisJobs"
+                SET status = 'cancelled', error = :error, result = :result, locked_by = NULL,
+                    finished_at = NOW(), updated_at = NOW()
+                WHERE ${this._ownedBy()}
+            `, { replacements: { ...this._owner(job), error: error.message, result: JSON.stringify({ coalesced_into: queued.id }) } });
+
+            console.warn(`🔁 Job ${job.id} fallito, prosegue il job ${queued.id} già in coda`);
+            for (const waiter of [...(this.waiters.get(job.id) || [])]) {
+                this._removeWaiter(job.id, waiter);
+                this._addWaiter(queued.id, waiter);
+            }
+        }
+    }
+
+    /**
+     * Job rimasti "running" oltre il lease (processo terminato durante l'analisi): di nuovo in coda
+     */
+    async _recoverExpired() {
+        const [rows] = await sequelize.query(`
+            UPDATE "AnalysisJobs"
+            SET status = 'queued', locked_by = NULL, locked_at = NULL, updated_at = NOW()
+            WHERE status = 'running'
+            AND locked_at < NOW() - (:leaseMs * INTERVAL '1 millisecond')
+            AND NOT EXISTS (
+                SELECT 1 FROM "AnalysisJobs" q
+                WHERE q.coalesce_key = "AnalysisJobs".coalesce_key AND q.status = 'queued'
+            )
+            RETURNING id
+        `, { replacements: { leaseMs: this.leaseMs } });
+
+        if (rows.length > 0) {
+            console.warn(`♻️ ${rows.length} job rimessi in coda dopo la scadenza del lease: ${rows.map(r => r.id).join(', ')}`);
+        }
+    }
+
+    // ------------------------------------------------------------------
+    // Esecuzione dei job
+    // ------------------------------------------------------------------
+
+    /**
+     * Analisi di una LessonImage: risultato salvato sull'immagine (riquadri al posto dello
+     * scatto originale quando il report è disponibile) e presenze registrate
+     */
+    async _runImageJob(job) {
+        const { LessonImage } = require('../models');
+        const image = await LessonImage.findByPk(job.image_id);
+        if (!image) {
+            throw new PermanentJobError(`Immagine ${job.image_id} non trovata`);
+        }
+        if (image.source === 'report') {
+            // Già analizzata: il frame originale è stato sostituito dal report con i riquadri
+            return this._imageSummary(image);
+        }
+
+        await image.update({ processing_status: 'processing' });
+
+        const analysisResult = await faceDetectionService.analyzeImageBlob(
+            image.image_data,
+            job.lesson_id,
+            { ...(job.payload || {}), imageId: image.id, priority: job.priority }
+        );
+        if (!analysisResult.success) {
+            await image.update({ processing_status: 'failed', error_message: analysisResult.error });
+            throw new Error(analysisResult.error || 'Analisi fallita');
+        }
+
+        const analysisFields = {
+            is_analyzed: true,
+            detected_faces: analysisResult.detected_faces || 0,
+            recognized_faces: analysisResult.recognized_students?.length || 0,
+            processing_status: 'completed',
+            error_message: null,
+            analyzed_at: new Date()
+        };
+
+        if (analysisResult.reportImageBlob) {
+            try {
+                await image.update({
+                    image_data: analysisResult.reportImageBlob,
+                    file_size: analysisResult.reportImageBlob.length,
+                    mime_type: analysisResult.reportImageMimeType || 'image/jpeg',
+                    source: 'report',
+                    ...analysisFields
+                });
+                console.log(`✅ Immagine aggiornata con riquadri: ID ${image.id}`);
+            } catch (reportError) {
+                console.error('❌ Errore aggiornamento immagine con riquadri:', reportError.message);
+                // Manteniamo l'immagine originale se l'update fallisce
+                await image.update(analysisFields);
+            }
+        } else {
+            await image.update(analysisFields);
+            if (analysisResult.reportPending) {
+                console.log(`🕒 Report con riquadri in preparazione: ID ${image.id}`);
+            }
+        }
+
+        return {
+            success: true,
+            image_id: image.id,
+            detected_faces: analysisResult.detected_faces || 0,
+            recognized_students: analysisResult.recognized_students || [],
+            guest_students: analysisResult.guest_students || [],
+            reportPending: !!analysisResult.reportPending
+        };
+    }
+
+    _imageSummary(image) {
+        return {
+            success: true,
+            image_id: image.id,
+            detected_faces: image.detected_faces || 0,
+            recognized_students: [],
+            guest_students: [],
+            reportPending: false,
+            already_analyzed: true
+        };
+    }
+
+    /**
+     * Analisi di tutte le immagini di una lezione (immagine più recente dal database se
+     * disponibile, altrimenti le immagini su filesystem)
+     */
+    async _runLessonJob(job) {
+        const fileAnalysisService = require('./fileAnalysisService');
+        const imageStorageService = require('./imageStorageService');
+        const { LessonImage } = require('../models');
+
+        const [lesson] = await sequelize.query(`
+            SELECT l.id, l.name as lesson_name, c.name as course_name
+            FROM "Lessons" l
+            LEFT JOIN "Courses" c ON l.course_id = c.id
+            WHERE l.id = :id
+        `, {
+            replacements: { id: job.lesson_id },
+            type: QueryTypes.SELECT
+        });
+        if (!lesson) {
+            throw new PermanentJobError(`Lezione ${job.lesson_id} non trovata`);
+        }
+
+        // Rianalisi: volti ed embeddings delle immagini già viste dal detection store, si rifà
+        // solo il match (soglia o studenti cambiati); payload.rematch = false forza il rilevamento
+        const options = { priority: job.priority, rematch: (job.payload || {}).rematch !== false };
+        let imageInfo = null;
+        let results = null;
+
+        try {
+            imageInfo = await imageStorageService.getImageForAnalysis(job.lesson_id);
+            console.log(`✅ Immagine recuperata da: ${imageInfo.source}`);
+
+            results = await fileAnalysisService.analyzeLessonImages(
+                job.lesson_id,
+                lesson.course_name,
+                lesson.lesson_name,
+                imageInfo.imagePath,
+                options
+            );
+
+            if (imageInfo.isTemporary) {
+                await imageStorageService.cleanupTemporaryFiles(imageInfo.imagePath);
+            }
+
+            if (imageInfo.source === 'database' && imageInfo.imageId) {
+                await LessonImage.update(
+                    { is_analyzed: true },
+                    { where: { id: imageInfo.imageId } }
+                );
+            }
+        } catch (dbError) {
+            console.log(`⚠️ Database fallito (${dbError.message}), provo filesystem tradizionale...`);
+            imageInfo = null;
+            results = await fileAnalysisService.analyzeLessonImages(
+                job.lesson_id,
+                lesson.course_name,
+                lesson.lesson_name,
+                null,
+                options
+            );
+        }
+
+        // success: false (nessuna immagine, lezione senza corso...) è un esito, non un errore da ritentare
+        if (!results) {
+            throw new Error('Nessun risultato dall\'analisi');
+        }
+
+        return {
+            results,
+            source: imageInfo ? imageInfo.source : 'filesystem'
+        };
+    }
+
+    // ------------------------------------------------------------------
+    // Stato
+    // ------------------------------------------------------------------
+
+    async getLessonJobs(lessonId, limit = 20) {
+        return sequelize.query(`
+            SELECT id, type, image_id, priority, status, coalesced, attempts, max_attempts,
+                   error, run_at, started_at, finished_at, created_at
+            FROM "AnalysisJobs"
+            WHERE lesson_id = :lessonId
+            ORDER BY created_at DESC
+            LIMIT :limit
+        `, {
+            replacements: { lessonId, limit },
+            type: QueryTypes.SELECT
+        });
+    }
+
+    async getStats() {
+        const counts = await sequelize.query(`
+            SELECT status, priority, COUNT(*)::int AS count,
+                   MIN(run_at) FILTER (WHERE status = 'queued') AS oldest_run_at
+            FROM "AnalysisJobs"
+            WHERE status IN ('queued', 'running') OR finished_at > NOW() - INTERVAL '1 hour'
+            GROUP BY status, priority
+            ORDER BY priority, status
+        `, { type: QueryTypes.SELECT });
+
+        return {
+            workerId: this.workerId,
+            started: this.started,
+            concurrency: this.concurrency,
+            reservedLiveSlots: this.reservedLiveSlots,
+            running: [...this.running.values()].map(job => ({
+                id: job.id,
+                key: job.coalesce_key,
+                priority: job.priority,
+                attempt: job.attempts,
+                startedAt: job.started_at
+            })),
+            waiters: this.waiters.size,
+            counts,
+            ...this.stats
+        };
+    }
+}
+
+const analysisQueueService = new AnalysisQueueService();
+analysisQueueService.PRIORITIES = PRIORITIES;
+module.exports = analysisQueueService;
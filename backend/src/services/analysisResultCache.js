@@ -0,0 +1,162 @@
+// backend/src/services/analysisResultCache.js
+// Cache dei risultati di analisi indirizzata per contenuto: la chiave è l'hash delle immagini
+// inviate, della versione della galleria studenti e dell'impronta di config e opzioni.
+// Le stesse immagini che tornano alla pipeline (upload ripetuti dal frontend, copia nel DB e su
+// disco della stessa lezione, trigger admin ripetuti) costano un hash invece di un'analisi.
+// LRU limitata per numero di voci e byte (risultato JSON + report), con TTL; le richieste
+// identiche ancora in corso condividono la stessa analisi invece di avviarne un'altra.
+
+const crypto = require('crypto');
+
+class AnalysisResultCache {
+    constructor(options = {}) {
+        this.enabled = options.enabled !== false;
+        this.maxEntries = options.maxEntries || 200;
+        this.maxBytes = options.maxBytes || 64 * 1024 * 1024;
+        this.ttlMs = options.ttlMs || 6 * 60 * 60 * 1000;
+
+        // key → { json, attachments, bytes, storedAt }, in ordine di ultimo uso
+        this.entries = new Map();
+        this.bytes = 0;
+        this.inflight = new Map();
+
+        this.stats = {
+            hits: 0,
+            misses: 0,
+            coalesced: 0,
+            stored: 0,
+            evicted: 0,
+            expired: 0
+        };
+    }
+
+    /**
+     * Chiave da immagini (Buffer), versione galleria e impronta della richiesta.
+     * Ogni parte entra come digest a lunghezza fissa, dopo il numero di immagini: confini e
+     * separatori dentro le parti non possono produrre la stessa sequenza per richieste diverse.
+     */
+    static key(imageBuffers, galleryVersion, fingerprint) {
+        const digest = (data) => crypto.createHash('sha256').update(data).digest();
+        const hash = crypto.createHash('sha256');
+        hash.update(`${imageBuffers.length}|`);
+        for (const buffer of imageBuffers) {
+            hash.update(digest(buffer));
+        }
+        hash.update(digest(String(galleryVersion)));
+        hash.update(digest(String(fingerprint)));
+        return hash.digest('hex');
+    }
+
+    /**
+     * Risultato in cache (copia: i chiamanti modificano il risultato) oppure null
+     */
+    get(key) {
+        const entry = this.entries.get(key);
+        if (!entry) {
+            return null;
+        }
+        if (Date.now() - entry.storedAt > this.ttlMs) {
+            this._remove(key, entry);
+            this.stats.expired++;
+            return null;
+        }
+        // LRU: la voce appena letta diventa la più recente
+        this.entries.delete(key);
+        this.entries.set(key, entry);
+        return this._copy(entry);
+    }
+
+    set(key, result, attachments = []) {
+        const json = JSON.stringify(result);
+        const bytes = Buffer.byteLength(json) + attachments.reduce((sum, a) => sum + (a ? a.length : 0), 0);
+        if (bytes > this.maxBytes) {
+            return;
+        }
+
+        const previous = this.entries.get(key);
+        if (previous) {
+            this._remove(key, previous);
+        }
+        this.entries.set(key, { json, attachments: attachments.slice(), bytes, storedAt: Date.now() });
+        this.bytes += bytes;
+        this.stats.stored++;
+
+        for (const [oldKey, oldEntry] of this.entries) {
+            if (this.entries.size <= this.maxEntries && this.bytes <= this.maxBytes) break;
+            this._remove(oldKey, oldEntry);
+            this.stats.evicted++;
+        }
+    }
+
+    /**
+     * Risultato in cache, analisi identica già in corso oppure compute();
+     * compute restituisce { result, attachments, cacheable }
+     *
+     * @returns {Promise<{result, attachments, cache: 'hit'|'coalesced'|'miss', ageMs?: number}>}
+     */
+    async getOrCompute(key, compute) {
+        const cached = this.get(key);
+        if (cached) {
+            this.stats.hits++;
+            return { ...cached, cache: 'hit' };
+        }
+
+        const running = this.inflight.get(key);
+        if (running) {
+            this.stats.coalesced++;
+            const shared = await running;
+            return { ...this._copy(shared), cache: 'coalesced' };
+        }
+
+        this.stats.misses++;
+        const promise = (async () => {
+            const { result, attachments = [], cacheable } = await compute();
+            const entry = { json: JSON.stringify(result), attachments, storedAt: Date.now() };
+            if (cacheable) {
+                this.set(key, result, attachments);
+            }
+            return entry;
+        })();
+        this.inflight.set(key, promise);
+
+        try {
+            const entry = await promise;
+            return { result: JSON.parse(entry.json), attachments: entry.attachments.slice(), cache: 'miss' };
+        } finally {
+            this.inflight.delete(key);
+        }
+    }
+
+    clear() {
+        this.entries.clear();
+        this.bytes = 0;
+    }
+
+    getStats() {
+        const lookups = this.stats.hits + this.stats.coalesced + this.stats.misses;
+        return {
+            enabled: this.enabled,
+            entries: this.entries.size,
+            bytes: this.bytes,
+            maxEntries: this.maxEntries,
+            maxBytes: this.maxBytes,
+            hitRate: lookups > 0 ? (this.stats.hits + this.stats.coalesced) / lookups : 0,
+            ...this.stats
+        };
+    }
+
+    _copy(entry) {
+        return {
+            result: JSON.parse(entry.json),
+            attachments: entry.attachments.slice(),
+            ageMs: Date.now() - entry.storedAt
+        };
+    }
+
+    _remove(key, entry) {
+        this.entries.delete(key);
+        this.bytes -= entry.bytes;
+    }
+}
+
+module.exports = AnalysisResultCache;
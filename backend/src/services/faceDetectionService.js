@@ -1,7 +1,12 @@
 const { spawn } = require('child_process');
 const path = require('path');
 const fs = require('fs');
+const os = require('os');
 const crypto = require('crypto');
+const FaceWorkerPool = require('./faceWorkerPool');
+const { encodeMessage, FrameDecoder } = require('./faceProtocol');
+const PythonLogTail = require('./pythonLogTail');
+const AnalysisResultCache = require('./analysisResultCache');
 const { sequelize } = require('../config/database');
 const { QueryTypes } = require('sequelize');
 
@@ -13,15 +18,10 @@ class FaceDetectionService {
         this.backendDir = process.cwd();
         
         this.tempDir = path.join(this.backendDir, 'temp', 'face_processing');
-        this.tempImagesDir = path.join(this.tempDir, 'images');
-        this.tempStudentsDir = path.join(this.tempDir, 'students');
-        this.tempOutputDir = path.join(this.tempDir, 'output');
         
-        [this.tempDir, this.tempImagesDir, this.tempStudentsDir, this.tempOutputDir].forEach(dir => {
-            if (!fs.existsSync(dir)) {
-                fs.mkdirSync(dir, { recursive: true });
-            }
-        });
+        if (!fs.existsSync(this.tempDir)) {
+            fs.mkdirSync(this.tempDir, { recursive: true });
+        }
         
         this.pythonScriptPath = path.join(this.backendDir, 'scripts', 'face_detection.py');
         this.configPath = path.join(this.backendDir, 'config', 'face_detection_config.json');
@@ -30,13 +30,81 @@ class FaceDetectionService {
         
         this.pythonExecutable = this._findPythonExecutable();
         
+        // Timeout per immagine; un batch ha a disposizione un multiplo
+        this.analysisTimeout = 60000;
+        this.batchImageTimeout = 15000;
+        
+        // FACE_TRACE=true: diagnostica completa per volto/studente nel risultato di ogni analisi
+        this.traceAnalyses = process.env.FACE_TRACE === 'true';
+        
+        // FACE_REPORT_MODE: "inline" (default) disegna il report prima di restituire le presenze,
+        // "deferred" lo fa disegnare subito dopo in background, "on_demand" alla prima richiesta
+        // dell'immagine (pannello screenshot). Vale per le analisi legate a una LessonImage.
+        this.reportMode = process.env.FACE_REPORT_MODE || 'inline';
+        this.maxPendingReports = parseInt(process.env.FACE_PENDING_REPORTS, 10) || 50;
+        this.pendingReports = new Map();
+        
+        // Pool di worker persistenti: i modelli restano caricati tra un'analisi e l'altra
+        this.useWorkerPool = process.env.FACE_WORKER_POOL !== 'false';
+        this.workerPool = null;
+        if (this.useWorkerPool) {
+            const defaultSize = Math.max(1, Math.min(2, os.cpus().length - 1));
+            this.workerPool = new FaceWorkerPool({
+                pythonExecutable: this.pythonExecutable,
+                scriptPath: this.pythonScriptPath,
+                configPath: fs.existsSync(this.configPath) ? this.configPath : null,
+                size: parseInt(process.env.FACE_WORKER_POOL_SIZE, 10) || defaultSize,
+                requestTimeout: this.analysisTimeout,
+                // Analisi simultanee (es. captureMultiple allo scoccare dell'ora) accorpate in un
+                // unico passaggio nel recognizer; FACE_MICRO_BATCH=false le invia una per una
+                microBatch: {
+                    enabled: process.env.FACE_MICRO_BATCH !== 'false',
+                    maxBatch: parseInt(process.env.FACE_MICRO_BATCH_MAX, 10) || 8,
+                    maxWaitMs: parseInt(process.env.FACE_MICRO_BATCH_WAIT_MS, 10) || 30,
+                    itemTimeout: this.batchImageTimeout
+                }
+            });
+        }
+        
         console.log(`📁 Backend dir: ${this.backendDir}`);
         console.log(`📁 Temp dir: ${this.tempDir}`);
         console.log(`🐍 Python script: ${this.pythonScriptPath}`);
         console.log(`🐍 Python executable: ${this.pythonExecutable}`);
+        console.log(`🛰️ Worker pool: ${this.workerPool ? `${this.workerPool.size} processi` : 'disabilitato'}`);
+        
+        // Hash foto già inviate ai worker (userId → md5): per queste basta un riferimento,
+        // l'embedding è nella cache Python (memoria + store su disco condiviso)
+        this.sentPhotoHashes = new Map();
+        
+        // Risultati per contenuto (immagini + galleria + config): le immagini duplicate non
+        // vengono rianalizzate; FACE_RESULT_CACHE=false la disattiva
+        this.resultCache = new AnalysisResultCache({
+            enabled: process.env.FACE_RESULT_CACHE !== 'false',
+            maxEntries: parseInt(process.env.FACE_RESULT_CACHE_ENTRIES, 10) || 200,
+            maxBytes: (parseInt(process.env.FACE_RESULT_CACHE_MB, 10) || 64) * 1024 * 1024
+        });
+        this.configFingerprint = this._configFingerprint();
+        
+        // Esito del frame gate Python sugli scatti periodici delle aule (options.frameKey)
+        this.frameGateStats = { skip: 0, partial: 0, full: 0 };
         console.log('\n✅ Face Detection Service inizializzato\n');
     }
 
+    /**
+     * Avvia in anticipo i worker Python così la prima analisi non paga il caricamento modelli
+     */
+    warmUp() {
+        if (this.workerPool) {
+            this.workerPool.start();
+        }
+    }
+
+    shutdown() {
+        if (this.workerPool) {
+            this.workerPool.stop();
+        }
+    }
+
     _findPythonExecutable() {
         const possiblePaths = [
             '/Users/stebbi/attendance-system/venv_deepface/bin/python3',
@@ -64,45 +132,45 @@ class FaceDetectionService {
         console.log(`\n🚀 ANALISI FACE DETECTION [${sessionId}]`);
         console.log(`Lesson ID: ${lessonId}`);
         console.log(`Image ID: ${imageId}`);
-        console.log(`Blob size: ${imageBlob.length} bytes`);
-        
-        let tempImagePath = null;
-        let tempStudentsJsonPath = null;
-        let tempOutputPath = null;
-        let tempStudentsDir = null;
-        let analysisResult = null;
+        console.log(`Blob size: ${imageBlob ? imageBlob.length : 0} bytes`);
         
         try {
             if (!imageBlob || imageBlob.length === 0) {
                 throw new Error('BLOB immagine vuoto');
             }
             
-            tempImagePath = await this._saveBlobAsFile(imageBlob, sessionId);
-            console.log(`✅ Immagine salvata: ${tempImagePath}`);
+            const imageBuffer = this._toBuffer(imageBlob);
             
-            console.log(`🔍 DEBUG: Cercando info per lessonId=${lessonId}`);
             const lessonInfo = await this._getLessonInfo(lessonId);
-            console.log(`🔍 DEBUG: lessonInfo result:`, lessonInfo);
             if (!lessonInfo) {
                 throw new Error(`Lezione ${lessonId} non trovata`);
             }
             console.log(`📚 Corso: ${lessonInfo.course_name} (ID: ${lessonInfo.course_id})`);
             
-            const studentsData = await this._generateStudentsData(lessonInfo.course_id, sessionId);
-            tempStudentsJsonPath = studentsData.jsonPath;
-            tempStudentsDir = studentsData.photosDir;
-            console.log(`✅ Studenti generati: ${studentsData.count}`);
+            const students = await this._loadCourseStudents(lessonInfo.course_id);
+            console.log(`✅ Studenti caricati: ${students.length}`);
             
-            tempOutputPath = path.join(this.tempOutputDir, `result_${sessionId}.json`);
-            
-            analysisResult = await this._executePythonAnalysis({
-                imagePath: tempImagePath,
-                studentsPath: tempStudentsJsonPath,
-                outputPath: tempOutputPath,
-                sessionId
+            const deferReport = imageId !== null && this.reportMode !== 'inline';
+            const { result: analysisResult, attachments } = await this._executePythonAnalysis({
+                buildRequest: (forceInline) => this._buildAnalyzeRequest(imageBuffer, students, forceInline, deferReport),
+                students,
+                cache: { images: [imageBuffer], options: { command: 'analyze_blob', deferReport } },
+                sessionId,
+                priority: options.priority,
+                rematch: !!options.rematch,
+                frameKey: options.frameKey
             });
+            const reportImageMimeType = this._reportMimeType(analysisResult);
+            const reportImageBlob = this._takeReportAttachment(analysisResult, attachments);
+            const reportJob = analysisResult.report_job;
+            delete analysisResult.report_job;
+            
+            if (analysisResult.error && !analysisResult.success) {
+                throw new Error(analysisResult.error);
+            }
             
             console.log(`✅ Analisi completata: ${analysisResult.detected_faces} volti, ${analysisResult.recognized_students?.length || 0} riconosciuti`);
+            analysisResult.guest_students = await this._describeGuests(analysisResult.guest_students);
             
             // Salva sempre un report completo per tutti gli studenti del corso
             await this._saveCompleteAttendanceReport(lessonId, analysisResult.recognized_students || [], imageId);
@@ -113,39 +181,21 @@ class FaceDetectionService {
                 analysisResult.recognized_students = uniqueStudents;
             }
             
-            let reportImageBlob = null;
-            console.log(`\n🖼️ === CONVERSIONE IMMAGINE REPORT ===`);
-            console.log(`📂 Report image path: ${analysisResult.report_image}`);
-            console.log(`📁 Path exists: ${analysisResult.report_image ? fs.existsSync(analysisResult.report_image) : 'false'}`);
-            
-            if (analysisResult.report_image && fs.existsSync(analysisResult.report_image)) {
-                try {
-                    reportImageBlob = fs.readFileSync(analysisResult.report_image);
-                    console.log(`✅ Report immagine convertita: ${reportImageBlob.length} bytes`);
-                    console.log(`📊 File stats:`, fs.statSync(analysisResult.report_image));
-                    
-                    // Cancella il file temporaneo dopo la lettura
-                    try {
-                        fs.unlinkSync(analysisResult.report_image);
-                        console.log(`🧹 File report temporaneo cancellato: ${analysisResult.report_image}`);
-                    } catch (cleanupError) {
-                        console.warn(`⚠️ Errore cancellazione file report: ${cleanupError.message}`);
-                    }
-                } catch (error) {
-                    console.warn(`⚠️ Errore lettura report immagine: ${error.message}`);
-                }
+            if (reportImageBlob) {
+                console.log(`🖼️ Report immagine ricevuto in memoria: ${reportImageBlob.length} bytes`);
+            } else if (reportJob && imageId !== null) {
+                this._scheduleReport(imageId, imageBuffer, reportJob);
             } else {
-                console.warn(`⚠️ Report immagine non trovata o path non valido`);
-                if (analysisResult.report_image) {
-                    console.warn(`   Path: ${analysisResult.report_image}`);
-                }
+                console.warn(`⚠️ Report immagine non disponibile`);
             }
             
             return {
                 success: true,
                 sessionId,
-                reportImagePath: analysisResult.report_image,
-                reportImageBlob: reportImageBlob,
+                reportImagePath: null,
+                reportImageBlob,
+                reportImageMimeType,
+                reportPending: !reportImageBlob && this.hasPendingReport(imageId),
                 ...analysisResult
             };
             
@@ -159,46 +209,137 @@ class FaceDetectionService {
                 detected_faces: 0,
                 recognized_students: []
             };
-            
-        } finally {
-            const filesToCleanup = [
-                tempImagePath,
-                tempStudentsJsonPath,
-                tempOutputPath,
-                tempStudentsDir
-            ];
-            
-            console.log(`🧹 File da pulire: ${filesToCleanup.filter(f => f).length}`);
-            if (analysisResult && analysisResult.report_image) {
-                console.log(`🖼️ Report image NON cancellata: ${analysisResult.report_image}`);
-            }
-            
-            this._cleanupTempFiles(filesToCleanup, sessionId);
         }
     }
 
-    async _saveBlobAsFile(imageBlob, sessionId) {
+    /**
+     * Analisi di un'immagine su disco (route di debug e chiamanti legacy basati su path)
+     */
+    async processImage(imagePath, lessonId, options = {}) {
+        if (!imagePath || !fs.existsSync(imagePath)) {
+            return {
+                success: false,
+                error: `Immagine non trovata: ${imagePath}`,
+                detected_faces: 0,
+                recognized_students: []
+            };
+        }
+        
+        const imageBuffer = await fs.promises.readFile(imagePath);
+        const result = await this.analyzeImageBlob(imageBuffer, lessonId, {
+            debugMode: options.debugMode,
+            imageId: options.dbImageId || null
+        });
+        
+        if (options.outputPath) {
+            const { reportImageBlob, ...serializable } = result;
+            await fs.promises.writeFile(options.outputPath, JSON.stringify(serializable, null, 2));
+        }
+        
+        return result;
+    }
+
+    /**
+     * Analisi di più immagini della stessa lezione in una sola richiesta Python:
+     * galleria studenti caricata una volta, risultati per immagine + verdetto unico
+     * 
+     * @param {Array<{name: string, buffer?: Buffer, path?: string}>} images
+     * @param {number} lessonId
+     * @param {Object} options - returnReports (report JPEG per immagine), saveAttendance (default true),
+     *                            priority (coda del pool: valori più bassi passano prima),
+     *                            rematch (volti dal detection store se già rilevati: solo match)
+     */
+    async analyzeImageBatch(images, lessonId, options = {}) {
+        const sessionId = crypto.randomBytes(8).toString('hex');
+        const saveAttendance = options.saveAttendance !== false;
+        console.log(`\n🚀 ANALISI BATCH FACE DETECTION [${sessionId}]`);
+        console.log(`Lesson ID: ${lessonId}`);
+        console.log(`Immagini: ${images.length}`);
+        
         try {
-            let buffer;
+            if (!images || images.length === 0) {
+                throw new Error('Nessuna immagine da analizzare');
+            }
             
-            if (Buffer.isBuffer(imageBlob)) {
-                buffer = imageBlob;
-            } else if (typeof imageBlob === 'string') {
-                buffer = Buffer.from(imageBlob, 'base64');
-            } else {
-                buffer = Buffer.from(imageBlob);
+            const batchImages = await Promise.all(images.map(async (image, i) => ({
+                name: image.name || `image_${i}`,
+                buffer: image.buffer ? this._toBuffer(image.buffer) : await fs.promises.readFile(image.path)
+            })));
+            
+            const lessonInfo = await this._getLessonInfo(lessonId);
+            if (!lessonInfo) {
+                throw new Error(`Lezione ${lessonId} non trovata`);
+            }
+            console.log(`📚 Corso: ${lessonInfo.course_name} (ID: ${lessonInfo.course_id})`);
+            
+            const students = await this._loadCourseStudents(lessonInfo.course_id);
+            console.log(`✅ Studenti caricati: ${students.length}`);
+            
+            const returnReports = !!options.returnReports;
+            const { result, attachments } = await this._executePythonAnalysis({
+                buildRequest: (forceInline) => this._buildBatchRequest(batchImages, students, forceInline, returnReports),
+                students,
+                cache: {
+                    images: batchImages.map(image => image.buffer),
+                    names: batchImages.map(image => image.name),
+                    options: { command: 'analyze_batch', returnReports }
+                },
+                sessionId,
+                timeout: this.analysisTimeout + batchImages.length * this.batchImageTimeout,
+                priority: options.priority,
+                rematch: !!options.rematch
+            });
+            
+            if (result.status !== 'success') {
+                throw new Error(result.error || 'Analisi batch fallita');
             }
             
-            const filePath = path.join(this.tempImagesDir, `image_${sessionId}.jpg`);
-            fs.writeFileSync(filePath, buffer);
+            const imageResults = (result.images || []).map(imageResult => {
+                const reportImageMimeType = this._reportMimeType(imageResult);
+                const reportImageBlob = this._takeReportAttachment(imageResult, attachments);
+                return {
+                    ...imageResult,
+                    success: imageResult.status === 'success',
+                    reportImageBlob,
+                    reportImageMimeType
+                };
+            });
+            
+            const merged = result.merged || { recognized_students: [] };
+            merged.guest_students = await this._describeGuests(merged.guest_students);
+            console.log(`✅ Batch completato: ${merged.images_analyzed}/${imageResults.length} immagini, ${merged.recognized_students.length} presenti`);
             
-            return filePath;
+            if (saveAttendance) {
+                await this._saveCompleteAttendanceReport(lessonId, merged.recognized_students, null);
+            }
+            
+            return {
+                success: true,
+                sessionId,
+                images: imageResults,
+                merged,
+                processing_info: result.processing_info
+            };
             
         } catch (error) {
-            throw new Error(`Errore salvataggio immagine: ${error.message}`);
+            console.error(`❌ Errore analisi batch [${sessionId}]:`, error.message);
+            
+            return {
+                success: false,
+                sessionId,
+                error: error.message,
+                images: [],
+                merged: { recognized_students: [], absent_students: [] }
+            };
         }
     }
 
+    _toBuffer(data) {
+        if (Buffer.isBuffer(data)) return data;
+        if (typeof data === 'string') return Buffer.from(data, 'base64');
+        return Buffer.from(data);
+    }
+
     async _getLessonInfo(lessonId) {
         try {
             const [lesson] = await sequelize.query(`
@@ -218,83 +359,502 @@ class FaceDetectionService {
         }
     }
 
-    async _generateStudentsData(courseId, sessionId) {
-        try {
-            const students = await sequelize.query(`
-                SELECT id, name, surname, matricola, "photoPath", email
-                FROM "Users" 
-                WHERE role = 'student' 
-                AND "courseId" = :courseId
-                AND "photoPath" IS NOT NULL
-            `, {
-                replacements: { courseId },
-                type: QueryTypes.SELECT
-            });
+    /**
+     * Studenti del corso con foto in memoria e hash md5 (stesso hash usato dalla cache Python)
+     */
+    async _loadCourseStudents(courseId) {
+        const rows = await sequelize.query(`
+            SELECT id, name, surname, matricola, "photoPath", email,
+                   face_embedding, face_embedding_model, face_embedding_dtype, face_embedding_photo_hash
+            FROM "Users" 
+            WHERE role = 'student' 
+            AND "courseId" = :courseId
+            AND "photoPath" IS NOT NULL
+        `, {
+            replacements: { courseId },
+            type: QueryTypes.SELECT
+        });
+        
+        console.log(`👥 Trovati ${rows.length} studenti per corso ${courseId}`);
+        
+        const students = [];
+        for (const row of rows) {
+            let photoBuffer;
+            if (Buffer.isBuffer(row.photoPath)) {
+                photoBuffer = row.photoPath;
+            } else if (typeof row.photoPath === 'string' && row.photoPath.length > 1000) {
+                photoBuffer = Buffer.from(row.photoPath, 'base64');
+            } else {
+                console.warn(`⚠️ Foto non valida per ${row.name} ${row.surname}`);
+                continue;
+            }
             
-            console.log(`👥 Trovati ${students.length} studenti per corso ${courseId}`);
+            const photoHash = crypto.createHash('md5').update(photoBuffer).digest('hex');
             
-            // Crea directory per foto temporanee
-            const photosDir = path.join(this.tempStudentsDir, `session_${sessionId}`);
-            fs.mkdirSync(photosDir, { recursive: true });
+            // Embedding dell'iscrizione valido solo se calcolato dalla foto attuale
+            let enrollment = null;
+            if (row.face_embedding && row.face_embedding_photo_hash === photoHash) {
+                enrollment = {
+                    embedding: this._toBuffer(row.face_embedding),
+                    model: row.face_embedding_model,
+                    dtype: row.face_embedding_dtype || 'float32'
+                };
+            }
             
-            const validStudents = [];
+            students.push({
+                id: row.id,
+                name: row.name,
+                surname: row.surname,
+                matricola: row.matricola,
+                email: row.email,
+                photoHash,
+                photoBuffer,
+                enrollment
+            });
+        }
+        
+        return students;
+    }
+
+    /**
+     * Calcola l'embedding di una foto studente (comando enroll) e lo salva nelle colonne
+     * face_embedding* dell'utente; una foto non valida non blocca il chiamante
+     */
+    async enrollStudentPhoto(userId, photoBuffer, info = {}) {
+        const sessionId = crypto.randomBytes(8).toString('hex');
+        const photo = this._toBuffer(photoBuffer);
+        console.log(`\n🪪 ISCRIZIONE VOLTO utente ${userId} [${sessionId}] (${photo.length} bytes)`);
+        
+        try {
+            const response = await this._sendAnalyzeRequest({
+                command: 'enroll',
+                user_id: userId,
+                name: info.name,
+                surname: info.surname,
+                photo: { attachment: 0 }
+            }, [photo], sessionId);
             
-            for (const student of students) {
-                try {
-                    let photoBuffer;
-                    
-                    if (Buffer.isBuffer(student.photoPath)) {
-                        photoBuffer = student.photoPath;
-                    } else if (typeof student.photoPath === 'string' && student.photoPath.length > 1000) {
-                        photoBuffer = Buffer.from(student.photoPath, 'base64');
-                    } else {
-                        console.warn(`⚠️ Foto non valida per ${student.name} ${student.surname}`);
-                        continue;
-                    }
-                    
-                    const photoPath = path.join(photosDir, `student_${student.id}.jpg`);
-                    fs.writeFileSync(photoPath, photoBuffer);
-                    
-                    validStudents.push({
-                        id: student.id,
-                        name: student.name,
-                        surname: student.surname,
-                        matricola: student.matricola,
-                        email: student.email,
-                        photoPath: photoPath
-                    });
-                    
-                } catch (error) {
-                    console.warn(`⚠️ Errore processamento foto per ${student.name}: ${error.message}`);
-                }
+            const result = response.result || {};
+            const embedding = (response.attachments || [])[result.embedding_attachment];
+            if (!embedding) {
+                throw new Error('Embedding non restituito dal worker');
             }
             
-                const jsonPath = path.join(this.tempStudentsDir, `students_${sessionId}.json`);
-            fs.writeFileSync(jsonPath, JSON.stringify(validStudents, null, 2));
+            const { User } = require('../models');
+            await User.update({
+                face_embedding: embedding,
+                face_embedding_model: result.model,
+                face_embedding_dtype: result.dtype,
+                face_embedding_photo_hash: result.photo_hash,
+                face_embedding_updated_at: new Date()
+            }, { where: { id: userId } });
             
-            return {
-                students: validStudents,
-                count: validStudents.length,
-                jsonPath: jsonPath,
-                photosDir: photosDir
+            // Il worker ha già l'embedding in cache: basta un riferimento anche senza colonna
+            this.sentPhotoHashes.set(userId, result.photo_hash);
+            
+            console.log(`✅ Embedding salvato: ${result.model} ${result.dim}×${result.dtype} (${embedding.length} bytes)`);
+            return { success: true, model: result.model, dim: result.dim, dtype: result.dtype };
+        } catch (error) {
+            console.warn(`⚠️ Iscrizione volto utente ${userId} non riuscita: ${error.message}`);
+            return { success: false, error: error.message };
+        }
+    }
+
+    /**
+     * Toglie gli studenti dall'indice di istituto (eliminazione o disattivazione): il worker
+     * lo registra nel journal e gli altri processi lo applicano alla prossima analisi
+     */
+    async removeStudentFromIndex(userIds) {
+        const ids = (Array.isArray(userIds) ? userIds : [userIds]).map(id => parseInt(id, 10));
+        const sessionId = crypto.randomBytes(8).toString('hex');
+        try {
+            const response = await this._sendAnalyzeRequest({ command: 'index_remove', user_ids: ids }, [], sessionId);
+            const result = response.result || {};
+            ids.forEach(id => this.sentPhotoHashes.delete(id));
+            // Gli ospiti riconosciuti dall'indice di istituto sono nei risultati in cache
+            this.resultCache.clear();
+            console.log(`🧭 Rimossi dall'indice di istituto: ${result.removed ?? 0}/${ids.length} (${result.indexed ?? 'n/d'} indicizzati)`);
+            return { success: true, removed: result.removed ?? 0 };
+        } catch (error) {
+            console.warn(`⚠️ Rimozione dall'indice di istituto non riuscita (${ids.join(', ')}): ${error.message}`);
+            return { success: false, error: error.message };
+        }
+    }
+
+    /**
+     * Dati anagrafici degli studenti esterni al corso riconosciuti dall'indice di istituto;
+     * restano fuori dal report presenze della lezione
+     */
+    async _describeGuests(guests) {
+        if (!guests || guests.length === 0) return [];
+        
+        try {
+            const { User } = require('../models');
+            const users = await User.findAll({
+                where: { id: guests.map(guest => guest.userId), role: 'student', is_active: true },
+                attributes: ['id', 'name', 'surname', 'matricola', 'courseId']
+            });
+            const byId = new Map(users.map(user => [user.id, user]));
+            
+            const described = guests
+                .filter(guest => byId.has(guest.userId))
+                .map(guest => {
+                    const user = byId.get(guest.userId);
+                    return {
+                        ...guest,
+                        name: user.name,
+                        surname: user.surname,
+                        matricola: user.matricola,
+                        courseId: user.courseId
+                    };
+                });
+            if (described.length > 0) {
+                console.log(`🧭 Studenti di altri corsi riconosciuti: ${described.map(g => `${g.name} ${g.surname} (corso ${g.courseId})`).join(', ')}`);
+            }
+            return described;
+        } catch (error) {
+            console.warn(`⚠️ Studenti esterni non risolti: ${error.message}`);
+            return guests;
+        }
+    }
+
+    /**
+     * Rifà in background le iscrizioni calcolate con un modello diverso da quello attuale
+     */
+    _refreshEnrollments(students, ids) {
+        const stale = students.filter(student => ids.includes(student.id));
+        if (stale.length === 0) return;
+        
+        console.log(`🔄 ${stale.length} embeddings di iscrizione da ricalcolare (modello cambiato)`);
+        stale.reduce(
+            (chain, student) => chain.then(() => this.enrollStudentPhoto(student.id, student.photoBuffer, student)),
+            Promise.resolve()
+        );
+    }
+
+    /**
+     * Manifest studenti: le foto non ancora note ai worker vengono accodate agli allegati,
+     * per le altre basta l'hash (riferimento all'embedding in cache)
+     */
+    _buildStudentsManifest(students, attachments, forceInline = new Set()) {
+        const manifest = [];
+        let references = 0;
+        let embeddings = 0;
+        
+        for (const student of students) {
+            const entry = {
+                id: student.id,
+                name: student.name,
+                surname: student.surname,
+                matricola: student.matricola,
+                email: student.email,
+                photo_hash: student.photoHash
             };
             
+            if (!forceInline.has(student.id) && student.enrollment) {
+                // Embedding dell'iscrizione: niente foto né inferenza lato Python
+                entry.embedding = {
+                    attachment: attachments.length,
+                    model: student.enrollment.model,
+                    dtype: student.enrollment.dtype
+                };
+                attachments.push(student.enrollment.embedding);
+                embeddings++;
+            } else if (!forceInline.has(student.id) && this.sentPhotoHashes.get(student.id) === student.photoHash) {
+                references++;
+            } else {
+                entry.photo = { attachment: attachments.length };
+                attachments.push(student.photoBuffer);
+            }
+            manifest.push(entry);
+        }
+        
+        return { manifest, references, embeddings };
+    }
+
+    /**
+     * analyze_blob: allegato 0 = immagine, poi le foto del manifest
+     * (deferReport: al posto del report il risultato porta report_job, vedi _scheduleReport)
+     */
+    _buildAnalyzeRequest(imageBuffer, students, forceInline, deferReport = false) {
+        const attachments = [imageBuffer];
+        const { manifest, references, embeddings } = this._buildStudentsManifest(students, attachments, forceInline);
+        
+        const request = {
+            command: 'analyze_blob',
+            image: { attachment: 0 },
+            students: manifest,
+            return_report: true
+        };
+        if (deferReport) {
+            request.report_mode = 'deferred';
+        }
+        
+        return { request, attachments, references, embeddings };
+    }
+
+    /**
+     * analyze_batch: allegati 0..N-1 = immagini della lezione, poi le foto del manifest
+     */
+    _buildBatchRequest(images, students, forceInline, returnReports) {
+        const attachments = images.map(image => image.buffer);
+        const { manifest, references, embeddings } = this._buildStudentsManifest(students, attachments, forceInline);
+        
+        return {
+            request: {
+                command: 'analyze_batch',
+                images: images.map((image, i) => ({ name: image.name, attachment: i })),
+                students: manifest,
+                return_report: returnReports
+            },
+            attachments,
+            references,
+            embeddings
+        };
+    }
+
+    /**
+     * Impronta della configurazione Python (letta dai worker all'avvio) per la cache risultati
+     */
+    _configFingerprint() {
+        try {
+            return crypto.createHash('md5').update(fs.readFileSync(this.configPath)).digest('hex');
         } catch (error) {
-            console.error('Errore generazione studenti:', error);
-            throw error;
+            return 'default';
+        }
+    }
+
+    /**
+     * Versione della galleria: cambia con iscrizioni, foto, embeddings o anagrafica del corso
+     */
+    _galleryVersion(students) {
+        const hash = crypto.createHash('md5');
+        [...students].sort((a, b) => a.id - b.id).forEach(student => {
+            const enrollment = student.enrollment ? `${student.enrollment.model}/${student.enrollment.dtype}` : '-';
+            hash.update(`${student.id}:${student.photoHash}:${enrollment}:${student.name}:${student.surname}\n`);
+        });
+        return hash.digest('hex');
+    }
+
+    /**
+     * Analisi con cache per contenuto: cache = { images: Buffer[], options } identifica
+     * la richiesta insieme a galleria, config, trace e rematch. Solo i risultati riusciti
+     * vengono conservati; una richiesta identica già in corso attende la stessa analisi.
+     * Gli scatti con frameKey non passano dalla cache: l'esito del frame gate dipende dal frame
+     * precedente dell'aula e ogni scatto deve aggiornarne lo stato.
+     */
+    async _executePythonAnalysis(params) {
+        const { cache, students, rematch = false, frameKey = null } = params;
+        if (!cache || !this.resultCache.enabled || frameKey) {
+            return this._runPythonAnalysis(params);
+        }
+        
+        const key = AnalysisResultCache.key(
+            cache.images,
+            this._galleryVersion(students),
+            JSON.stringify({
+                config: this.configFingerprint,
+                trace: this.traceAnalyses,
+                rematch: !!rematch,
+                ...cache.options
+            })
+        );
+        
+        const outcome = await this.resultCache.getOrCompute(key, async () => {
+            const { result, attachments } = await this._runPythonAnalysis(params);
+            // Batch: in cache solo se tutte le immagini sono state analizzate
+            const cacheable = result.status === 'success' &&
+                (result.images || []).every(image => image.status === 'success');
+            return { result, attachments, cacheable };
+        });
+        
+        if (outcome.cache !== 'miss') {
+            console.log(`♻️ Risultato dalla cache (${outcome.cache}, ${Math.round((outcome.ageMs || 0) / 1000)}s): analisi Python evitata`);
+            outcome.result.result_cache = { status: outcome.cache, age_ms: outcome.ageMs };
+            // I nomi (file temporanei) non fanno parte della chiave: quelli della richiesta corrente
+            (cache.names || []).forEach((name, i) => {
+                if (outcome.result.images && outcome.result.images[i]) {
+                    outcome.result.images[i].image_file = name;
+                }
+            });
         }
+        return { result: outcome.result, attachments: outcome.attachments };
     }
 
-    async _executePythonAnalysis({ imagePath, studentsPath, outputPath, sessionId }) {
+    /**
+     * Invia la richiesta costruita da buildRequest(forceInline); se alcuni riferimenti non sono
+     * più in cache (TTL/evizione) la ripete una volta con quelle foto inline
+     * (rematch: immagini già analizzate riusano volti ed embeddings salvati, rifà solo il match)
+     */
+    async _runPythonAnalysis({ buildRequest: build, students, sessionId, timeout, priority, rematch = false, frameKey = null }) {
+        const buildRequest = (forceInline) => {
+            const built = build(forceInline);
+            if (this.traceAnalyses) {
+                built.request.trace = true;
+            }
+            if (rematch) {
+                built.request.rematch = true;
+            }
+            if (frameKey) {
+                built.request.frame_key = frameKey;
+            }
+            return built;
+        };
+        
+        let { request, attachments, references, embeddings } = buildRequest(new Set());
+        console.log(`📦 Manifest: ${students.length} studenti (${embeddings} embeddings, ${references} riferimenti, ${request.students.length - references - embeddings} foto inline)`);
+        
+        let response = await this._sendAnalyzeRequest(request, attachments, sessionId, timeout, priority);
+        let result = response.result || {};
+        const staleEnrollments = result.stale_enrollments || [];
+        
+        const unresolved = new Set(result.unresolved_students || []);
+        if (unresolved.size > 0) {
+            console.warn(`⚠️ ${unresolved.size} embedding non in cache, nuovo invio con foto inline`);
+            unresolved.forEach(id => this.sentPhotoHashes.delete(id));
+            ({ request, attachments } = buildRequest(unresolved));
+            response = await this._sendAnalyzeRequest(request, attachments, sessionId, timeout, priority);
+            result = response.result || {};
+        }
+        
+        // Iscrizioni di un altro modello (rilevate al primo invio, prima dell'eventuale ripetizione)
+        if (staleEnrollments.length > 0) {
+            this._refreshEnrollments(students, staleEnrollments);
+        }
+        
+        const hashById = new Map(students.map(s => [s.id, s.photoHash]));
+        for (const id of result.gallery_cached_ids || []) {
+            if (hashById.has(id)) {
+                this.sentPhotoHashes.set(id, hashById.get(id));
+            }
+        }
+        
+        // Solo le analisi eseguite davvero da Python contano nelle statistiche del frame gate
+        this._countFrameGate(frameKey, result);
+        
+        return { result, attachments: response.attachments || [] };
+    }
+
+    /**
+     * Conteggio skip/partial/full del frame gate (scatti periodici della stessa aula)
+     */
+    _countFrameGate(frameKey, result) {
+        const gate = result.performance_metrics && result.performance_metrics.frame_gate;
+        if (!frameKey || !gate || !(gate.mode in this.frameGateStats)) {
+            return;
+        }
+        this.frameGateStats[gate.mode]++;
+        if (gate.mode !== 'full') {
+            console.log(`⏭️ Frame gate ${frameKey}: ${gate.mode} (${gate.reused_faces} volti riusati, ${gate.regions} regioni rianalizzate)`);
+        }
+    }
+
+    _takeReportAttachment(result, attachments) {
+        const index = result.report_attachment;
+        delete result.report_attachment;
+        delete result.report_format;
+        return index !== undefined ? attachments[index] || null : null;
+    }
+
+    _reportMimeType(result) {
+        return result.report_format === 'webp' ? 'image/webp' : 'image/jpeg';
+    }
+
+    /**
+     * Report differito di una LessonImage: frame e report_job restano in memoria (al più
+     * maxPendingReports, i più vecchi vengono scartati e resta l'immagine originale)
+     */
+    _scheduleReport(imageId, imageBuffer, job) {
+        imageId = Number(imageId);
+        if (this.pendingReports.size >= this.maxPendingReports) {
+            const [oldestId, oldest] = this.pendingReports.entries().next().value;
+            if (!oldest.promise) {
+                this.pendingReports.delete(oldestId);
+                console.warn(`⚠️ Report differito scartato per immagine ${oldestId} (coda piena)`);
+            }
+        }
+        this.pendingReports.set(imageId, { imageBuffer, job, promise: null });
+        console.log(`🕒 Report immagine ${imageId} differito (${this.reportMode})`);
+        
+        if (this.reportMode !== 'on_demand') {
+            this.ensureReport(imageId).catch(() => {});
+        }
+    }
+
+    hasPendingReport(imageId) {
+        return this.pendingReports.has(Number(imageId));
+    }
+
+    /**
+     * Disegna (una sola volta) il report differito e lo salva nella LessonImage;
+     * null se per l'immagine non c'è nulla in attesa
+     */
+    ensureReport(imageId) {
+        imageId = Number(imageId);
+        const entry = this.pendingReports.get(imageId);
+        if (!entry) {
+            return Promise.resolve(null);
+        }
+        if (!entry.promise) {
+            entry.promise = this._renderDeferredReport(imageId, entry)
+                .catch(error => {
+                    console.error(`❌ Report differito immagine ${imageId} fallito: ${error.message}`);
+                    return null;
+                })
+                .finally(() => this.pendingReports.delete(imageId));
+        }
+        return entry.promise;
+    }
+
+    async _renderDeferredReport(imageId, { imageBuffer, job }) {
+        const sessionId = crypto.randomBytes(8).toString('hex');
+        const response = await this._sendAnalyzeRequest(
+            { command: 'render_report', image: { attachment: 0 }, job },
+            [imageBuffer],
+            sessionId
+        );
+        const result = response.result || {};
+        const mimeType = this._reportMimeType(result);
+        const reportImageBlob = this._takeReportAttachment(result, response.attachments || []);
+        if (!reportImageBlob) {
+            throw new Error('Report non restituito dal worker');
+        }
+        
+        const { LessonImage } = require('../models');
+        await LessonImage.update({
+            image_data: reportImageBlob,
+            file_size: reportImageBlob.length,
+            mime_type: mimeType,
+            source: 'report'
+        }, { where: { id: imageId } });
+        
+        console.log(`🖼️ Report differito immagine ${imageId}: ${reportImageBlob.length} bytes in ${Math.round(result.render_ms || 0)}ms`);
+        return reportImageBlob;
+    }
+
+    async _sendAnalyzeRequest(request, attachments, sessionId, timeout = this.analysisTimeout, priority = 0) {
+        if (this.workerPool) {
+            try {
+                console.log(`\n🛰️ Analisi tramite worker persistente [${sessionId}]...`);
+                return await this.workerPool.request(request, { attachments, timeout, priority });
+            } catch (error) {
+                // Errore o timeout dell'analisi: un processo singolo la ripeterebbe da capo, con un
+                // avvio a freddo in più e fino al doppio del timeout
+                if (error.code !== FaceWorkerPool.POOL_UNAVAILABLE) {
+                    throw error;
+                }
+                console.warn(`⚠️ Worker pool non disponibile (${error.message}), fallback su processo singolo`);
+            }
+        }
+        
+        return this._spawnPythonAnalysis(request, attachments, sessionId, timeout);
+    }
+
+    async _spawnPythonAnalysis(request, attachments, sessionId, timeout = this.analysisTimeout) {
         console.log(`\n🐍 Esecuzione analisi Python [${sessionId}]...`);
         
         return new Promise((resolve, reject) => {
-            const args = [
-                this.pythonScriptPath,
-                imagePath,
-                '--output', outputPath,
-                '--students', studentsPath
-            ];
+            const args = [this.pythonScriptPath, '--framed'];
             
             // Aggiungi config path
             if (fs.existsSync(this.configPath)) {
@@ -307,74 +867,65 @@ class FaceDetectionService {
                 env: { ...process.env, PYTHONUNBUFFERED: '1' }
             });
             
-            let stdout = '';
-            let stderr = '';
+            const decoder = new FrameDecoder();
+            const logTail = new PythonLogTail();
+            let response = null;
             
-            const timeout = setTimeout(() => {
+            const timer = setTimeout(() => {
                 console.error('⏱️ Timeout Python - killing process');
                 pythonProcess.kill('SIGKILL');
                 reject(new Error('Timeout analisi Python'));
-            }, 60000);
+            }, timeout);
             
-            pythonProcess.stdout.on('data', (data) => {
-                const text = data.toString();
-                stdout += text;
-                console.log(`[Python OUT] ${text.trim()}`);
+            pythonProcess.stdout.on('data', (chunk) => {
+                try {
+                    for (const { message, attachments: blobs } of decoder.push(chunk)) {
+                        response = { ...message, attachments: blobs };
+                    }
+                } catch (error) {
+                    console.error('Errore parsing risultato:', error.message);
+                }
             });
             
             pythonProcess.stderr.on('data', (data) => {
-                const text = data.toString();
-                stderr += text;
-                if (!text.includes('tensorflow') && !text.includes('WARNING')) {
-                    console.log(`[Python ERR] ${text.trim()}`);
+                for (const line of logTail.push(data)) {
+                    console.log(`[Python ERR] ${line}`);
                 }
             });
             
             pythonProcess.on('error', (error) => {
-                clearTimeout(timeout);
+                clearTimeout(timer);
                 reject(error);
             });
             
+            // EPIPE se il processo muore prima di leggere tutto lo stdin: gestito da 'close'
+            pythonProcess.stdin.on('error', () => {});
+            pythonProcess.stdin.end(encodeMessage(request, attachments));
+            
             pythonProcess.on('close', (code) => {
-                clearTimeout(timeout);
+                clearTimeout(timer);
                 
                 console.log(`\n✅ Python completato con exit code: ${code}`);
                 
-                if (code !== 0) {
+                if (!response || response.status !== 'ok') {
+                    const tail = logTail.drain();
+                    if (tail) {
+                        console.error(`🧾 Ultime righe di face_detection.py:\n${tail}`);
+                    }
+                }
+                if (!response) {
                     reject(new Error(`Python script fallito con codice ${code}`));
                     return;
                 }
-                
-                try {
-                    if (fs.existsSync(outputPath)) {
-                        const resultData = fs.readFileSync(outputPath, 'utf8');
-                        const result = JSON.parse(resultData);
-                        resolve(result);
-                    } else {
-                        const jsonMatch = stdout.match(/\{[\s\S]*\}/);
-                        if (jsonMatch) {
-                            resolve(JSON.parse(jsonMatch[0]));
-                        } else {
-                            resolve({
-                                detected_faces: 0,
-                                recognized_students: [],
-                                error: 'Nessun output generato'
-                            });
-                        }
-                    }
-                } catch (error) {
-                    console.error('Errore parsing risultato:', error);
-                    resolve({
-                        detected_faces: 0,
-                        recognized_students: [],
-                        error: 'Errore parsing risultato'
-                    });
+                if (response.status !== 'ok') {
+                    reject(new Error(response.error || 'Errore analisi Python'));
+                    return;
                 }
+                resolve(response);
             });
         });
     }
 
-
     async _saveCompleteAttendanceReport(lessonId, recognizedStudents, imageId = null) {
         console.log(`\n📊 === SALVATAGGIO REPORT COMPLETO ===`);
         console.log(`📊 LessonId: ${lessonId}`);
@@ -474,26 +1025,6 @@ class FaceDetectionService {
         return Array.from(studentMap.values());
     }
 
-    _cleanupTempFiles(filePaths, sessionId) {
-        console.log(`\n🧹 Cleanup file temporanei [${sessionId}]...`);
-        
-        for (const filePath of filePaths) {
-            if (filePath && fs.existsSync(filePath)) {
-                try {
-                    const stats = fs.statSync(filePath);
-                    if (stats.isDirectory()) {
-                        fs.rmSync(filePath, { recursive: true, force: true });
-                    } else {
-                        fs.unlinkSync(filePath);
-                    }
-                    console.log(`   ✅ Rimosso: ${path.basename(filePath)}`);
-                } catch (error) {
-                    console.warn(`   ⚠️ Errore rimozione ${filePath}: ${error.message}`);
-                }
-            }
-        }
-    }
-
     async checkStatus() {
         const scriptExists = fs.existsSync(this.pythonScriptPath);
         const tempDirExists = fs.existsSync(this.tempDir);
@@ -504,6 +1035,9 @@ class FaceDetectionService {
             pythonScriptExists: scriptExists,
             tempDirectory: this.tempDir,
             tempDirExists: tempDirExists,
+            workerPool: this.workerPool ? this.workerPool.getStats() : null,
+            resultCache: this.resultCache.getStats(),
+            frameGate: { ...this.frameGateStats },
             status: scriptExists ? 'Ready' : 'Script mancante'
         };
     }
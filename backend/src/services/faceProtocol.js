@@ -0,0 +1,87 @@
+// backend/src/services/faceProtocol.js
+// Protocollo a frame con face_detection.py (serve / --framed)
+// Ogni frame: lunghezza big-endian a 4 byte + payload.
+// Un messaggio è un frame JSON; se contiene "attachments": N è seguito
+// da N frame binari grezzi (immagine, foto studenti, report JPEG).
+
+const FRAME_HEADER_SIZE = 4;
+const MAX_FRAME_SIZE = 256 * 1024 * 1024;
+
+function frame(payload) {
+    const header = Buffer.alloc(FRAME_HEADER_SIZE);
+    header.writeUInt32BE(payload.length, 0);
+    return [header, payload];
+}
+
+/**
+ * Serializza un messaggio JSON e i suoi allegati binari in un unico buffer
+ */
+function encodeMessage(message, attachments = []) {
+    const json = Buffer.from(JSON.stringify({ ...message, attachments: attachments.length }), 'utf8');
+    const parts = frame(json);
+    for (const blob of attachments) {
+        parts.push(...frame(Buffer.isBuffer(blob) ? blob : Buffer.from(blob)));
+    }
+    return Buffer.concat(parts);
+}
+
+/**
+ * Decoder incrementale: accumula chunk e restituisce i messaggi completi
+ * come { message, attachments }
+ */
+class FrameDecoder {
+    constructor() {
+        this.chunks = [];
+        this.buffered = 0;
+        this.pending = null;
+    }
+
+    push(chunk) {
+        this.chunks.push(chunk);
+        this.buffered += chunk.length;
+
+        const messages = [];
+        let payload;
+        while ((payload = this._nextFrame()) !== null) {
+            if (!this.pending) {
+                const message = JSON.parse(payload.toString('utf8'));
+                this.pending = { message, attachments: [], expected: message.attachments || 0 };
+            } else {
+                this.pending.attachments.push(payload);
+            }
+
+            if (this.pending.attachments.length === this.pending.expected) {
+                messages.push({ message: this.pending.message, attachments: this.pending.attachments });
+                this.pending = null;
+            }
+        }
+        return messages;
+    }
+
+    _nextFrame() {
+        if (this.buffered < FRAME_HEADER_SIZE) return null;
+        if (this.chunks.length > 1) {
+            this.chunks = [Buffer.concat(this.chunks)];
+        }
+
+        const buffer = this.chunks[0];
+        const length = buffer.readUInt32BE(0);
+        if (length > MAX_FRAME_SIZE) {
+            throw new Error(`Frame troppo grande: ${length} bytes`);
+        }
+        if (buffer.length < FRAME_HEADER_SIZE + length) return null;
+
+        const payload = buffer.subarray(FRAME_HEADER_SIZE, FRAME_HEADER_SIZE + length);
+        const rest = buffer.subarray(FRAME_HEADER_SIZE + length);
+        this.chunks = rest.length > 0 ? [rest] : [];
+        this.buffered = rest.length;
+        return payload;
+    }
+}
+
+module.exports = {
+    FRAME_HEADER_SIZE,
+    MAX_FRAME_SIZE,
+    encodeMessage,
+    FrameDecoder
+};
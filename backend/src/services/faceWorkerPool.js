@@ -0,0 +1,476 @@
+// backend/src/services/faceWorkerPool.js
+// Pool di worker Python persistenti (face_detection.py serve) con modelli residenti
+// Micro-batching: le analisi analyze_blob in coda vengono accorpate in un unico analyze_multi,
+// così i volti di più aule passano nel recognizer con un solo forward pass
+
+const { spawn } = require('child_process');
+const EventEmitter = require('events');
+const { encodeMessage, FrameDecoder } = require('./faceProtocol');
+const PythonLogTail = require('./pythonLogTail');
+
+// Codice degli errori per cui il pool non può servire la richiesta (arrestato, nessun worker vivo,
+// worker che non arrivano a "ready"): solo in questi casi il chiamante ripiega su un processo
+// singolo. Risposte di errore del worker e timeout sono l'esito dell'analisi stessa.
+const POOL_UNAVAILABLE = 'WORKER_POOL_UNAVAILABLE';
+
+function unavailableError(message) {
+    const error = new Error(message);
+    error.code = POOL_UNAVAILABLE;
+    return error;
+}
+
+class FaceWorkerPool extends EventEmitter {
+    constructor(options = {}) {
+        super();
+
+        this.pythonExecutable = options.pythonExecutable;
+        this.scriptPath = options.scriptPath;
+        this.configPath = options.configPath || null;
+        this.size = options.size || 2;
+        this.requestTimeout = options.requestTimeout || 60000;
+        this.startupTimeout = options.startupTimeout || 120000;
+        this.healthCheckInterval = options.healthCheckInterval || 30000;
+        this.healthCheckTimeout = options.healthCheckTimeout || 10000;
+        this.maxRestartDelay = options.maxRestartDelay || 30000;
+
+        // Finestra adattiva: con una sola richiesta recente si invia subito (nessuna latenza
+        // aggiunta), con più arrivi ravvicinati si attende fino a maxWaitMs per riempire il batch
+        const microBatch = options.microBatch || {};
+        this.microBatch = {
+            enabled: microBatch.enabled !== false,
+            maxBatch: Math.max(1, microBatch.maxBatch || 8),
+            maxWaitMs: microBatch.maxWaitMs ?? 30,
+            waitPerRequestMs: microBatch.waitPerRequestMs ?? 5,
+            itemTimeout: microBatch.itemTimeout || 15000
+        };
+        this.batchTimer = null;
+        this.recentArrivals = [];
+
+        this.workers = [];
+        this.queue = [];
+        this.nextRequestId = 1;
+        this.started = false;
+        this.stopping = false;
+        this.healthTimer = null;
+
+        this.stats = {
+            requests: 0,
+            completed: 0,
+            failed: 0,
+            restarts: 0,
+            timeouts: 0,
+            microBatches: 0,
+            microBatchedRequests: 0
+        };
+    }
+
+    /**
+     * Avvia i worker (idempotente)
+     */
+    start() {
+        if (this.started) return;
+        this.started = true;
+        this.stopping = false;
+
+        console.log(`🛰️ Avvio pool worker face detection (${this.size} processi)`);
+
+        for (let slot = 0; slot < this.size; slot++) {
+            this.workers.push(this._spawnWorker(slot));
+        }
+
+        this.healthTimer = setInterval(() => this._healthCheck(), this.healthCheckInterval);
+        this.healthTimer.unref();
+    }
+
+    _spawnWorker(slot, restarts = 0) {
+        const args = [this.scriptPath, 'serve'];
+        if (this.configPath) {
+            args.push('--config', this.configPath);
+        }
+
+        const proc = spawn(this.pythonExecutable, args, {
+            env: { ...process.env, PYTHONUNBUFFERED: '1' },
+            stdio: ['pipe', 'pipe', 'pipe']
+        });
+
+        const worker = {
+            slot,
+            proc,
+            state: 'starting',
+            decoder: new FrameDecoder(),
+            logTail: new PythonLogTail(),
+            current: null,
+            pendingPing: null,
+            restarts,
+            startedAt: Date.now(),
+            served: 0
+        };
+
+        worker.startupTimer = setTimeout(() => {
+            if (worker.state === 'starting') {
+                console.error(`⏱️ Worker ${slot} non pronto entro ${this.startupTimeout}ms`);
+                this._restartWorker(worker, 'startup timeout');
+            }
+        }, this.startupTimeout);
+
+        proc.stdout.on('data', (chunk) => this._onData(worker, chunk));
+
+        // EPIPE se il worker termina mentre riceve una richiesta: senza handler l'evento 'error'
+        // non gestito farebbe terminare l'intero server
+        proc.stdin.on('error', (error) => {
+            console.error(`❌ Scrittura verso il worker ${slot} fallita: ${error.message}`);
+            this._restartWorker(worker, `stdin ${error.code || error.message}`);
+        });
+
+        proc.stderr.on('data', (data) => {
+            for (const line of worker.logTail.push(data)) {
+                console.log(`[Python W${slot}] ${line}`);
+            }
+        });
+
+        proc.on('error', (error) => {
+            console.error(`❌ Errore processo worker ${slot}:`, error.message);
+            this._restartWorker(worker, error.message);
+        });
+
+        proc.on('exit', (code, signal) => {
+            if (worker.state !== 'dead') {
+                console.warn(`⚠️ Worker ${slot} terminato (code ${code}, signal ${signal})`);
+                this._restartWorker(worker, `exit ${code ?? signal}`);
+            }
+        });
+
+        return worker;
+    }
+
+    _onData(worker, chunk) {
+        let messages;
+        try {
+            messages = worker.decoder.push(chunk);
+        } catch (error) {
+            console.error(`❌ Frame non valido dal worker ${worker.slot}: ${error.message}`);
+            this._restartWorker(worker, 'invalid frame');
+            return;
+        }
+
+        for (const { message, attachments } of messages) {
+            message.attachments = attachments;
+            this._onMessage(worker, message);
+        }
+    }
+
+    _onMessage(worker, message) {
+        if (message.type === 'ready') {
+            clearTimeout(worker.startupTimer);
+            worker.state = 'idle';
+            worker.restarts = 0;
+            console.log(`✅ Worker ${worker.slot} pronto (pid ${message.pid}, startup ${Math.round(message.startup_ms)}ms)`);
+            this._dispatch();
+            return;
+        }
+
+        if (worker.pendingPing && message.id === worker.pendingPing.id) {
+            clearTimeout(worker.pendingPing.timer);
+            worker.pendingPing = null;
+            if (!worker.current) {
+                worker.state = 'idle';
+                this._dispatch();
+            }
+            return;
+        }
+
+        const job = worker.current;
+        if (!job || message.id !== job.id) {
+            console.warn(`⚠️ Risposta inattesa dal worker ${worker.slot} (id ${message.id})`);
+            return;
+        }
+
+        clearTimeout(job.timer);
+        worker.current = null;
+        worker.state = 'idle';
+        worker.served += job.size || 1;
+
+        if (message.status === 'ok') {
+            this.stats.completed += job.size || 1;
+            job.resolve(message);
+        } else {
+            this.stats.failed += job.size || 1;
+            this._printLogTail(worker, `richiesta ${job.id} fallita`);
+            job.reject(new Error(message.error || 'Errore worker'));
+        }
+
+        this._dispatch();
+    }
+
+    /**
+     * Invia una richiesta al primo worker libero
+     * options.attachments: Buffer binari inviati dopo il frame JSON
+     * options.priority: posizione in coda, valori più bassi prima (default 0, FIFO a parità)
+     * La risposta espone gli eventuali allegati in message.attachments
+     */
+    request(payload, options = {}) {
+        this.start();
+        this.stats.requests++;
+
+        // Tutti i worker in attesa di riavvio: la richiesta non resta ferma per il backoff
+        if (this.workers.length > 0 && this.workers.every(w => w.state === 'dead')) {
+            this.stats.failed++;
+            return Promise.reject(unavailableError('Nessun worker attivo (riavvio in corso)'));
+        }
+
+        const now = Date.now();
+        if (this._isBatchable(payload)) {
+            this.recentArrivals.push(now);
+        }
+
+        return new Promise((resolve, reject) => {
+            const job = {
+                id: this.nextRequestId++,
+                payload,
+                attachments: options.attachments || [],
+                timeout: options.timeout || this.requestTimeout,
+                priority: options.priority || 0,
+                enqueuedAt: now,
+                resolve,
+                reject
+            };
+            // Inserimento ordinato: una lezione in corso non attende il backfill già in coda
+            const position = this.queue.findIndex(queued => queued.priority > job.priority);
+            this.queue.splice(position === -1 ? this.queue.length : position, 0, job);
+            this._dispatch();
+        });
+    }
+
+    _isBatchable(payload) {
+        return this.microBatch.enabled && this.microBatch.maxBatch > 1 && payload.command === 'analyze_blob';
+    }
+
+    /**
+     * Batch e attesa in base al carico: arrivi analyze_blob nelle ultime finestre
+     */
+    _batchPlan(now) {
+        const horizon = Math.max(1, this.microBatch.maxWaitMs) * 4;
+        while (this.recentArrivals.length > 0 && now - this.recentArrivals[0] > horizon) {
+            this.recentArrivals.shift();
+        }
+        const load = this.recentArrivals.length;
+        return {
+            target: Math.max(1, Math.min(this.microBatch.maxBatch, load)),
+            waitMs: load <= 1 ? 0 : Math.min(this.microBatch.maxWaitMs, this.microBatch.waitPerRequestMs * load)
+        };
+    }
+
+    /**
+     * Prossimo job da inviare: la richiesta in testa, oppure un analyze_multi con le analyze_blob
+     * in coda della stessa priorità; mentre la testa attende altri arrivi (timer già programmato)
+     * parte la prima richiesta non accorpabile, null se non ce ne sono
+     */
+    _nextJob() {
+        const head = this.queue[0];
+        if (!this._isBatchable(head.payload)) {
+            return this.queue.shift();
+        }
+
+        const now = Date.now();
+        const { target, waitMs } = this._batchPlan(now);
+        // Una lezione in corso non viaggia nello stesso batch (e con gli stessi tempi) del backfill
+        const batchable = this.queue.filter(job => job.priority === head.priority && this._isBatchable(job.payload));
+        const remaining = head.enqueuedAt + waitMs - now;
+        if (batchable.length < target && remaining > 0) {
+            if (!this.batchTimer) {
+                this.batchTimer = setTimeout(() => {
+                    this.batchTimer = null;
+                    this._dispatch();
+                }, remaining);
+            }
+            const position = this.queue.findIndex(job => !this._isBatchable(job.payload));
+            return position === -1 ? null : this.queue.splice(position, 1)[0];
+        }
+
+        const jobs = batchable.slice(0, this.microBatch.maxBatch);
+        this.queue = this.queue.filter(job => !jobs.includes(job));
+        return jobs.length === 1 ? jobs[0] : this._combineJobs(jobs);
+    }
+
+    /**
+     * Un analyze_multi per più richieste: allegati concatenati (offset per elemento), risposta
+     * suddivisa tra i chiamanti originali con gli stessi campi di un analyze_blob
+     */
+    _combineJobs(jobs) {
+        const attachments = [];
+        const items = jobs.map(job => {
+            const item = { request: job.payload, attachment_offset: attachments.length, attachment_count: job.attachments.length };
+            attachments.push(...job.attachments);
+            return item;
+        });
+
+        this.stats.microBatches++;
+        this.stats.microBatchedRequests += jobs.length;
+        console.log(`🧺 Micro-batch: ${jobs.length} analisi accorpate (attesa max ${Date.now() - jobs[0].enqueuedAt}ms)`);
+
+        return {
+            id: this.nextRequestId++,
+            payload: { command: 'analyze_multi', items },
+            attachments,
+            // Rilevamento e match restano sequenziali nel worker: tempo in più per ogni elemento
+            timeout: Math.max(...jobs.map(job => job.timeout)) + (jobs.length - 1) * this.microBatch.itemTimeout,
+            size: jobs.length,
+            resolve: (message) => {
+                const results = message.results || [];
+                jobs.forEach((job, i) => {
+                    const item = results[i];
+                    if (!item) {
+                        job.reject(new Error('Risposta analyze_multi incompleta'));
+                        return;
+                    }
+                    job.resolve({
+                        ...item,
+                        id: job.id,
+                        attachments: (message.attachments || []).slice(item.attachment_offset, item.attachment_offset + item.attachment_count)
+                    });
+                });
+            },
+            reject: (error) => jobs.forEach(job => job.reject(error))
+        };
+    }
+
+    _dispatch() {
+        while (this.queue.length > 0) {
+            const worker = this.workers.find(w => w.state === 'idle');
+            if (!worker) return;
+
+            const job = this._nextJob();
+            if (!job) return;
+            worker.state = 'busy';
+            worker.current = job;
+            // La coda di log mostrata su errore riguarda solo questa richiesta
+            worker.logTail.drain();
+
+            job.timer = setTimeout(() => {
+                this.stats.timeouts++;
+                console.error(`⏱️ Timeout richiesta ${job.id} sul worker ${worker.slot} - restart`);
+                worker.current = null;
+                job.reject(new Error('Timeout analisi Python'));
+                this._restartWorker(worker, 'request timeout');
+            }, job.timeout);
+
+            this._send(worker, { ...job.payload, id: job.id }, job.attachments);
+        }
+    }
+
+    _send(worker, message, attachments = []) {
+        worker.proc.stdin.write(encodeMessage(message, attachments));
+    }
+
+    _healthCheck() {
+        for (const worker of this.workers) {
+            if (worker.state !== 'idle') continue;
+
+            const id = this.nextRequestId++;
+            worker.state = 'checking';
+            worker.pendingPing = {
+                id,
+                timer: setTimeout(() => {
+                    console.error(`💔 Worker ${worker.slot} non risponde al ping - restart`);
+                    this._restartWorker(worker, 'health check timeout');
+                }, this.healthCheckTimeout)
+            };
+
+            this._send(worker, { id, command: 'ping' });
+        }
+    }
+
+    _restartWorker(worker, reason) {
+        if (worker.state === 'dead') return;
+        const failedAtStartup = worker.state === 'starting';
+        worker.state = 'dead';
+
+        clearTimeout(worker.startupTimer);
+        if (worker.pendingPing) {
+            clearTimeout(worker.pendingPing.timer);
+            worker.pendingPing = null;
+        }
+
+        if (worker.current) {
+            clearTimeout(worker.current.timer);
+            this._printLogTail(worker, reason);
+            this.stats.failed += worker.current.size || 1;
+            worker.current.reject(new Error(`Worker ${worker.slot} terminato: ${reason}`));
+            worker.current = null;
+        }
+
+        try {
+            worker.proc.kill('SIGKILL');
+        } catch (e) {
+            // processo già terminato
+        }
+
+        if (this.stopping) return;
+
+        // Worker non avviato (interprete o script mancanti, errore all'import) e nessun altro
+        // pronto: le richieste in coda non attendono i riavvii
+        if (failedAtStartup && !this.workers.some(w => w !== worker && ['idle', 'busy', 'checking'].includes(w.state))) {
+            this._rejectQueued(unavailableError(`Worker ${worker.slot} non avviato: ${reason}`));
+        }
+
+        const delay = Math.min(this.maxRestartDelay, 1000 * Math.pow(2, worker.restarts));
+        this.stats.restarts++;
+        console.log(`🔄 Restart worker ${worker.slot} tra ${delay}ms (${reason})`);
+
+        setTimeout(() => {
+            if (this.stopping) return;
+            this.workers[worker.slot] = this._spawnWorker(worker.slot, worker.restarts + 1);
+        }, delay).unref();
+    }
+
+    _rejectQueued(error) {
+        clearTimeout(this.batchTimer);
+        this.batchTimer = null;
+        for (const job of this.queue.splice(0)) {
+            this.stats.failed++;
+            job.reject(error);
+        }
+    }
+
+    _printLogTail(worker, reason) {
+        const tail = worker.logTail.drain();
+        if (tail) {
+            console.error(`🧾 Ultime righe del worker ${worker.slot} (${reason}):\n${tail}`);
+        }
+    }
+
+    /**
+     * Ferma tutti i worker e rifiuta le richieste in coda
+     */
+    stop() {
+        this.stopping = true;
+        this.started = false;
+        clearInterval(this.healthTimer);
+        this._rejectQueued(unavailableError('Pool worker arrestato'));
+
+        for (const worker of this.workers) {
+            this._restartWorker(worker, 'shutdown');
+        }
+        this.workers = [];
+    }
+
+    getStats() {
+        return {
+            size: this.size,
+            started: this.started,
+            queued: this.queue.length,
+            microBatch: this.microBatch.enabled ? { maxBatch: this.microBatch.maxBatch, maxWaitMs: this.microBatch.maxWaitMs } : null,
+            workers: this.workers.map(w => ({
+                slot: w.slot,
+                pid: w.proc.pid,
+                state: w.state,
+                served: w.served,
+                uptimeMs: Date.now() - w.startedAt
+            })),
+            ...this.stats
+        };
+    }
+}
+
+FaceWorkerPool.POOL_UNAVAILABLE = POOL_UNAVAILABLE;
+module.exports = FaceWorkerPool;
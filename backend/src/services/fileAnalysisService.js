@@ -1,6 +1,7 @@
 // backend/src/services/fileAnalysisService.js - VERSIONE COMPLETA CON SUPPORTO BLOB
 const fs = require('fs');
 const path = require('path');
+const crypto = require('crypto');
 const faceDetectionService = require('./faceDetectionService');
 const imageStorageService = require('./imageStorageService');
 const { sequelize } = require('../config/database');
@@ -137,6 +138,10 @@ class FileAnalysisService {
     async findLessonImages(lessonId, imagesPath) {
         console.log(`🔍 Ricerca immagini per lezione ${lessonId} in modalità ${this.storageMode}`);
         const images = [];
+        // Hash del contenuto: in modalità hybrid la copia su disco di un'immagine già nel DB
+        // non viene analizzata una seconda volta
+        const seenHashes = new Set();
+        const contentHash = (buffer) => crypto.createHash('md5').update(buffer).digest('hex');
         
         // 1. Cerca immagini nel database (BLOB) se modalità database o hybrid
         if (this.storageMode === 'database' || this.storageMode === 'hybrid') {
@@ -157,6 +162,7 @@ class FileAnalysisService {
                     
                     // Scrivi l'immagine BLOB su file temporaneo
                     fs.writeFileSync(tempPath, dbImage.image_data);
+                    seenHashes.add(contentHash(dbImage.image_data));
                     
                     images.push({
                         path: tempPath,
@@ -193,6 +199,13 @@ class FileAnalysisService {
                     const filePath = path.join(imagesPath, file);
                     const stats = fs.statSync(filePath);
                     
+                    const hash = contentHash(fs.readFileSync(filePath));
+                    if (seenHashes.has(hash)) {
+                        console.log(`    ♻️ ${file} già presente (stesso contenuto), saltata`);
+                        continue;
+                    }
+                    seenHashes.add(hash);
+                    
                     images.push({
                         path: filePath,
                         source: 'filesystem',
@@ -395,7 +408,7 @@ class FileAnalysisService {
     }
     
     // ✅ METODO PRINCIPALE: Analisi lezione con supporto ibrido completo
-    async analyzeLessonImages(lessonId, courseName, lessonName, specificImagePath = null) {
+    async analyzeLessonImages(lessonId, courseName, lessonName, specificImagePath = null, options = {}) {
         console.log(`\n🚀 AVVIO ANALISI IBRIDA`);
         console.log(`======================================`);
         console.log(`📚 Lezione ID: ${lessonId}`);
@@ -497,108 +510,101 @@ class FileAnalysisService {
                 console.log(`✅ Studenti disponibili: ${studentsData.length}`);
             }
             
-            // 5. Elabora ogni immagine
-            console.log('\n5️⃣ Avvio elaborazione immagini...');
+            // 5. Elabora tutte le immagini in una sola richiesta (galleria studenti caricata una volta)
+            console.log('\n5️⃣ Avvio elaborazione batch immagini...');
             const analysisResults = [];
             let totalFaces = 0;
             let totalRecognized = 0;
             
-            for (let i = 0; i < imagesToAnalyze.length; i++) {
-                const imageInfo = imagesToAnalyze[i];
-                const imageNum = i + 1;
-                
-                console.log(`\n📸 Immagine ${imageNum}/${imagesToAnalyze.length}: ${imageInfo.filename}`);
+            const timestamp = new Date().toISOString().replace(/[:.]/g, '-');
+            const reportFiles = imagesToAnalyze.map(imageInfo => {
+                const reportFilename = `report_${path.basename(imageInfo.filename, path.extname(imageInfo.filename))}_${timestamp}.json`;
+                return { reportFilename, reportPath: path.join(reportsPath, reportFilename) };
+            });
+            
+            imagesToAnalyze.forEach((imageInfo, i) => {
+                console.log(`\n📸 Immagine ${i + 1}/${imagesToAnalyze.length}: ${imageInfo.filename}`);
                 console.log(`   📍 Source: ${imageInfo.source} (${imageInfo.originalSource})`);
                 console.log(`   📁 Path: ${imageInfo.path}`);
+                console.log(`   📊 Report: ${reportFiles[i].reportFilename}`);
+            });
+            
+            console.time(`   ⏱️ Tempo elaborazione batch`);
+            const batchResult = await faceDetectionService.analyzeImageBatch(
+                imagesToAnalyze.map(imageInfo => ({ name: imageInfo.filename, path: imageInfo.path })),
+                lessonId,
+                { priority: options.priority, rematch: options.rematch }
+            );
+            console.timeEnd(`   ⏱️ Tempo elaborazione batch`);
+            
+            for (let i = 0; i < imagesToAnalyze.length; i++) {
+                const imageInfo = imagesToAnalyze[i];
+                const { reportFilename, reportPath } = reportFiles[i];
+                const result = batchResult.success ? batchResult.images[i] : null;
                 
-                // Nome file report
-                const timestamp = new Date().toISOString().replace(/[:.]/g, '-');
-                const reportFilename = `report_${path.basename(imageInfo.filename, path.extname(imageInfo.filename))}_${timestamp}.json`;
-                const reportPath = path.join(reportsPath, reportFilename);
-                
-                console.log(`   📊 Report: ${reportFilename}`);
-                
-                // Opzioni per il processing
-                const processingOptions = {
-                    outputPath: reportPath,
-                    bypassEnhancement: this.bypassEnhancement,
-                    debugMode: this.debugMode,
-                    courseId: lesson.course_id,
-                    studentsJsonPath,
-                    skipStudentRecognition,
-                    sourceType: imageInfo.source,
-                    dbImageId: imageInfo.dbImageId,
-                    lessonInfo: {
-                        courseName: actualCourseName,
-                        lessonName: actualLessonName,
-                        classroomName
-                    }
-                };
-                
-                try {
-                    console.time(`   ⏱️ Tempo elaborazione`);
-                    const result = await faceDetectionService.processImage(
-                        imageInfo.path, 
-                        lessonId,
-                        processingOptions
-                    );
-                    console.timeEnd(`   ⏱️ Tempo elaborazione`);
-                    
-                    const faces = result.detected_faces || 0;
-                    const recognized = result.recognized_students ? result.recognized_students.length : 0;
-                    
-                    totalFaces += faces;
-                    totalRecognized += recognized;
-                    
+                if (!result || !result.success) {
+                    const errorMessage = result ? result.error : batchResult.error;
+                    console.error(`   ❌ Errore elaborazione ${imageInfo.filename}: ${errorMessage}`);
                     analysisResults.push({
                         imageFile: imageInfo.filename,
                         reportFile: reportFilename,
                         reportPath,
-                        detectedFaces: faces,
-                        recognizedStudents: recognized,
-                        screenshotId: result.screenshotId,
-                        source: imageInfo.source,
-                        dbImageId: imageInfo.dbImageId,
-                        success: result.success,
-                        processingTime: result.processingTime || 'N/A'
-                    });
-                    
-                    console.log(`   ✅ Risultato: ${faces} volti, ${recognized} riconosciuti`);
-                    
-                    // Marca come analizzata se da database
-                    if (imageInfo.source === 'database' && imageInfo.dbImageId) {
-                        try {
-                            const { LessonImage } = require('../models');
-                            await LessonImage.update(
-                                { 
-                                    is_analyzed: true,
-                                    analysis_metadata: {
-                                        analyzed_at: new Date().toISOString(),
-                                        detected_faces: faces,
-                                        recognized_students: recognized,
-                                        analysis_version: 'hybrid_v1'
-                                    }
-                                },
-                                { where: { id: imageInfo.dbImageId } }
-                            );
-                            console.log(`   💾 Immagine DB ${imageInfo.dbImageId} aggiornata`);
-                        } catch (updateError) {
-                            console.warn(`   ⚠️ Errore aggiornamento DB: ${updateError.message}`);
-                        }
-                    }
-                    
-                } catch (imageError) {
-                    console.error(`   ❌ Errore elaborazione: ${imageError.message}`);
-                    analysisResults.push({
-                        imageFile: imageInfo.filename,
-                        reportFile: reportFilename,
-                        reportPath,
-                        error: imageError.message,
+                        error: errorMessage,
                         detectedFaces: 0,
                         recognizedStudents: 0,
                         source: imageInfo.source,
                         success: false
                     });
+                    continue;
+                }
+                
+                const faces = result.detected_faces || 0;
+                const recognized = result.recognized_students ? result.recognized_students.length : 0;
+                
+                totalFaces += faces;
+                totalRecognized += recognized;
+                
+                try {
+                    const { reportImageBlob, ...serializable } = result;
+                    fs.writeFileSync(reportPath, JSON.stringify(serializable, null, 2));
+                } catch (writeError) {
+                    console.warn(`   ⚠️ Errore scrittura report ${reportFilename}: ${writeError.message}`);
+                }
+                
+                analysisResults.push({
+                    imageFile: imageInfo.filename,
+                    reportFile: reportFilename,
+                    reportPath,
+                    detectedFaces: faces,
+                    recognizedStudents: recognized,
+                    source: imageInfo.source,
+                    dbImageId: imageInfo.dbImageId,
+                    success: true,
+                    processingTime: result.processing_info ? result.processing_info.processing_time : 'N/A'
+                });
+                
+                console.log(`   ✅ ${imageInfo.filename}: ${faces} volti, ${recognized} riconosciuti`);
+                
+                // Marca come analizzata se da database
+                if (imageInfo.source === 'database' && imageInfo.dbImageId) {
+                    try {
+                        const { LessonImage } = require('../models');
+                        await LessonImage.update(
+                            { 
+                                is_analyzed: true,
+                                analysis_metadata: {
+                                    analyzed_at: new Date().toISOString(),
+                                    detected_faces: faces,
+                                    recognized_students: recognized,
+                                    analysis_version: 'hybrid_v1'
+                                }
+                            },
+                            { where: { id: imageInfo.dbImageId } }
+                        );
+                        console.log(`   💾 Immagine DB ${imageInfo.dbImageId} aggiornata`);
+                    } catch (updateError) {
+                        console.warn(`   ⚠️ Errore aggiornamento DB: ${updateError.message}`);
+                    }
                 }
             }
             
@@ -615,6 +621,7 @@ class FileAnalysisService {
             console.log(`   ❌ Analisi fallite: ${failedAnalysis}/${analysisResults.length}`);
             console.log(`   👥 Totale volti rilevati: ${totalFaces}`);
             console.log(`   🎯 Totale studenti riconosciuti: ${totalRecognized}`);
+            console.log(`   🧮 Presenti (verdetto unico lezione): ${(batchResult.merged.recognized_students || []).length}`);
             
             const finalResult = {
                 success: true,
@@ -627,6 +634,7 @@ class FileAnalysisService {
                 reportsPath,
                 imagesCount: imagesToAnalyze.length,
                 results: analysisResults,
+                mergedAttendance: batchResult.merged,
                 statistics: {
                     totalImages: analysisResults.length,
                     successfulAnalysis,
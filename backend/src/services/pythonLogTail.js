@@ -0,0 +1,63 @@
+// backend/src/services/pythonLogTail.js
+// Stderr dei processi face_detection.py: coda limitata delle ultime righe, mostrata solo
+// quando un'analisi fallisce. In console passano subito solo ERROR/CRITICAL (e le righe
+// di traceback che li seguono), oppure tutto con FACE_PYTHON_LOG=verbose.
+
+const LEVEL_PATTERN = / - (DEBUG|INFO|WARNING|ERROR|CRITICAL) - /;
+
+class PythonLogTail {
+    constructor(options = {}) {
+        this.maxLines = options.maxLines || 200;
+        this.maxLineLength = options.maxLineLength || 2000;
+        this.verbose = options.verbose ?? process.env.FACE_PYTHON_LOG === 'verbose';
+
+        this.lines = [];
+        this.partial = '';
+        this.lastLevel = 'INFO';
+    }
+
+    /**
+     * Aggiunge un chunk di stderr; restituisce le righe complete da mostrare subito
+     */
+    push(chunk) {
+        const text = this.partial + chunk.toString();
+        const parts = text.split('\n');
+        this.partial = parts.pop();
+        if (this.partial.length > this.maxLineLength) {
+            parts.push(this.partial);
+            this.partial = '';
+        }
+
+        const echo = [];
+        for (let line of parts) {
+            line = line.replace(/\r$/, '');
+            if (!line.trim() || line.includes('tensorflow')) continue;
+            if (line.length > this.maxLineLength) {
+                line = `${line.slice(0, this.maxLineLength)}… (+${line.length - this.maxLineLength})`;
+            }
+
+            // Le righe senza livello (traceback, dump diagnostica) ereditano quello precedente
+            const match = line.match(LEVEL_PATTERN);
+            if (match) this.lastLevel = match[1];
+
+            this.lines.push(line);
+            if (this.lines.length > this.maxLines) this.lines.shift();
+
+            if (this.verbose || this.lastLevel === 'ERROR' || this.lastLevel === 'CRITICAL') {
+                echo.push(line);
+            }
+        }
+        return echo;
+    }
+
+    /**
+     * Ultime righe ricevute (contesto per un errore), svuotando la coda
+     */
+    drain() {
+        const tail = this.lines.join('\n');
+        this.lines = [];
+        return tail;
+    }
+}
+
+module.exports = PythonLogTail;
@@ -0,0 +1,149 @@
+// backend/tests/analysisQueueService.test.js
+// Coda analisi con sequelize.query sostituita (nessun database): accorpamento dei duplicati,
+// rinnovo del lease durante l'esecuzione, esito di un tentativo superato (UPDATE con rowCount 0)
+// non registrato. Richiede solo le dipendenze npm installate.
+
+process.env.NODE_ENV = process.env.NODE_ENV || 'test';
+// Nessun worker Python: i job eseguono handler sostituiti nei test
+process.env.FACE_WORKER_POOL = 'false';
+
+const test = require('node:test');
+const assert = require('node:assert');
+
+let queue, sequelize;
+let skipReason = false;
+try {
+    queue = require('../src/services/analysisQueueService');
+    ({ sequelize } = require('../src/config/database'));
+} catch (error) {
+    if (error.code !== 'MODULE_NOT_FOUND') throw error;
+    skipReason = `dipendenze npm non installate (${error.message.split('\n')[0]})`;
+}
+
+const sleep = (ms) => new Promise(resolve => setTimeout(resolve, ms));
+const FENCE = `locked_by = :workerId AND attempts = :attempts`;
+
+/**
+ * Sostituisce sequelize.query: respond(sql, options) restituisce il risultato ([rows, metadata]);
+ * le chiamate restano in calls per le verifiche
+ */
+function stubQuery(t, respond) {
+    const calls = [];
+    t.mock.method(sequelize, 'query', async (sql, options = {}) => {
+        calls.push({ sql, replacements: options.replacements || {} });
+        return respond(sql, options);
+    });
+    return calls;
+}
+
+function runningJob(overrides = {}) {
+    return {
+        id: 42,
+        type: 'lesson',
+        lesson_id: 5,
+        image_id: null,
+        coalesce_key: 'lesson:5',
+        priority: 0,
+        attempts: 1,
+        max_attempts: 3,
+        payload: {},
+        ...overrides
+    };
+}
+
+function recordingWaiter(jobId) {
+    const waiter = { outcomes: [] };
+    waiter.resolve = (result) => waiter.outcomes.push({ result });
+    waiter.reject = (error) => waiter.outcomes.push({ error });
+    queue._addWaiter(jobId, waiter);
+    return waiter;
+}
+
+const originalHandlers = {};
+const originalTimings = {};
+
+test.before(() => {
+    if (skipReason) return;
+    Object.assign(originalHandlers, queue.handlers);
+    Object.assign(originalTimings, { leaseMs: queue.leaseMs, leaseRenewInterval: queue.leaseRenewInterval });
+});
+
+test.afterEach(() => {
+    if (skipReason) return;
+    Object.assign(queue.handlers, originalHandlers);
+    Object.assign(queue, originalTimings);
+    queue.waiters.clear();
+});
+
+test('richiesta duplicata in coda: accorpata al job esistente', { skip: skipReason }, async (t) => {
+    const calls = stubQuery(t, () => [[{ id: 7, priority: 0, coalesced: 1, was_coalesced: true }], 1]);
+    const coalescedBefore = queue.stats.coalesced;
+
+    const job = await queue.enqueue({ type: 'lesson', lessonId: 5, priority: 'live' });
+
+    assert.deepStrictEqual(job, { id: 7, priority: 0, coalesced: true });
+    assert.strictEqual(queue.stats.coalesced, coalescedBefore + 1);
+    assert.match(calls[0].sql, /ON CONFLICT \(coalesce_key\) WHERE status = 'queued'/);
+    assert.strictEqual(calls[0].replacements.coalesceKey, 'lesson:5');
+    assert.strictEqual(calls[0].replacements.priority, queue.PRIORITIES.live);
+});
+
+test('il lease viene rinnovato finché il job è in esecuzione', { skip: skipReason }, async (t) => {
+    const calls = stubQuery(t, () => [[], { rowCount: 1 }]);
+    const renewals = () => calls.filter(call => /SET locked_at = NOW\(\)/.test(call.sql));
+    queue.leaseRenewInterval = 20;
+
+    const job = runningJob();
+    const waiter = recordingWaiter(job.id);
+    const completedBefore = queue.stats.completed;
+    queue.handlers.lesson = async () => {
+        await sleep(150);
+        return { ok: true };
+    };
+    await queue._execute(job);
+
+    assert.ok(renewals().length >= 3, `rinnovi: ${renewals().length}`);
+    for (const call of renewals()) {
+        assert.ok(call.sql.includes(FENCE));
+        assert.deepStrictEqual(call.replacements, { id: job.id, workerId: queue.workerId, attempts: job.attempts });
+    }
+    const completion = calls.find(call => /SET status = 'completed'/.test(call.sql));
+    assert.ok(completion.sql.includes(FENCE));
+    assert.strictEqual(queue.stats.completed, completedBefore + 1);
+    assert.deepStrictEqual(waiter.outcomes, [{ result: { ok: true } }]);
+    assert.strictEqual(queue.running.size, 0);
+
+    // Job terminato: nessun altro rinnovo
+    const renewed = renewals().length;
+    await sleep(60);
+    assert.strictEqual(renewals().length, renewed);
+});
+
+test('un tentativo superato non registra completamento, fallimento né nuovo tentativo', { skip: skipReason }, async (t) => {
+    // Lease scaduto e job ripreso da un altro tentativo: ogni UPDATE del vecchio tentativo non trova la riga
+    const calls = stubQuery(t, () => [[], { rowCount: 0 }]);
+    const cases = [
+        { outcome: 'completed', job: runningJob(), handler: async () => ({ from: 'tentativo superato' }) },
+        { outcome: 'failed', job: runningJob({ attempts: 3 }), handler: async () => { throw new Error('analisi fallita'); } },
+        { outcome: 'queued', job: runningJob(), handler: async () => { throw new Error('analisi fallita'); } }
+    ];
+
+    for (const { outcome, job, handler } of cases) {
+        calls.length = 0;
+        const stats = { ...queue.stats };
+        const waiter = recordingWaiter(job.id);
+        queue.handlers.lesson = handler;
+
+        await queue._execute(job);
+
+        const update = calls.find(call => call.sql.includes(`SET status = '${outcome}'`));
+        assert.ok(update, outcome);
+        assert.ok(update.sql.includes(FENCE), outcome);
+        assert.strictEqual(update.replacements.attempts, job.attempts, outcome);
+        assert.strictEqual(update.replacements.workerId, queue.workerId, outcome);
+        assert.deepStrictEqual(queue.stats, stats, outcome);
+        assert.deepStrictEqual(waiter.outcomes, [], outcome);
+        assert.strictEqual(queue.running.size, 0, outcome);
+        queue.waiters.clear();
+    }
+});
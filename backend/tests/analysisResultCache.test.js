@@ -0,0 +1,114 @@
+// backend/tests/analysisResultCache.test.js
+// Cache dei risultati: chiavi senza collisioni, LRU per voci e byte, TTL, analisi condivise
+
+const test = require('node:test');
+const assert = require('node:assert');
+const AnalysisResultCache = require('../src/services/analysisResultCache');
+
+const key = AnalysisResultCache.key;
+const buf = (text) => Buffer.from(text);
+
+test('la chiave distingue contenuto, ordine e confini delle immagini', () => {
+    const base = key([buf('ab'), buf('c')], 'v1', 'f');
+    assert.strictEqual(key([buf('ab'), buf('c')], 'v1', 'f'), base);
+    assert.notStrictEqual(key([buf('a'), buf('bc')], 'v1', 'f'), base);
+    assert.notStrictEqual(key([buf('c'), buf('ab')], 'v1', 'f'), base);
+    assert.notStrictEqual(key([buf('abc')], 'v1', 'f'), base);
+    assert.notStrictEqual(key([buf('ab'), buf('c'), buf('')], 'v1', 'f'), base);
+    assert.notStrictEqual(key([buf('ab'), buf('C')], 'v1', 'f'), base);
+});
+
+test('la chiave distingue versione galleria e impronta anche con separatori', () => {
+    const images = [buf('img')];
+    assert.notStrictEqual(key(images, 'v1', 'f'), key(images, 'v2', 'f'));
+    assert.notStrictEqual(key(images, 'v1', 'f'), key(images, 'v1', 'g'));
+    assert.notStrictEqual(key(images, 'a|b', 'c'), key(images, 'a', 'b|c'));
+    assert.notStrictEqual(key(images, 'v1', 'f'), key(images, 'v1f', ''));
+    assert.notStrictEqual(key([], 'v', 'f'), key([buf('')], 'v', 'f'));
+});
+
+test('get restituisce una copia e aggiorna l\'ordine LRU', () => {
+    const cache = new AnalysisResultCache({ maxEntries: 2 });
+    cache.set('a', { faces: [1] }, [buf('x')]);
+    cache.set('b', { faces: [2] });
+
+    const first = cache.get('a');
+    first.result.faces.push(99);
+    first.attachments.push(buf('y'));
+    assert.deepStrictEqual(cache.get('a').result, { faces: [1] });
+    assert.strictEqual(cache.get('a').attachments.length, 1);
+
+    // 'a' è stata letta per ultima: esce 'b'
+    cache.set('c', { faces: [3] });
+    assert.strictEqual(cache.get('b'), null);
+    assert.ok(cache.get('a'));
+    assert.strictEqual(cache.stats.evicted, 1);
+});
+
+test('limite in byte: evizione delle voci più vecchie, voci troppo grandi ignorate', () => {
+    const cache = new AnalysisResultCache({ maxBytes: 100 });
+    cache.set('a', {}, [Buffer.alloc(40)]);
+    cache.set('b', {}, [Buffer.alloc(40)]);
+    cache.set('c', {}, [Buffer.alloc(40)]);
+    assert.deepStrictEqual([...cache.entries.keys()], ['b', 'c']);
+    assert.ok(cache.bytes <= 100);
+
+    cache.set('grande', {}, [Buffer.alloc(200)]);
+    assert.strictEqual(cache.get('grande'), null);
+    assert.deepStrictEqual([...cache.entries.keys()], ['b', 'c']);
+});
+
+test('le voci scadute non vengono restituite', (t) => {
+    let now = 1000000;
+    t.mock.method(Date, 'now', () => now);
+    const cache = new AnalysisResultCache({ ttlMs: 1000 });
+    cache.set('a', { ok: true });
+
+    now += 1000;
+    assert.strictEqual(cache.get('a').ageMs, 1000);
+    now += 1;
+    assert.strictEqual(cache.get('a'), null);
+    assert.strictEqual(cache.stats.expired, 1);
+    assert.strictEqual(cache.bytes, 0);
+});
+
+test('getOrCompute: richieste identiche in corso condividono una sola analisi', async () => {
+    const cache = new AnalysisResultCache();
+    let calls = 0;
+    let release;
+    const compute = async () => {
+        calls++;
+        await new Promise(resolve => { release = resolve; });
+        return { result: { faces: 2 }, attachments: [buf('r')], cacheable: true };
+    };
+
+    const first = cache.getOrCompute('k', compute);
+    const second = cache.getOrCompute('k', compute);
+    release();
+    const [a, b] = await Promise.all([first, second]);
+
+    assert.strictEqual(calls, 1);
+    assert.strictEqual(a.cache, 'miss');
+    assert.strictEqual(b.cache, 'coalesced');
+    assert.deepStrictEqual(b.result, a.result);
+    assert.notStrictEqual(b.result, a.result);
+
+    const third = await cache.getOrCompute('k', compute);
+    assert.strictEqual(third.cache, 'hit');
+    assert.strictEqual(calls, 1);
+    assert.strictEqual(cache.inflight.size, 0);
+});
+
+test('getOrCompute: risultati non conservabili ed errori non restano in cache', async () => {
+    const cache = new AnalysisResultCache();
+    const partial = await cache.getOrCompute('k', async () => ({ result: { status: 'error' }, cacheable: false }));
+    assert.strictEqual(partial.cache, 'miss');
+    assert.strictEqual(cache.get('k'), null);
+
+    await assert.rejects(cache.getOrCompute('k', async () => { throw new Error('python'); }), /python/);
+    assert.strictEqual(cache.inflight.size, 0);
+
+    const retried = await cache.getOrCompute('k', async () => ({ result: { status: 'success' }, cacheable: true }));
+    assert.strictEqual(retried.cache, 'miss');
+    assert.ok(cache.get('k'));
+});
@@ -0,0 +1,12 @@
+"""
+Test dei moduli Python della pipeline (backend/scripts)
+Gli script si importano per nome come fa face_detection.py: scripts/ va nel path.
+Esecuzione: cd backend && python -m pytest tests
+"""
+
+import os
+import sys
+
+SCRIPTS_DIR = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'scripts')
+if SCRIPTS_DIR not in sys.path:
+    sys.path.insert(0, SCRIPTS_DIR)
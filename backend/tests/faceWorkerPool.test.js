@@ -0,0 +1,95 @@
+// backend/tests/faceWorkerPool.test.js
+// Pool worker con processi reali (tests/fixtures/fakeFaceWorker.js al posto di face_detection.py):
+// protocollo a frame, errori del worker, worker terminati durante una richiesta e riavvii
+
+const test = require('node:test');
+const assert = require('node:assert');
+const fs = require('fs');
+const os = require('os');
+const path = require('path');
+const FaceWorkerPool = require('../src/services/faceWorkerPool');
+
+const FAKE_WORKER = path.join(__dirname, 'fixtures', 'fakeFaceWorker.js');
+
+function createPool(t, options = {}) {
+    const pool = new FaceWorkerPool({
+        pythonExecutable: process.execPath,
+        scriptPath: FAKE_WORKER,
+        size: 1,
+        requestTimeout: 10000,
+        microBatch: { enabled: false },
+        ...options
+    });
+    t.after(() => pool.stop());
+    return pool;
+}
+
+function waitFor(condition, timeout = 5000) {
+    const deadline = Date.now() + timeout;
+    return new Promise((resolve, reject) => {
+        const check = () => {
+            if (condition()) return resolve();
+            if (Date.now() > deadline) return reject(new Error('Condizione non raggiunta'));
+            setTimeout(check, 20);
+        };
+        check();
+    });
+}
+
+test('richiesta e risposta con allegati attraverso il processo worker', async (t) => {
+    const pool = createPool(t);
+    const response = await pool.request({ command: 'echo' }, { attachments: [Buffer.from('foto'), Buffer.alloc(0)] });
+
+    assert.strictEqual(response.status, 'ok');
+    assert.strictEqual(response.command, 'echo');
+    assert.deepStrictEqual(response.attachments.map(String), ['foto', '']);
+    assert.strictEqual(pool.stats.completed, 1);
+});
+
+test('una risposta di errore del worker arriva al chiamante senza riavvio', async (t) => {
+    const pool = createPool(t);
+    await assert.rejects(pool.request({ command: 'fail' }), (error) => {
+        assert.strictEqual(error.message, 'immagine non valida');
+        assert.notStrictEqual(error.code, FaceWorkerPool.POOL_UNAVAILABLE);
+        return true;
+    });
+    assert.strictEqual((await pool.request({ command: 'echo' })).status, 'ok');
+    assert.strictEqual(pool.stats.restarts, 0);
+});
+
+test('worker terminato mentre riceve la richiesta: errore al chiamante, server vivo, riavvio', async (t) => {
+    const marker = path.join(fs.mkdtempSync(path.join(os.tmpdir(), 'face-pool-')), 'crashed');
+    process.env.FAKE_WORKER_CRASH_MARKER = marker;
+    t.after(() => { delete process.env.FAKE_WORKER_CRASH_MARKER; });
+    const pool = createPool(t);
+    await pool.request({ command: 'echo' });
+
+    // Allegato molto più grande del buffer della pipe: la scrittura è ancora in corso all'uscita (EPIPE)
+    await assert.rejects(
+        pool.request({ command: 'crash' }, { attachments: [Buffer.alloc(32 * 1024 * 1024)] }),
+        /Worker 0 terminato/
+    );
+    assert.strictEqual(pool.stats.restarts, 1);
+
+    await waitFor(() => pool.workers[0].state === 'idle');
+    assert.strictEqual((await pool.request({ command: 'echo' })).status, 'ok');
+});
+
+test('worker che non si avviano: le richieste in coda falliscono come pool non disponibile', async (t) => {
+    const pool = createPool(t, { scriptPath: path.join(__dirname, 'fixtures', 'inesistente.js') });
+
+    await assert.rejects(pool.request({ command: 'echo' }), (error) => {
+        assert.strictEqual(error.code, FaceWorkerPool.POOL_UNAVAILABLE);
+        assert.match(error.message, /non avviato/);
+        return true;
+    });
+    // Durante il backoff del riavvio non c'è alcun worker vivo: rifiuto immediato
+    await assert.rejects(pool.request({ command: 'echo' }), { code: FaceWorkerPool.POOL_UNAVAILABLE });
+});
+
+test('stop rifiuta le richieste in coda come pool non disponibile', async (t) => {
+    const pool = createPool(t);
+    const pending = pool.request({ command: 'echo' });
+    pool.stop();
+    await assert.rejects(pending, { code: FaceWorkerPool.POOL_UNAVAILABLE, message: 'Pool worker arrestato' });
+});
@@ -0,0 +1,122 @@
+// backend/tests/faceWorkerPoolMicroBatch.test.js
+// Pool worker: micro-batching per priorità e richieste non accorpabili, con worker simulati
+// (nessun processo Python: _send registra i messaggi, le risposte passano da _onMessage)
+
+const test = require('node:test');
+const assert = require('node:assert');
+const FaceWorkerPool = require('../src/services/faceWorkerPool');
+
+function createPool(workers = 1) {
+    const pool = new FaceWorkerPool({ microBatch: { maxBatch: 4, maxWaitMs: 40, waitPerRequestMs: 10 } });
+    pool.started = true;
+    pool.sent = [];
+    pool.workers = Array.from({ length: workers }, (_, slot) => ({
+        slot, state: 'idle', current: null, served: 0, logTail: { drain() { return ''; } }
+    }));
+    pool._send = (worker, message, attachments) => pool.sent.push({ worker, message, attachments });
+    return pool;
+}
+
+function blob(name) {
+    return { command: 'analyze_blob', name };
+}
+
+// Risposta del worker all'ultimo messaggio ricevuto (analyze_multi: un risultato per elemento)
+function reply(pool, sent) {
+    const { worker, message, attachments } = sent;
+    const response = { id: message.id, status: 'ok', attachments };
+    if (message.command === 'analyze_multi') {
+        response.results = message.items.map(item => ({
+            status: 'success', name: item.request.name,
+            attachment_offset: item.attachment_offset, attachment_count: item.attachment_count
+        }));
+    } else {
+        response.name = message.name;
+    }
+    pool._onMessage(worker, response);
+}
+
+const sleep = (ms) => new Promise(resolve => setTimeout(resolve, ms));
+
+test('una richiesta isolata parte subito senza attesa', async () => {
+    const pool = createPool();
+    const pending = pool.request(blob('a'));
+
+    assert.strictEqual(pool.sent.length, 1);
+    assert.strictEqual(pool.sent[0].message.command, 'analyze_blob');
+    reply(pool, pool.sent[0]);
+    assert.strictEqual((await pending).name, 'a');
+    assert.strictEqual(pool.stats.microBatches, 0);
+});
+
+test('arrivi ravvicinati della stessa priorità viaggiano in un analyze_multi', async () => {
+    const pool = createPool();
+    pool.workers[0].state = 'busy';
+    const pending = ['a', 'b', 'c'].map((name, i) =>
+        pool.request(blob(name), { attachments: [Buffer.from(name), Buffer.from(`${name}${i}`)] }));
+
+    pool.workers[0].state = 'idle';
+    pool._dispatch();
+
+    assert.strictEqual(pool.sent.length, 1);
+    const { message, attachments } = pool.sent[0];
+    assert.strictEqual(message.command, 'analyze_multi');
+    assert.deepStrictEqual(message.items.map(item => item.request.name), ['a', 'b', 'c']);
+    assert.deepStrictEqual(message.items.map(item => item.attachment_offset), [0, 2, 4]);
+    assert.strictEqual(attachments.length, 6);
+
+    reply(pool, pool.sent[0]);
+    const results = await Promise.all(pending);
+    assert.deepStrictEqual(results.map(r => r.name), ['a', 'b', 'c']);
+    assert.deepStrictEqual(results[1].attachments.map(String), ['b', 'b1']);
+    assert.strictEqual(pool.stats.completed, 3);
+    assert.strictEqual(pool.stats.microBatchedRequests, 3);
+});
+
+test('priorità diverse non finiscono nello stesso batch', async () => {
+    const pool = createPool();
+    pool.workers[0].state = 'busy';
+    const pending = [
+        pool.request(blob('backfill-1'), { priority: 10 }),
+        pool.request(blob('lezione-1')),
+        pool.request(blob('backfill-2'), { priority: 10 }),
+        pool.request(blob('lezione-2'))
+    ];
+
+    pool.workers[0].state = 'idle';
+    pool._dispatch();
+    // Solo 2 richieste della priorità in testa su 4 arrivi: si attende la finestra
+    assert.strictEqual(pool.sent.length, 0);
+    await sleep(60);
+
+    assert.strictEqual(pool.sent.length, 1);
+    assert.deepStrictEqual(pool.sent[0].message.items.map(item => item.request.name), ['lezione-1', 'lezione-2']);
+    reply(pool, pool.sent[0]);
+
+    assert.strictEqual(pool.sent.length, 2);
+    assert.deepStrictEqual(pool.sent[1].message.items.map(item => item.request.name), ['backfill-1', 'backfill-2']);
+    reply(pool, pool.sent[1]);
+
+    const results = await Promise.all(pending);
+    assert.deepStrictEqual(results.map(r => r.name), ['backfill-1', 'lezione-1', 'backfill-2', 'lezione-2']);
+});
+
+test('una richiesta non accorpabile non attende la finestra del batch in testa', async () => {
+    const pool = createPool(2);
+    // Carico recente alto: la testa analyze_blob attende altri arrivi
+    pool.recentArrivals.push(Date.now(), Date.now(), Date.now());
+    const analysis = pool.request(blob('a'));
+    const stats = pool.request({ command: 'stats' });
+
+    assert.strictEqual(pool.sent.length, 1);
+    assert.strictEqual(pool.sent[0].message.command, 'stats');
+    reply(pool, pool.sent[0]);
+    await stats;
+    assert.strictEqual(pool.sent.length, 1);
+
+    await sleep(60);
+    assert.strictEqual(pool.sent.length, 2);
+    assert.strictEqual(pool.sent[1].message.command, 'analyze_blob');
+    reply(pool, pool.sent[1]);
+    assert.strictEqual((await analysis).name, 'a');
+});
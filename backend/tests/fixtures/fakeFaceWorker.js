@@ -0,0 +1,47 @@
+// backend/tests/fixtures/fakeFaceWorker.js
+// Worker finto per i test del pool: stesso protocollo a frame di face_detection.py serve
+// (messaggio "ready", risposte con lo stesso id). Comandi:
+//   echo  → ok con il comando e gli allegati ricevuti
+//   fail  → status "error"
+//   crash → termina appena riceve la richiesta, senza leggere il resto dello stdin
+//           (solo la prima volta se FAKE_WORKER_CRASH_MARKER indica un file ancora assente)
+
+const fs = require('fs');
+const { encodeMessage, FrameDecoder } = require('../../src/services/faceProtocol');
+
+const marker = process.env.FAKE_WORKER_CRASH_MARKER;
+const decoder = new FrameDecoder();
+// Inizio della richiesta corrente, null dopo il primo frame (il JSON precede gli allegati)
+let head = Buffer.alloc(0);
+
+function send(message, attachments = []) {
+    process.stdout.write(encodeMessage(message, attachments));
+}
+
+function firstFrame(chunk) {
+    head = Buffer.concat([head, chunk]);
+    if (head.length < 4 || head.length < 4 + head.readUInt32BE(0)) return null;
+    const message = JSON.parse(head.subarray(4, 4 + head.readUInt32BE(0)).toString('utf8'));
+    head = null;
+    return message;
+}
+
+process.stdin.on('data', (chunk) => {
+    if (head !== null) {
+        const message = firstFrame(chunk);
+        if (message && message.command === 'crash' && !(marker && fs.existsSync(marker))) {
+            if (marker) fs.writeFileSync(marker, '');
+            process.exit(3);
+        }
+    }
+    for (const { message, attachments } of decoder.push(chunk)) {
+        head = Buffer.alloc(0);
+        if (message.command === 'fail') {
+            send({ id: message.id, status: 'error', error: 'immagine non valida' });
+        } else {
+            send({ id: message.id, status: 'ok', command: message.command }, attachments);
+        }
+    }
+});
+
+send({ type: 'ready', pid: process.pid, startup_ms: 1 });
@@ -0,0 +1,135 @@
+"""Indice ANN (backend esatto) e journal condiviso: lettura incrementale, snapshot e compattazione"""
+
+import time
+
+import numpy as np
+import pytest
+
+from ann_index import StudentAnnIndex, GalleryJournal, JournalTruncated
+
+DIM = 32
+PARAMS = {"backend": "exact", "initial_capacity": 16}
+
+def _vectors(count, seed=0):
+    return np.random.default_rng(seed).normal(size=(count, DIM)).astype(np.float32)
+
+def _upserts(user_ids, ts, seed=0):
+    entries = []
+    for user_id, vector in zip(user_ids, _vectors(len(user_ids), seed)):
+        entry = GalleryJournal.upsert_entry(user_id, "m", vector, f"h{user_id}")
+        entry["ts"] = ts
+        entries.append(entry)
+    return entries
+
+def test_exact_search_upsert_and_remove():
+    vectors = _vectors(40)
+    index = StudentAnnIndex("m", PARAMS)
+    index.upsert(list(range(40)), vectors)
+    assert len(index) == 40 and index.backend_in_use == "exact"
+
+    results = index.search(vectors[[3, 17]] * 5, k=2)
+    assert [row[0][0] for row in results] == [3, 17]
+    assert results[0][0][1] == pytest.approx(1.0, abs=1e-5)
+    assert results[0][0][1] >= results[0][1][1]
+
+    # Sostituzione e rimozione: la riga 3 ora punta al vettore di 17, 17 sparisce
+    index.upsert([3], vectors[[17]])
+    index.remove([17])
+    assert 17 not in index and len(index) == 39
+    assert index.search(vectors[[17]], k=1)[0][0][0] == 3
+
+def test_empty_index_returns_no_candidates():
+    assert StudentAnnIndex("m", PARAMS).search(_vectors(2), k=2) == [[], []]
+
+def test_readers_see_only_complete_new_lines(tmp_path):
+    path = str(tmp_path / "journal.jsonl")
+    writer, reader = GalleryJournal(path), GalleryJournal(path)
+    writer.append(_upserts([1, 2], ts=time.time()))
+
+    assert [e["id"] for e in reader.read_new()] == [1, 2]
+    assert reader.read_new() == []
+
+    # Riga scritta a metà da un altro processo: resta per la lettura successiva
+    with open(path, 'ab') as f:
+        f.write(b'{"ts": 1, "op": "remove"')
+    assert reader.read_new() == []
+    with open(path, 'ab') as f:
+        f.write(b', "id": 2}\n')
+    assert reader.read_new() == [{"ts": 1, "op": "remove", "id": 2}]
+
+def test_apply_filters_model_and_since(tmp_path):
+    journal = GalleryJournal(str(tmp_path / "journal.jsonl"))
+    index = StudentAnnIndex("m", PARAMS)
+    entries = _upserts([1, 2], ts=100) + _upserts([3], ts=200)
+    entries.append({**GalleryJournal.upsert_entry(4, "altro", _vectors(1)[0], None), "ts": 200})
+    entries.append({**GalleryJournal.remove_entry(1), "ts": 200})
+
+    assert journal.apply(index, entries, since=150) == 2
+    assert 3 in index and 1 not in index and 2 not in index and 4 not in index
+    assert index.photo_hashes[3] == "h3"
+
+def test_snapshot_compaction_and_resume(tmp_path):
+    path = str(tmp_path / "journal.jsonl")
+    snapshot = str(tmp_path / "gallery.gal.ann")
+    journal = GalleryJournal(path)
+    old = time.time() - 3600
+
+    journal.append(_upserts([1, 2, 3], ts=old))
+    index = StudentAnnIndex("m", PARAMS)
+    journal.apply(index, journal.read_new())
+    behind = GalleryJournal(path)
+
+    with journal.locked():
+        assert index.save(snapshot, "gallery-v1", journal_offset=journal.offset)
+        removed = journal.compact(journal.offset, cutoff_ts=time.time())
+    assert removed == journal.offset
+    assert StudentAnnIndex.saved_offset(snapshot, "gallery-v1") == journal.offset
+    assert StudentAnnIndex.saved_offset(snapshot, "gallery-v2") is None
+
+    # Il file ora contiene solo l'intestazione: le voci sono nello snapshot
+    with open(path) as f:
+        assert f.read().count("\n") == 1
+
+    # Un lettore fermo prima della compattazione deve ricaricare lo snapshot
+    with pytest.raises(JournalTruncated):
+        behind.read_new()
+
+    journal.append(_upserts([4], ts=time.time(), seed=1))
+    # Il lettore già in coda prosegue senza accorgersi della compattazione
+    assert [e["id"] for e in journal.read_new()] == [4]
+
+    loaded = StudentAnnIndex.load(snapshot, "m", PARAMS, "gallery-v1")
+    assert loaded is not None and len(loaded) == 3
+    assert loaded.photo_hashes == {1: "h1", 2: "h2", 3: "h3"}
+    assert StudentAnnIndex.load(snapshot, "m", PARAMS, "gallery-v2") is None
+    assert StudentAnnIndex.load(snapshot, "altro", PARAMS, "gallery-v1") is None
+
+    resumed = GalleryJournal(path)
+    resumed.offset = loaded.journal_offset
+    resumed.apply(loaded, resumed.read_new())
+    assert sorted(loaded.photo_hashes) == [1, 2, 3, 4]
+    assert loaded.search(_vectors(1, seed=1), k=1)[0][0][0] == 4
+
+def test_compaction_keeps_entries_within_retention(tmp_path):
+    path = str(tmp_path / "journal.jsonl")
+    journal = GalleryJournal(path)
+    now = time.time()
+    journal.append(_upserts([1, 2], ts=now - 7200) + _upserts([3], ts=now - 60))
+    journal.read_new()
+    end = journal.offset
+
+    with journal.locked():
+        removed = journal.compact(end, cutoff_ts=now - 3600)
+    assert 0 < removed < end
+
+    # Ricostruzione senza snapshot: si riparte dalla prima voce rimasta
+    rebuilt = GalleryJournal(path)
+    rebuilt.rewind()
+    assert rebuilt.base == removed
+    assert [e["id"] for e in rebuilt.read_new()] == [3]
+    assert rebuilt.offset == end
+
+    # Seconda compattazione entro la retention: nulla da rimuovere, intestazione invariata
+    with journal.locked():
+        assert journal.compact(end, cutoff_ts=now - 3600) == 0
+    assert journal.read_new() == []
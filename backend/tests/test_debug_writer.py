@@ -0,0 +1,83 @@
+"""Writer degli artefatti di debug: politiche di scarto, quota disco e svuotamento all'uscita"""
+
+import os
+import subprocess
+import sys
+import threading
+import textwrap
+
+import numpy as np
+import pytest
+
+from debug_writer import DebugArtifactWriter
+
+SCRIPTS_DIR = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'scripts')
+
+def _blocked_writer(tmp_path, drop_policy):
+    """Writer con il thread fermo sul primo artefatto: le altre richieste restano in coda"""
+    writer = DebugArtifactWriter({"queue_size": 2, "drop_policy": drop_policy}, [str(tmp_path)])
+    started, release = threading.Event(), threading.Event()
+
+    def first():
+        started.set()
+        release.wait(5)
+        return "primo"
+
+    writer.submit(str(tmp_path / "0.txt"), first)
+    assert started.wait(5)
+    return writer, release
+
+@pytest.mark.parametrize("drop_policy,expected", [
+    ("drop_newest", ["0.txt", "1.txt", "2.txt"]),
+    ("drop_oldest", ["0.txt", "2.txt", "3.txt"]),
+])
+def test_drop_policy(tmp_path, drop_policy, expected):
+    writer, release = _blocked_writer(tmp_path, drop_policy)
+    accepted = [writer.submit(str(tmp_path / f"{i}.txt"), lambda i=i: str(i)) for i in (1, 2, 3)]
+    release.set()
+
+    assert writer.flush(5)
+    writer.close()
+    assert accepted == [True, True, drop_policy == "drop_oldest"]
+    assert writer.stats["dropped"] == 1
+    assert sorted(os.listdir(tmp_path)) == expected
+
+def test_images_text_and_disk_quota(tmp_path):
+    writer = DebugArtifactWriter({"max_disk_bytes": 250}, [str(tmp_path)])
+    image = np.full((32, 32, 3), 128, dtype=np.uint8)
+    writer.submit(str(tmp_path / "volto.png"), lambda: image)
+    writer.submit(str(tmp_path / "saltato.txt"), lambda: None)
+    for i in range(3):
+        writer.submit(str(tmp_path / f"match_{i}.txt"), lambda: "x" * 100)
+    assert writer.flush(5)
+    writer.close()
+
+    # Quota: restano solo gli ultimi file entro max_disk_bytes
+    assert sorted(os.listdir(tmp_path)) == ["match_1.txt", "match_2.txt"]
+    assert writer.stats["written"] == 4
+    assert writer.stats["evicted"] == 2
+
+    # Dopo close() un nuovo submit riavvia il thread
+    assert writer.submit(str(tmp_path / "riavvio.txt"), lambda: "x")
+    writer.close()
+    assert (tmp_path / "riavvio.txt").read_text() == "x"
+
+def test_queue_drained_at_exit_without_close(tmp_path):
+    script = textwrap.dedent(f"""
+        import sys, time
+        sys.path.insert(0, {SCRIPTS_DIR!r})
+        import numpy as np
+        from debug_writer import DebugArtifactWriter
+
+        def render():
+            time.sleep(0.01)
+            return np.random.randint(0, 255, (240, 320, 3), dtype=np.uint8)
+
+        writer = DebugArtifactWriter({{}}, [{str(tmp_path)!r}])
+        for i in range(20):
+            writer.submit({str(tmp_path)!r} + f"/{{i}}.jpg", render)
+    """)
+    result = subprocess.run([sys.executable, "-c", script], capture_output=True, timeout=60)
+
+    assert result.returncode == 0, result.stderr.decode(errors='replace')
+    assert len([name for name in os.listdir(tmp_path) if name.endswith(".jpg")]) == 20
@@ -0,0 +1,83 @@
+"""Store dei rilevamenti: rilettura, separazione per impronta, quota e retention"""
+
+import os
+import time
+
+import numpy as np
+
+from detection_store import DetectionStore
+
+def _faces(count, secondary=False):
+    rng = np.random.default_rng(count)
+    faces = []
+    for i in range(count):
+        face = {
+            'bbox': {'x': 10 * i, 'y': 5, 'w': 40, 'h': 50},
+            'confidence': 0.8 + i / 100,
+            'blur_score': 120.0 + i,
+            'embedding': rng.normal(size=16)
+        }
+        if secondary:
+            face['embedding_secondary'] = rng.normal(size=8)
+        faces.append(face)
+    return faces
+
+def test_put_get_round_trip(tmp_path):
+    store = DetectionStore(str(tmp_path))
+    faces = _faces(3, secondary=True)
+    store.put("fp", "abcdef", faces, raw_faces=5)
+
+    loaded, raw_faces = DetectionStore(str(tmp_path)).get("fp", "abcdef")
+    assert raw_faces == 5
+    assert [f['bbox'] for f in loaded] == [f['bbox'] for f in faces]
+    for original, face in zip(faces, loaded):
+        assert face['confidence'] == np.float32(original['confidence'])
+        assert face['quality_score'] == 40 * 50
+        np.testing.assert_allclose(face['embedding'], original['embedding'], rtol=1e-6)
+        np.testing.assert_allclose(face['embedding_secondary'], original['embedding_secondary'], rtol=1e-6)
+
+def test_empty_detection_and_fingerprint_isolation(tmp_path):
+    store = DetectionStore(str(tmp_path))
+    store.put("fp1", "abcdef", [], raw_faces=0)
+
+    assert store.get("fp1", "abcdef") == ([], 0)
+    assert store.get("fp2", "abcdef") is None
+    assert store.stats["hits"] == 1 and store.stats["misses"] == 1
+
+def test_corrupted_file_is_a_miss(tmp_path):
+    store = DetectionStore(str(tmp_path))
+    store.put("fp", "abcdef", _faces(1), raw_faces=1)
+    with open(store._path("fp", "abcdef"), 'wb') as f:
+        f.write(b"troncato")
+    assert store.get("fp", "abcdef") is None
+
+def test_sweep_evicts_least_recently_used(tmp_path):
+    store = DetectionStore(str(tmp_path), max_bytes=0, sweep_every=1000)
+    keys = [f"k{i}aaaa" for i in range(4)]
+    for key in keys:
+        store.put("fp", key, _faces(2), raw_faces=2)
+
+    now = time.time()
+    for age, key in enumerate(reversed(keys)):
+        os.utime(store._path("fp", key), (now - 100 * age, now - 100 * age))
+    # Una lettura rinnova l'ultimo uso: k0 (il più vecchio) diventa il più recente
+    assert store.get("fp", keys[0]) is not None
+
+    file_size = os.path.getsize(store._path("fp", keys[0]))
+    store.max_bytes = 2 * file_size
+    store.sweep()
+
+    remaining = [key for key in keys if os.path.exists(store._path("fp", key))]
+    assert remaining == [keys[0], keys[3]]
+    assert store.stats["evicted"] == 2
+
+def test_sweep_applies_retention(tmp_path):
+    store = DetectionStore(str(tmp_path), retention_days=1, sweep_every=2)
+    store.put("fp", "old000", _faces(1), raw_faces=1)
+    old = time.time() - 2 * 86400
+    os.utime(store._path("fp", "old000"), (old, old))
+
+    # La seconda scrittura raggiunge sweep_every e avvia la pulizia
+    store.put("fp", "new000", _faces(1), raw_faces=1)
+    assert not os.path.exists(store._path("fp", "old000"))
+    assert os.path.exists(store._path("fp", "new000"))
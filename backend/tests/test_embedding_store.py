@@ -0,0 +1,127 @@
+"""Store persistente degli embeddings: rilettura, TTL e compattazione"""
+
+import os
+
+import numpy as np
+import pytest
+
+import embedding_store
+from embedding_store import PersistentEmbeddingStore, encode_embedding, decode_embedding
+
+DIM = 128
+
+def _vector(seed):
+    return np.random.default_rng(seed).normal(size=DIM).astype(np.float32)
+
+class FakeClock:
+    def __init__(self, start=1_000_000.0):
+        self.now = start
+
+    def __call__(self):
+        return self.now
+
+@pytest.fixture
+def clock(monkeypatch):
+    fake = FakeClock()
+    monkeypatch.setattr(embedding_store.time, "time", fake)
+    return fake
+
+def test_put_flush_get_round_trip(tmp_path):
+    store = PersistentEmbeddingStore(str(tmp_path), ttl_seconds=3600)
+    store.put(1, "Facenet512", "h1", _vector(1))
+
+    # Prima della flush la lettura arriva dal buffer in attesa
+    np.testing.assert_array_equal(store.get(1, "Facenet512", "h1"), _vector(1))
+    store.flush()
+
+    other = PersistentEmbeddingStore(str(tmp_path), ttl_seconds=3600)
+    np.testing.assert_array_equal(other.get(1, "Facenet512", "h1"), _vector(1))
+    assert other.get(1, "Facenet512", "h2") is None
+    assert other.get(1, "Facenet", "h1") is None
+    assert other.stats()["Facenet512"] == {"entries": 1, "rows": 1, "bytes": DIM * 4}
+
+def test_expired_entries_are_misses(tmp_path, clock):
+    store = PersistentEmbeddingStore(str(tmp_path), ttl_seconds=100, refresh_interval=0)
+    store.put(1, "m", "h", _vector(1))
+    store.flush()
+
+    clock.now += 99
+    assert store.get(1, "m", "h") is not None
+    clock.now += 2
+    assert store.get(1, "m", "h") is None
+
+def test_compaction_keeps_newest_live_rows(tmp_path, clock):
+    row_bytes = DIM * 4
+    store = PersistentEmbeddingStore(str(tmp_path), ttl_seconds=1000, max_bytes=10 * row_bytes, refresh_interval=0)
+
+    # 4 righe che scadranno, poi 6 recenti: il file arriva al limite
+    for user_id in range(4):
+        store.put(user_id, "m", "h", _vector(user_id))
+    store.flush()
+    clock.now += 900
+    for user_id in range(4, 10):
+        store.put(user_id, "m", "h", _vector(user_id))
+    store.flush()
+    first_data_file = store._read_index("m")["data_file"]
+
+    # Oltre il limite: compattazione a una nuova generazione prima dell'append
+    clock.now += 200
+    for user_id in range(10, 12):
+        store.put(user_id, "m", "h", _vector(user_id))
+    store.flush()
+
+    index = store._read_index("m")
+    assert index["generation"] == 1
+    assert index["data_file"] != first_data_file
+    assert not os.path.exists(tmp_path / first_data_file)
+    # Budget 75% di max_bytes meno le righe in arrivo: 7 - 2 = 5 righe vive più le 2 nuove
+    assert index["rows"] == 7
+    assert os.path.getsize(tmp_path / index["data_file"]) == index["rows"] * row_bytes
+
+    reader = PersistentEmbeddingStore(str(tmp_path), ttl_seconds=1000, refresh_interval=0)
+    for user_id in range(4):
+        assert reader.get(user_id, "m", "h") is None
+    kept = [user_id for user_id in range(4, 12) if reader.get(user_id, "m", "h") is not None]
+    assert len(kept) == 7
+    for user_id in kept:
+        np.testing.assert_array_equal(reader.get(user_id, "m", "h"), _vector(user_id))
+    assert {10, 11} <= set(kept)
+
+def test_dimension_change_resets_model(tmp_path):
+    store = PersistentEmbeddingStore(str(tmp_path))
+    store.put(1, "m", "h", _vector(1))
+    store.flush()
+    store.put(2, "m", "h", np.ones(64, dtype=np.float32))
+    store.flush()
+
+    index = store._read_index("m")
+    assert index["dim"] == 64
+    assert list(index["entries"]) == ["2:h"]
+
+def test_weights_change_invalidates_model(tmp_path):
+    old = PersistentEmbeddingStore(str(tmp_path), weights=lambda model: "facenet512.onnx:100:1")
+    old.put(1, "m", "h", _vector(1))
+    old.flush()
+    old_data_file = old._read_index("m")["data_file"]
+
+    # Stesso nome modello, pesi riesportati: le entry vecchie non vengono lette
+    new = PersistentEmbeddingStore(str(tmp_path), weights=lambda model: "facenet512.onnx:100:2")
+    assert new.get(1, "m", "h") is None
+    np.testing.assert_array_equal(old.get(1, "m", "h"), _vector(1))
+
+    new.put(2, "m", "h", _vector(2))
+    new.flush()
+    index = new._read_index("m")
+    assert index["weights"] == "facenet512.onnx:100:2"
+    assert index["generation"] == 1
+    assert list(index["entries"]) == ["2:h"]
+    assert not os.path.exists(tmp_path / old_data_file)
+    np.testing.assert_array_equal(new.get(2, "m", "h"), _vector(2))
+
+@pytest.mark.parametrize("dtype,tolerance", [("float32", 0), ("float16", 1e-2), ("int8", 2e-2)])
+def test_encode_decode_embedding(dtype, tolerance):
+    vector = _vector(3)
+    data = encode_embedding(vector, dtype)
+    decoded = decode_embedding(data, dtype)
+    assert decoded.shape == (DIM,)
+    np.testing.assert_allclose(decoded, vector, atol=tolerance * np.abs(vector).max())
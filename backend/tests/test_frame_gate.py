@@ -0,0 +1,144 @@
+"""Frame gate: decisioni skip/partial/full e invecchiamento del frame di riferimento"""
+
+import numpy as np
+import pytest
+
+import frame_gate
+from frame_gate import FrameGate
+
+WIDTH, HEIGHT = 640, 360
+
+def _scene(seed=0):
+    """Aula sintetica: rettangoli di grigi diversi (celle della griglia 32x18 di 20 px)"""
+    rng = np.random.default_rng(seed)
+    image = np.full((HEIGHT, WIDTH, 3), 110, dtype=np.uint8)
+    for _ in range(40):
+        x, y = int(rng.integers(0, WIDTH - 60)), int(rng.integers(0, HEIGHT - 60))
+        w, h = int(rng.integers(20, 120)), int(rng.integers(20, 120))
+        image[y:y + h, x:x + w] = int(rng.integers(30, 200))
+    return image
+
+def _face(x, y, size=40, seed=0):
+    return {
+        'bbox': {'x': x, 'y': y, 'w': size, 'h': size},
+        'confidence': 0.9,
+        'blur_score': 150.0,
+        'embedding': np.random.default_rng(seed).normal(size=8)
+    }
+
+class FakeClock:
+    def __init__(self, start=1_000_000.0):
+        self.now = start
+
+    def __call__(self):
+        return self.now
+
+@pytest.fixture
+def clock(monkeypatch):
+    fake = FakeClock()
+    monkeypatch.setattr(frame_gate.time, "time", fake)
+    return fake
+
+@pytest.fixture
+def gate(tmp_path, clock):
+    return FrameGate({"max_consecutive_skips": 2, "max_age_s": 600}, str(tmp_path))
+
+def _reference(gate, image, faces):
+    plan = gate.plan("aula-1", image, "fp")
+    assert plan["mode"] == "full"
+    gate.commit(plan, faces)
+    return plan
+
+def test_first_frame_is_full(gate):
+    plan = gate.plan("aula-1", _scene(), "fp")
+    assert plan["mode"] == "full"
+    assert plan["reason"] == "nessun frame di riferimento"
+    assert gate.stats == {"skip": 0, "partial": 0, "full": 1}
+
+def test_same_scene_and_exposure_shift_are_skipped(gate):
+    image = _scene()
+    faces = [_face(60, 60), _face(400, 200, seed=1)]
+    _reference(gate, image, faces)
+
+    plan = gate.plan("aula-1", image, "fp")
+    assert plan["mode"] == "skip"
+    assert [f['bbox'] for f in plan["faces"]] == [f['bbox'] for f in faces]
+    np.testing.assert_allclose(plan["faces"][1]['embedding'], faces[1]['embedding'], rtol=1e-6)
+
+    # Esposizione automatica: tutta la scena più chiara non conta come cambiamento
+    brighter = np.clip(image.astype(np.int16) + 25, 0, 255).astype(np.uint8)
+    assert gate.plan("aula-1", brighter, "fp")["mode"] == "skip"
+
+def test_local_change_is_partial(gate):
+    image = _scene()
+    inside, outside = _face(420, 120), _face(40, 40, seed=1)
+    _reference(gate, image, [inside, outside])
+
+    changed = image.copy()
+    changed[100:180, 400:480] = 250
+    plan = gate.plan("aula-1", changed, "fp")
+
+    assert plan["mode"] == "partial"
+    assert 0.02 < plan["changed_ratio"] <= 0.35
+    assert plan["regions"]
+    for x, y, w, h in plan["regions"]:
+        assert w >= 160 and h >= 160
+        assert x <= 400 and y <= 100 and x + w >= 480 and y + h >= 180
+    # Solo i volti fuori dalle regioni da rianalizzare vengono riusati
+    assert [f['bbox'] for f in plan["faces"]] == [outside['bbox']]
+
+def test_new_scene_is_full(gate):
+    _reference(gate, _scene(0), [])
+    plan = gate.plan("aula-1", _scene(1), "fp")
+    assert plan["mode"] == "full"
+    assert plan["reason"] == "scena cambiata"
+
+def test_reference_invalidated_by_models_and_resolution(gate):
+    image = _scene()
+    _reference(gate, image, [])
+    assert gate.plan("aula-1", image, "altro-fp")["reason"] == "modelli cambiati"
+    assert gate.plan("aula-1", image[:, :320], "fp")["reason"] == "risoluzione cambiata"
+    assert gate.plan("aula-2", image, "fp")["reason"] == "nessun frame di riferimento"
+
+def test_consecutive_skips_are_capped(gate):
+    image = _scene()
+    _reference(gate, image, [])
+    for _ in range(2):
+        plan = gate.plan("aula-1", image, "fp")
+        assert plan["mode"] == "skip"
+        gate.commit(plan, plan["faces"])
+
+    plan = gate.plan("aula-1", image, "fp")
+    assert plan["mode"] == "full"
+    assert plan["reason"] == "troppi skip consecutivi"
+    gate.commit(plan, [])
+    assert gate.plan("aula-1", image, "fp")["mode"] == "skip"
+
+def test_partial_commits_do_not_refresh_reference_age(gate, clock):
+    image = _scene()
+    _reference(gate, image, [_face(40, 40)])
+    analyzed_at = clock.now
+
+    # Una scena che cambia di poco a ogni scatto: solo partial, mai un full
+    for step, value in enumerate((250, 10, 250)):
+        clock.now += 200
+        changed = image.copy()
+        changed[100:180, 400:480] = value
+        plan = gate.plan("aula-1", changed, "fp")
+        assert plan["mode"] == "partial", step
+        assert plan["analyzed_at"] == analyzed_at
+        gate.commit(plan, plan["faces"])
+        image = changed
+
+    clock.now += 1
+    plan = gate.plan("aula-1", image, "fp")
+    assert plan["mode"] == "full"
+    assert plan["reason"] == "riferimento troppo vecchio"
+
+    gate.commit(plan, [])
+    clock.now += 10
+    assert gate.plan("aula-1", image, "fp")["mode"] == "skip"
+
+def test_unreadable_state_falls_back_to_full(gate, tmp_path):
+    (tmp_path / "aula-1.npz").write_bytes(b"non un npz")
+    assert gate.plan("aula-1", _scene(), "fp")["mode"] == "full"
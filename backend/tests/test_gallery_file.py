@@ -0,0 +1,99 @@
+"""Formato .gal: scrittura e rilettura per ogni dtype di conservazione"""
+
+import numpy as np
+import pytest
+
+from gallery_file import PackedGallery, GALLERY_MAGIC
+
+# Errore massimo sul coseno dopo la quantizzazione (righe normalizzate, dim 512)
+TOLERANCE = {"float32": 1e-6, "float16": 2e-3, "int8": 2e-2}
+
+def _embeddings(rows=12, dim=512, seed=0):
+    rng = np.random.default_rng(seed)
+    return (rng.normal(size=(rows, dim)) * rng.uniform(0.5, 20, size=(rows, 1))).astype(np.float32)
+
+@pytest.fixture(params=["float32", "float16", "int8"])
+def dtype(request):
+    return request.param
+
+def _check_gallery(gallery, ids, embeddings, hashes, dtype):
+    assert len(gallery) == len(ids)
+    assert gallery.ids == ids
+    assert gallery.photo_hashes == hashes
+    assert gallery.dim == embeddings.shape[1]
+    assert gallery.dtype == dtype
+    assert gallery.model == "Facenet512"
+    assert (gallery.scales is not None) == (dtype == "int8")
+
+    norms = np.linalg.norm(embeddings, axis=1)
+    np.testing.assert_allclose(gallery.norms, norms, rtol=1e-6)
+
+    # Righe de-quantizzate: stessa direzione e stessa norma dell'originale
+    for row in range(len(ids)):
+        vector = gallery.vector(row)
+        cosine = vector @ embeddings[row] / (np.linalg.norm(vector) * norms[row])
+        assert cosine == pytest.approx(1.0, abs=TOLERANCE[dtype])
+        assert np.linalg.norm(vector) == pytest.approx(norms[row], rel=TOLERANCE[dtype] * 5)
+
+    queries = _embeddings(rows=3, seed=1)
+    queries /= np.linalg.norm(queries, axis=1, keepdims=True)
+    expected = queries @ (embeddings / norms[:, None]).T
+    np.testing.assert_allclose(gallery.dot(queries, block_rows=5), expected, atol=TOLERANCE[dtype])
+
+def test_pack_from_bytes_round_trip(dtype):
+    ids = list(range(100, 112))
+    hashes = [f"hash{i}" for i in ids]
+    embeddings = _embeddings()
+
+    data = PackedGallery.pack(ids, embeddings, "Facenet512", dtype, hashes)
+
+    assert data[:len(GALLERY_MAGIC)] == GALLERY_MAGIC
+    gallery = PackedGallery.from_bytes(data)
+    assert gallery.header["data_offset"] % 64 == 0
+    _check_gallery(gallery, ids, embeddings, hashes, dtype)
+
+def test_write_open_round_trip(tmp_path, dtype):
+    ids = [f"u{i}" for i in range(12)]
+    hashes = [None] * 12
+    embeddings = _embeddings(seed=2)
+    path = str(tmp_path / "gallery.gal")
+
+    written = PackedGallery.write(path, ids, embeddings, "Facenet512", dtype)
+
+    assert written == (tmp_path / "gallery.gal").stat().st_size
+    gallery = PackedGallery.open(path)
+    assert gallery.source == path
+    _check_gallery(gallery, ids, embeddings, hashes, dtype)
+
+def test_compact_dtypes_are_smaller():
+    embeddings = _embeddings(rows=64)
+    sizes = {
+        dtype: PackedGallery.from_bytes(PackedGallery.pack(list(range(64)), embeddings, "m", dtype)).matrix.nbytes
+        for dtype in ("float32", "float16", "int8")
+    }
+    assert sizes["float16"] * 2 == sizes["float32"]
+    assert sizes["int8"] * 4 == sizes["float32"]
+
+def test_find_checks_photo_hash():
+    gallery = PackedGallery.from_bytes(
+        PackedGallery.pack([7, 8], _embeddings(rows=2), "m", "float32", ["a", None])
+    )
+    assert gallery.find(7) == 0
+    assert gallery.find(7, "a") == 0
+    assert gallery.find(7, "b") is None
+    # Senza hash salvato la riga vale per qualunque foto
+    assert gallery.find(8, "x") == 1
+    assert gallery.find(9) is None
+
+def test_rejects_truncated_and_foreign_files():
+    data = PackedGallery.pack([1, 2], _embeddings(rows=2), "m", "int8")
+    with pytest.raises(ValueError, match="troncato"):
+        PackedGallery.from_bytes(data[:-10])
+    with pytest.raises(ValueError, match="magic"):
+        PackedGallery.from_bytes(b"NOTAGAL!" + data[8:])
+
+def test_rejects_unknown_dtype_and_misaligned_ids():
+    with pytest.raises(ValueError):
+        PackedGallery.pack([1, 2], _embeddings(rows=2), "m", "float64")
+    with pytest.raises(ValueError):
+        PackedGallery.pack([1], _embeddings(rows=2), "m", "float32")